@@ -2,25 +2,26 @@
 AI Helper для чат-бота поддержки на базе OpenAI
 """
 import os
+import json
 import logging
-from typing import Optional
+from typing import List, Optional, Sequence
 from openai import OpenAI
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
+from translation_cache import TranslationCache
+
 # Загружаем переменные окружения из .env
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-# Простейший in-memory кэш для переводов:
-# ключ: (исходный_текст, целевой_язык, исходный_язык) -> значение: переведённый_текст
-_translation_cache = {}
-
 # Получаем API ключ и настройки из переменных окружения
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
 OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
 OPENAI_MAX_TOKENS = int(os.getenv('OPENAI_MAX_TOKENS', '500'))
+# Потолок max_tokens одного запроса пакетного перевода (лимит ответа gpt-3.5-turbo — 4096)
+OPENAI_BATCH_MAX_TOKENS = int(os.getenv('OPENAI_BATCH_MAX_TOKENS', '4096'))
 
 # Настройки Supabase для постоянного кэша переводов (если доступны)
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -35,6 +36,20 @@ if SUPABASE_URL and SUPABASE_KEY:
         logger.warning(f"Failed to initialize Supabase client for translation cache: {e}")
         _translation_cache_db_client = None
 
+# Названия языков для промптов перевода
+LANG_NAMES = {
+    'ru': 'русский',
+    'en': 'английский',
+    'es': 'испанский',
+    'fr': 'французский',
+    'de': 'немецкий',
+    'it': 'итальянский',
+    'pt': 'португальский',
+    'zh': 'китайский',
+    'ja': 'японский',
+    'ko': 'корейский'
+}
+
 # Системный промпт для AI ассистента
 SYSTEM_PROMPT = """Ты - дружелюбный помощник в боте программы лояльности.
 
@@ -61,6 +76,11 @@ SYSTEM_PROMPT = """Ты - дружелюбный помощник в боте п
 """
 
 
+def estimate_translation_tokens(text: str) -> int:
+    """Грубая оценка токенов перевода в JSON-массиве: ~2 символа на токен плюс кавычки и запятая"""
+    return len(text) // 2 + 8
+
+
 class AIAssistant:
     """Класс для работы с AI ассистентом"""
     
@@ -75,6 +95,7 @@ class AIAssistant:
         self.api_key = api_key
         self.model = model
         self.max_tokens = OPENAI_MAX_TOKENS
+        self.batch_max_tokens = OPENAI_BATCH_MAX_TOKENS
         self.enabled = bool(api_key)
         
         if self.enabled:
@@ -195,22 +216,8 @@ class AIAssistant:
         if not text or not text.strip():
             return text
         
-        # Маппинг языков для промпта
-        lang_names = {
-            'ru': 'русский',
-            'en': 'английский',
-            'es': 'испанский',
-            'fr': 'французский',
-            'de': 'немецкий',
-            'it': 'итальянский',
-            'pt': 'португальский',
-            'zh': 'китайский',
-            'ja': 'японский',
-            'ko': 'корейский'
-        }
-        
-        source_name = lang_names.get(source_lang, source_lang)
-        target_name = lang_names.get(target_lang, target_lang)
+        source_name = LANG_NAMES.get(source_lang, source_lang)
+        target_name = LANG_NAMES.get(target_lang, target_lang)
         
         # Промпт для перевода
         translation_prompt = f"""Ты профессиональный переводчик. Переведи следующий текст с {source_name} на {target_name}.
@@ -261,10 +268,109 @@ class AIAssistant:
             logger.error(f"Error translating text: {e}")
             return None
 
+    async def translate_batch(
+        self,
+        texts: Sequence[str],
+        target_lang: str = 'en',
+        source_lang: str = 'ru'
+    ) -> List[Optional[str]]:
+        """
+        Перевести несколько текстов одним запросом к модели
+        
+        Тексты передаются JSON-массивом, ответ ожидается массивом той же длины.
+        Тексты делятся на запросы так, чтобы оценка ответа укладывалась в batch_max_tokens.
+        Если ответ не удалось разобрать, тексты переводятся по одному.
+        
+        Args:
+            texts: Тексты для перевода
+            target_lang: Целевой язык ('en', 'ru', и т.д.)
+            source_lang: Исходный язык ('ru', 'en', и т.д.)
+            
+        Returns:
+            Переводы в порядке texts (None для непереведённых)
+        """
+        if not self.enabled:
+            logger.warning("AI assistant is disabled")
+            return [None] * len(texts)
+        
+        results: List[Optional[str]] = []
+        group: List[str] = []
+        budget = 0
+        for text in texts:
+            tokens = min(estimate_translation_tokens(text), self.max_tokens * 2)
+            if group and budget + tokens > self.batch_max_tokens:
+                results.extend(await self._translate_group(group, budget, target_lang, source_lang))
+                group, budget = [], 0
+            group.append(text)
+            budget += tokens
+        if group:
+            results.extend(await self._translate_group(group, budget, target_lang, source_lang))
+        return results
+
+    async def _translate_group(
+        self,
+        texts: List[str],
+        budget: int,
+        target_lang: str,
+        source_lang: str
+    ) -> List[Optional[str]]:
+        """Один запрос пакетного перевода; budget — оценка токенов ответа для max_tokens"""
+        if len(texts) == 1:
+            return [await self.translate_text(texts[0], target_lang, source_lang)]
+        
+        source_name = LANG_NAMES.get(source_lang, source_lang)
+        target_name = LANG_NAMES.get(target_lang, target_lang)
+        
+        translation_prompt = f"""Переведи каждый элемент JSON-массива с {source_name} на {target_name}.
+
+Правила перевода:
+1. Сохраняй смысл и тон оригинала
+2. Сохраняй форматирование (переносы строк, пунктуацию)
+3. Если текст содержит плейсхолдеры вида {{variable}}, сохрани их без изменений
+4. Верни только JSON-массив строк той же длины и в том же порядке, без комментариев
+
+Массив для перевода:
+{json.dumps(list(texts), ensure_ascii=False)}"""
+        
+        try:
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "Ты профессиональный переводчик. Отвечаешь только валидным JSON."
+                    },
+                    {
+                        "role": "user",
+                        "content": translation_prompt
+                    }
+                ],
+                max_tokens=min(budget, self.batch_max_tokens),
+                temperature=0.3
+            )
+            
+            content = response.choices[0].message.content.strip()
+            # Модель иногда оборачивает JSON в ```json ... ```
+            content = content.strip('`').removeprefix('json').strip()
+            translated = json.loads(content)
+            
+            if isinstance(translated, list) and len(translated) == len(texts) and all(isinstance(t, str) for t in translated):
+                logger.info(f"Batch translated: {source_lang} -> {target_lang} ({len(texts)} texts)")
+                return [t.strip() or None for t in translated]
+            
+            logger.warning("Unexpected batch translation shape, falling back to single requests")
+        except Exception as e:
+            logger.warning(f"Batch translation failed, falling back to single requests: {e}")
+        
+        return [await self.translate_text(text, target_lang, source_lang) for text in texts]
+
 
 # Глобальный экземпляр ассистента
 ai_assistant = AIAssistant()
 
+# Кэш переводов: LRU в памяти + таблица translation_cache, промахи переводятся пакетами
+_translation_cache = TranslationCache(ai_assistant, db_client=_translation_cache_db_client)
+
 
 async def get_ai_support_answer(question: str) -> str:
     """
@@ -300,64 +406,18 @@ async def translate_text_ai(text: str, target_lang: str = 'en', source_lang: str
     Returns:
         Переведенный текст или оригинал в случае ошибки
     """
-    if not text or not text.strip():
-        return text
-
-    # Проверяем in-memory кэш, чтобы не дергать OpenAI для одинаковых текстов в рамках процесса
-    cache_key = (text, target_lang, source_lang)
-    cached = _translation_cache.get(cache_key)
-    if cached is not None:
-        return cached
-
-    # Проверяем постоянный кэш в Supabase (если доступен)
-    db_translation = None
-    if _translation_cache_db_client is not None:
-        try:
-            # Используем хэш текста, чтобы не хранить потенциально длинные строки в индексе
-            import hashlib
-            text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
-            response = (
-                _translation_cache_db_client
-                .from_("translation_cache")
-                .select("translated_text")
-                .eq("text_hash", text_hash)
-                .eq("source_lang", source_lang)
-                .eq("target_lang", target_lang)
-                .limit(1)
-                .execute()
-            )
-            if response.data:
-                db_translation = response.data[0].get("translated_text")
-        except Exception as e:
-            logger.warning(f"Failed to read translation cache from Supabase: {e}")
+    return (await translate_texts_ai([text], target_lang, source_lang))[0]
 
-    if db_translation:
-        _translation_cache[cache_key] = db_translation
-        return db_translation
 
-    # Если в кэше нет — обращаемся к OpenAI
-    translated = await ai_assistant.translate_text(text, target_lang, source_lang)
+async def translate_texts_ai(texts: Sequence[str], target_lang: str = 'en', source_lang: str = 'ru') -> List[str]:
+    """
+    Перевод нескольких текстов: кэш в памяти, затем translation_cache,
+    оставшиеся промахи — одним пакетным запросом к AI
     
-    if translated:
-        _translation_cache[cache_key] = translated
-
-        # Пишем в постоянный кэш Supabase (мягкий режим: не падаем при ошибке)
-        if _translation_cache_db_client is not None:
-            try:
-                import hashlib
-                text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
-                _translation_cache_db_client.from_("translation_cache").insert({
-                    "text_hash": text_hash,
-                    "source_lang": source_lang,
-                    "target_lang": target_lang,
-                    "source_text": text,
-                    "translated_text": translated,
-                }).execute()
-            except Exception as e:
-                logger.warning(f"Failed to write translation cache to Supabase: {e}")
-
-        return translated
-    else:
+    Returns:
+        Переводы в порядке texts (оригинал для непереведённых)
+    """
+    translated = await _translation_cache.translate_many(texts, target_lang, source_lang)
+    if any(t is None for t in translated):
         logger.warning("Translation failed, returning original text")
-        return text
-
+    return [t if t is not None else text for text, t in zip(texts, translated)]
@@ -0,0 +1,49 @@
+-- ============================================
+-- Бэкфилл переводов: колонки для услуг и акций и пакетная запись переводов
+-- Запустите этот скрипт в SQL Editor вашего проекта Supabase
+-- ============================================
+-- Для нового языка добавьте колонки <поле>_<язык> по тому же образцу
+-- (news: title, preview_text, content; services и promotions: title, description).
+
+ALTER TABLE services
+  ADD COLUMN IF NOT EXISTS title_en TEXT,
+  ADD COLUMN IF NOT EXISTS description_en TEXT;
+
+ALTER TABLE promotions
+  ADD COLUMN IF NOT EXISTS title_en TEXT,
+  ADD COLUMN IF NOT EXISTS description_en TEXT;
+
+
+-- Записывает переводы пачкой строк: один UPDATE ... FROM на колонку.
+-- p_rows: [{"id": ..., "title_en": "...", ...}]; отсутствующие в строке поля не трогаются.
+CREATE OR REPLACE FUNCTION public.apply_translations_batch(
+    p_table TEXT,
+    p_columns TEXT[],
+    p_rows JSONB
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_column TEXT;
+BEGIN
+    IF p_table NOT IN ('news', 'services', 'promotions') THEN
+        RAISE EXCEPTION 'apply_translations_batch: table % is not allowed', p_table;
+    END IF;
+
+    FOREACH v_column IN ARRAY p_columns LOOP
+        IF v_column !~ '^[a-z_]+_[a-z]{2}$' THEN
+            RAISE EXCEPTION 'apply_translations_batch: column % is not a translation column', v_column;
+        END IF;
+
+        EXECUTE format(
+            'UPDATE %1$I t SET %2$I = r.%2$I
+             FROM jsonb_populate_recordset(NULL::%1$I, $1) r
+             WHERE t.id = r.id AND r.%2$I IS NOT NULL',
+            p_table, v_column
+        ) USING p_rows;
+    END LOOP;
+
+    RETURN jsonb_array_length(p_rows);
+END;
+$$;
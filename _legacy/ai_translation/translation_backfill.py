@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Возобновляемый бэкфилл переводов для news, services и promotions.
+
+Строки без перевода читаются страницами по курсору (id), страницы переводятся
+параллельно (не больше concurrency одновременно) пакетами через TranslationCache,
+результаты пишутся одним вызовом RPC apply_translations_batch на страницу.
+Прогресс сохраняется в checkpoint-файл: после перезапуска обход продолжается
+с последней полностью записанной страницы.
+
+Пример:
+    python translation_backfill.py --table news --lang en --concurrency 4
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+from translation_cache import TranslationCache
+
+
+logger = logging.getLogger("translation_backfill")
+
+
+class BackfillSpec:
+    """Что переводить в таблице: исходные поля и их запасные источники."""
+
+    def __init__(self, table: str, fields: Sequence[str], fallbacks: Optional[Dict[str, tuple]] = None, key: str = "id"):
+        self.table = table
+        self.fields = tuple(fields)
+        # Поле -> (исходное поле, максимальная длина), если своё значение пустое
+        self.fallbacks = fallbacks or {}
+        self.key = key
+
+    def target(self, field: str, lang: str) -> str:
+        return f"{field}_{lang}"
+
+    def columns(self, lang: str) -> str:
+        sources = set(self.fields) | {source for source, _ in self.fallbacks.values()}
+        targets = [self.target(field, lang) for field in self.fields]
+        return ", ".join([self.key, *sorted(sources), *targets])
+
+    def untranslated_filter(self, lang: str) -> str:
+        return ",".join(f"{self.target(field, lang)}.is.null" for field in self.fields)
+
+    def source_text(self, row: dict, field: str) -> str:
+        value = row.get(field) or ""
+        if not value.strip() and field in self.fallbacks:
+            source, max_len = self.fallbacks[field]
+            value = (row.get(source) or "")[:max_len]
+        return value
+
+
+BACKFILL_SPECS = {
+    "news": BackfillSpec("news", ("title", "preview_text", "content"), fallbacks={"preview_text": ("content", 200)}),
+    "services": BackfillSpec("services", ("title", "description")),
+    "promotions": BackfillSpec("promotions", ("title", "description")),
+}
+
+
+class TranslationBackfill:
+    """Бэкфилл переводов одной таблицы с ограниченным параллелизмом и чекпоинтами."""
+
+    def __init__(
+        self,
+        client: Any,
+        translator: TranslationCache,
+        target_lang: str = "en",
+        source_lang: str = "ru",
+        page_size: int = 100,
+        concurrency: int = 4,
+        checkpoint_path: Optional[str] = None,
+    ):
+        self.client = client
+        self.translator = translator
+        self.target_lang = target_lang
+        self.source_lang = source_lang
+        self.page_size = max(int(page_size), 1)
+        self.concurrency = max(int(concurrency), 1)
+        self.checkpoint_path = checkpoint_path
+
+    # --- чекпоинты --------------------------------------------------------
+    def load_checkpoint(self, table: str) -> Optional[Any]:
+        """Последний id, до которого включительно переводы уже записаны."""
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return None
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data.get(f"{table}:{self.target_lang}")
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать чекпоинт {self.checkpoint_path}: {e}")
+            return None
+
+    def save_checkpoint(self, table: str, cursor: Any):
+        if not self.checkpoint_path:
+            return
+        data = {}
+        if os.path.exists(self.checkpoint_path):
+            try:
+                with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except Exception:
+                data = {}
+        data[f"{table}:{self.target_lang}"] = cursor
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    # --- этапы ------------------------------------------------------------
+    def fetch_page(self, spec: BackfillSpec, after: Optional[Any]) -> List[dict]:
+        query = (
+            self.client.from_(spec.table)
+            .select(spec.columns(self.target_lang))
+            .or_(spec.untranslated_filter(self.target_lang))
+        )
+        if after is not None:
+            query = query.gt(spec.key, after)
+        return query.order(spec.key).limit(self.page_size).execute().data or []
+
+    async def translate_page(self, spec: BackfillSpec, rows: List[dict]) -> List[dict]:
+        """Переводит все недостающие поля страницы одним вызовом translate_many."""
+        slots, texts = [], []
+        for row in rows:
+            for field in spec.fields:
+                if row.get(spec.target(field, self.target_lang)):
+                    continue
+                text = spec.source_text(row, field)
+                if text.strip():
+                    slots.append((row[spec.key], field))
+                    texts.append(text)
+
+        translated = await self.translator.translate_many(texts, self.target_lang, self.source_lang)
+
+        updates: Dict[Any, dict] = {}
+        for (row_id, field), value in zip(slots, translated):
+            if value:
+                updates.setdefault(row_id, {spec.key: row_id})[spec.target(field, self.target_lang)] = value
+        return list(updates.values())
+
+    def write_page(self, spec: BackfillSpec, updates: List[dict]) -> int:
+        """Пишет переводы страницы одним RPC; без функции в БД — построчными UPDATE."""
+        if not updates:
+            return 0
+        columns = [spec.target(field, self.target_lang) for field in spec.fields]
+        try:
+            response = self.client.rpc("apply_translations_batch", {
+                "p_table": spec.table,
+                "p_columns": columns,
+                "p_rows": updates,
+            }).execute()
+            return int(response.data or 0)
+        except Exception as e:
+            logger.warning(f"apply_translations_batch недоступна, пишу построчно: {e}")
+            for update in updates:
+                values = {k: v for k, v in update.items() if k != spec.key}
+                self.client.from_(spec.table).update(values).eq(spec.key, update[spec.key]).execute()
+            return len(updates)
+
+    # --- запуск -----------------------------------------------------------
+    async def run(self, spec: BackfillSpec) -> Dict[str, Any]:
+        """Проходит таблицу до конца. Возвращает статистику прогона."""
+        started = time.perf_counter()
+        stats = {"table": spec.table, "pages": 0, "rows_scanned": 0, "rows_updated": 0, "texts": 0}
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+        done_pages: Dict[int, Any] = {}
+        state = {"next_to_commit": 0}
+        cursor = self.load_checkpoint(spec.table)
+        if cursor is not None:
+            logger.info(f"{spec.table}: продолжаю с {spec.key} > {cursor}")
+
+        async def produce():
+            nonlocal cursor
+            sequence = 0
+            while True:
+                rows = await asyncio.to_thread(self.fetch_page, spec, cursor)
+                if not rows:
+                    break
+                cursor = rows[-1][spec.key]
+                await queue.put((sequence, rows, cursor))
+                sequence += 1
+                if len(rows) < self.page_size:
+                    break
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+        async def work():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                sequence, rows, last_key = item
+                updates = await self.translate_page(spec, rows)
+                written = await asyncio.to_thread(self.write_page, spec, updates)
+
+                stats["pages"] += 1
+                stats["rows_scanned"] += len(rows)
+                stats["rows_updated"] += written
+                stats["texts"] += sum(len(u) - 1 for u in updates)
+
+                # Чекпоинт двигается только по непрерывному префиксу записанных страниц
+                done_pages[sequence] = last_key
+                while state["next_to_commit"] in done_pages:
+                    committed = done_pages.pop(state["next_to_commit"])
+                    state["next_to_commit"] += 1
+                    self.save_checkpoint(spec.table, committed)
+
+        tasks = [asyncio.create_task(produce())] + [asyncio.create_task(work()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        # Проход завершён: следующий запуск начнёт с начала и подберёт строки, где перевод не удался
+        self.save_checkpoint(spec.table, None)
+
+        stats["elapsed"] = time.perf_counter() - started
+        logger.info(
+            f"{spec.table}: страниц {stats['pages']}, строк {stats['rows_scanned']}, "
+            f"обновлено {stats['rows_updated']}, за {stats['elapsed']:.1f}с"
+        )
+        return stats
+
+
+async def main(argv: Optional[Sequence[str]] = None) -> None:
+    import argparse
+
+    from dotenv import load_dotenv
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    from supabase_manager import SupabaseManager
+    from ai_helper import _translation_cache
+
+    parser = argparse.ArgumentParser(description="Бэкфилл переводов контента")
+    parser.add_argument("--table", action="append", choices=sorted(BACKFILL_SPECS), help="Таблица (можно несколько раз)")
+    parser.add_argument("--lang", default="en", help="Целевой язык")
+    parser.add_argument("--source-lang", default="ru", help="Исходный язык")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("TRANSLATION_BACKFILL_CONCURRENCY", "4")))
+    parser.add_argument("--checkpoint", default=".translation_backfill.json", help="Файл чекпоинтов")
+    parser.add_argument("--restart", action="store_true", help="Игнорировать чекпоинт и начать сначала")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    db = SupabaseManager()
+    if not getattr(db, "client", None):
+        logger.error("Supabase client is not initialized. Check SUPABASE_URL / SUPABASE_KEY.")
+        return
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    _translation_cache.max_concurrency = args.concurrency
+
+    backfill = TranslationBackfill(
+        db.client,
+        _translation_cache,
+        target_lang=args.lang,
+        source_lang=args.source_lang,
+        page_size=args.page_size,
+        concurrency=args.concurrency,
+        checkpoint_path=args.checkpoint,
+    )
+    for table in args.table or list(BACKFILL_SPECS):
+        await backfill.run(BACKFILL_SPECS[table])
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
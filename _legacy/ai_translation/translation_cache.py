@@ -0,0 +1,259 @@
+"""
+Слой переводов с адресацией по содержимому.
+
+Ключ перевода — SHA-256 нормализованного текста + пара языков; в бэкенд уходит
+исходный текст, чтобы перевод сохранил его форматирование. Перед таблицей
+translation_cache стоит in-memory LRU, а промахи, накопленные за одну итерацию
+event loop (в том числе от параллельных вызовов), уходят в бэкенд одним пакетом.
+Повторный перевод неизменённого текста не обращается к бэкенду.
+
+Бэкенд — любой объект с методом
+    async translate_batch(texts, target_lang, source_lang) -> list[Optional[str]]
+В проде это ai_helper.AIAssistant, в тестах — LocalTranslationBackend.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Optional, Protocol, Sequence
+
+
+logger = logging.getLogger(__name__)
+
+TRANSLATION_CACHE_TABLE = "translation_cache"
+
+_HORIZONTAL_SPACE_RE = re.compile(r"[ \t\u00a0]+")
+
+
+class TranslationBackend(Protocol):
+    async def translate_batch(
+        self, texts: Sequence[str], target_lang: str, source_lang: str
+    ) -> list[Optional[str]]:
+        ...
+
+
+def normalize_text(text: str) -> str:
+    """Приводит текст к канонической форме: NFC, \\n вместо \\r\\n, без лишних пробелов по краям строк."""
+    text = unicodedata.normalize("NFC", text).replace("\r\n", "\n").replace("\r", "\n")
+    lines = [_HORIZONTAL_SPACE_RE.sub(" ", line).strip() for line in text.split("\n")]
+    return "\n".join(lines).strip()
+
+
+def text_hash(text: str) -> str:
+    """Хэш нормализованного текста — ключ в translation_cache."""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class LocalTranslationBackend:
+    """
+    Детерминированный переводчик без сети: "[en] текст". Для тестов и локальной разработки.
+    latency — имитация задержки сетевого запроса (секунд на пакет).
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self.texts_translated = 0
+
+    async def translate_batch(
+        self, texts: Sequence[str], target_lang: str, source_lang: str
+    ) -> list[Optional[str]]:
+        self.calls += 1
+        self.texts_translated += len(texts)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [f"[{target_lang}] {text}" for text in texts]
+
+
+class TranslationCache:
+    """LRU в памяти + таблица translation_cache + пакетный перевод промахов."""
+
+    # Сколько хэшей передаём в одном in_() — ограничение длины URL PostgREST
+    DB_LOOKUP_CHUNK = 100
+
+    def __init__(
+        self,
+        backend: TranslationBackend,
+        db_client: Any = None,
+        max_entries: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        max_concurrency: Optional[int] = None,
+    ):
+        self.backend = backend
+        self.db_client = db_client
+        self.max_entries = int(max_entries if max_entries is not None else os.getenv("TRANSLATION_CACHE_SIZE", "5000"))
+        # Максимум текстов в одном запросе к бэкенду
+        self.batch_size = int(batch_size if batch_size is not None else os.getenv("TRANSLATION_BATCH_SIZE", "20"))
+        # Максимум одновременных запросов к бэкенду
+        self.max_concurrency = int(max_concurrency if max_concurrency is not None else os.getenv("TRANSLATION_MAX_CONCURRENCY", "4"))
+        self._memory: "OrderedDict[tuple[str, str, str], str]" = OrderedDict()
+        # Ожидающие перевода промахи: (source, target) -> {hash: исходный текст}
+        self._pending: dict[tuple[str, str], dict[str, str]] = {}
+        self._inflight: dict[tuple[str, str, str], asyncio.Future] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._backend_slots: Optional[asyncio.Semaphore] = None
+
+    async def translate(self, text: str, target_lang: str = "en", source_lang: str = "ru") -> Optional[str]:
+        """Переводит один текст. Параллельные вызовы объединяются в общий пакет."""
+        return (await self.translate_many([text], target_lang, source_lang))[0]
+
+    async def translate_many(
+        self, texts: Sequence[str], target_lang: str = "en", source_lang: str = "ru"
+    ) -> list[Optional[str]]:
+        """
+        Переводит список текстов. Пустые строки возвращаются как есть,
+        None в результате — перевод не удался.
+        """
+        results: list[Optional[str]] = [None] * len(texts)
+        waiting: list[tuple[int, asyncio.Future]] = []
+
+        for index, text in enumerate(texts):
+            if not text or not text.strip():
+                results[index] = text
+                continue
+            digest = text_hash(text)
+            cached = self.get_cached(digest, target_lang, source_lang)
+            if cached is not None:
+                results[index] = cached
+                continue
+            waiting.append((index, self._enqueue(digest, text, target_lang, source_lang)))
+
+        for index, future in waiting:
+            results[index] = await future
+        return results
+
+    def get_cached(self, digest: str, target_lang: str, source_lang: str) -> Optional[str]:
+        key = (digest, source_lang, target_lang)
+        value = self._memory.get(key)
+        if value is not None:
+            self._memory.move_to_end(key)
+        return value
+
+    def clear(self):
+        self._memory.clear()
+
+    def _remember(self, digest: str, target_lang: str, source_lang: str, translated: str):
+        key = (digest, source_lang, target_lang)
+        self._memory[key] = translated
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _enqueue(self, digest: str, text: str, target_lang: str, source_lang: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Новый event loop (например, повторный asyncio.run) — состояние прежнего неактуально
+            self._loop = loop
+            self._pending = {}
+            self._inflight = {}
+            self._flush_task = None
+            self._backend_slots = asyncio.Semaphore(max(self.max_concurrency, 1))
+
+        key = (digest, source_lang, target_lang)
+        future = self._inflight.get(key)
+        if future is not None:
+            return future
+
+        future = loop.create_future()
+        self._inflight[key] = future
+        self._pending.setdefault((source_lang, target_lang), {})[digest] = text
+        if self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush())
+        return future
+
+    async def _flush(self):
+        # Даём остальным корутинам этой итерации добавить свои промахи в пакет
+        await asyncio.sleep(0)
+        pending, self._pending = self._pending, {}
+        self._flush_task = None
+
+        for (source_lang, target_lang), items in pending.items():
+            try:
+                resolved = await self._resolve(items, target_lang, source_lang)
+            except Exception as e:
+                logger.error(f"Translation batch failed ({source_lang} -> {target_lang}): {e}")
+                resolved = {}
+            for digest in items:
+                future = self._inflight.pop((digest, source_lang, target_lang), None)
+                if future is not None and not future.done():
+                    future.set_result(resolved.get(digest))
+
+    async def _resolve(self, items: dict[str, str], target_lang: str, source_lang: str) -> dict[str, str]:
+        resolved = self._load_from_db(list(items), target_lang, source_lang)
+        for digest, translated in resolved.items():
+            self._remember(digest, target_lang, source_lang, translated)
+
+        missing = [digest for digest in items if digest not in resolved]
+        size = max(self.batch_size, 1)
+        fresh: dict[str, str] = {}
+
+        async def translate_chunk(chunk: list[str]):
+            async with self._backend_slots:
+                translations = await self.backend.translate_batch([items[d] for d in chunk], target_lang, source_lang)
+            for digest, translated in zip(chunk, translations or []):
+                if translated:
+                    fresh[digest] = translated
+                    self._remember(digest, target_lang, source_lang, translated)
+
+        outcomes = await asyncio.gather(
+            *(translate_chunk(missing[i:i + size]) for i in range(0, len(missing), size)),
+            return_exceptions=True
+        )
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                logger.error(f"Translation batch failed ({source_lang} -> {target_lang}): {outcome}")
+
+        if fresh:
+            self._store_in_db(fresh, items, target_lang, source_lang)
+        resolved.update(fresh)
+        return resolved
+
+    def _load_from_db(self, digests: list[str], target_lang: str, source_lang: str) -> dict[str, str]:
+        if self.db_client is None or not digests:
+            return {}
+        found: dict[str, str] = {}
+        try:
+            for start in range(0, len(digests), self.DB_LOOKUP_CHUNK):
+                response = (
+                    self.db_client
+                    .from_(TRANSLATION_CACHE_TABLE)
+                    .select("text_hash, translated_text")
+                    .eq("source_lang", source_lang)
+                    .eq("target_lang", target_lang)
+                    .in_("text_hash", digests[start:start + self.DB_LOOKUP_CHUNK])
+                    .execute()
+                )
+                for row in response.data or []:
+                    if row.get("translated_text"):
+                        found[row["text_hash"]] = row["translated_text"]
+        except Exception as e:
+            logger.warning(f"Failed to read translation cache from Supabase: {e}")
+        return found
+
+    def _store_in_db(self, translations: dict[str, str], sources: dict[str, str], target_lang: str, source_lang: str):
+        if self.db_client is None:
+            return
+        rows = [
+            {
+                "text_hash": digest,
+                "source_lang": source_lang,
+                "target_lang": target_lang,
+                "source_text": sources[digest],
+                "translated_text": translated,
+            }
+            for digest, translated in translations.items()
+        ]
+        try:
+            (
+                self.db_client
+                .from_(TRANSLATION_CACHE_TABLE)
+                .upsert(rows, on_conflict="text_hash,source_lang,target_lang", ignore_duplicates=True)
+                .execute()
+            )
+        except Exception as e:
+            logger.warning(f"Failed to write translation cache to Supabase: {e}")
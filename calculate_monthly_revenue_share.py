@@ -65,47 +65,18 @@ def calculate_last_month_revenue_share():
         return None
 
 
-def approve_pending_payments(period_start: date, period_end: date):
-    """Одобряет все pending выплаты за период"""
+def approve_pending_payments(period_start: date, period_end: date, approved_by: str = 'system'):
+    """Одобряет все pending выплаты за период (пачками, с записью запуска для аудита)"""
     try:
         sm = SupabaseManager()
+        result = PartnerRevenueShare(sm).approve_pending_payments(period_start, period_end, approved_by=approved_by)
         
-        # Получаем все pending выплаты за период
-        payments = sm.client.table('partner_revenue_share').select(
-            'id, partner_chat_id, final_amount'
-        ).eq('status', 'pending').gte(
-            'period_start', period_start.isoformat()
-        ).lte('period_end', period_end.isoformat()).execute()
-        
-        if not payments.data:
+        if not result['approved_count']:
             logger.info("Нет pending выплат для одобрения")
-            return 0
-        
-        approved_count = 0
-        total_amount = 0.0
-        
-        for payment in payments.data:
-            try:
-                # Одобряем выплату
-                sm.client.table('partner_revenue_share').update({
-                    'status': 'approved'
-                }).eq('id', payment['id']).execute()
-                
-                approved_count += 1
-                total_amount += float(payment.get('final_amount', 0))
-                
-                logger.info(
-                    f"Одобрена выплата {payment['id']}: "
-                    f"${payment.get('final_amount', 0):.2f} для партнера {payment['partner_chat_id']}"
-                )
-            except Exception as e:
-                logger.error(f"Ошибка одобрения выплаты {payment['id']}: {e}")
-        
-        logger.info(f"Одобрено выплат: {approved_count}, общая сумма: ${total_amount:.2f}")
-        return approved_count
+        return result['approved_count']
         
     except Exception as e:
-        logger.error(f"Ошибка при одобрении выплат: {e}")
+        logger.error(f"Ошибка при одобрении выплат (повторный запуск продолжит с места остановки): {e}")
         return 0
 
 
@@ -135,9 +106,18 @@ def main():
         action='store_true',
         help='Автоматически одобрить все pending выплаты'
     )
+    parser.add_argument(
+        '--approve-payment',
+        type=int,
+        help='Одобрить одну выплату по ID (ручная проверка) и выйти'
+    )
     
     args = parser.parse_args()
     
+    if args.approve_payment:
+        approved = PartnerRevenueShare(SupabaseManager()).approve_payment(args.approve_payment)
+        sys.exit(0 if approved else 1)
+    
     # Определяем период
     today = date.today()
     
@@ -0,0 +1,228 @@
+import datetime
+import logging
+from typing import Iterable, Optional
+
+from dateutil import parser
+
+from user_data_erasure import DELETED_USER_ID
+
+
+LIFETIME_TABLE = 'client_lifetime_stats'
+VISITS_TABLE = 'client_visit_stats'
+
+# Визит — начисление или списание у партнера (как в Churn Prevention)
+VISIT_OPERATIONS = ('accrual', 'redemption')
+
+TRANSACTION_COLUMNS = 'id, client_chat_id, partner_chat_id, date_time, operation_type, total_amount, earned_points, spent_points'
+LIFETIME_COLUMNS = 'client_chat_id, transactions_count, ltv, points_earned, points_spent, first_transaction_at, last_transaction_at'
+VISITS_COLUMNS = 'partner_chat_id, visit_count, avg_interval_days, first_visit_at, last_visit_at'
+
+
+def _moment(value) -> Optional[datetime.datetime]:
+    if not value:
+        return None
+    try:
+        moment = parser.isoparse(value) if isinstance(value, str) else value
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(moment, datetime.datetime):
+        return None
+    return moment if moment.tzinfo else moment.replace(tzinfo=datetime.timezone.utc)
+
+
+def mean_interval_days(first, last, count: int) -> float:
+    """
+    Средний интервал между последовательными событиями в днях.
+
+    Сумма интервалов между отсортированными датами равна (last - first), поэтому среднее
+    считается по первой и последней дате и числу событий — без хранения всех дат.
+    """
+    first, last = _moment(first), _moment(last)
+    if not first or not last or count < 2:
+        return 0.0
+    return round((last - first).total_seconds() / 86400.0 / (count - 1), 2)
+
+
+def aggregate_client_transactions(transactions: Iterable[dict]) -> tuple:
+    """
+    Сворачивает транзакции в строки client_lifetime_stats и client_visit_stats.
+
+    Возвращает (lifetime, visits): словари с ключами client_chat_id и
+    (client_chat_id, partner_chat_id). LTV — total_amount начислений, начисленные баллы —
+    earned_points начислений и приветственных бонусов, списанные — spent_points списаний.
+    Анонимизированные транзакции (DELETED_USER) не учитываются.
+    """
+    lifetime: dict = {}
+    visits: dict = {}
+    for txn in transactions:
+        client_chat_id = txn.get('client_chat_id')
+        if client_chat_id is None or client_chat_id == DELETED_USER_ID:
+            continue
+        client_chat_id = str(client_chat_id)
+        operation_type = txn.get('operation_type')
+        moment = _moment(txn.get('date_time'))
+
+        row = lifetime.get(client_chat_id)
+        if row is None:
+            row = lifetime[client_chat_id] = {
+                'client_chat_id': client_chat_id, 'transactions_count': 0, 'ltv': 0.0,
+                'points_earned': 0.0, 'points_spent': 0.0,
+                'first_transaction_at': None, 'last_transaction_at': None
+            }
+        row['transactions_count'] += 1
+        if operation_type == 'accrual':
+            row['ltv'] += float(txn.get('total_amount') or 0.0)
+        if operation_type in ('accrual', 'enrollment_bonus'):
+            row['points_earned'] += float(txn.get('earned_points') or 0)
+        elif operation_type == 'redemption':
+            row['points_spent'] += float(txn.get('spent_points') or 0)
+        if moment:
+            _extend_range(row, 'first_transaction_at', 'last_transaction_at', moment)
+
+        partner_chat_id = txn.get('partner_chat_id')
+        if operation_type not in VISIT_OPERATIONS or not partner_chat_id or partner_chat_id == DELETED_USER_ID or not moment:
+            continue
+        key = (client_chat_id, str(partner_chat_id))
+        visit = visits.get(key)
+        if visit is None:
+            visit = visits[key] = {
+                'client_chat_id': client_chat_id, 'partner_chat_id': key[1],
+                'visit_count': 0, 'first_visit_at': None, 'last_visit_at': None
+            }
+        visit['visit_count'] += 1
+        _extend_range(visit, 'first_visit_at', 'last_visit_at', moment)
+
+    for row in lifetime.values():
+        for column in ('first_transaction_at', 'last_transaction_at'):
+            row[column] = row[column].isoformat() if row[column] else None
+    for visit in visits.values():
+        visit['avg_interval_days'] = mean_interval_days(visit['first_visit_at'], visit['last_visit_at'], visit['visit_count'])
+        visit['first_visit_at'] = visit['first_visit_at'].isoformat()
+        visit['last_visit_at'] = visit['last_visit_at'].isoformat()
+    return lifetime, visits
+
+
+def _extend_range(row: dict, first_column: str, last_column: str, moment: datetime.datetime):
+    if row[first_column] is None or moment < row[first_column]:
+        row[first_column] = moment
+    if row[last_column] is None or moment > row[last_column]:
+        row[last_column] = moment
+
+
+class ClientStats:
+    """
+    Накопительные агрегаты клиента: client_lifetime_stats (итоги за всё время) и
+    client_visit_stats (визиты к каждому партнеру, последний визит, средний интервал).
+
+    Таблицы поддерживают триггеры на transactions (migrations/create_client_lifetime_stats.sql);
+    rebuild() пересчитывает их по исходным данным.
+    """
+
+    WRITE_CHUNK = 500
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    @property
+    def client(self):
+        return self.manager.client
+
+    def get(self, client_chat_id: str, top_partners: int = 3) -> tuple:
+        """
+        Итоги клиента и его самые посещаемые партнеры — два запроса независимо от числа транзакций.
+
+        Returns:
+            (lifetime: dict или None, visits: список строк client_visit_stats по убыванию визитов)
+        """
+        client_chat_id = str(client_chat_id)
+        try:
+            lifetime = self.client.from_(LIFETIME_TABLE).select(LIFETIME_COLUMNS).eq('client_chat_id', client_chat_id).limit(1).execute()
+            visits = (
+                self.client.from_(VISITS_TABLE)
+                .select(VISITS_COLUMNS)
+                .eq('client_chat_id', client_chat_id)
+                .order('visit_count', desc=True)
+                .limit(top_partners)
+                .execute()
+            )
+            return (lifetime.data[0] if lifetime.data else None), (visits.data or [])
+        except Exception as e:
+            # Таблицы агрегатов недоступны (миграция не применена) — считаем по транзакциям клиента
+            logging.error(f"Error reading client stats for {client_chat_id}, aggregating raw rows: {e}")
+
+        lifetime, visits = aggregate_client_transactions(self._fetch_transactions(client_chat_id))
+        ranked = sorted(visits.values(), key=lambda v: v['visit_count'], reverse=True)
+        return lifetime.get(client_chat_id), ranked[:top_partners]
+
+    def rebuild(self, client_chat_id: Optional[str] = None) -> int:
+        """
+        Пересчитывает агрегаты по transactions (первичное заполнение, сверка после сбоев).
+        Сначала пробует RPC rebuild_client_stats, иначе пересчитывает на стороне приложения.
+        Возвращает число записанных строк.
+        """
+        params = {'p_client_chat_id': str(client_chat_id) if client_chat_id else None}
+        try:
+            response = self.client.rpc('rebuild_client_stats', params).execute()
+            return int(response.data or 0) if not isinstance(response.data, list) else len(response.data)
+        except Exception as e:
+            logging.warning(f"rebuild_client_stats RPC unavailable, rebuilding in application: {e}")
+        return self._rebuild_locally(client_chat_id)
+
+    def _rebuild_locally(self, client_chat_id: Optional[str]) -> int:
+        if client_chat_id:
+            clients = [str(client_chat_id)]
+            transactions = self._fetch_transactions(clients[0])
+        else:
+            transactions = self._fetch_transactions(None)
+            clients = None
+        lifetime, visits = aggregate_client_transactions(transactions)
+        if clients is None:
+            # Клиенты, у которых агрегаты остались, а транзакций уже нет, тоже пересчитываются (строки удаляются)
+            clients = sorted(set(lifetime) | self._stored_clients())
+        visits = self._known_visits(visits)
+
+        visits_by_client: dict = {}
+        for (visit_client, _), row in visits.items():
+            visits_by_client.setdefault(visit_client, []).append(row)
+
+        # Пересчёт по частям клиентов: остальные строки таблиц остаются на месте
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        written = 0
+        for start in range(0, len(clients), self.WRITE_CHUNK):
+            chunk = clients[start:start + self.WRITE_CHUNK]
+            lifetime_rows = [dict(lifetime[c], updated_at=now) for c in chunk if c in lifetime]
+            visit_rows = [dict(row, last_computed_at=now) for c in chunk for row in visits_by_client.get(c, ())]
+            for table, rows in ((LIFETIME_TABLE, lifetime_rows), (VISITS_TABLE, visit_rows)):
+                self.client.from_(table).delete().in_('client_chat_id', chunk).execute()
+                for row_start in range(0, len(rows), self.WRITE_CHUNK):
+                    self.client.from_(table).insert(rows[row_start:row_start + self.WRITE_CHUNK]).execute()
+                written += len(rows)
+        return written
+
+    def _stored_clients(self) -> set:
+        """Клиенты, у которых уже есть итоги (визиты без итогов не появляются — и те и другие из transactions)."""
+        rows = self.manager._fetch_all_rows(lambda: self.client.from_(LIFETIME_TABLE).select('client_chat_id'), key='client_chat_id')
+        return {str(row['client_chat_id']) for row in rows}
+
+    def _known_visits(self, visits: dict) -> dict:
+        """Визиты только клиентов из users и партнеров из partners — как внешние ключи client_visit_stats."""
+        users = self._existing('users', {client for client, _ in visits})
+        partners = self._existing('partners', {partner for _, partner in visits})
+        return {key: row for key, row in visits.items() if key[0] in users and key[1] in partners}
+
+    def _existing(self, table: str, chat_ids: set) -> set:
+        chat_ids = sorted(chat_ids)
+        found = set()
+        for start in range(0, len(chat_ids), self.WRITE_CHUNK):
+            response = self.client.from_(table).select('chat_id').in_('chat_id', chat_ids[start:start + self.WRITE_CHUNK]).execute()
+            found.update(str(row['chat_id']) for row in response.data or [])
+        return found
+
+    def _fetch_transactions(self, client_chat_id: Optional[str]) -> list:
+        def build_query():
+            query = self.client.from_('transactions').select(TRANSACTION_COLUMNS)
+            if client_chat_id:
+                query = query.eq('client_chat_id', client_chat_id)
+            return query
+
+        return self.manager._fetch_all_rows(build_query)
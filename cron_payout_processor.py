@@ -18,6 +18,7 @@ from dotenv import load_dotenv
 from supabase_manager import SupabaseManager
 from partner_revenue_share import PartnerRevenueShare
 from ton_payment_service import TONPaymentService
+from ton_payouts import TONPayoutPipeline
 
 load_dotenv()
 
@@ -66,49 +67,22 @@ def process_monthly_revenue_share_payouts():
         else:
             logger.info(f"Расчет уже выполнен: {len(existing_calculations.data)} записей")
         
-        # 2. Получить все approved выплаты за прошлый месяц
-        payments = sm.client.table('partner_revenue_share').select(
-            'id, partner_chat_id, final_amount, amount_usd, ton_tx_hash'
-        ).eq('period_start', last_month_start.isoformat()).eq(
-            'period_end', last_month_end.isoformat()
-        ).eq('status', 'approved').is_('ton_tx_hash', 'null').execute()
-        
-        if not payments.data:
+        # 2. Выплатить все approved начисления за прошлый месяц пачками по одному курсу
+        summary = TONPayoutPipeline(sm, ton_service).pay_revenue_share(last_month_start, last_month_end)
+        if summary['exchange_rate'] is None:
             logger.info("Нет approved выплат для обработки")
             return 0
         
-        logger.info(f"Найдено {len(payments.data)} approved выплат для обработки")
-        
-        # 3. Обработать каждую выплату
-        processed_count = 0
-        failed_count = 0
-        total_amount = Decimal('0')
-        
-        for payment in payments.data:
-            payment_id = payment['id']
-            partner_chat_id = payment['partner_chat_id']
-            amount_usd = Decimal(str(payment.get('amount_usd') or payment.get('final_amount', 0)))
-            
-            logger.info(f"Обработка Revenue Share {payment_id} для партнера {partner_chat_id}: ${amount_usd}")
-            
-            try:
-                success = ton_service.process_revenue_share_payment(payment_id)
-                
-                if success:
-                    processed_count += 1
-                    total_amount += amount_usd
-                    logger.info(f"✅ Revenue Share {payment_id} успешно выплачена")
-                else:
-                    failed_count += 1
-                    logger.error(f"❌ Ошибка выплаты Revenue Share {payment_id}")
-                    
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"❌ Исключение при обработке Revenue Share {payment_id}: {e}")
+        processed_count = summary['processed']
+        failed_count = summary['failed']
+        total_amount = summary['total_usd']
         
         logger.info("=" * 60)
         logger.info(f"Обработано: {processed_count} выплат")
         logger.info(f"Ошибок: {failed_count}")
+        logger.info(f"Пропущено (нет кошелька или TON выплаты отключены): {summary['skipped']}")
+        logger.info(f"Требуют сверки с блокчейном: {summary['in_doubt']}")
+        logger.info(f"Курс TON/USD: {summary['exchange_rate']} ({summary['rate_source']})")
         logger.info(f"Общая сумма: ${total_amount} USD")
         logger.info("=" * 60)
         
@@ -138,63 +112,23 @@ def process_referral_commissions_payouts(min_amount_usd: Decimal = Decimal('10.0
         sm = SupabaseManager()
         ton_service = TONPaymentService(sm)
         
-        # 1. Получить всех партнеров с pending комиссиями
-        # Нужно получить уникальных партнеров (referrer_chat_id) с pending комиссиями
-        pending_commissions = sm.client.table('referral_rewards').select(
-            'referrer_chat_id, amount_usd'
-        ).eq('status', 'pending').like('reward_type', 'commission_%').execute()
-        
-        if not pending_commissions.data:
+        # Комиссии суммируются по получателю в БД, выплаты уходят пачками по одному курсу
+        summary = TONPayoutPipeline(sm, ton_service).pay_referral_commissions(min_amount_usd)
+        if not summary['partners']:
             logger.info("Нет pending комиссий для обработки")
             return 0
         
-        # Группируем по партнерам
-        partner_totals = {}
-        for commission in pending_commissions.data:
-            partner_id = commission['referrer_chat_id']
-            amount = Decimal(str(commission.get('amount_usd', 0)))
-            
-            if partner_id not in partner_totals:
-                partner_totals[partner_id] = Decimal('0')
-            
-            partner_totals[partner_id] += amount
-        
-        logger.info(f"Найдено {len(partner_totals)} партнеров с pending комиссиями")
-        
-        # 2. Обработать каждого партнера
-        processed_count = 0
-        failed_count = 0
-        skipped_count = 0
-        
-        for partner_chat_id, total_amount in partner_totals.items():
-            if total_amount < min_amount_usd:
-                skipped_count += 1
-                logger.info(f"⏭️  Партнер {partner_chat_id}: сумма ${total_amount} < порога ${min_amount_usd}, пропускаем")
-                continue
-            
-            logger.info(f"Обработка комиссий для партнера {partner_chat_id}: ${total_amount} USD")
-            
-            try:
-                success = ton_service.process_referral_commissions_batch(
-                    partner_chat_id=partner_chat_id,
-                    min_amount_usd=min_amount_usd
-                )
-                
-                if success:
-                    processed_count += 1
-                    logger.info(f"✅ Комиссии для партнера {partner_chat_id} успешно выплачены")
-                else:
-                    failed_count += 1
-                    logger.error(f"❌ Ошибка выплаты комиссий для партнера {partner_chat_id}")
-                    
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"❌ Исключение при обработке комиссий для партнера {partner_chat_id}: {e}")
+        logger.info(f"Найдено {summary['partners']} партнеров с pending комиссиями")
+        processed_count = summary['processed']
+        failed_count = summary['failed']
+        skipped_count = summary['below_minimum']
         
         logger.info("=" * 60)
         logger.info(f"Обработано: {processed_count} партнеров")
         logger.info(f"Пропущено: {skipped_count} партнеров (сумма < порога)")
+        logger.info(f"Пропущено: {summary['skipped']} партнеров (нет кошелька или TON выплаты отключены)")
         logger.info(f"Ошибок: {failed_count}")
+        logger.info(f"Требуют сверки с блокчейном: {summary['in_doubt']}")
         logger.info("=" * 60)
         
         return processed_count
@@ -0,0 +1,14 @@
+-- ============================================
+-- TON выплаты: источник курса TON/USD
+-- Дата: 2026-10-19
+-- ============================================
+-- Курс берётся из кеша в памяти, БД, Binance или CoinGecko; при недоступности источников
+-- может быть использован устаревший курс (ton_exchange_rate.py). Для разбора выплат
+-- вместе с курсом сохраняются его источник и время получения.
+
+ALTER TABLE ton_payments
+  ADD COLUMN IF NOT EXISTS exchange_rate_source TEXT,
+  ADD COLUMN IF NOT EXISTS exchange_rate_fetched_at TIMESTAMPTZ;
+
+COMMENT ON COLUMN ton_payments.exchange_rate_source IS 'Источник курса: database, binance, coingecko, default';
+COMMENT ON COLUMN ton_payments.exchange_rate_fetched_at IS 'Когда курс получен из источника (для устаревшего курса — раньше sent_at)';
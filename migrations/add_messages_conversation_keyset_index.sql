@@ -0,0 +1,12 @@
+-- ============================================
+-- Сообщения: индекс для курсорной пагинации get_conversation
+-- Дата: 2026-10-19
+-- ============================================
+-- Курсор (created_at, id) внутри переписки (client_chat_id, partner_chat_id):
+-- страница читается по индексу без пропуска строк, как при OFFSET.
+
+CREATE INDEX IF NOT EXISTS idx_messages_conversation_keyset
+    ON messages(client_chat_id, partner_chat_id, created_at, id);
+
+-- Старый индекс по паре покрывается новым
+DROP INDEX IF EXISTS idx_messages_conversation;
@@ -0,0 +1,35 @@
+-- ============================================
+-- Новости: индекс ленты и версия для кэша страниц
+-- Дата: 2026-10-19
+-- ============================================
+-- Бот кэширует страницы ленты (get_news_feed) и сверяет их с версией
+-- app_settings.news_feed_version. Версию увеличивает триггер при изменении
+-- колонок, которые попадают в список. views_count и переводы версию не меняют:
+-- просмотры в кэш не попадают, бот дочитывает их по id новостей страницы.
+
+CREATE INDEX IF NOT EXISTS idx_news_feed
+    ON news(is_published, created_at DESC, id DESC);
+
+INSERT INTO app_settings (setting_key, setting_value, description, updated_by)
+VALUES ('news_feed_version', '1', 'Версия ленты новостей для инвалидации кэша страниц', 'system')
+ON CONFLICT (setting_key) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION public.bump_news_feed_version()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE app_settings
+    SET setting_value = (COALESCE(NULLIF(setting_value, ''), '0')::BIGINT + 1)::TEXT,
+        updated_at = NOW(),
+        updated_by = 'news_trigger'
+    WHERE setting_key = 'news_feed_version';
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trigger_bump_news_feed_version ON news;
+CREATE TRIGGER trigger_bump_news_feed_version
+    AFTER INSERT OR DELETE OR UPDATE OF title, preview_text, image_url, is_published, created_at ON news
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION bump_news_feed_version();
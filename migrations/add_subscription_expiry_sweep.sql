@@ -0,0 +1,23 @@
+-- ============================================
+-- Подписки на продукты платформы: обход по сроку действия
+-- Дата: 2026-10-19
+-- ============================================
+-- scripts/platform_subscriptions_job.py раз в день переводит истёкшие активные подписки
+-- в 'expired' и отмечает истекающие в ближайшие дни (expiry_notified_at), выдавая список
+-- для уведомлений. Подписки читаются страницами по valid_until из частичных индексов
+-- и обновляются пачками (UPDATE ... WHERE id IN (...)).
+
+ALTER TABLE client_product_subscriptions
+    ADD COLUMN IF NOT EXISTS expiry_notified_at TIMESTAMPTZ;
+
+COMMENT ON COLUMN client_product_subscriptions.expiry_notified_at IS 'Когда клиент предупреждён о скором окончании подписки (NULL — ещё нет)';
+
+-- Истёкшие активные подписки: status = 'active' AND valid_until < now ORDER BY valid_until, id
+CREATE INDEX IF NOT EXISTS idx_client_product_subscriptions_active_expiry
+    ON client_product_subscriptions(valid_until, id)
+    WHERE status = 'active';
+
+-- Истекающие подписки без предупреждения
+CREATE INDEX IF NOT EXISTS idx_client_product_subscriptions_expiry_notice
+    ON client_product_subscriptions(valid_until, id)
+    WHERE status = 'active' AND expiry_notified_at IS NULL;
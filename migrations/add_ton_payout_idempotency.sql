@@ -0,0 +1,47 @@
+-- ============================================
+-- TON выплаты: ключи идемпотентности и пакетная запись статусов
+-- Дата: 2026-10-19
+-- ============================================
+-- Пакетный запуск (ton_payouts.py) резервирует выплату в ton_payments до отправки:
+-- idempotency_key = '<payment_type>:<id источника>', например 'revenue_share:42'.
+-- Уникальный ключ не даёт отправить одно начисление дважды при повторном или параллельном запуске.
+-- mark_revenue_share_paid_ton() переводит пачку начислений в paid_ton одним вызовом:
+-- p_items = [{"id": 42, "ton_tx_hash": "...", "ton_payment_id": "..."}, ...]
+
+ALTER TABLE ton_payments ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_ton_payments_idempotency_key
+    ON ton_payments(idempotency_key);
+
+COMMENT ON COLUMN ton_payments.idempotency_key IS 'Ключ идемпотентности выплаты: <payment_type>:<id источника>';
+
+
+CREATE OR REPLACE FUNCTION public.mark_revenue_share_paid_ton(
+    p_items JSONB
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_rows INTEGER := 0;
+BEGIN
+    WITH items AS (
+        SELECT *
+        FROM jsonb_to_recordset(COALESCE(p_items, '[]'::jsonb))
+            AS i(id INTEGER, ton_tx_hash TEXT, ton_payment_id UUID)
+    ),
+    updated AS (
+        UPDATE partner_revenue_share r
+        SET status = 'paid_ton',
+            ton_tx_hash = i.ton_tx_hash,
+            ton_payment_id = i.ton_payment_id
+        FROM items i
+        WHERE r.id = i.id
+          AND r.status = 'approved'
+        RETURNING 1
+    )
+    SELECT COUNT(*) INTO v_rows FROM updated;
+
+    RETURN v_rows;
+END;
+$$;
@@ -0,0 +1,278 @@
+-- ============================================
+-- Аналитика клиента: накопительные агрегаты
+-- Дата: 2026-10-19
+-- ============================================
+-- client_lifetime_stats — итоги клиента за всё время (LTV, баллы, первая и последняя транзакция)
+-- client_visit_stats    — визиты клиента к партнёру (таблица Churn Prevention), дополнена first_visit_at
+--
+-- Агрегаты поддерживаются триггерами на transactions: вставка обновляет строки за O(1),
+-- удаление и правка (редкие, в том числе анонимизация GDPR) — триггерами уровня оператора:
+-- каждый затронутый клиент пересчитывается один раз за оператор, а не на каждую строку.
+-- Средний интервал визитов = (last_visit_at - first_visit_at) / (visit_count - 1):
+-- сумма интервалов между отсортированными датами равна разнице крайних дат.
+-- Анонимизированные транзакции ('DELETED_USER') в агрегатах не учитываются; визиты пишутся
+-- только для клиентов из users и партнеров из partners (внешние ключи client_visit_stats).
+-- rebuild_client_stats() пересчитывает агрегаты по transactions.
+
+CREATE TABLE IF NOT EXISTS client_lifetime_stats (
+    client_chat_id TEXT PRIMARY KEY,
+    transactions_count INTEGER NOT NULL DEFAULT 0,
+    ltv NUMERIC(14,2) NOT NULL DEFAULT 0,
+    points_earned NUMERIC(14,2) NOT NULL DEFAULT 0,
+    points_spent NUMERIC(14,2) NOT NULL DEFAULT 0,
+    first_transaction_at TIMESTAMPTZ,
+    last_transaction_at TIMESTAMPTZ,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+COMMENT ON TABLE client_lifetime_stats IS 'Итоги клиента за всё время (обновляются триггером на transactions)';
+COMMENT ON COLUMN client_lifetime_stats.ltv IS 'Сумма total_amount начислений (accrual)';
+COMMENT ON COLUMN client_lifetime_stats.points_earned IS 'earned_points начислений и приветственных бонусов';
+COMMENT ON COLUMN client_lifetime_stats.points_spent IS 'spent_points списаний (redemption)';
+
+ALTER TABLE client_visit_stats ADD COLUMN IF NOT EXISTS first_visit_at TIMESTAMPTZ;
+COMMENT ON COLUMN client_visit_stats.first_visit_at IS 'Дата первого визита по этой паре (client, partner) — для среднего интервала';
+
+CREATE INDEX IF NOT EXISTS idx_client_visit_stats_client_visits ON client_visit_stats(client_chat_id, visit_count DESC);
+CREATE INDEX IF NOT EXISTS idx_transactions_client_chat_id ON transactions(client_chat_id);
+
+ALTER TABLE client_lifetime_stats ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Service role can do everything" ON client_lifetime_stats;
+CREATE POLICY "Service role can do everything" ON client_lifetime_stats FOR ALL TO service_role USING (true) WITH CHECK (true);
+
+
+-- Пересчитывает агрегаты по transactions для списка клиентов (NULL — для всех)
+CREATE OR REPLACE FUNCTION public.rebuild_client_stats_for(
+    p_client_chat_ids TEXT[]
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_rows INTEGER;
+    v_total INTEGER := 0;
+BEGIN
+    IF p_client_chat_ids IS NULL THEN
+        -- Полный пересчёт: триггеры ждут его завершения и применяются поверх
+        LOCK TABLE client_lifetime_stats, client_visit_stats IN EXCLUSIVE MODE;
+    END IF;
+
+    DELETE FROM client_lifetime_stats
+    WHERE p_client_chat_ids IS NULL OR client_chat_id = ANY(p_client_chat_ids);
+    DELETE FROM client_visit_stats
+    WHERE p_client_chat_ids IS NULL OR client_chat_id = ANY(p_client_chat_ids);
+
+    INSERT INTO client_lifetime_stats (
+        client_chat_id, transactions_count, ltv, points_earned, points_spent,
+        first_transaction_at, last_transaction_at, updated_at
+    )
+    SELECT
+        t.client_chat_id,
+        COUNT(*),
+        COALESCE(SUM(t.total_amount) FILTER (WHERE t.operation_type = 'accrual'), 0),
+        COALESCE(SUM(t.earned_points) FILTER (WHERE t.operation_type IN ('accrual', 'enrollment_bonus')), 0),
+        COALESCE(SUM(t.spent_points) FILTER (WHERE t.operation_type = 'redemption'), 0),
+        MIN(t.date_time::timestamptz),
+        MAX(t.date_time::timestamptz),
+        NOW()
+    FROM transactions t
+    WHERE t.client_chat_id IS NOT NULL
+      AND t.client_chat_id <> 'DELETED_USER'
+      AND (p_client_chat_ids IS NULL OR t.client_chat_id = ANY(p_client_chat_ids))
+    GROUP BY t.client_chat_id;
+    GET DIAGNOSTICS v_rows = ROW_COUNT;
+    v_total := v_total + v_rows;
+
+    INSERT INTO client_visit_stats (
+        client_chat_id, partner_chat_id, visit_count, avg_interval_days,
+        first_visit_at, last_visit_at, last_computed_at
+    )
+    SELECT
+        v.client_chat_id,
+        v.partner_chat_id,
+        v.visit_count,
+        CASE WHEN v.visit_count > 1
+            THEN ROUND((EXTRACT(EPOCH FROM (v.last_visit_at - v.first_visit_at)) / 86400.0 / (v.visit_count - 1))::numeric, 2)
+            ELSE 0
+        END,
+        v.first_visit_at,
+        v.last_visit_at,
+        NOW()
+    FROM (
+        SELECT
+            t.client_chat_id,
+            t.partner_chat_id,
+            COUNT(*) AS visit_count,
+            MIN(t.date_time::timestamptz) AS first_visit_at,
+            MAX(t.date_time::timestamptz) AS last_visit_at
+        FROM transactions t
+        JOIN users u ON u.chat_id = t.client_chat_id
+        JOIN partners p ON p.chat_id = t.partner_chat_id
+        WHERE t.date_time IS NOT NULL
+          AND t.operation_type IN ('accrual', 'redemption')
+          AND t.client_chat_id <> 'DELETED_USER'
+          AND t.partner_chat_id <> 'DELETED_USER'
+          AND (p_client_chat_ids IS NULL OR t.client_chat_id = ANY(p_client_chat_ids))
+        GROUP BY t.client_chat_id, t.partner_chat_id
+    ) v;
+    GET DIAGNOSTICS v_rows = ROW_COUNT;
+    v_total := v_total + v_rows;
+
+    RETURN v_total;
+END;
+$$;
+
+
+-- Пересчитывает агрегаты по transactions: один клиент (p_client_chat_id) или все
+CREATE OR REPLACE FUNCTION public.rebuild_client_stats(
+    p_client_chat_id TEXT DEFAULT NULL
+)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    SELECT public.rebuild_client_stats_for(
+        CASE WHEN p_client_chat_id IS NULL THEN NULL ELSE ARRAY[p_client_chat_id] END
+    );
+$$;
+
+
+-- Вклад новой транзакции: O(1) upsert в обе таблицы
+CREATE OR REPLACE FUNCTION public.apply_client_stats_insert(p_txn transactions)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_moment TIMESTAMPTZ := p_txn.date_time::timestamptz;
+BEGIN
+    IF p_txn.client_chat_id IS NULL OR p_txn.client_chat_id = 'DELETED_USER' THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO client_lifetime_stats AS s (
+        client_chat_id, transactions_count, ltv, points_earned, points_spent,
+        first_transaction_at, last_transaction_at, updated_at
+    )
+    VALUES (
+        p_txn.client_chat_id,
+        1,
+        CASE WHEN p_txn.operation_type = 'accrual' THEN COALESCE(p_txn.total_amount, 0) ELSE 0 END,
+        CASE WHEN p_txn.operation_type IN ('accrual', 'enrollment_bonus') THEN COALESCE(p_txn.earned_points, 0) ELSE 0 END,
+        CASE WHEN p_txn.operation_type = 'redemption' THEN COALESCE(p_txn.spent_points, 0) ELSE 0 END,
+        v_moment, v_moment, NOW()
+    )
+    ON CONFLICT (client_chat_id) DO UPDATE
+    SET
+        transactions_count = s.transactions_count + 1,
+        ltv = s.ltv + EXCLUDED.ltv,
+        points_earned = s.points_earned + EXCLUDED.points_earned,
+        points_spent = s.points_spent + EXCLUDED.points_spent,
+        first_transaction_at = LEAST(s.first_transaction_at, EXCLUDED.first_transaction_at),
+        last_transaction_at = GREATEST(s.last_transaction_at, EXCLUDED.last_transaction_at),
+        updated_at = NOW();
+
+    -- client_visit_stats ссылается на users и partners: транзакции клиента не из users
+    -- или партнера не из partners (в том числе анонимизированные) не считаются визитами
+    IF p_txn.operation_type NOT IN ('accrual', 'redemption')
+       OR p_txn.partner_chat_id IS NULL
+       OR p_txn.partner_chat_id = 'DELETED_USER'
+       OR v_moment IS NULL
+       OR NOT EXISTS (SELECT 1 FROM users WHERE chat_id = p_txn.client_chat_id)
+       OR NOT EXISTS (SELECT 1 FROM partners WHERE chat_id = p_txn.partner_chat_id) THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO client_visit_stats AS v (
+        client_chat_id, partner_chat_id, visit_count, avg_interval_days,
+        first_visit_at, last_visit_at, last_computed_at
+    )
+    VALUES (p_txn.client_chat_id, p_txn.partner_chat_id, 1, 0, v_moment, v_moment, NOW())
+    ON CONFLICT (client_chat_id, partner_chat_id) DO UPDATE
+    SET
+        visit_count = v.visit_count + 1,
+        -- Строки, записанные compute_client_visit_stats до этой миграции, могут не иметь first_visit_at:
+        -- восстанавливаем его из среднего интервала
+        first_visit_at = LEAST(
+            COALESCE(v.first_visit_at, v.last_visit_at - MAKE_INTERVAL(secs => v.avg_interval_days * 86400 * GREATEST(v.visit_count - 1, 0))),
+            EXCLUDED.first_visit_at
+        ),
+        last_visit_at = GREATEST(v.last_visit_at, EXCLUDED.last_visit_at),
+        last_computed_at = NOW();
+
+    UPDATE client_visit_stats
+    SET avg_interval_days = ROUND((EXTRACT(EPOCH FROM (last_visit_at - first_visit_at)) / 86400.0 / (visit_count - 1))::numeric, 2)
+    WHERE client_chat_id = p_txn.client_chat_id
+      AND partner_chat_id = p_txn.partner_chat_id
+      AND visit_count > 1;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION public.maintain_client_stats()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM apply_client_stats_insert(NEW);
+    RETURN NEW;
+END;
+$$;
+
+
+-- Удаление и правка транзакций: крайние даты не вычитаются, поэтому затронутых клиентов
+-- пересчитываем — каждого один раз за оператор (анонимизация GDPR меняет сотни строк разом)
+CREATE OR REPLACE FUNCTION public.refresh_client_stats_after_change()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_clients TEXT[];
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT o.client_chat_id) INTO v_clients
+        FROM old_rows o
+        WHERE o.client_chat_id IS NOT NULL AND o.client_chat_id <> 'DELETED_USER';
+    ELSE
+        -- Только строки, где изменились колонки агрегатов
+        SELECT array_agg(DISTINCT c.client_chat_id) INTO v_clients
+        FROM old_rows o
+        JOIN new_rows n ON n.id = o.id
+        CROSS JOIN LATERAL (VALUES (o.client_chat_id), (n.client_chat_id)) AS c(client_chat_id)
+        WHERE (o.client_chat_id, o.partner_chat_id, o.date_time, o.operation_type,
+               o.total_amount, o.earned_points, o.spent_points)
+              IS DISTINCT FROM
+              (n.client_chat_id, n.partner_chat_id, n.date_time, n.operation_type,
+               n.total_amount, n.earned_points, n.spent_points)
+          AND c.client_chat_id IS NOT NULL
+          AND c.client_chat_id <> 'DELETED_USER';
+    END IF;
+
+    IF v_clients IS NOT NULL THEN
+        PERFORM rebuild_client_stats_for(v_clients);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- Таблицы переходов несовместимы со списком колонок и несколькими событиями — по триггеру на событие
+DROP TRIGGER IF EXISTS trigger_maintain_client_stats ON transactions;
+CREATE TRIGGER trigger_maintain_client_stats
+    AFTER INSERT ON transactions
+    FOR EACH ROW
+    EXECUTE FUNCTION maintain_client_stats();
+
+DROP TRIGGER IF EXISTS trigger_client_stats_after_update ON transactions;
+CREATE TRIGGER trigger_client_stats_after_update
+    AFTER UPDATE ON transactions
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION refresh_client_stats_after_change();
+
+DROP TRIGGER IF EXISTS trigger_client_stats_after_delete ON transactions;
+CREATE TRIGGER trigger_client_stats_after_delete
+    AFTER DELETE ON transactions
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION refresh_client_stats_after_change();
+
+-- Первичное заполнение
+SELECT public.rebuild_client_stats();
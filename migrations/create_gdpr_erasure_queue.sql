@@ -0,0 +1,77 @@
+-- ============================================
+-- GDPR: очередь удаления данных пользователей и пакетное удаление
+-- Дата: 2026-10-19
+-- ============================================
+-- Массовые запросы на удаление (например, закрытие партнёра с тысячами клиентов)
+-- ставятся в gdpr_erasure_requests и обрабатываются пачками.
+-- erase_user_data_batch выполняет все шаги для пачки в одной транзакции:
+-- либо пачка удалена целиком, либо ничего не изменилось и её можно повторить.
+
+CREATE TABLE IF NOT EXISTS gdpr_erasure_requests (
+    chat_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'completed')),
+    requested_by TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    requested_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    completed_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_gdpr_erasure_requests_pending
+    ON gdpr_erasure_requests (chat_id)
+    WHERE status = 'pending';
+
+COMMENT ON TABLE gdpr_erasure_requests IS 'Очередь GDPR-удаления: статус и попытки по каждому пользователю';
+
+ALTER TABLE gdpr_erasure_requests ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Service role can do everything" ON gdpr_erasure_requests;
+CREATE POLICY "Service role can do everything"
+    ON gdpr_erasure_requests FOR ALL
+    TO service_role
+    USING (true)
+    WITH CHECK (true);
+
+-- Индексы для set-based шагов по chat_id
+CREATE INDEX IF NOT EXISTS idx_services_partner_chat_id ON services (partner_chat_id);
+CREATE INDEX IF NOT EXISTS idx_promotions_partner_chat_id ON promotions (partner_chat_id);
+CREATE INDEX IF NOT EXISTS idx_transactions_client_chat_id ON transactions (client_chat_id);
+CREATE INDEX IF NOT EXISTS idx_transactions_partner_chat_id ON transactions (partner_chat_id);
+CREATE INDEX IF NOT EXISTS idx_partner_applications_chat_id ON partner_applications (chat_id);
+
+
+-- Удаляет/анонимизирует данные пачки пользователей в порядке зависимостей.
+-- Возвращает статус по таблицам в формате delete_user_data.
+CREATE OR REPLACE FUNCTION public.erase_user_data_batch(
+    p_chat_ids TEXT[]
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    DELETE FROM services WHERE partner_chat_id = ANY(p_chat_ids);
+    DELETE FROM promotions WHERE partner_chat_id = ANY(p_chat_ids);
+
+    UPDATE transactions
+    SET client_chat_id = 'DELETED_USER',
+        description = 'User data deleted per GDPR request'
+    WHERE client_chat_id = ANY(p_chat_ids);
+
+    UPDATE transactions
+    SET partner_chat_id = 'DELETED_USER'
+    WHERE partner_chat_id = ANY(p_chat_ids);
+
+    DELETE FROM partner_applications WHERE chat_id = ANY(p_chat_ids);
+    DELETE FROM partners WHERE chat_id = ANY(p_chat_ids);
+    DELETE FROM clients WHERE chat_id = ANY(p_chat_ids);
+
+    RETURN jsonb_build_object(
+        'services', 'deleted',
+        'promotions', 'deleted',
+        'transactions', 'anonymized',
+        'partner_applications', 'deleted',
+        'partners', 'deleted',
+        'clients', 'deleted'
+    );
+END;
+$$;
@@ -0,0 +1,203 @@
+-- ============================================
+-- Сообщения: счётчики непрочитанных по паре (получатель, собеседник)
+-- Дата: 2026-10-19
+-- ============================================
+-- Счётчики поддерживаются триггером на messages (вставка, изменение is_read,
+-- удаление), поэтому учитываются записи и из бота, и из Cloudflare Workers.
+-- reconcile_message_unread_counters() пересчитывает их по таблице messages.
+
+CREATE TABLE IF NOT EXISTS message_unread_counters (
+    recipient_type TEXT NOT NULL CHECK (recipient_type IN ('client', 'partner')),
+    recipient_chat_id TEXT NOT NULL,
+    counterpart_chat_id TEXT NOT NULL,
+    unread_count INTEGER NOT NULL DEFAULT 0 CHECK (unread_count >= 0),
+    updated_at TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (recipient_type, recipient_chat_id, counterpart_chat_id)
+);
+
+COMMENT ON TABLE message_unread_counters IS 'Количество непрочитанных сообщений для получателя от конкретного собеседника';
+COMMENT ON COLUMN message_unread_counters.recipient_type IS 'Кто читает: client или partner';
+COMMENT ON COLUMN message_unread_counters.counterpart_chat_id IS 'Chat ID отправителя (партнёр для клиента, клиент для партнёра)';
+
+ALTER TABLE message_unread_counters ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Service role can do everything" ON message_unread_counters;
+CREATE POLICY "Service role can do everything"
+    ON message_unread_counters FOR ALL
+    TO service_role
+    USING (true)
+    WITH CHECK (true);
+
+
+-- Применяет изменение счётчика для получателя сообщения
+CREATE OR REPLACE FUNCTION public.apply_message_unread_delta(
+    p_message messages,
+    p_delta INTEGER
+)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_recipient_type TEXT;
+    v_recipient TEXT;
+    v_counterpart TEXT;
+BEGIN
+    IF p_message.sender_type = 'client' THEN
+        v_recipient_type := 'partner';
+        v_recipient := p_message.partner_chat_id;
+        v_counterpart := p_message.client_chat_id;
+    ELSE
+        v_recipient_type := 'client';
+        v_recipient := p_message.client_chat_id;
+        v_counterpart := p_message.partner_chat_id;
+    END IF;
+
+    INSERT INTO message_unread_counters AS c (
+        recipient_type, recipient_chat_id, counterpart_chat_id, unread_count, updated_at
+    )
+    VALUES (v_recipient_type, v_recipient, v_counterpart, GREATEST(p_delta, 0), NOW())
+    ON CONFLICT (recipient_type, recipient_chat_id, counterpart_chat_id) DO UPDATE
+    SET
+        unread_count = GREATEST(c.unread_count + p_delta, 0),
+        updated_at = NOW();
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION public.maintain_message_unread_counters()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        IF COALESCE(NEW.is_read, FALSE) = FALSE THEN
+            PERFORM apply_message_unread_delta(NEW, 1);
+        END IF;
+        RETURN NEW;
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF COALESCE(OLD.is_read, FALSE) = FALSE AND NEW.is_read = TRUE THEN
+            PERFORM apply_message_unread_delta(NEW, -1);
+        ELSIF OLD.is_read = TRUE AND COALESCE(NEW.is_read, FALSE) = FALSE THEN
+            PERFORM apply_message_unread_delta(NEW, 1);
+        END IF;
+        RETURN NEW;
+    ELSIF TG_OP = 'DELETE' THEN
+        IF COALESCE(OLD.is_read, FALSE) = FALSE THEN
+            PERFORM apply_message_unread_delta(OLD, -1);
+        END IF;
+        RETURN OLD;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trigger_maintain_message_unread_counters ON messages;
+CREATE TRIGGER trigger_maintain_message_unread_counters
+    AFTER INSERT OR UPDATE OF is_read OR DELETE ON messages
+    FOR EACH ROW
+    EXECUTE FUNCTION maintain_message_unread_counters();
+
+
+-- Пересчитывает счётчики по таблице messages (сверка после сбоев и ручных правок).
+-- p_recipient_chat_id ограничивает пересчёт одним получателем.
+CREATE OR REPLACE FUNCTION public.reconcile_message_unread_counters(
+    p_recipient_chat_id TEXT DEFAULT NULL
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_rows INTEGER := 0;
+BEGIN
+    WITH actual AS (
+        SELECT
+            CASE WHEN m.sender_type = 'client' THEN 'partner' ELSE 'client' END AS recipient_type,
+            CASE WHEN m.sender_type = 'client' THEN m.partner_chat_id ELSE m.client_chat_id END AS recipient_chat_id,
+            CASE WHEN m.sender_type = 'client' THEN m.client_chat_id ELSE m.partner_chat_id END AS counterpart_chat_id,
+            COUNT(*)::INT AS unread_count
+        FROM messages m
+        WHERE m.is_read = FALSE
+        GROUP BY 1, 2, 3
+    ),
+    scoped AS (
+        SELECT * FROM actual
+        WHERE p_recipient_chat_id IS NULL OR recipient_chat_id = p_recipient_chat_id
+    ),
+    zeroed AS (
+        UPDATE message_unread_counters c
+        SET unread_count = 0, updated_at = NOW()
+        WHERE (p_recipient_chat_id IS NULL OR c.recipient_chat_id = p_recipient_chat_id)
+          AND c.unread_count <> 0
+          AND NOT EXISTS (
+              SELECT 1 FROM scoped s
+              WHERE s.recipient_type = c.recipient_type
+                AND s.recipient_chat_id = c.recipient_chat_id
+                AND s.counterpart_chat_id = c.counterpart_chat_id
+          )
+        RETURNING 1
+    ),
+    upserted AS (
+        INSERT INTO message_unread_counters (
+            recipient_type, recipient_chat_id, counterpart_chat_id, unread_count, updated_at
+        )
+        SELECT s.recipient_type, s.recipient_chat_id, s.counterpart_chat_id, s.unread_count, NOW()
+        FROM scoped s
+        ON CONFLICT (recipient_type, recipient_chat_id, counterpart_chat_id) DO UPDATE
+        SET unread_count = EXCLUDED.unread_count, updated_at = NOW()
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM zeroed) + (SELECT COUNT(*) FROM upserted) INTO v_rows;
+
+    RETURN v_rows;
+END;
+$$;
+
+-- Первичное заполнение
+SELECT public.reconcile_message_unread_counters();
+
+
+-- Список переписок партнёра берёт непрочитанные из счётчиков вместо GROUP BY по messages
+CREATE OR REPLACE FUNCTION public.get_partner_conversations_page(
+    p_partner_chat_id TEXT,
+    p_limit INTEGER DEFAULT 50,
+    p_before_activity_at TIMESTAMPTZ DEFAULT NULL,
+    p_before_client_chat_id TEXT DEFAULT NULL
+)
+RETURNS TABLE (
+    client_chat_id TEXT,
+    last_message JSONB,
+    last_activity_at TIMESTAMPTZ,
+    unread_count INTEGER
+)
+LANGUAGE sql
+STABLE
+AS $$
+WITH last_messages AS (
+    SELECT DISTINCT ON (m.client_chat_id)
+        m.client_chat_id,
+        to_jsonb(m) AS last_message,
+        m.created_at AS last_activity_at
+    FROM messages m
+    WHERE m.partner_chat_id = p_partner_chat_id
+    ORDER BY m.client_chat_id, m.created_at DESC, m.id DESC
+),
+page AS (
+    SELECT lm.*
+    FROM last_messages lm
+    WHERE p_before_activity_at IS NULL
+       OR (lm.last_activity_at, lm.client_chat_id) < (p_before_activity_at, COALESCE(p_before_client_chat_id, ''))
+    ORDER BY lm.last_activity_at DESC, lm.client_chat_id DESC
+    LIMIT LEAST(GREATEST(p_limit, 1), 200)
+)
+SELECT
+    pg.client_chat_id,
+    pg.last_message,
+    pg.last_activity_at,
+    COALESCE(c.unread_count, 0) AS unread_count
+FROM page pg
+LEFT JOIN message_unread_counters c
+    ON c.recipient_type = 'partner'
+   AND c.recipient_chat_id = p_partner_chat_id
+   AND c.counterpart_chat_id = pg.client_chat_id
+ORDER BY pg.last_activity_at DESC, pg.client_chat_id DESC;
+$$;
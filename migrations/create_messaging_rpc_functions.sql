@@ -0,0 +1,66 @@
+-- ============================================
+-- Сообщения: RPC-функции для списка переписок партнёра
+-- Дата: 2026-10-19
+-- ============================================
+
+-- Индекс под выборку «последнее сообщение по каждому клиенту партнёра»
+CREATE INDEX IF NOT EXISTS idx_messages_partner_client_created
+    ON messages(partner_chat_id, client_chat_id, created_at DESC, id DESC);
+
+
+-- 1) get_partner_conversations_page()
+-- Возвращает страницу переписок партнёра за один запрос:
+--  - последнее сообщение по каждому клиенту (DISTINCT ON)
+--  - количество непрочитанных сообщений от клиента (GROUP BY)
+-- Пагинация по курсору (last_activity_at, client_chat_id), от новых к старым.
+
+CREATE OR REPLACE FUNCTION public.get_partner_conversations_page(
+    p_partner_chat_id TEXT,
+    p_limit INTEGER DEFAULT 50,
+    p_before_activity_at TIMESTAMPTZ DEFAULT NULL,
+    p_before_client_chat_id TEXT DEFAULT NULL
+)
+RETURNS TABLE (
+    client_chat_id TEXT,
+    last_message JSONB,
+    last_activity_at TIMESTAMPTZ,
+    unread_count INTEGER
+)
+LANGUAGE sql
+STABLE
+AS $$
+WITH last_messages AS (
+    SELECT DISTINCT ON (m.client_chat_id)
+        m.client_chat_id,
+        to_jsonb(m) AS last_message,
+        m.created_at AS last_activity_at
+    FROM messages m
+    WHERE m.partner_chat_id = p_partner_chat_id
+    ORDER BY m.client_chat_id, m.created_at DESC, m.id DESC
+),
+page AS (
+    SELECT lm.*
+    FROM last_messages lm
+    WHERE p_before_activity_at IS NULL
+       OR (lm.last_activity_at, lm.client_chat_id) < (p_before_activity_at, COALESCE(p_before_client_chat_id, ''))
+    ORDER BY lm.last_activity_at DESC, lm.client_chat_id DESC
+    LIMIT LEAST(GREATEST(p_limit, 1), 200)
+),
+unread AS (
+    SELECT m.client_chat_id, COUNT(*)::INT AS unread_count
+    FROM messages m
+    WHERE m.partner_chat_id = p_partner_chat_id
+      AND m.sender_type = 'client'
+      AND m.is_read = FALSE
+      AND m.client_chat_id IN (SELECT pg.client_chat_id FROM page pg)
+    GROUP BY m.client_chat_id
+)
+SELECT
+    pg.client_chat_id,
+    pg.last_message,
+    pg.last_activity_at,
+    COALESCE(u.unread_count, 0) AS unread_count
+FROM page pg
+LEFT JOIN unread u ON u.client_chat_id = pg.client_chat_id
+ORDER BY pg.last_activity_at DESC, pg.client_chat_id DESC;
+$$;
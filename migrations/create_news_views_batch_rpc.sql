@@ -0,0 +1,38 @@
+-- ============================================
+-- Новости: пакетный атомарный инкремент просмотров
+-- Дата: 2026-10-19
+-- ============================================
+-- Бот копит просмотры в памяти и периодически отправляет их одним вызовом:
+-- p_views = [{"news_id": 1, "delta": 15}, ...]. Инкремент выполняется в UPDATE,
+-- поэтому параллельные вызовы не теряют просмотры. Неизвестные news_id и
+-- неположительные delta отбрасываются: обновляются только существующие новости.
+
+CREATE OR REPLACE FUNCTION public.increment_news_views_batch(
+    p_views JSONB
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_rows INTEGER := 0;
+BEGIN
+    WITH deltas AS (
+        SELECT
+            (e->>'news_id')::BIGINT AS news_id,
+            SUM((e->>'delta')::INTEGER) AS delta
+        FROM jsonb_array_elements(COALESCE(p_views, '[]'::jsonb)) AS e
+        WHERE (e->>'delta')::INTEGER > 0
+        GROUP BY 1
+    ),
+    updated AS (
+        UPDATE news n
+        SET views_count = COALESCE(n.views_count, 0) + d.delta
+        FROM deltas d
+        WHERE n.id = d.news_id
+        RETURNING 1
+    )
+    SELECT COUNT(*) INTO v_rows FROM updated;
+
+    RETURN v_rows;
+END;
+$$;
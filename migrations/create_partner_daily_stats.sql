@@ -0,0 +1,386 @@
+-- ============================================
+-- Аналитика партнёра: дневные агрегаты
+-- Дата: 2026-10-19
+-- ============================================
+-- partner_daily_stats   — итоги по (партнёр, день, валюта)
+-- partner_daily_clients — клиент × день × валюта (уникальные клиенты и повторные визиты за период)
+-- partner_daily_nps     — оценки NPS по (партнёр, день)
+--
+-- Агрегаты поддерживаются триггерами на transactions и nps_ratings, поэтому учитываются
+-- записи и из бота, и из Cloudflare Workers. День — дата в UTC.
+-- rebuild_partner_daily_stats() пересчитывает их по исходным таблицам.
+-- Колонка id нужна только для постраничного чтения (курсор в PostgREST).
+
+CREATE TABLE IF NOT EXISTS partner_daily_stats (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY UNIQUE,
+    partner_chat_id TEXT NOT NULL,
+    stat_date DATE NOT NULL,
+    currency TEXT NOT NULL DEFAULT 'USD',
+    revenue NUMERIC(14,2) NOT NULL DEFAULT 0,
+    points_accrued NUMERIC(14,2) NOT NULL DEFAULT 0,
+    points_spent NUMERIC(14,2) NOT NULL DEFAULT 0,
+    transactions_count INTEGER NOT NULL DEFAULT 0,
+    accrual_count INTEGER NOT NULL DEFAULT 0,
+    redemption_count INTEGER NOT NULL DEFAULT 0,
+    unique_clients INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (partner_chat_id, stat_date, currency)
+);
+
+COMMENT ON TABLE partner_daily_stats IS 'Дневные итоги партнёра по валютам (обновляются триггером на transactions)';
+COMMENT ON COLUMN partner_daily_stats.revenue IS 'Сумма total_amount начислений (accrual)';
+COMMENT ON COLUMN partner_daily_stats.points_accrued IS 'earned_points начислений и приветственных бонусов';
+COMMENT ON COLUMN partner_daily_stats.points_spent IS 'spent_points списаний (redemption)';
+COMMENT ON COLUMN partner_daily_stats.unique_clients IS 'Уникальные клиенты за день в этой валюте';
+
+CREATE TABLE IF NOT EXISTS partner_daily_clients (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY UNIQUE,
+    partner_chat_id TEXT NOT NULL,
+    stat_date DATE NOT NULL,
+    currency TEXT NOT NULL DEFAULT 'USD',
+    client_chat_id TEXT NOT NULL,
+    transactions_count INTEGER NOT NULL DEFAULT 0,
+    accrual_count INTEGER NOT NULL DEFAULT 0,
+    revenue NUMERIC(14,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (partner_chat_id, stat_date, currency, client_chat_id)
+);
+
+COMMENT ON TABLE partner_daily_clients IS 'Транзакции клиента у партнёра за день (уникальные и вернувшиеся клиенты за период)';
+
+CREATE TABLE IF NOT EXISTS partner_daily_nps (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY UNIQUE,
+    partner_chat_id TEXT NOT NULL,
+    stat_date DATE NOT NULL,
+    ratings_count INTEGER NOT NULL DEFAULT 0,
+    ratings_sum INTEGER NOT NULL DEFAULT 0,
+    promoters INTEGER NOT NULL DEFAULT 0,
+    passives INTEGER NOT NULL DEFAULT 0,
+    detractors INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (partner_chat_id, stat_date)
+);
+
+COMMENT ON TABLE partner_daily_nps IS 'Оценки NPS партнёра за день: промоутеры >= 9, нейтральные 7-8, детракторы <= 6';
+
+ALTER TABLE partner_daily_stats ENABLE ROW LEVEL SECURITY;
+ALTER TABLE partner_daily_clients ENABLE ROW LEVEL SECURITY;
+ALTER TABLE partner_daily_nps ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Service role can do everything" ON partner_daily_stats;
+CREATE POLICY "Service role can do everything" ON partner_daily_stats FOR ALL TO service_role USING (true) WITH CHECK (true);
+DROP POLICY IF EXISTS "Service role can do everything" ON partner_daily_clients;
+CREATE POLICY "Service role can do everything" ON partner_daily_clients FOR ALL TO service_role USING (true) WITH CHECK (true);
+DROP POLICY IF EXISTS "Service role can do everything" ON partner_daily_nps;
+CREATE POLICY "Service role can do everything" ON partner_daily_nps FOR ALL TO service_role USING (true) WITH CHECK (true);
+
+
+-- Ревизия данных дашбордов партнёра: растёт при UPDATE/DELETE транзакций и оценок NPS.
+-- Новые записи видны в водяном знаке кеша дашбордов по последнему id, а изменения
+-- и удаления старых записей — только по ревизии.
+CREATE TABLE IF NOT EXISTS partner_stats_revisions (
+    partner_chat_id TEXT PRIMARY KEY,
+    revision BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+COMMENT ON TABLE partner_stats_revisions IS 'Ревизия данных дашбордов партнёра (UPDATE/DELETE в transactions и nps_ratings) для сброса кеша';
+
+ALTER TABLE partner_stats_revisions ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Service role can do everything" ON partner_stats_revisions;
+CREATE POLICY "Service role can do everything" ON partner_stats_revisions FOR ALL TO service_role USING (true) WITH CHECK (true);
+
+CREATE OR REPLACE FUNCTION public.bump_partner_stats_revision(
+    p_partner_chat_id TEXT
+)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF p_partner_chat_id IS NULL THEN
+        RETURN;
+    END IF;
+    INSERT INTO partner_stats_revisions AS r (partner_chat_id, revision, updated_at)
+    VALUES (p_partner_chat_id, 1, NOW())
+    ON CONFLICT (partner_chat_id) DO UPDATE
+    SET revision = r.revision + 1, updated_at = NOW();
+END;
+$$;
+
+-- Применяет вклад одной транзакции (p_sign = 1 при вставке, -1 при удалении)
+CREATE OR REPLACE FUNCTION public.apply_partner_daily_delta(
+    p_txn transactions,
+    p_sign INTEGER
+)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_day DATE;
+    v_currency TEXT := COALESCE(p_txn.currency, 'USD');
+    v_is_accrual INTEGER := CASE WHEN p_txn.operation_type = 'accrual' THEN 1 ELSE 0 END;
+    v_revenue NUMERIC := CASE WHEN p_txn.operation_type = 'accrual' THEN COALESCE(p_txn.total_amount, 0) ELSE 0 END;
+    v_points_accrued NUMERIC := CASE WHEN p_txn.operation_type IN ('accrual', 'enrollment_bonus') THEN COALESCE(p_txn.earned_points, 0) ELSE 0 END;
+    v_points_spent NUMERIC := CASE WHEN p_txn.operation_type = 'redemption' THEN COALESCE(p_txn.spent_points, 0) ELSE 0 END;
+    v_client_txns INTEGER;
+    v_client_delta INTEGER := 0;
+BEGIN
+    IF p_txn.partner_chat_id IS NULL OR p_txn.date_time IS NULL THEN
+        RETURN;
+    END IF;
+    v_day := (p_txn.date_time::timestamptz AT TIME ZONE 'UTC')::date;
+
+    IF p_txn.client_chat_id IS NOT NULL THEN
+        INSERT INTO partner_daily_clients AS c (
+            partner_chat_id, stat_date, currency, client_chat_id, transactions_count, accrual_count, revenue
+        )
+        VALUES (
+            p_txn.partner_chat_id, v_day, v_currency, p_txn.client_chat_id,
+            p_sign, p_sign * v_is_accrual, p_sign * v_revenue
+        )
+        ON CONFLICT (partner_chat_id, stat_date, currency, client_chat_id) DO UPDATE
+        SET
+            transactions_count = c.transactions_count + EXCLUDED.transactions_count,
+            accrual_count = c.accrual_count + EXCLUDED.accrual_count,
+            revenue = c.revenue + EXCLUDED.revenue
+        RETURNING transactions_count INTO v_client_txns;
+
+        -- Первая транзакция клиента за день добавляет уникального клиента, удаление последней — убирает
+        IF p_sign > 0 AND v_client_txns = 1 THEN
+            v_client_delta := 1;
+        ELSIF p_sign < 0 AND v_client_txns <= 0 THEN
+            DELETE FROM partner_daily_clients
+            WHERE partner_chat_id = p_txn.partner_chat_id
+              AND stat_date = v_day
+              AND currency = v_currency
+              AND client_chat_id = p_txn.client_chat_id;
+            v_client_delta := -1;
+        END IF;
+    END IF;
+
+    INSERT INTO partner_daily_stats AS s (
+        partner_chat_id, stat_date, currency, revenue, points_accrued, points_spent,
+        transactions_count, accrual_count, redemption_count, unique_clients, updated_at
+    )
+    VALUES (
+        p_txn.partner_chat_id, v_day, v_currency,
+        p_sign * v_revenue, p_sign * v_points_accrued, p_sign * v_points_spent,
+        p_sign, p_sign * v_is_accrual,
+        p_sign * CASE WHEN p_txn.operation_type = 'redemption' THEN 1 ELSE 0 END,
+        v_client_delta, NOW()
+    )
+    ON CONFLICT (partner_chat_id, stat_date, currency) DO UPDATE
+    SET
+        revenue = s.revenue + EXCLUDED.revenue,
+        points_accrued = s.points_accrued + EXCLUDED.points_accrued,
+        points_spent = s.points_spent + EXCLUDED.points_spent,
+        transactions_count = s.transactions_count + EXCLUDED.transactions_count,
+        accrual_count = s.accrual_count + EXCLUDED.accrual_count,
+        redemption_count = s.redemption_count + EXCLUDED.redemption_count,
+        unique_clients = GREATEST(s.unique_clients + EXCLUDED.unique_clients, 0),
+        updated_at = NOW();
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION public.maintain_partner_daily_stats()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM apply_partner_daily_delta(OLD, -1);
+        -- Изменение старой записи не двигает последний id: сбрасываем кеш дашбордов ревизией
+        PERFORM bump_partner_stats_revision(OLD.partner_chat_id);
+        IF TG_OP = 'UPDATE' AND NEW.partner_chat_id IS DISTINCT FROM OLD.partner_chat_id THEN
+            PERFORM bump_partner_stats_revision(NEW.partner_chat_id);
+        END IF;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM apply_partner_daily_delta(NEW, 1);
+        RETURN NEW;
+    END IF;
+    RETURN OLD;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trigger_maintain_partner_daily_stats ON transactions;
+CREATE TRIGGER trigger_maintain_partner_daily_stats
+    AFTER INSERT OR DELETE OR UPDATE OF partner_chat_id, client_chat_id, date_time, currency,
+        operation_type, total_amount, earned_points, spent_points
+    ON transactions
+    FOR EACH ROW
+    EXECUTE FUNCTION maintain_partner_daily_stats();
+
+
+CREATE OR REPLACE FUNCTION public.apply_partner_daily_nps_delta(
+    p_rating nps_ratings,
+    p_sign INTEGER
+)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF p_rating.partner_chat_id IS NULL OR p_rating.rating IS NULL OR p_rating.created_at IS NULL THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO partner_daily_nps AS n (
+        partner_chat_id, stat_date, ratings_count, ratings_sum, promoters, passives, detractors
+    )
+    VALUES (
+        p_rating.partner_chat_id,
+        (p_rating.created_at::timestamptz AT TIME ZONE 'UTC')::date,
+        p_sign,
+        p_sign * p_rating.rating,
+        p_sign * CASE WHEN p_rating.rating >= 9 THEN 1 ELSE 0 END,
+        p_sign * CASE WHEN p_rating.rating IN (7, 8) THEN 1 ELSE 0 END,
+        p_sign * CASE WHEN p_rating.rating <= 6 THEN 1 ELSE 0 END
+    )
+    ON CONFLICT (partner_chat_id, stat_date) DO UPDATE
+    SET
+        ratings_count = n.ratings_count + EXCLUDED.ratings_count,
+        ratings_sum = n.ratings_sum + EXCLUDED.ratings_sum,
+        promoters = n.promoters + EXCLUDED.promoters,
+        passives = n.passives + EXCLUDED.passives,
+        detractors = n.detractors + EXCLUDED.detractors;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION public.maintain_partner_daily_nps()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM apply_partner_daily_nps_delta(OLD, -1);
+        -- Изменение старой записи не двигает последний id: сбрасываем кеш дашбордов ревизией
+        PERFORM bump_partner_stats_revision(OLD.partner_chat_id);
+        IF TG_OP = 'UPDATE' AND NEW.partner_chat_id IS DISTINCT FROM OLD.partner_chat_id THEN
+            PERFORM bump_partner_stats_revision(NEW.partner_chat_id);
+        END IF;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM apply_partner_daily_nps_delta(NEW, 1);
+        RETURN NEW;
+    END IF;
+    RETURN OLD;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trigger_maintain_partner_daily_nps ON nps_ratings;
+CREATE TRIGGER trigger_maintain_partner_daily_nps
+    AFTER INSERT OR DELETE OR UPDATE OF partner_chat_id, rating, created_at
+    ON nps_ratings
+    FOR EACH ROW
+    EXECUTE FUNCTION maintain_partner_daily_nps();
+
+
+-- Пересчитывает агрегаты по transactions и nps_ratings (первичное заполнение,
+-- сверка после сбоев и ручных правок). Все параметры необязательны:
+-- p_partner_chat_id — один партнёр, p_from / p_to — дни включительно (UTC).
+CREATE OR REPLACE FUNCTION public.rebuild_partner_daily_stats(
+    p_partner_chat_id TEXT DEFAULT NULL,
+    p_from DATE DEFAULT NULL,
+    p_to DATE DEFAULT NULL
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_from TIMESTAMPTZ := CASE WHEN p_from IS NULL THEN NULL ELSE p_from::timestamp AT TIME ZONE 'UTC' END;
+    v_to TIMESTAMPTZ := CASE WHEN p_to IS NULL THEN NULL ELSE (p_to + 1)::timestamp AT TIME ZONE 'UTC' END;
+    v_rows INTEGER;
+    v_total INTEGER := 0;
+BEGIN
+    -- Триггеры, пишущие в агрегаты во время пересчёта, ждут его завершения и применяются поверх
+    LOCK TABLE partner_daily_stats, partner_daily_clients, partner_daily_nps IN EXCLUSIVE MODE;
+
+    DELETE FROM partner_daily_clients
+    WHERE (p_partner_chat_id IS NULL OR partner_chat_id = p_partner_chat_id)
+      AND (p_from IS NULL OR stat_date >= p_from)
+      AND (p_to IS NULL OR stat_date <= p_to);
+    DELETE FROM partner_daily_stats
+    WHERE (p_partner_chat_id IS NULL OR partner_chat_id = p_partner_chat_id)
+      AND (p_from IS NULL OR stat_date >= p_from)
+      AND (p_to IS NULL OR stat_date <= p_to);
+    DELETE FROM partner_daily_nps
+    WHERE (p_partner_chat_id IS NULL OR partner_chat_id = p_partner_chat_id)
+      AND (p_from IS NULL OR stat_date >= p_from)
+      AND (p_to IS NULL OR stat_date <= p_to);
+
+    CREATE TEMP TABLE _partner_daily_txn ON COMMIT DROP AS
+    SELECT
+        t.partner_chat_id,
+        (t.date_time::timestamptz AT TIME ZONE 'UTC')::date AS stat_date,
+        COALESCE(t.currency, 'USD') AS currency,
+        t.client_chat_id,
+        t.operation_type,
+        CASE WHEN t.operation_type = 'accrual' THEN COALESCE(t.total_amount, 0) ELSE 0 END AS revenue,
+        CASE WHEN t.operation_type IN ('accrual', 'enrollment_bonus') THEN COALESCE(t.earned_points, 0) ELSE 0 END AS points_accrued,
+        CASE WHEN t.operation_type = 'redemption' THEN COALESCE(t.spent_points, 0) ELSE 0 END AS points_spent
+    FROM transactions t
+    WHERE t.partner_chat_id IS NOT NULL
+      AND t.date_time IS NOT NULL
+      AND (p_partner_chat_id IS NULL OR t.partner_chat_id = p_partner_chat_id)
+      AND (v_from IS NULL OR t.date_time::timestamptz >= v_from)
+      AND (v_to IS NULL OR t.date_time::timestamptz < v_to);
+
+    INSERT INTO partner_daily_clients (
+        partner_chat_id, stat_date, currency, client_chat_id, transactions_count, accrual_count, revenue
+    )
+    SELECT
+        partner_chat_id, stat_date, currency, client_chat_id,
+        COUNT(*),
+        COUNT(*) FILTER (WHERE operation_type = 'accrual'),
+        SUM(revenue)
+    FROM _partner_daily_txn
+    WHERE client_chat_id IS NOT NULL
+    GROUP BY partner_chat_id, stat_date, currency, client_chat_id;
+    GET DIAGNOSTICS v_rows = ROW_COUNT;
+    v_total := v_total + v_rows;
+
+    INSERT INTO partner_daily_stats (
+        partner_chat_id, stat_date, currency, revenue, points_accrued, points_spent,
+        transactions_count, accrual_count, redemption_count, unique_clients, updated_at
+    )
+    SELECT
+        partner_chat_id, stat_date, currency,
+        SUM(revenue), SUM(points_accrued), SUM(points_spent),
+        COUNT(*),
+        COUNT(*) FILTER (WHERE operation_type = 'accrual'),
+        COUNT(*) FILTER (WHERE operation_type = 'redemption'),
+        COUNT(DISTINCT client_chat_id),
+        NOW()
+    FROM _partner_daily_txn
+    GROUP BY partner_chat_id, stat_date, currency;
+    GET DIAGNOSTICS v_rows = ROW_COUNT;
+    v_total := v_total + v_rows;
+
+    INSERT INTO partner_daily_nps (
+        partner_chat_id, stat_date, ratings_count, ratings_sum, promoters, passives, detractors
+    )
+    SELECT
+        n.partner_chat_id,
+        (n.created_at::timestamptz AT TIME ZONE 'UTC')::date,
+        COUNT(*),
+        SUM(n.rating),
+        COUNT(*) FILTER (WHERE n.rating >= 9),
+        COUNT(*) FILTER (WHERE n.rating IN (7, 8)),
+        COUNT(*) FILTER (WHERE n.rating <= 6)
+    FROM nps_ratings n
+    WHERE n.partner_chat_id IS NOT NULL
+      AND n.rating IS NOT NULL
+      AND n.created_at IS NOT NULL
+      AND (p_partner_chat_id IS NULL OR n.partner_chat_id = p_partner_chat_id)
+      AND (v_from IS NULL OR n.created_at::timestamptz >= v_from)
+      AND (v_to IS NULL OR n.created_at::timestamptz < v_to)
+    GROUP BY 1, 2;
+    GET DIAGNOSTICS v_rows = ROW_COUNT;
+    v_total := v_total + v_rows;
+
+    RETURN v_total;
+END;
+$$;
+
+-- Первичное заполнение
+SELECT public.rebuild_partner_daily_stats();
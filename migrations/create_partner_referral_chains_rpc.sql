@@ -0,0 +1,46 @@
+-- ============================================
+-- Сеть партнеров: цепочки пригласивших одним запросом
+-- Дата: 2026-10-19
+-- ============================================
+-- approve_partner / approve_partners строят partner_network уровней 1-3 для всех
+-- одобренных партнеров сразу: get_partner_referral_chains возвращает цепочки
+-- пригласивших (по partners.referred_by_chat_id) для массива chat_id одним вызовом,
+-- а связи пишутся одним upsert ... ON CONFLICT (referrer_chat_id, referred_chat_id) DO NOTHING.
+-- Без функции код делает по одному запросу к partners на уровень.
+
+-- Цепочка для каждого chat_id: depth = 0 — сам партнер, 1 — пригласивший, ...
+-- В цепочку попадают только существующие партнеры; цикл обрывается.
+CREATE OR REPLACE FUNCTION get_partner_referral_chains(
+    p_chat_ids TEXT[],
+    p_depth INTEGER DEFAULT 3
+)
+RETURNS TABLE (chat_id TEXT, ancestor_chat_id TEXT, depth INTEGER)
+LANGUAGE sql
+STABLE
+AS $$
+    WITH RECURSIVE chains AS (
+        SELECT p.chat_id AS chat_id,
+               p.chat_id AS ancestor_chat_id,
+               p.referred_by_chat_id AS next_chat_id,
+               0 AS depth,
+               ARRAY[p.chat_id] AS path
+        FROM partners p
+        WHERE p.chat_id = ANY(p_chat_ids)
+        UNION ALL
+        SELECT c.chat_id,
+               p.chat_id,
+               p.referred_by_chat_id,
+               c.depth + 1,
+               c.path || p.chat_id
+        FROM chains c
+        JOIN partners p ON p.chat_id = c.next_chat_id
+        WHERE c.depth + 1 < p_depth
+          AND NOT p.chat_id = ANY(c.path)
+    )
+    SELECT chains.chat_id, chains.ancestor_chat_id, chains.depth
+    FROM chains
+    ORDER BY chains.chat_id, chains.depth;
+$$;
+
+COMMENT ON FUNCTION get_partner_referral_chains(TEXT[], INTEGER) IS 'Цепочки пригласивших партнеров (до p_depth звеньев, включая самого партнера) для построения partner_network';
+
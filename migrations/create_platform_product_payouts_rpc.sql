@@ -0,0 +1,140 @@
+-- ============================================
+-- Платформенные продукты: агрегация выплат партнёрам одним вызовом
+-- Дата: 2026-10-19
+-- ============================================
+-- aggregate_platform_product_payouts() за одну транзакцию привязывает визиты периода
+-- с payout_status='not_processed' к draft batch и пересчитывает partner_payout_items
+-- группировкой по всем визитам batch — вместо INSERT на партнёра и UPDATE на каждый визит.
+-- Повторный запуск за тот же период дополняет существующий draft batch; суммы items
+-- считаются заново, поэтому не удваиваются; статус уже существующих items не меняется
+-- (новые создаются в 'pending'). Параллельные запуски за период сериализуются
+-- advisory-блокировкой.
+
+-- Параллельные запуски до этой миграции могли создать несколько draft batch за период:
+-- сливаем их в самый ранний (визиты перепривязываются, items пересчитываются по визитам),
+-- иначе уникальный индекс ниже не создастся
+DO $$
+DECLARE
+    r RECORD;
+    v_keepers BIGINT[] := ARRAY[]::BIGINT[];
+BEGIN
+    FOR r IN
+        SELECT b.id AS duplicate_id, k.keeper_id
+        FROM partner_payout_batches b
+        JOIN (
+            SELECT period_start, period_end, MIN(id) AS keeper_id
+            FROM partner_payout_batches
+            WHERE status = 'draft'
+            GROUP BY period_start, period_end
+            HAVING COUNT(*) > 1
+        ) k ON k.period_start = b.period_start AND k.period_end = b.period_end
+        WHERE b.status = 'draft'
+          AND b.id <> k.keeper_id
+    LOOP
+        UPDATE product_visits SET payout_batch_id = r.keeper_id WHERE payout_batch_id = r.duplicate_id;
+        DELETE FROM partner_payout_batches WHERE id = r.duplicate_id;  -- items удаляются каскадом
+        v_keepers := array_append(v_keepers, r.keeper_id);
+    END LOOP;
+
+    INSERT INTO partner_payout_items (batch_id, partner_chat_id, total_visits, total_payout_amount, currency, status)
+    SELECT
+        v.payout_batch_id,
+        v.partner_chat_id,
+        COUNT(*),
+        ROUND(SUM(v.payout_amount), 2),
+        MIN(v.payout_currency),
+        'pending'
+    FROM product_visits v
+    WHERE v.payout_batch_id = ANY(v_keepers)
+    GROUP BY v.payout_batch_id, v.partner_chat_id
+    ON CONFLICT (batch_id, partner_chat_id) DO UPDATE
+    SET total_visits = EXCLUDED.total_visits,
+        total_payout_amount = EXCLUDED.total_payout_amount,
+        currency = EXCLUDED.currency;
+END;
+$$;
+
+-- Не больше одного draft batch за период
+CREATE UNIQUE INDEX IF NOT EXISTS idx_partner_payout_batches_draft_period
+    ON partner_payout_batches(period_start, period_end)
+    WHERE status = 'draft';
+
+CREATE INDEX IF NOT EXISTS idx_product_visits_payout_batch
+    ON product_visits(payout_batch_id)
+    WHERE payout_batch_id IS NOT NULL;
+
+
+CREATE OR REPLACE FUNCTION public.aggregate_platform_product_payouts(
+    p_period_start DATE,
+    p_period_end DATE
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_batch_id BIGINT;
+    v_visits INTEGER := 0;
+    v_items INTEGER := 0;
+BEGIN
+    PERFORM pg_advisory_xact_lock(
+        hashtext('aggregate_platform_product_payouts'),
+        hashtext(p_period_start::TEXT || ':' || p_period_end::TEXT)
+    );
+
+    SELECT b.id INTO v_batch_id
+    FROM partner_payout_batches b
+    WHERE b.period_start = p_period_start
+      AND b.period_end = p_period_end
+      AND b.status = 'draft'
+    ORDER BY b.id
+    LIMIT 1;
+
+    IF v_batch_id IS NULL THEN
+        IF NOT EXISTS (
+            SELECT 1
+            FROM product_visits v
+            WHERE v.payout_status = 'not_processed'
+              AND v.status = 'confirmed'
+              AND v.visited_at >= p_period_start
+              AND v.visited_at <= p_period_end
+        ) THEN
+            RETURN jsonb_build_object('batch_id', NULL, 'items_count', 0, 'visits_count', 0);
+        END IF;
+
+        INSERT INTO partner_payout_batches (period_start, period_end, status)
+        VALUES (p_period_start, p_period_end, 'draft')
+        RETURNING id INTO v_batch_id;
+    END IF;
+
+    UPDATE product_visits v
+    SET payout_status = 'included_in_batch',
+        payout_batch_id = v_batch_id
+    WHERE v.payout_status = 'not_processed'
+      AND v.status = 'confirmed'
+      AND v.visited_at >= p_period_start
+      AND v.visited_at <= p_period_end;
+    GET DIAGNOSTICS v_visits = ROW_COUNT;
+
+    INSERT INTO partner_payout_items (batch_id, partner_chat_id, total_visits, total_payout_amount, currency, status)
+    SELECT
+        v_batch_id,
+        v.partner_chat_id,
+        COUNT(*),
+        ROUND(SUM(v.payout_amount), 2),
+        MIN(v.payout_currency),
+        'pending'
+    FROM product_visits v
+    WHERE v.payout_batch_id = v_batch_id
+    GROUP BY v.partner_chat_id
+    ON CONFLICT (batch_id, partner_chat_id) DO UPDATE
+    SET total_visits = EXCLUDED.total_visits,
+        total_payout_amount = EXCLUDED.total_payout_amount,
+        currency = EXCLUDED.currency;
+    GET DIAGNOSTICS v_items = ROW_COUNT;
+
+    RETURN jsonb_build_object('batch_id', v_batch_id, 'items_count', v_items, 'visits_count', v_visits);
+END;
+$$;
+
+COMMENT ON FUNCTION public.aggregate_platform_product_payouts(DATE, DATE) IS
+    'Привязывает непроведённые визиты периода к draft batch и пересчитывает строки выплат партнёрам';
@@ -0,0 +1,129 @@
+-- ============================================
+-- Платформенные продукты: допуск и запись визита одним вызовом
+-- Дата: 2026-10-19
+-- ============================================
+-- record_platform_product_visit() проверяет абонемент, партнёра и лимиты и записывает визит
+-- в одной транзакции — вместо проверки из четырёх запросов и повторной проверки перед записью.
+-- Подписка блокируется (FOR UPDATE) до конца транзакции, поэтому одновременные сканирования
+-- одного абонемента выполняются по очереди и не превышают max_visits_total
+-- и visit_limit_per_client. Повторное сканирование у того же партнёра в течение
+-- p_dedup_seconds возвращает уже записанный визит с duplicate = true.
+-- Результат: {"success": bool, "visit": {...} | null, "duplicate": bool, "error": text | null}
+-- Лимит visit_limit_per_client читается из product_visit_counters, и счётчик увеличивается
+-- в той же транзакции: таблицу создаёт create_product_visit_counters.sql (применяется вместе с этой).
+
+CREATE INDEX IF NOT EXISTS idx_product_visits_subscription_partner
+    ON product_visits(subscription_id, partner_chat_id, visited_at)
+    WHERE status = 'confirmed';
+
+
+CREATE OR REPLACE FUNCTION public.record_platform_product_visit(
+    p_client_chat_id TEXT,
+    p_partner_chat_id TEXT,
+    p_product_id BIGINT,
+    p_source TEXT DEFAULT 'bot_manual',
+    p_dedup_seconds INTEGER DEFAULT 0
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_sub client_product_subscriptions%ROWTYPE;
+    v_pp platform_product_partners%ROWTYPE;
+    v_product platform_products%ROWTYPE;
+    v_visit product_visits%ROWTYPE;
+    v_partner_visits INTEGER;
+BEGIN
+    SELECT s.* INTO v_sub
+    FROM client_product_subscriptions s
+    WHERE s.client_chat_id = p_client_chat_id
+      AND s.product_id = p_product_id
+      AND s.status = 'active'
+      AND s.valid_until >= NOW()
+    ORDER BY s.valid_until DESC
+    LIMIT 1
+    FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('success', false, 'visit', NULL, 'duplicate', false,
+                                  'error', 'Нет активного абонемента по этому продукту.');
+    END IF;
+
+    SELECT pp.* INTO v_pp
+    FROM platform_product_partners pp
+    WHERE pp.product_id = p_product_id
+      AND pp.partner_chat_id = p_partner_chat_id
+      AND pp.is_active;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('success', false, 'visit', NULL, 'duplicate', false,
+                                  'error', 'Эта студия не входит в ваш абонемент.');
+    END IF;
+
+    -- Повторное сканирование: отдаём уже записанный визит, даже если он исчерпал лимит
+    IF COALESCE(p_dedup_seconds, 0) > 0 THEN
+        SELECT v.* INTO v_visit
+        FROM product_visits v
+        WHERE v.subscription_id = v_sub.id
+          AND v.partner_chat_id = p_partner_chat_id
+          AND v.status = 'confirmed'
+          AND v.visited_at >= NOW() - make_interval(secs => p_dedup_seconds)
+        ORDER BY v.visited_at DESC
+        LIMIT 1;
+        IF FOUND THEN
+            RETURN jsonb_build_object('success', true, 'visit', to_jsonb(v_visit), 'duplicate', true, 'error', NULL);
+        END IF;
+    END IF;
+
+    SELECT p.* INTO v_product FROM platform_products p WHERE p.id = p_product_id;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('success', false, 'visit', NULL, 'duplicate', false, 'error', 'Продукт не найден.');
+    END IF;
+
+    IF v_product.max_visits_total IS NOT NULL AND v_sub.visits_total_used >= v_product.max_visits_total THEN
+        RETURN jsonb_build_object('success', false, 'visit', NULL, 'duplicate', false,
+                                  'error', 'Исчерпан лимит визитов по абонементу.');
+    END IF;
+
+    IF v_pp.visit_limit_per_client IS NOT NULL THEN
+        SELECT COALESCE(SUM(c.visits_count), 0) INTO v_partner_visits
+        FROM product_visit_counters c
+        WHERE c.subscription_id = v_sub.id
+          AND c.partner_chat_id = p_partner_chat_id;
+        IF v_partner_visits >= v_pp.visit_limit_per_client THEN
+            RETURN jsonb_build_object('success', false, 'visit', NULL, 'duplicate', false,
+                                      'error', format('Лимит визитов в эту студию (%s) исчерпан.', v_pp.visit_limit_per_client));
+        END IF;
+    END IF;
+
+    INSERT INTO product_visits (
+        subscription_id, product_id, client_chat_id, partner_chat_id, source,
+        status, payout_amount, payout_currency, payout_status
+    )
+    VALUES (
+        v_sub.id, p_product_id, p_client_chat_id, p_partner_chat_id, COALESCE(p_source, 'bot_manual'),
+        'confirmed', v_pp.payout_per_visit, 'RUB', 'not_processed'
+    )
+    RETURNING * INTO v_visit;
+
+    UPDATE client_product_subscriptions
+    SET visits_total_used = visits_total_used + 1
+    WHERE id = v_sub.id;
+
+    INSERT INTO product_visit_counters AS c (
+        subscription_id, partner_chat_id, product_id, period_start, visits_count, payout_amount, currency
+    )
+    VALUES (
+        v_sub.id, p_partner_chat_id, p_product_id,
+        date_trunc('month', v_visit.visited_at AT TIME ZONE 'UTC')::DATE,
+        1, v_visit.payout_amount, v_visit.payout_currency
+    )
+    ON CONFLICT (subscription_id, partner_chat_id, period_start) DO UPDATE
+    SET visits_count = c.visits_count + 1,
+        payout_amount = c.payout_amount + EXCLUDED.payout_amount,
+        updated_at = NOW();
+
+    RETURN jsonb_build_object('success', true, 'visit', to_jsonb(v_visit), 'duplicate', false, 'error', NULL);
+END;
+$$;
+
+COMMENT ON FUNCTION public.record_platform_product_visit(TEXT, TEXT, BIGINT, TEXT, INTEGER) IS
+    'Допуск по кросс-абонементу: проверка лимитов по счётчикам и запись визита в одной транзакции с блокировкой подписки';
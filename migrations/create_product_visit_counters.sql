@@ -0,0 +1,73 @@
+-- ============================================
+-- Платформенные продукты: счётчики визитов (подписка × партнёр × месяц)
+-- Дата: 2026-10-19
+-- ============================================
+-- Лимит visit_limit_per_client и сводка партнёра по визитам читают product_visit_counters
+-- вместо подсчёта строк product_visits, поэтому их стоимость не зависит от истории визитов.
+-- Период — календарный месяц (UTC): первый визит месяца создаёт новую строку.
+-- Счётчик увеличивает record_platform_product_visit (create_platform_product_visit_rpc.sql —
+-- единственное определение функции); без RPC — приложение (product_visit_counters.py).
+-- rebuild_product_visit_counters() пересчитывает счётчики по product_visits.
+
+CREATE TABLE IF NOT EXISTS product_visit_counters (
+    id BIGSERIAL PRIMARY KEY,
+    subscription_id BIGINT NOT NULL REFERENCES client_product_subscriptions(id) ON DELETE CASCADE,
+    partner_chat_id TEXT NOT NULL REFERENCES partners(chat_id) ON DELETE CASCADE,
+    product_id BIGINT REFERENCES platform_products(id) ON DELETE CASCADE,
+    period_start DATE NOT NULL,
+    visits_count INTEGER NOT NULL DEFAULT 0,
+    payout_amount NUMERIC(12,2) NOT NULL DEFAULT 0,
+    currency TEXT NOT NULL DEFAULT 'RUB',
+    updated_at TIMESTAMPTZ DEFAULT NOW(),
+    UNIQUE (subscription_id, partner_chat_id, period_start)
+);
+
+COMMENT ON TABLE product_visit_counters IS 'Подтверждённые визиты по кросс-абонементам: подписка × партнёр × месяц';
+COMMENT ON COLUMN product_visit_counters.period_start IS 'Первый день месяца (UTC) визитов';
+
+CREATE INDEX IF NOT EXISTS idx_product_visit_counters_partner_period
+    ON product_visit_counters(partner_chat_id, period_start);
+
+
+CREATE OR REPLACE FUNCTION public.rebuild_product_visit_counters(
+    p_partner_chat_id TEXT DEFAULT NULL
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_rows INTEGER := 0;
+BEGIN
+    DELETE FROM product_visit_counters c
+    WHERE p_partner_chat_id IS NULL OR c.partner_chat_id = p_partner_chat_id;
+
+    INSERT INTO product_visit_counters (
+        subscription_id, partner_chat_id, product_id, period_start, visits_count, payout_amount, currency
+    )
+    SELECT
+        v.subscription_id,
+        v.partner_chat_id,
+        MIN(v.product_id),
+        date_trunc('month', v.visited_at AT TIME ZONE 'UTC')::DATE,
+        COUNT(*),
+        COALESCE(SUM(v.payout_amount), 0),
+        MIN(v.payout_currency)
+    FROM product_visits v
+    WHERE v.status = 'confirmed'
+      AND (p_partner_chat_id IS NULL OR v.partner_chat_id = p_partner_chat_id)
+    GROUP BY v.subscription_id, v.partner_chat_id, date_trunc('month', v.visited_at AT TIME ZONE 'UTC');
+    GET DIAGNOSTICS v_rows = ROW_COUNT;
+
+    RETURN v_rows;
+END;
+$$;
+
+COMMENT ON FUNCTION public.rebuild_product_visit_counters(TEXT) IS
+    'Пересчитывает product_visit_counters по подтверждённым визитам (всех партнёров или одного)';
+
+ALTER TABLE product_visit_counters ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Service role can do everything" ON product_visit_counters;
+CREATE POLICY "Service role can do everything" ON product_visit_counters FOR ALL TO service_role USING (true) WITH CHECK (true);
+
+-- Заполнить счётчики по уже записанным визитам
+SELECT public.rebuild_product_visit_counters();
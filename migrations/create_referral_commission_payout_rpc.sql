@@ -0,0 +1,72 @@
+-- ============================================
+-- Выплаты реферальных комиссий: группировка в БД и пакетная отметка оплаты
+-- Дата: 2026-10-19
+-- ============================================
+-- get_pending_referral_commissions() возвращает pending-комиссии, сгруппированные по получателю,
+-- вместо выгрузки всех строк referral_rewards в приложение.
+-- Выплата покрывает комиссии получателя до max_reward_id включительно; ton_payments.referral_reward_id
+-- хранит эту границу. mark_referral_rewards_paid_ton() переводит их в paid_ton одним вызовом:
+-- p_items = [{"referrer_chat_id": "...", "max_reward_id": 42, "ton_tx_hash": "...", "ton_payment_id": "..."}, ...]
+
+CREATE INDEX IF NOT EXISTS idx_referral_rewards_pending_commissions
+    ON referral_rewards(referrer_chat_id, id)
+    WHERE status = 'pending' AND reward_type LIKE 'commission_%';
+
+COMMENT ON COLUMN ton_payments.referral_reward_id IS 'Для выплаты комиссий — последняя (максимальная) комиссия получателя, вошедшая в выплату';
+
+
+CREATE OR REPLACE FUNCTION public.get_pending_referral_commissions()
+RETURNS TABLE (
+    referrer_chat_id TEXT,
+    total_usd NUMERIC,
+    rewards_count BIGINT,
+    min_reward_id INTEGER,
+    max_reward_id INTEGER
+)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT
+        r.referrer_chat_id,
+        COALESCE(SUM(r.amount_usd), 0),
+        COUNT(*),
+        MIN(r.id),
+        MAX(r.id)
+    FROM referral_rewards r
+    WHERE r.status = 'pending'
+      AND r.reward_type LIKE 'commission_%'
+    GROUP BY r.referrer_chat_id;
+$$;
+
+
+CREATE OR REPLACE FUNCTION public.mark_referral_rewards_paid_ton(
+    p_items JSONB
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_rows INTEGER := 0;
+BEGIN
+    WITH items AS (
+        SELECT *
+        FROM jsonb_to_recordset(COALESCE(p_items, '[]'::jsonb))
+            AS i(referrer_chat_id TEXT, max_reward_id INTEGER, ton_tx_hash TEXT, ton_payment_id UUID)
+    ),
+    updated AS (
+        UPDATE referral_rewards r
+        SET status = 'paid_ton',
+            ton_tx_hash = i.ton_tx_hash,
+            ton_payment_id = i.ton_payment_id
+        FROM items i
+        WHERE r.referrer_chat_id = i.referrer_chat_id
+          AND r.id <= i.max_reward_id
+          AND r.status = 'pending'
+          AND r.reward_type LIKE 'commission_%'
+        RETURNING 1
+    )
+    SELECT COUNT(*) INTO v_rows FROM updated;
+
+    RETURN v_rows;
+END;
+$$;
@@ -0,0 +1,44 @@
+-- ============================================
+-- Revenue Share: пакетное одобрение выплат с аудитом запусков
+-- Дата: 2026-10-19
+-- ============================================
+-- approve_pending_payments одобряет выплаты периода пачками. Каждый запуск — одна запись
+-- в revenue_share_approval_runs; одобренные выплаты ссылаются на неё через approval_run_id.
+-- Прерванный запуск остаётся в статусе 'running' и продолжается следующим вызовом
+-- с last_payment_id. Ручное одобрение одной выплаты заполняет approved_by без approval_run_id.
+
+CREATE TABLE IF NOT EXISTS revenue_share_approval_runs (
+    id SERIAL PRIMARY KEY,
+    period_start DATE NOT NULL,
+    period_end DATE NOT NULL,
+    approved_by TEXT NOT NULL DEFAULT 'system',
+    status TEXT NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'completed')),
+    approved_count INTEGER NOT NULL DEFAULT 0,
+    total_amount NUMERIC(14,2) NOT NULL DEFAULT 0,
+    last_payment_id INTEGER,
+    started_at TIMESTAMP DEFAULT NOW(),
+    finished_at TIMESTAMP
+);
+
+-- Не больше одного незавершённого запуска за период
+CREATE UNIQUE INDEX IF NOT EXISTS idx_revenue_share_approval_runs_running
+    ON revenue_share_approval_runs(period_start, period_end)
+    WHERE status = 'running';
+
+COMMENT ON TABLE revenue_share_approval_runs IS 'Запуски пакетного одобрения Revenue Share (аудит)';
+COMMENT ON COLUMN revenue_share_approval_runs.last_payment_id IS 'Последний обработанный id выплаты — точка продолжения прерванного запуска';
+
+ALTER TABLE partner_revenue_share
+    ADD COLUMN IF NOT EXISTS approval_run_id INTEGER REFERENCES revenue_share_approval_runs(id),
+    ADD COLUMN IF NOT EXISTS approved_by TEXT,
+    ADD COLUMN IF NOT EXISTS approved_at TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_revenue_share_approval_run
+    ON partner_revenue_share(approval_run_id)
+    WHERE approval_run_id IS NOT NULL;
+
+COMMENT ON COLUMN partner_revenue_share.approval_run_id IS 'Запуск пакетного одобрения (NULL — одобрено вручную)';
+
+ALTER TABLE revenue_share_approval_runs ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Service role can do everything" ON revenue_share_approval_runs;
+CREATE POLICY "Service role can do everything" ON revenue_share_approval_runs FOR ALL TO service_role USING (true) WITH CHECK (true);
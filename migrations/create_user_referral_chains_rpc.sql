@@ -0,0 +1,46 @@
+-- ============================================
+-- Реферальная программа клиентов: цепочка рефереров одним запросом
+-- Дата: 2026-10-19
+-- ============================================
+-- При регистрации по реферальной ссылке _create_referral_tree_links получает цепочку
+-- рефереров (по users.referred_by_chat_id) одним вызовом get_user_referral_chains
+-- и пишет связи referral_tree всех уровней одним
+-- upsert ... ON CONFLICT (referrer_chat_id, referred_chat_id) DO NOTHING:
+-- параллельные регистрации не создают дублей и не падают на уникальном ключе.
+-- Без функции код делает по одному запросу к users на уровень.
+
+-- Цепочка для каждого chat_id: depth = 0 — сам пользователь, 1 — его реферер, ...
+-- В цепочку попадают только существующие пользователи; цикл обрывается.
+CREATE OR REPLACE FUNCTION get_user_referral_chains(
+    p_chat_ids TEXT[],
+    p_depth INTEGER DEFAULT 3
+)
+RETURNS TABLE (chat_id TEXT, ancestor_chat_id TEXT, depth INTEGER)
+LANGUAGE sql
+STABLE
+AS $$
+    WITH RECURSIVE chains AS (
+        SELECT u.chat_id AS chat_id,
+               u.chat_id AS ancestor_chat_id,
+               u.referred_by_chat_id AS next_chat_id,
+               0 AS depth,
+               ARRAY[u.chat_id] AS path
+        FROM users u
+        WHERE u.chat_id = ANY(p_chat_ids)
+        UNION ALL
+        SELECT c.chat_id,
+               u.chat_id,
+               u.referred_by_chat_id,
+               c.depth + 1,
+               c.path || u.chat_id
+        FROM chains c
+        JOIN users u ON u.chat_id = c.next_chat_id
+        WHERE c.depth + 1 < p_depth
+          AND NOT u.chat_id = ANY(c.path)
+    )
+    SELECT chains.chat_id, chains.ancestor_chat_id, chains.depth
+    FROM chains
+    ORDER BY chains.chat_id, chains.depth;
+$$;
+
+COMMENT ON FUNCTION get_user_referral_chains(TEXT[], INTEGER) IS 'Цепочки рефереров клиентов (до p_depth звеньев, включая самого пользователя) для построения referral_tree';
@@ -0,0 +1,125 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+
+class NewsViewCounter:
+    """Буфер просмотров новостей с отложенной записью агрегированных инкрементов."""
+
+    def __init__(self, manager, flush_interval: Optional[float] = None, max_pending: Optional[int] = None,
+                 max_news: Optional[int] = None, retry_cooldown: Optional[float] = None):
+        self.manager = manager
+        # Окно возможной потери просмотров при аварийном завершении процесса
+        self.flush_interval = float(flush_interval if flush_interval is not None else os.getenv("NEWS_VIEWS_FLUSH_INTERVAL", "10"))
+        # Сброс досрочно, если в буфере накопилось столько просмотров
+        self.max_pending = int(max_pending if max_pending is not None else os.getenv("NEWS_VIEWS_MAX_PENDING", "1000"))
+        # Сколько разных новостей держать в буфере; просмотры новых сверх этого отбрасываются
+        self.max_news = int(max_news if max_news is not None else os.getenv("NEWS_VIEWS_MAX_BUFFERED_NEWS", "10000"))
+        # Пауза (в секундах) после неудачного сброса, пока просмотры только копятся в буфере
+        self.retry_cooldown = float(retry_cooldown if retry_cooldown is not None else os.getenv("NEWS_VIEWS_RETRY_COOLDOWN", "30"))
+        self._pending: dict[int, int] = {}
+        self._pending_total = 0
+        self._dropped = 0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started = False
+
+    def record(self, news_id: int, views: int = 1) -> bool:
+        """
+        Учитывает просмотр в буфере. Запись в БД произойдёт при ближайшем сбросе.
+        Возвращает False, если просмотр не учтён (некорректный id или буфер заполнен).
+        """
+        try:
+            news_id = int(news_id)
+        except (TypeError, ValueError):
+            return False
+        if views <= 0 or news_id <= 0:
+            return False
+        with self._lock:
+            if not self._add(news_id, views):
+                return False
+            should_flush = self._pending_total >= self.max_pending and time.monotonic() >= self._retry_at
+        self._ensure_started()
+        if should_flush:
+            self.flush()
+        return True
+
+    def pending(self) -> dict[int, int]:
+        with self._lock:
+            return dict(self._pending)
+
+    def flush(self, force: bool = True) -> int:
+        """
+        Записывает накопленные просмотры одним вызовом RPC. Возвращает число записанных просмотров.
+        С force=False ничего не делает, пока не прошла пауза после неудачного сброса.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending or (not force and time.monotonic() < self._retry_at):
+                    return 0
+                batch = self._pending
+                self._pending = {}
+                self._pending_total = 0
+
+            client = getattr(self.manager, "client", None)
+            try:
+                if not client:
+                    raise RuntimeError("Supabase client is not configured")
+                # Несуществующие news_id RPC пропускает (UPDATE только по строкам news)
+                client.rpc("increment_news_views_batch", {
+                    "p_views": [{"news_id": news_id, "delta": delta} for news_id, delta in batch.items()]
+                }).execute()
+                with self._lock:
+                    self._retry_at = 0.0
+                    if self._dropped:
+                        logging.warning(f"Пока буфер просмотров новостей был заполнен, отброшено просмотров: {self._dropped}")
+                        self._dropped = 0
+                return sum(batch.values())
+            except Exception as e:
+                logging.error(f"Не удалось записать просмотры новостей, вернул в буфер: {e}")
+                with self._lock:
+                    self._retry_at = time.monotonic() + self.retry_cooldown
+                    for news_id, delta in batch.items():
+                        self._add(news_id, delta)
+                return 0
+
+    def stop(self):
+        """Останавливает фоновый сброс и записывает остаток буфера."""
+        self._stop_event.set()
+        thread = self._thread
+        if thread and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+    def _add(self, news_id: int, views: int) -> bool:
+        """Добавляет просмотры в буфер (под self._lock); новую новость — только если есть место."""
+        if news_id not in self._pending and len(self._pending) >= self.max_news:
+            if not self._dropped:
+                logging.warning(f"Буфер просмотров новостей заполнен ({self.max_news} новостей), просмотры новых новостей отбрасываются")
+            self._dropped += views
+            return False
+        self._pending[news_id] = self._pending.get(news_id, 0) + views
+        self._pending_total += views
+        return True
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            if self.flush_interval > 0:
+                self._thread = threading.Thread(target=self._run, name="news-views-flush", daemon=True)
+                self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush(force=False)
@@ -0,0 +1,302 @@
+import datetime
+from typing import Iterable, Optional
+
+import pandas as pd
+
+
+def month_index(values: pd.Series) -> pd.Series:
+    """Номер месяца (год * 12 + месяц - 1) по ISO-строке даты; NaN для пустых и нераспознанных."""
+    text = values.astype('string')
+    year = pd.to_numeric(text.str.slice(0, 4), errors='coerce')
+    month = pd.to_numeric(text.str.slice(5, 7), errors='coerce')
+    return year * 12 + month - 1
+
+
+def _month_label(index: int) -> str:
+    return f"{index // 12}-{str(index % 12 + 1).zfill(2)}"
+
+
+def cohort_analysis(clients: pd.DataFrame, transactions: pd.DataFrame, as_of: Optional[datetime.datetime] = None) -> dict:
+    """
+    Когорты клиентов по месяцу регистрации и матрица удержания «когорта × месяц жизни».
+
+    Args:
+        clients: колонки chat_id, reg_date
+        transactions: колонки client_chat_id, date_time, total_amount, operation_type
+            (учитываются только начисления — operation_type == 'accrual'); необязательная
+            колонка transactions_count — число начислений в строке (для дневных агрегатов
+            partner_daily_clients, по умолчанию 1)
+        as_of: дата, до которой строится матрица (по умолчанию — сейчас)
+
+    Returns:
+        {'cohorts': [...], 'retention_matrix': [...]}, когорты по возрастанию месяца
+    """
+    result = {'cohorts': [], 'retention_matrix': []}
+    if clients.empty:
+        return result
+
+    clients = clients.assign(cohort=month_index(clients['reg_date'])).dropna(subset=['cohort'])
+    if clients.empty:
+        return result
+    cohort_of = (
+        clients.assign(chat_id=clients['chat_id'].astype(str))
+        .drop_duplicates('chat_id')
+        .set_index('chat_id')['cohort']
+    )
+    sizes = cohort_of.groupby(cohort_of).size()
+
+    txn = transactions
+    if not txn.empty:
+        txn = txn[txn['operation_type'] == 'accrual']
+        txn = txn.assign(client=txn['client_chat_id'].astype(str))
+        txn = txn[txn['client'].isin(cohort_of.index)]
+    if txn.empty:
+        txn = pd.DataFrame({'client': pd.Series(dtype=str), 'cohort': pd.Series(dtype=float),
+                            'period': pd.Series(dtype=float), 'amount': pd.Series(dtype=float),
+                            'weight': pd.Series(dtype=int)})
+    else:
+        weight = (
+            pd.to_numeric(txn['transactions_count'], errors='coerce').fillna(0).astype(int)
+            if 'transactions_count' in txn.columns else 1
+        )
+        txn = txn.assign(
+            cohort=txn['client'].map(cohort_of),
+            amount=pd.to_numeric(txn['total_amount'], errors='coerce').fillna(0.0),
+            weight=weight,
+        )
+        txn = txn.assign(period=month_index(txn['date_time']) - txn['cohort'])
+
+    totals = txn.groupby('cohort').agg(revenue=('amount', 'sum'), transactions=('weight', 'sum'))
+    activity = (
+        txn[txn['period'] >= 0]
+        .groupby(['cohort', 'period'])
+        .agg(active_clients=('client', 'nunique'), revenue=('amount', 'sum'))
+    )
+
+    now = as_of or datetime.datetime.now(datetime.timezone.utc)
+    current_month = now.year * 12 + now.month - 1
+
+    for cohort, clients_count in sizes.sort_index().items():
+        cohort, clients_count = int(cohort), int(clients_count)
+        revenue = float(totals['revenue'].get(cohort, 0.0))
+        transactions_count = int(totals['transactions'].get(cohort, 0))
+        result['cohorts'].append({
+            'month': _month_label(cohort),
+            'clients_count': int(clients_count),
+            'total_revenue': round(revenue, 2),
+            'total_transactions': transactions_count,
+            'avg_revenue_per_client': round(revenue / clients_count, 2) if clients_count else 0,
+            'avg_transactions_per_client': round(transactions_count / clients_count, 2) if clients_count else 0
+        })
+
+        cohort_activity = activity.loc[cohort] if cohort in activity.index.get_level_values(0) else None
+        last_period = max(current_month - cohort, int(cohort_activity.index.max()) if cohort_activity is not None else 0, 0)
+        periods = []
+        for period in range(last_period + 1):
+            if cohort_activity is not None and period in cohort_activity.index:
+                active = int(cohort_activity.at[period, 'active_clients'])
+                period_revenue = float(cohort_activity.at[period, 'revenue'])
+            else:
+                active, period_revenue = 0, 0.0
+            periods.append({
+                'period': period,
+                'active_clients': active,
+                'retention_rate': round(active / clients_count * 100, 2) if clients_count else 0,
+                'revenue': round(period_revenue, 2)
+            })
+        result['retention_matrix'].append({
+            'month': _month_label(cohort),
+            'clients_count': int(clients_count),
+            'periods': periods
+        })
+
+    return result
+
+
+def partner_stats_payload(total_referrals: int = 0, totals: Optional[dict] = None) -> dict:
+    """
+    Ключевая статистика партнера (get_partner_stats).
+
+    Args:
+        total_referrals: количество приглашенных клиентов
+        totals: итоги за всё время в формате PartnerDailyRollups.period_totals
+    """
+    stats = {
+        'total_referrals': total_referrals, 'total_transactions': 0, 'total_accrued_points': 0,
+        'total_spent_usd': 0.0, 'avg_nps_rating': 0.0, 'promoters': 0, 'detractors': 0
+    }
+    if not totals:
+        return stats
+
+    stats['total_transactions'] = totals['transactions']
+    stats['total_spent_usd'] = totals['revenue']
+    stats['total_accrued_points'] = totals['points_accrued']
+
+    nps = totals['nps']
+    if nps['ratings_count']:
+        stats['avg_nps_rating'] = round(nps['ratings_sum'] / nps['ratings_count'], 2)
+        stats['promoters'] = nps['promoters']
+        stats['detractors'] = nps['detractors']
+    return stats
+
+
+def advanced_stats_payload(period_days: int, totals: Optional[dict] = None, total_clients: int = 0,
+                           new_clients: int = 0, total_promoters: int = 0) -> dict:
+    """
+    Расширенная статистика партнера (get_advanced_partner_stats).
+
+    Args:
+        period_days: период анализа в днях
+        totals: итоги за период в формате PartnerDailyRollups.period_totals (с клиентами)
+        total_clients: всего клиентов партнера
+        new_clients: клиентов, зарегистрированных за период
+        total_promoters: активных промоутеров среди клиентов партнера
+    """
+    stats = {
+        # Базовые метрики
+        'period_days': period_days,
+        'total_clients': total_clients,
+        'active_clients': 0,  # Клиенты с транзакциями за период
+        'new_clients': new_clients,  # Новые клиенты за период
+
+        # Финансовые метрики
+        'total_revenue': 0.0,  # Общий оборот
+        'avg_check': 0.0,  # Средний чек
+        'avg_ltv': 0.0,  # Средний LTV клиента
+
+        # Транзакционные метрики
+        'total_transactions': 0,
+        'accrual_transactions': 0,  # Количество начислений
+        'redemption_transactions': 0,  # Количество списаний
+        'total_points_accrued': 0,
+        'total_points_redeemed': 0,
+
+        # Метрики вовлеченности
+        'returning_clients': 0,  # Клиенты с >1 транзакцией за период
+        'avg_frequency': 0.0,  # Средняя частота покупок
+        'churn_rate': 0.0,  # Процент ушедших клиентов
+
+        # NPS метрики
+        'avg_nps': 0.0,
+        'nps_score': 0,  # Чистый NPS индекс
+        'promoters': 0,
+        'passives': 0,
+        'detractors': 0,
+        'total_promoters': total_promoters,  # Количество промоутеров среди клиентов партнера
+
+        # Конверсионные метрики
+        'registration_to_first_purchase': 0.0,  # % клиентов с первой покупкой
+        'repeat_purchase_rate': 0.0,  # % повторных покупок
+    }
+    if not totals:
+        return stats
+
+    client_totals = totals['clients']
+    stats['total_transactions'] = totals['transactions']
+    stats['accrual_transactions'] = totals['accrual_transactions']
+    stats['redemption_transactions'] = totals['redemption_transactions']
+    stats['total_revenue'] = totals['revenue']
+    stats['total_points_accrued'] = totals['points_accrued']
+    stats['total_points_redeemed'] = totals['points_redeemed']
+    stats['active_clients'] = len(client_totals)
+
+    # Средний чек
+    if stats['accrual_transactions']:
+        stats['avg_check'] = round(stats['total_revenue'] / stats['accrual_transactions'], 2)
+
+    # Средний LTV (по клиентам с начислениями за период)
+    client_revenues = {chat_id: c['revenue'] for chat_id, c in client_totals.items() if c['accrual_transactions']}
+    if client_revenues:
+        stats['avg_ltv'] = round(sum(client_revenues.values()) / len(client_revenues), 2)
+
+    # Клиенты с повторными покупками
+    stats['returning_clients'] = sum(1 for c in client_totals.values() if c['transactions'] > 1)
+
+    # Средняя частота покупок (транзакций на активного клиента)
+    if stats['active_clients'] > 0:
+        stats['avg_frequency'] = round(stats['total_transactions'] / stats['active_clients'], 2)
+
+    # Churn rate (упрощенная формула: клиенты без транзакций за период / всего клиентов)
+    if stats['total_clients'] > 0:
+        inactive_clients = stats['total_clients'] - stats['active_clients']
+        stats['churn_rate'] = round((inactive_clients / stats['total_clients']) * 100, 2)
+
+    # NPS метрики за период (как в дашборде: промоутеры >= 9, нейтральные 7-8, детракторы <= 6)
+    nps = totals['nps']
+    if nps['ratings_count']:
+        stats['avg_nps'] = round(nps['ratings_sum'] / nps['ratings_count'], 2)
+        stats['promoters'] = nps['promoters']
+        stats['passives'] = nps['passives']
+        stats['detractors'] = nps['detractors']
+        # Чистый NPS индекс (как в дашборде: Math.round(((promoters - detractors) / totalNPS) * 100))
+        stats['nps_score'] = int(round(((nps['promoters'] - nps['detractors']) / nps['ratings_count']) * 100))
+
+    # Конверсионные метрики
+    # Регистрация -> Первая покупка
+    clients_with_purchases = len(client_revenues)
+    if stats['total_clients'] > 0:
+        stats['registration_to_first_purchase'] = round((clients_with_purchases / stats['total_clients']) * 100, 2)
+
+    # Повторные покупки
+    if clients_with_purchases > 0:
+        stats['repeat_purchase_rate'] = round((stats['returning_clients'] / clients_with_purchases) * 100, 2)
+    return stats
+
+
+def stats_by_period_payload(start_date: str, end_date: str, stats_rows: Iterable[dict] = (), client_rows: Iterable[dict] = ()) -> dict:
+    """
+    Статистика партнера по дням для графиков (get_partner_stats_by_period).
+
+    Args:
+        start_date, end_date: границы периода, как их передал вызывающий код
+        stats_rows: строки partner_daily_stats за период (валюты одного дня складываются)
+        client_rows: строки partner_daily_clients за период (для уникальных клиентов)
+    """
+    result = {
+        'period': {'start': start_date, 'end': end_date},
+        'daily_stats': [],  # Массив объектов {date, revenue, transactions, clients}
+        'totals': {
+            'revenue': 0.0,
+            'transactions': 0,
+            'unique_clients': 0,
+            'points_accrued': 0
+        }
+    }
+
+    daily_data = {}
+    for row in stats_rows:
+        day_data = daily_data.setdefault(row['stat_date'], {
+            'date': row['stat_date'],
+            'revenue': 0.0,
+            'transactions': 0,
+            'clients': set(),
+            'points_accrued': 0
+        })
+        day_data['revenue'] += float(row.get('revenue') or 0)
+        day_data['transactions'] += int(row.get('transactions_count') or 0)
+        day_data['points_accrued'] += int(round(float(row.get('points_accrued') or 0)))
+
+    # Уникальные клиенты не складываются из дневных итогов — берём пары (день, клиент)
+    all_clients = set()
+    for row in client_rows:
+        if row['stat_date'] in daily_data:
+            daily_data[row['stat_date']]['clients'].add(row['client_chat_id'])
+        all_clients.add(row['client_chat_id'])
+
+    # Преобразуем в массив для фронтенда
+    for date_key in sorted(daily_data.keys()):
+        day_data = daily_data[date_key]
+        result['daily_stats'].append({
+            'date': day_data['date'],
+            'revenue': round(day_data['revenue'], 2),
+            'transactions': day_data['transactions'],
+            'unique_clients': len(day_data['clients']),
+            'points_accrued': day_data['points_accrued']
+        })
+        result['totals']['revenue'] += day_data['revenue']
+        result['totals']['transactions'] += day_data['transactions']
+        result['totals']['points_accrued'] += day_data['points_accrued']
+
+    result['totals']['unique_clients'] = len(all_clients)
+    result['totals']['revenue'] = round(result['totals']['revenue'], 2)
+    return result
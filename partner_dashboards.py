@@ -0,0 +1,207 @@
+import datetime
+import logging
+import os
+from typing import Iterable, Optional
+
+import pandas as pd
+from dateutil import parser
+
+from partner_analytics import cohort_analysis, partner_stats_payload, advanced_stats_payload, stats_by_period_payload
+from partner_rollups import period_bounds, summarize
+
+
+USER_TABLE = 'users'
+PARTNER_ID_COLUMN = 'referral_source'
+
+
+def _parse_moment(value) -> Optional[datetime.datetime]:
+    """Дата регистрации в UTC; наивные даты считаются UTC, нераспознанные — None."""
+    if not value:
+        return None
+    try:
+        moment = parser.isoparse(value) if isinstance(value, str) else value
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(moment, datetime.datetime):
+        return None
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=datetime.timezone.utc)
+    return moment
+
+
+def _group_by_partner(rows: Iterable[dict], column: str = 'partner_chat_id') -> dict:
+    grouped: dict = {}
+    for row in rows:
+        partner_chat_id = row.get(column)
+        if partner_chat_id:
+            grouped.setdefault(str(partner_chat_id), []).append(row)
+    return grouped
+
+
+class PartnerDashboardPrecomputer:
+    """
+    Ночной предрасчёт дашбордов всех партнеров за один проход.
+
+    Дневные агрегаты читаются один раз: окно периодов и графика (наибольший период или
+    глубина графика) и отдельно — дни старше окна, которые нужны только дашбордам за всё
+    время (get_partner_stats и когорты). Клиенты и промоутеры читаются целиком, неполные
+    первые дни периодов — одним запросом к transactions и nps_ratings на период для всех
+    партнеров. Payload'ы считаются теми же функциями, что и интерактивные методы
+    SupabaseManager, и пишутся в analytics_cache пачками, поэтому число запросов зависит
+    от объёма данных (числа страниц), а не от числа партнеров.
+    """
+
+    def __init__(self, manager, periods: Optional[Iterable[int]] = None, chart_days: Optional[int] = None):
+        self.manager = manager
+        if periods is None:
+            periods = os.getenv("PARTNER_DASHBOARD_PERIODS", "7,30,90").split(',')
+        self.periods = tuple(int(p) for p in periods if str(p).strip())
+        self.chart_days = int(chart_days if chart_days is not None else os.getenv("PARTNER_DASHBOARD_CHART_DAYS", "30"))
+
+    @property
+    def client(self):
+        return self.manager.client
+
+    def run(self, now: Optional[datetime.datetime] = None, refresh_days: int = 1) -> dict:
+        """
+        Пересчитывает дашборды всех партнеров и сохраняет их в analytics_cache.
+
+        Args:
+            now: момент расчёта (по умолчанию — сейчас, UTC)
+            refresh_days: сколько последних полных дней пересчитать в дневных агрегатах
+                перед расчётом (сверка с transactions после сбоев триггеров; 0 — не пересчитывать)
+
+        Returns:
+            {'partners': число партнеров, 'entries': записано в кеш, 'watermark': {...}}
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        today = now.astimezone(datetime.timezone.utc).date()
+
+        # Водяной знак снимается до чтения данных: всё, что появится позже, получит больший id
+        # и сделает предрасчитанный payload неактуальным при интерактивном запросе
+        watermark = {'transaction_id': self._last_id('transactions'), 'nps_id': self._last_id('nps_ratings')}
+        revisions = self.manager._partner_stats_revisions()
+
+        if refresh_days > 0:
+            self.manager.partner_rollups.rebuild(
+                None, (today - datetime.timedelta(days=refresh_days)).isoformat(),
+                (today - datetime.timedelta(days=1)).isoformat()
+            )
+
+        # Как в get_advanced_partner_stats: period_days <= 0 — весь период
+        period_starts = {
+            period_days: now - datetime.timedelta(days=period_days) if period_days > 0
+            else datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+            for period_days in self.periods
+        }
+        chart_start = (today - datetime.timedelta(days=self.chart_days)).isoformat()
+        chart_end = today.isoformat()
+        # Окно, которое нужно payload'ам периодов и графика; при периоде 0 — вся история
+        read_from = None if any(period_days <= 0 for period_days in self.periods) else min(
+            [chart_start] + [start.astimezone(datetime.timezone.utc).date().isoformat() for start in period_starts.values()]
+        )
+
+        rollups = self.manager.partner_rollups
+        users = self.manager._fetch_all_rows(
+            lambda: self.client.from_(USER_TABLE).select(f'chat_id, reg_date, {PARTNER_ID_COLUMN}').neq(PARTNER_ID_COLUMN, ''),
+            key='chat_id'
+        )
+        stats_rows, client_rows, nps_rows = (_group_by_partner(rows) for rows in rollups.all_partners_daily(read_from))
+        # Дни до окна — только для итогов за всё время и когорт
+        history = rollups.all_partners_daily(before=read_from) if read_from else ([], [], [])
+        history_stats, history_clients, history_nps = (_group_by_partner(rows) for rows in history)
+        clients_by_partner = _group_by_partner(users, PARTNER_ID_COLUMN)
+
+        # Активные промоутеры по партнерам — через клиента (как _count_partner_promoters)
+        partner_of = {str(u['chat_id']): str(u[PARTNER_ID_COLUMN]) for u in users}
+        active_promoters = self.manager._fetch_all_rows(
+            lambda: self.client.from_('promoters').select('client_chat_id').eq('is_active', True),
+            key='client_chat_id'
+        )
+        promoters: dict = {}
+        for row in active_promoters:
+            partner_chat_id = partner_of.get(str(row['client_chat_id']))
+            if partner_chat_id:
+                promoters[partner_chat_id] = promoters.get(partner_chat_id, 0) + 1
+
+        # Неполные первые дни периодов — одним запросом для всех партнеров
+        periods = {}
+        for period_days, period_start in period_starts.items():
+            first_full_day, partial_day = period_bounds(period_start)
+            partial_stats, partial_clients, partial_nps = {}, {}, {}
+            if partial_day:
+                stats, clients, nps = rollups.aggregate_range(*partial_day)
+                partial_stats = _group_by_partner(stats.values())
+                partial_clients = _group_by_partner(clients.values())
+                partial_nps = _group_by_partner(nps.values())
+            periods[period_days] = (period_start, first_full_day, partial_stats, partial_clients, partial_nps)
+
+        entries = {}
+        partners = set(clients_by_partner) | set(stats_rows) | set(nps_rows) | set(history_stats) | set(history_nps)
+        for partner_chat_id in sorted(partners):
+            partner_clients = clients_by_partner.get(partner_chat_id, [])
+            partner_stats = stats_rows.get(partner_chat_id, [])
+            partner_client_rows = client_rows.get(partner_chat_id, [])
+            partner_nps = nps_rows.get(partner_chat_id, [])
+            partner_watermark = dict(
+                watermark, clients=len(partner_clients),
+                revision=revisions.get(partner_chat_id, 0) if revisions is not None else None
+            )
+
+            def put(cache_key: str, payload: dict, window_start: Optional[datetime.datetime] = None):
+                entries[cache_key] = {'watermark': partner_watermark, 'stats': payload}
+                if window_start is not None:
+                    entries[cache_key]['window_start'] = window_start.isoformat()
+
+            put(f"partner_stats:{partner_chat_id}", partner_stats_payload(len(partner_clients), summarize(
+                history_stats.get(partner_chat_id, []) + partner_stats, (), history_nps.get(partner_chat_id, []) + partner_nps
+            )))
+
+            put(f"partner_stats_by_period:{partner_chat_id}:{chart_start}:{chart_end}", stats_by_period_payload(
+                chart_start, chart_end,
+                [r for r in partner_stats if chart_start <= r['stat_date'] <= chart_end],
+                [r for r in partner_client_rows if chart_start <= r['stat_date'] <= chart_end],
+            ))
+
+            if partner_clients:
+                put(f"partner_cohorts:{partner_chat_id}", self._cohorts(
+                    partner_clients, history_clients.get(partner_chat_id, []) + partner_client_rows, now
+                ))
+
+            registered = [_parse_moment(c.get('reg_date')) for c in partner_clients]
+            for period_days, (period_start, first_full_day, partial_stats, partial_clients, partial_nps) in periods.items():
+                totals = summarize(
+                    [r for r in partner_stats if r['stat_date'] >= first_full_day] + partial_stats.get(partner_chat_id, []),
+                    [r for r in partner_client_rows if r['stat_date'] >= first_full_day] + partial_clients.get(partner_chat_id, []),
+                    [r for r in partner_nps if r['stat_date'] >= first_full_day] + partial_nps.get(partner_chat_id, []),
+                )
+                put(f"partner_advanced_stats:{partner_chat_id}:{period_days}:{period_start.date().isoformat()}", advanced_stats_payload(
+                    period_days, totals,
+                    total_clients=len(partner_clients),
+                    new_clients=sum(1 for moment in registered if moment and moment >= period_start),
+                    total_promoters=promoters.get(partner_chat_id, 0),
+                ), window_start=period_start)
+
+        written = self.manager._set_cache_entries(entries)
+        logging.info(f"Partner dashboards precomputed: {len(partners)} partners, {written} cache entries")
+        return {'partners': len(partners), 'entries': written, 'watermark': watermark}
+
+    # --- Внутреннее ---------------------------------------------------
+
+    @staticmethod
+    def _cohorts(clients: list, client_rows: list, now: datetime.datetime) -> dict:
+        """Когорты по строкам partner_daily_clients: день и число начислений вместо отдельных транзакций."""
+        accruals = [
+            {'client_chat_id': r['client_chat_id'], 'date_time': r['stat_date'], 'total_amount': r.get('revenue'),
+             'operation_type': 'accrual', 'transactions_count': r.get('accrual_count')}
+            for r in client_rows if int(r.get('accrual_count') or 0) > 0
+        ]
+        return cohort_analysis(
+            pd.DataFrame(clients, columns=['chat_id', 'reg_date']),
+            pd.DataFrame(accruals, columns=['client_chat_id', 'date_time', 'total_amount', 'operation_type', 'transactions_count']),
+            as_of=now
+        )
+
+    def _last_id(self, table: str):
+        response = self.client.from_(table).select('id').order('id', desc=True).limit(1).execute()
+        return response.data[0]['id'] if response.data else None
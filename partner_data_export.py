@@ -0,0 +1,202 @@
+import csv
+import datetime
+import logging
+import os
+import tempfile
+from typing import Iterable, Iterator, Optional
+
+from dateutil import parser
+
+
+# Колонки экспорта транзакций партнера: колонка transactions -> заголовок CSV
+EXPORT_COLUMNS = {
+    'date_time': 'Дата и время',
+    'client_chat_id': 'ID клиента',
+    'operation_type': 'Тип операции',
+    'total_amount': 'Сумма чека',
+    'earned_points': 'Начислено баллов',
+    'spent_points': 'Списано баллов',
+    'currency': 'Валюта',
+    'description': 'Описание',
+}
+
+DEFAULT_EXPORT_COLUMNS = ('date_time', 'client_chat_id', 'operation_type', 'total_amount', 'earned_points', 'spent_points', 'description')
+
+OPERATION_LABELS = {
+    'accrual': 'Начисление',
+    'redemption': 'Списание',
+    'enrollment_bonus': 'Приветственный бонус',
+}
+
+EXPORT_FORMATS = ('csv', 'parquet')
+
+
+class ExportMismatchError(Exception):
+    """Число выгруженных строк не совпало с числом строк в источнике."""
+
+
+class PartnerDataExporter:
+    """
+    Экспорт транзакций партнера в CSV или Parquet: строки читаются страницами по курсору id
+    и сразу пишутся в файл, поэтому память не зависит от объёма данных.
+    """
+
+    def __init__(self, manager, page_size: Optional[int] = None):
+        self.manager = manager
+        # Сколько строк держим в памяти одновременно
+        self.page_size = int(page_size if page_size is not None else os.getenv("PARTNER_EXPORT_PAGE_SIZE", "1000"))
+
+    @property
+    def client(self):
+        return self.manager.client
+
+    def export(self, partner_chat_id: str, period_days: int = 90, fmt: str = 'csv',
+               columns: Optional[Iterable[str]] = None, output_dir: Optional[str] = None,
+               now: Optional[datetime.datetime] = None) -> tuple:
+        """
+        Пишет транзакции партнера за period_days в файл.
+
+        Выгружаются строки с id не больше последнего на момент старта, поэтому новые
+        транзакции во время экспорта не попадают в файл; в конце число строк сверяется
+        с count по тем же фильтрам.
+
+        Args:
+            partner_chat_id: ID партнера
+            period_days: период в днях (<= 0 — вся история)
+            fmt: 'csv' или 'parquet'
+            columns: колонки из EXPORT_COLUMNS (по умолчанию DEFAULT_EXPORT_COLUMNS)
+            output_dir: каталог для файла (по умолчанию временный каталог системы, как раньше;
+                файл удаляет вызывающий код после отправки)
+            now: момент отсчёта периода (по умолчанию — сейчас, UTC)
+
+        Returns:
+            (путь к файлу или None, если данных нет; число строк)
+
+        Raises:
+            ValueError: неизвестный формат или колонка
+            ExportMismatchError: число строк в файле не совпало с источником
+        """
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format: {fmt}")
+        columns = list(columns or DEFAULT_EXPORT_COLUMNS)
+        unknown = [c for c in columns if c not in EXPORT_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown export columns: {', '.join(unknown)}")
+
+        partner_chat_id = str(partner_chat_id)
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        since = (now - datetime.timedelta(days=period_days)).isoformat() if period_days and period_days > 0 else None
+
+        last_id = self._last_id(partner_chat_id, since)
+        if last_id is None:
+            return None, 0
+
+        output_dir = output_dir or tempfile.gettempdir()
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, f"partner_{partner_chat_id}_export_{now.strftime('%Y%m%d_%H%M%S')}.{fmt}")
+        tmp_path = f"{path}.part"
+
+        pages = self.iter_pages(partner_chat_id, since, last_id, columns)
+        try:
+            if fmt == 'csv':
+                rows = self._write_csv(tmp_path, pages, columns)
+            else:
+                rows = self._write_parquet(tmp_path, pages, columns)
+
+            expected = self._count(partner_chat_id, since, last_id)
+            if rows != expected:
+                raise ExportMismatchError(f"exported {rows} rows, source has {expected}")
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        logging.info(f"Exported {rows} transactions for partner {partner_chat_id} to {path}")
+        return path, rows
+
+    def iter_pages(self, partner_chat_id: str, since: Optional[str], last_id, columns: list) -> Iterator[list]:
+        """Отдаёт транзакции партнера страницами по курсору id (только выбранные колонки)."""
+        select = ', '.join(['id'] + [c for c in columns if c != 'id'])
+        after = None
+        while True:
+            query = self._filtered(self.client.from_('transactions').select(select), partner_chat_id, since, last_id)
+            if after is not None:
+                query = query.gt('id', after)
+            rows = query.order('id').limit(self.page_size).execute().data or []
+            if not rows:
+                return
+            yield rows
+            if len(rows) < self.page_size:
+                return
+            after = rows[-1]['id']
+
+    # --- Запись -------------------------------------------------------
+
+    @staticmethod
+    def _write_csv(path: str, pages: Iterator[list], columns: list) -> int:
+        rows = 0
+        with open(path, 'w', encoding='utf-8-sig', newline='') as f:  # utf-8-sig для Excel
+            writer = csv.writer(f)
+            writer.writerow([EXPORT_COLUMNS[c] for c in columns])
+            for page in pages:
+                for txn in page:
+                    writer.writerow([
+                        OPERATION_LABELS.get(txn.get(c), txn.get(c)) if c == 'operation_type' else txn.get(c)
+                        for c in columns
+                    ])
+                rows += len(page)
+        return rows
+
+    @staticmethod
+    def _write_parquet(path: str, pages: Iterator[list], columns: list) -> int:
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ValueError(f"Parquet export requires pyarrow: {e}")
+
+        types = {
+            'date_time': pa.timestamp('us', tz='UTC'),
+            'total_amount': pa.float64(),
+            'earned_points': pa.float64(),
+            'spent_points': pa.float64(),
+        }
+        schema = pa.schema([(c, types.get(c, pa.string())) for c in columns])
+
+        def value(column: str, raw):
+            if raw is None:
+                return None
+            if column == 'date_time':
+                moment = parser.isoparse(raw) if isinstance(raw, str) else raw
+                return moment if moment.tzinfo else moment.replace(tzinfo=datetime.timezone.utc)
+            if column in types:
+                return float(raw)
+            return str(raw)
+
+        rows = 0
+        with pq.ParquetWriter(path, schema) as writer:
+            for page in pages:
+                batch = {c: [value(c, txn.get(c)) for txn in page] for c in columns}
+                writer.write_table(pa.Table.from_pydict(batch, schema=schema))
+                rows += len(page)
+        return rows
+
+    # --- Внутреннее ---------------------------------------------------
+
+    @staticmethod
+    def _filtered(query, partner_chat_id: str, since: Optional[str], last_id=None):
+        query = query.eq('partner_chat_id', partner_chat_id)
+        if since:
+            query = query.gte('date_time', since)
+        if last_id is not None:
+            query = query.lte('id', last_id)
+        return query
+
+    def _last_id(self, partner_chat_id: str, since: Optional[str]):
+        query = self._filtered(self.client.from_('transactions').select('id'), partner_chat_id, since)
+        response = query.order('id', desc=True).limit(1).execute()
+        return response.data[0]['id'] if response.data else None
+
+    def _count(self, partner_chat_id: str, since: Optional[str], last_id) -> int:
+        query = self._filtered(self.client.from_('transactions').select('id', count='exact'), partner_chat_id, since, last_id)
+        return query.limit(1).execute().count or 0
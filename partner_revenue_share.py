@@ -500,6 +500,131 @@ class PartnerRevenueShare:
             logger.error(f"Ошибка при обновлении данных партнера: {e}")
             return False
     
+    def approve_pending_payments(
+        self,
+        period_start: date,
+        period_end: date,
+        approved_by: str = 'system',
+        chunk_size: Optional[int] = None
+    ) -> Dict[str, any]:
+        """
+        Одобряет все pending выплаты за период пачками
+        
+        Запуск фиксируется одной записью в revenue_share_approval_runs, одобренные выплаты
+        ссылаются на неё (approval_run_id). Прерванный запуск продолжается с места остановки
+        при повторном вызове за тот же период.
+        
+        Args:
+            period_start: Начало периода
+            period_end: Конец периода
+            approved_by: Кто одобряет (для аудита)
+            chunk_size: Выплат в одной пачке (по умолчанию REVENUE_SHARE_APPROVAL_CHUNK)
+            
+        Returns:
+            dict: run_id, approved_count, total_amount, resumed
+        """
+        chunk_size = int(chunk_size if chunk_size is not None else os.getenv("REVENUE_SHARE_APPROVAL_CHUNK", "500"))
+        client = self.db.client
+        run, resumed = self._open_approval_run(period_start, period_end, approved_by)
+        run_id = run['id']
+        approved_count = int(run.get('approved_count') or 0)
+        total_amount = Decimal(str(run.get('total_amount') or 0))
+        after = run.get('last_payment_id') or 0
+        
+        while True:
+            page = client.table('partner_revenue_share').select('id').eq('status', 'pending').gte(
+                'period_start', period_start.isoformat()
+            ).lte('period_end', period_end.isoformat()).gt('id', after).order('id').limit(chunk_size).execute().data or []
+            if not page:
+                break
+            
+            ids = [row['id'] for row in page]
+            # Условие на статус: выплаты, одобренные вручную за это время, не переписываются
+            updated = client.table('partner_revenue_share').update({
+                'status': 'approved',
+                'approval_run_id': run_id,
+                'approved_by': approved_by,
+                'approved_at': datetime.now().isoformat()
+            }).in_('id', ids).eq('status', 'pending').execute().data or []
+            
+            approved_count += len(updated)
+            total_amount += sum(Decimal(str(r.get('final_amount') or 0)) for r in updated)
+            after = ids[-1]
+            client.table('revenue_share_approval_runs').update({
+                'approved_count': approved_count,
+                'total_amount': float(total_amount),
+                'last_payment_id': after
+            }).eq('id', run_id).execute()
+        
+        client.table('revenue_share_approval_runs').update({
+            'status': 'completed',
+            'approved_count': approved_count,
+            'total_amount': float(total_amount),
+            'finished_at': datetime.now().isoformat()
+        }).eq('id', run_id).execute()
+        
+        logger.info(f"Одобрено выплат: {approved_count}, общая сумма: ${total_amount:.2f} (запуск {run_id})")
+        return {
+            'run_id': run_id,
+            'approved_count': approved_count,
+            'total_amount': total_amount,
+            'resumed': resumed
+        }
+    
+    def approve_payment(self, payment_id: int, approved_by: str = 'admin') -> bool:
+        """
+        Одобряет одну pending выплату (ручная проверка)
+        
+        Returns:
+            bool: True если выплата была в статусе pending и одобрена
+        """
+        try:
+            result = self.db.client.table('partner_revenue_share').update({
+                'status': 'approved',
+                'approved_by': approved_by,
+                'approved_at': datetime.now().isoformat()
+            }).eq('id', payment_id).eq('status', 'pending').execute()
+            
+            if not result.data:
+                logger.warning(f"Выплата {payment_id} не найдена или не в статусе pending")
+                return False
+            
+            logger.info(f"Одобрена выплата {payment_id}: ${float(result.data[0].get('final_amount') or 0):.2f} ({approved_by})")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка одобрения выплаты {payment_id}: {e}")
+            return False
+    
+    def _open_approval_run(self, period_start: date, period_end: date, approved_by: str) -> Tuple[dict, bool]:
+        """Возвращает незавершённый запуск одобрения за период или создаёт новый"""
+        client = self.db.client
+        running = client.table('revenue_share_approval_runs').select('*').eq(
+            'period_start', period_start.isoformat()
+        ).eq('period_end', period_end.isoformat()).eq('status', 'running').order('id').limit(1).execute()
+        
+        if running.data:
+            run = running.data[0]
+            # Счётчики могли не записаться перед сбоем — пересчитываем по одобренным выплатам
+            def build_query():
+                return client.table('partner_revenue_share').select('id, final_amount').eq('approval_run_id', run['id'])
+            
+            approved = self.db._fetch_all_rows(build_query)
+            run['approved_count'] = len(approved)
+            run['total_amount'] = sum(Decimal(str(r.get('final_amount') or 0)) for r in approved)
+            logger.info(f"Продолжаю прерванный запуск одобрения {run['id']} (одобрено {len(approved)})")
+            return run, True
+        
+        run = client.table('revenue_share_approval_runs').insert({
+            'period_start': period_start.isoformat(),
+            'period_end': period_end.isoformat(),
+            'approved_by': approved_by,
+            'status': 'running',
+            'approved_count': 0,
+            'total_amount': 0,
+            'started_at': datetime.now().isoformat()
+        }).execute().data[0]
+        return run, False
+    
     def get_partner_revenue_share_summary(
         self,
         partner_chat_id: str,
@@ -0,0 +1,355 @@
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+from dateutil import parser
+
+
+DAILY_STATS_TABLE = 'partner_daily_stats'
+DAILY_CLIENTS_TABLE = 'partner_daily_clients'
+DAILY_NPS_TABLE = 'partner_daily_nps'
+
+DEFAULT_CURRENCY = 'USD'
+
+TRANSACTION_COLUMNS = 'id, partner_chat_id, client_chat_id, date_time, currency, operation_type, total_amount, earned_points, spent_points'
+NPS_COLUMNS = 'id, partner_chat_id, rating, created_at'
+
+STATS_COLUMNS = 'id, stat_date, currency, revenue, points_accrued, points_spent, transactions_count, accrual_count, redemption_count, unique_clients'
+CLIENTS_COLUMNS = 'id, stat_date, client_chat_id, transactions_count, accrual_count, revenue'
+NPS_ROLLUP_COLUMNS = 'id, stat_date, ratings_count, ratings_sum, promoters, passives, detractors'
+
+
+def stat_date(value) -> Optional[str]:
+    """День (UTC, YYYY-MM-DD) для даты транзакции или оценки; None для пустой/нераспознанной даты."""
+    if not value:
+        return None
+    try:
+        moment = parser.isoparse(value) if isinstance(value, str) else value
+    except (TypeError, ValueError):
+        return None
+    if isinstance(moment, datetime.datetime):
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(datetime.timezone.utc)
+        moment = moment.date()
+    return moment.isoformat()
+
+
+def aggregate_transactions(transactions: Iterable[dict]) -> tuple:
+    """
+    Сворачивает транзакции в строки partner_daily_stats и partner_daily_clients.
+
+    Возвращает (stats, clients): словари с ключами (partner, день, валюта) и
+    (partner, день, валюта, клиент). Выручка — total_amount начислений,
+    начисленные баллы — earned_points начислений и приветственных бонусов,
+    списанные — spent_points списаний.
+    """
+    stats: dict = {}
+    clients: dict = {}
+    for txn in transactions:
+        partner_chat_id = txn.get('partner_chat_id')
+        day = stat_date(txn.get('date_time'))
+        if partner_chat_id is None or day is None:
+            continue
+        partner_chat_id = str(partner_chat_id)
+        currency = txn.get('currency') or DEFAULT_CURRENCY
+        operation_type = txn.get('operation_type')
+        is_accrual = operation_type == 'accrual'
+        amount = float(txn.get('total_amount') or 0.0) if is_accrual else 0.0
+
+        row = stats.get((partner_chat_id, day, currency))
+        if row is None:
+            row = stats[(partner_chat_id, day, currency)] = {
+                'partner_chat_id': partner_chat_id, 'stat_date': day, 'currency': currency,
+                'revenue': 0.0, 'points_accrued': 0.0, 'points_spent': 0.0,
+                'transactions_count': 0, 'accrual_count': 0, 'redemption_count': 0, 'unique_clients': 0
+            }
+        row['transactions_count'] += 1
+        row['revenue'] += amount
+        if is_accrual:
+            row['accrual_count'] += 1
+        if operation_type in ('accrual', 'enrollment_bonus'):
+            row['points_accrued'] += float(txn.get('earned_points') or 0)
+        elif operation_type == 'redemption':
+            row['redemption_count'] += 1
+            row['points_spent'] += float(txn.get('spent_points') or 0)
+
+        client_chat_id = txn.get('client_chat_id')
+        if client_chat_id is None:
+            continue
+        client_key = (partner_chat_id, day, currency, str(client_chat_id))
+        client = clients.get(client_key)
+        if client is None:
+            row['unique_clients'] += 1
+            client = clients[client_key] = {
+                'partner_chat_id': partner_chat_id, 'stat_date': day, 'currency': currency,
+                'client_chat_id': str(client_chat_id), 'transactions_count': 0, 'accrual_count': 0, 'revenue': 0.0
+            }
+        client['transactions_count'] += 1
+        client['accrual_count'] += int(is_accrual)
+        client['revenue'] += amount
+    return stats, clients
+
+
+def aggregate_nps(ratings: Iterable[dict]) -> dict:
+    """Сворачивает оценки NPS в строки partner_daily_nps с ключом (partner, день)."""
+    result: dict = {}
+    for item in ratings:
+        rating = item.get('rating')
+        partner_chat_id = item.get('partner_chat_id')
+        day = stat_date(item.get('created_at'))
+        if rating is None or partner_chat_id is None or day is None:
+            continue
+        key = (str(partner_chat_id), day)
+        row = result.get(key)
+        if row is None:
+            row = result[key] = {
+                'partner_chat_id': key[0], 'stat_date': day,
+                'ratings_count': 0, 'ratings_sum': 0, 'promoters': 0, 'passives': 0, 'detractors': 0
+            }
+        row['ratings_count'] += 1
+        row['ratings_sum'] += rating
+        if rating >= 9:
+            row['promoters'] += 1
+        elif rating in (7, 8):
+            row['passives'] += 1
+        elif rating <= 6:
+            row['detractors'] += 1
+    return result
+
+
+def period_bounds(since: Optional[datetime.datetime]) -> tuple:
+    """
+    Делит период «с момента since» на полные дни и неполный первый день.
+
+    Возвращает (first_full_day, partial_day): первый полный день (YYYY-MM-DD или None —
+    весь период) и границы неполного дня (since, начало first_full_day) в ISO или None.
+    """
+    if since is None:
+        return None, None
+    if since.tzinfo is not None:
+        since = since.astimezone(datetime.timezone.utc)
+    first_full_day, partial_day = since.date(), None
+    if since.time() != datetime.time(0):
+        first_full_day += datetime.timedelta(days=1)
+        partial_day = (since.isoformat(), first_full_day.isoformat())
+    return first_full_day.isoformat(), partial_day
+
+
+def points(value) -> int:
+    """Баллы из агрегата (NUMERIC приходит как float или строка) — целым числом, как в transactions."""
+    return int(round(float(value or 0)))
+
+
+def summarize(stats_rows: Iterable[dict], client_rows: Iterable[dict] = (), nps_rows: Iterable[dict] = ()) -> dict:
+    """
+    Итоги по строкам агрегатов (partner_daily_stats, partner_daily_clients, partner_daily_nps)
+    в формате PartnerDailyRollups.period_totals.
+    """
+    stats_rows = list(stats_rows)
+    totals = {
+        'transactions': sum(int(r.get('transactions_count') or 0) for r in stats_rows),
+        'accrual_transactions': sum(int(r.get('accrual_count') or 0) for r in stats_rows),
+        'redemption_transactions': sum(int(r.get('redemption_count') or 0) for r in stats_rows),
+        'revenue': sum((float(r.get('revenue') or 0) for r in stats_rows), 0.0),
+        'points_accrued': sum(points(r.get('points_accrued')) for r in stats_rows),
+        'points_redeemed': sum(points(r.get('points_spent')) for r in stats_rows),
+        'nps': {key: 0 for key in ('ratings_count', 'ratings_sum', 'promoters', 'passives', 'detractors')},
+        'clients': {}
+    }
+    for row in nps_rows:
+        for key in totals['nps']:
+            totals['nps'][key] += int(row.get(key) or 0)
+    for row in client_rows:
+        client = totals['clients'].setdefault(row['client_chat_id'], {'transactions': 0, 'accrual_transactions': 0, 'revenue': 0.0})
+        client['transactions'] += int(row.get('transactions_count') or 0)
+        client['accrual_transactions'] += int(row.get('accrual_count') or 0)
+        client['revenue'] += float(row.get('revenue') or 0)
+    return totals
+
+
+class PartnerDailyRollups:
+    """
+    Дневные агрегаты партнера: partner_daily_stats (по валютам), partner_daily_clients
+    (клиент × день — для уникальных клиентов за период) и partner_daily_nps.
+
+    Таблицы поддерживают триггеры на transactions и nps_ratings
+    (migrations/create_partner_daily_stats.sql); rebuild() пересчитывает их по исходным данным.
+    """
+
+    WRITE_CHUNK = 500
+    READ_WORKERS = 5
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    @property
+    def client(self):
+        return self.manager.client
+
+    # --- Чтение -------------------------------------------------------
+
+    def daily_stats(self, partner_chat_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None) -> list:
+        """Строки partner_daily_stats партнера за дни [start_date, end_date] (границы включительно)."""
+        return self._read_rollup(DAILY_STATS_TABLE, STATS_COLUMNS, partner_chat_id, start_date, end_date)
+
+    def daily_clients(self, partner_chat_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None) -> list:
+        return self._read_rollup(DAILY_CLIENTS_TABLE, CLIENTS_COLUMNS, partner_chat_id, start_date, end_date)
+
+    def daily_nps(self, partner_chat_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None) -> list:
+        return self._read_rollup(DAILY_NPS_TABLE, NPS_ROLLUP_COLUMNS, partner_chat_id, start_date, end_date)
+
+    def all_partners_daily(self, start_date: Optional[str] = None, before: Optional[str] = None) -> tuple:
+        """
+        Строки агрегатов всех партнеров за дни [start_date, before) (по умолчанию — за всё время):
+        (partner_daily_stats, partner_daily_clients, partner_daily_nps).
+        """
+        def reader(table: str, columns: str):
+            def build_query():
+                query = self.client.from_(table).select(f'partner_chat_id, {columns}')
+                if start_date:
+                    query = query.gte('stat_date', start_date)
+                return query.lt('stat_date', before) if before else query
+            return build_query
+
+        return tuple(
+            self.manager._fetch_all_rows(reader(table, columns))
+            for table, columns in ((DAILY_STATS_TABLE, STATS_COLUMNS), (DAILY_CLIENTS_TABLE, CLIENTS_COLUMNS),
+                                   (DAILY_NPS_TABLE, NPS_ROLLUP_COLUMNS))
+        )
+
+    def aggregate_range(self, since: str, until: str, partner_chat_id: Optional[str] = None) -> tuple:
+        """
+        Агрегаты по исходным transactions и nps_ratings за [since, until) — для неполных дней,
+        которых ещё нет в таблицах агрегатов. Без partner_chat_id — по всем партнерам.
+
+        Returns:
+            (stats, clients, nps) — словари строк в формате aggregate_transactions и aggregate_nps
+        """
+        partner_chat_id = str(partner_chat_id) if partner_chat_id else None
+        stats, clients = aggregate_transactions(self._fetch_transactions(partner_chat_id, since, until))
+        return stats, clients, aggregate_nps(self._fetch_nps(partner_chat_id, since, until))
+
+    def period_totals(self, partner_chat_id: str, since: Optional[datetime.datetime] = None, include_clients: bool = True) -> dict:
+        """
+        Итоги партнера начиная с момента since (по умолчанию — за всё время).
+
+        Полные дни берутся из агрегатов, неполный первый день — из transactions и
+        nps_ratings напрямую, поэтому граница периода точная, а объём чтения зависит
+        от числа дней, а не транзакций.
+
+        Returns:
+            {'transactions', 'accrual_transactions', 'redemption_transactions', 'revenue',
+             'points_accrued', 'points_redeemed', 'nps': {...},
+             'clients': {chat_id: {'transactions', 'accrual_transactions', 'revenue'}}}
+        """
+        partner_chat_id = str(partner_chat_id)
+        first_full_day, partial_day = period_bounds(since)
+
+        # Чтения независимы — выполняем их параллельно
+        with ThreadPoolExecutor(max_workers=self.READ_WORKERS) as pool:
+            stats_future = pool.submit(self.daily_stats, partner_chat_id, first_full_day)
+            nps_future = pool.submit(self.daily_nps, partner_chat_id, first_full_day)
+            clients_future = pool.submit(self.daily_clients, partner_chat_id, first_full_day) if include_clients else None
+            partial_txn_future = pool.submit(self._fetch_transactions, partner_chat_id, *partial_day) if partial_day else None
+            partial_nps_future = pool.submit(self._fetch_nps, partner_chat_id, *partial_day) if partial_day else None
+
+            stats_rows, client_rows, nps_rows = [], [], []
+            if partial_day:
+                stats, clients = aggregate_transactions(partial_txn_future.result())
+                stats_rows.extend(stats.values())
+                client_rows.extend(clients.values())
+                nps_rows.extend(aggregate_nps(partial_nps_future.result()).values())
+            stats_rows.extend(stats_future.result())
+            nps_rows.extend(nps_future.result())
+            if clients_future:
+                client_rows.extend(clients_future.result())
+
+        return summarize(stats_rows, client_rows, nps_rows)
+
+    # --- Пересчёт -----------------------------------------------------
+
+    def rebuild(self, partner_chat_id: Optional[str] = None, start_date: Optional[str] = None, end_date: Optional[str] = None) -> int:
+        """
+        Пересчитывает агрегаты по transactions и nps_ratings (после сбоев, ручных правок
+        или до установки триггеров). Сначала пробует RPC rebuild_partner_daily_stats,
+        иначе пересчитывает на стороне приложения. Возвращает число записанных строк.
+        """
+        params = {
+            'p_partner_chat_id': str(partner_chat_id) if partner_chat_id else None,
+            'p_from': start_date,
+            'p_to': end_date
+        }
+        try:
+            response = self.client.rpc('rebuild_partner_daily_stats', params).execute()
+            return int(response.data or 0) if not isinstance(response.data, list) else len(response.data)
+        except Exception as e:
+            logging.warning(f"rebuild_partner_daily_stats RPC unavailable, rebuilding in application: {e}")
+        return self._rebuild_locally(partner_chat_id, start_date, end_date)
+
+    def _rebuild_locally(self, partner_chat_id: Optional[str], start_date: Optional[str], end_date: Optional[str]) -> int:
+        until = (datetime.date.fromisoformat(end_date) + datetime.timedelta(days=1)).isoformat() if end_date else None
+        partner_chat_id = str(partner_chat_id) if partner_chat_id else None
+        stats, clients = aggregate_transactions(self._fetch_transactions(partner_chat_id, start_date, until))
+        nps = aggregate_nps(self._fetch_nps(partner_chat_id, start_date, until))
+
+        written = 0
+        for table, rows in ((DAILY_CLIENTS_TABLE, clients), (DAILY_STATS_TABLE, stats), (DAILY_NPS_TABLE, nps)):
+            query = self.client.from_(table).delete()
+            if partner_chat_id:
+                query = query.eq('partner_chat_id', partner_chat_id)
+            else:
+                query = query.neq('partner_chat_id', '')
+            if start_date:
+                query = query.gte('stat_date', start_date)
+            if end_date:
+                query = query.lte('stat_date', end_date)
+            query.execute()
+
+            rows = list(rows.values())
+            for start in range(0, len(rows), self.WRITE_CHUNK):
+                self.client.from_(table).insert(rows[start:start + self.WRITE_CHUNK]).execute()
+            written += len(rows)
+        return written
+
+    # --- Внутреннее ---------------------------------------------------
+
+    def _read_rollup(self, table: str, columns: str, partner_chat_id: str, start_date: Optional[str], end_date: Optional[str]) -> list:
+        def build_query():
+            query = self.client.from_(table).select(columns).eq('partner_chat_id', str(partner_chat_id))
+            if start_date:
+                query = query.gte('stat_date', start_date)
+            if end_date:
+                query = query.lte('stat_date', end_date)
+            return query
+
+        try:
+            return self.manager._fetch_all_rows(build_query)
+        except Exception as e:
+            # Таблица агрегатов недоступна (миграция не применена) — считаем по исходным данным
+            logging.error(f"Error reading {table} for partner {partner_chat_id}, aggregating raw rows: {e}")
+        until = (datetime.date.fromisoformat(end_date) + datetime.timedelta(days=1)).isoformat() if end_date else None
+        if table == DAILY_NPS_TABLE:
+            return list(aggregate_nps(self._fetch_nps(str(partner_chat_id), start_date, until)).values())
+        stats, clients = aggregate_transactions(self._fetch_transactions(str(partner_chat_id), start_date, until))
+        return list((stats if table == DAILY_STATS_TABLE else clients).values())
+
+    def _fetch_transactions(self, partner_chat_id: Optional[str], since: Optional[str] = None, until: Optional[str] = None) -> list:
+        return self._fetch_source('transactions', TRANSACTION_COLUMNS, 'date_time', partner_chat_id, since, until)
+
+    def _fetch_nps(self, partner_chat_id: Optional[str], since: Optional[str] = None, until: Optional[str] = None) -> list:
+        return self._fetch_source('nps_ratings', NPS_COLUMNS, 'created_at', partner_chat_id, since, until)
+
+    def _fetch_source(self, table: str, columns: str, date_column: str, partner_chat_id: Optional[str],
+                      since: Optional[str], until: Optional[str]) -> list:
+        def build_query():
+            query = self.client.from_(table).select(columns)
+            if partner_chat_id:
+                query = query.eq('partner_chat_id', partner_chat_id)
+            if since:
+                query = query.gte(date_column, since)
+            if until:
+                query = query.lt(date_column, until)
+            return query
+
+        return self.manager._fetch_all_rows(build_query)
@@ -0,0 +1,93 @@
+import datetime
+import logging
+import os
+from typing import Callable, Optional
+
+
+SUBSCRIPTIONS_TABLE = 'client_product_subscriptions'
+
+SWEEP_COLUMNS = 'id, client_chat_id, product_id, valid_until'
+
+
+class ProductSubscriptionSweeper:
+    """
+    Обход подписок на продукты платформы по сроку действия (client_product_subscriptions).
+
+    sweep() переводит истёкшие активные подписки в 'expired' и отмечает подписки,
+    истекающие в ближайшие notice_days, в expiry_notified_at. Подписки читаются
+    страницами по индексу valid_until (WHERE status = 'active'): обработанная страница
+    выходит из выборки, поэтому следующий запрос снова берёт начало диапазона,
+    а в памяти одновременно находится не больше одной страницы.
+
+    По каждой странице вызывается notify(events) с компактным списком
+    {'event': 'expired' | 'expiring', 'subscription_id', 'client_chat_id', 'product_id', 'valid_until'}
+    до того, как страница будет отмечена: при сбое уведомления страница будет обработана
+    повторно (не меньше одного уведомления на подписку).
+    """
+
+    def __init__(self, manager, batch_size: Optional[int] = None, notice_days: Optional[int] = None):
+        self.manager = manager
+        # Подписок в одной странице (одном UPDATE)
+        self.batch_size = int(batch_size if batch_size is not None else os.getenv("PLATFORM_SUBSCRIPTION_SWEEP_BATCH", "1000"))
+        # За сколько дней до окончания подписки предупреждать клиента
+        self.notice_days = int(notice_days if notice_days is not None else os.getenv("PLATFORM_SUBSCRIPTION_NOTICE_DAYS", "3"))
+
+    @property
+    def client(self):
+        return self.manager.client
+
+    def sweep(self, now: Optional[datetime.datetime] = None,
+              notify: Optional[Callable[[list], None]] = None) -> dict:
+        """
+        Returns: {'expired': int, 'expiring': int, 'batches': int}
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        now_iso = now.isoformat()
+        notice_until = (now + datetime.timedelta(days=self.notice_days)).isoformat()
+        result = {'expired': 0, 'expiring': 0, 'batches': 0}
+
+        def expired_page():
+            return (
+                self.client.from_(SUBSCRIPTIONS_TABLE)
+                .select(SWEEP_COLUMNS)
+                .eq('status', 'active')
+                .lt('valid_until', now_iso)
+            )
+
+        def expire(query):
+            return query.update({'status': 'expired'}).eq('status', 'active').lt('valid_until', now_iso)
+
+        def expiring_page():
+            return (
+                self.client.from_(SUBSCRIPTIONS_TABLE)
+                .select(SWEEP_COLUMNS)
+                .eq('status', 'active')
+                .gte('valid_until', now_iso)
+                .lt('valid_until', notice_until)
+                .is_('expiry_notified_at', 'null')
+            )
+
+        def mark_notified(query):
+            return query.update({'expiry_notified_at': now_iso}).eq('status', 'active').is_('expiry_notified_at', 'null')
+
+        for event, build_page, transition in (('expired', expired_page, expire), ('expiring', expiring_page, mark_notified)):
+            while True:
+                page = build_page().order('valid_until').order('id').limit(self.batch_size).execute().data or []
+                if not page:
+                    break
+                if notify:
+                    notify([{
+                        'event': event,
+                        'subscription_id': row['id'],
+                        'client_chat_id': row['client_chat_id'],
+                        'product_id': row['product_id'],
+                        'valid_until': row['valid_until'],
+                    } for row in page])
+                updated = transition(self.client.from_(SUBSCRIPTIONS_TABLE)).in_('id', [row['id'] for row in page]).execute().data or []
+                result[event] += len(updated)
+                result['batches'] += 1
+                if not updated:
+                    # Страница не изменилась (например, нет прав на UPDATE) — не зацикливаемся
+                    logging.error(f"Обход подписок: страница {event} из {len(page)} подписок не обновлена, останавливаюсь")
+                    break
+        return result
@@ -0,0 +1,398 @@
+import datetime
+import logging
+from typing import Iterable, Optional
+
+from dateutil import parser
+
+
+COUNTERS_TABLE = 'product_visit_counters'
+
+DEFAULT_CURRENCY = 'RUB'
+
+COUNTER_COLUMNS = 'id, subscription_id, partner_chat_id, product_id, period_start, visits_count, payout_amount, currency'
+VISIT_COLUMNS = 'id, subscription_id, partner_chat_id, product_id, visited_at, payout_amount, payout_currency'
+
+
+def counter_period(value) -> Optional[str]:
+    """Первый день месяца (UTC, YYYY-MM-DD) для даты визита; None для пустой/нераспознанной даты."""
+    if not value:
+        return None
+    try:
+        moment = parser.isoparse(value) if isinstance(value, str) else value
+    except (TypeError, ValueError):
+        return None
+    if isinstance(moment, datetime.datetime):
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(datetime.timezone.utc)
+        moment = moment.date()
+    return moment.replace(day=1).isoformat()
+
+
+def aggregate_visits(visits: Iterable[dict]) -> dict:
+    """
+    Сворачивает подтверждённые визиты в строки product_visit_counters
+    с ключом (подписка, партнёр, месяц).
+    """
+    result: dict = {}
+    for visit in visits:
+        period = counter_period(visit.get('visited_at'))
+        if visit.get('subscription_id') is None or visit.get('partner_chat_id') is None or period is None:
+            continue
+        key = (visit['subscription_id'], str(visit['partner_chat_id']), period)
+        row = result.get(key)
+        if row is None:
+            row = result[key] = {
+                'subscription_id': key[0], 'partner_chat_id': key[1], 'product_id': visit.get('product_id'),
+                'period_start': period, 'visits_count': 0, 'payout_amount': 0.0,
+                'currency': visit.get('payout_currency') or DEFAULT_CURRENCY
+            }
+        row['visits_count'] += 1
+        row['payout_amount'] += float(visit.get('payout_amount') or 0)
+    for row in result.values():
+        row['payout_amount'] = round(row['payout_amount'], 2)
+    return result
+
+
+def full_months(period_start=None, period_end=None) -> tuple:
+    """
+    Полные календарные месяцы внутри периода [period_start, period_end] (границы — как в
+    выборке визитов: visited_at >= period_start и visited_at <= period_end).
+
+    Возвращает (first, before): первый полный месяц и месяц, с которого начинается неполный
+    хвост периода (YYYY-MM-DD; None — без ограничения). Полных месяцев нет, если first >= before.
+    """
+    first = before = None
+    if period_start:
+        start = period_start.date() if isinstance(period_start, datetime.datetime) else period_start
+        first = start.replace(day=1)
+        at_midnight = not isinstance(period_start, datetime.datetime) or period_start.time() == datetime.time(0)
+        if start != first or not at_midnight:
+            first = (first + datetime.timedelta(days=32)).replace(day=1)
+        first = first.isoformat()
+    if period_end:
+        end = period_end.date() if isinstance(period_end, datetime.datetime) else period_end
+        before = end.replace(day=1).isoformat()
+    return first, before
+
+
+def summarize(counter_rows: Iterable[dict] = (), visits: Iterable[dict] = ()) -> dict:
+    """
+    Сводка партнёра по строкам счётчиков (полные месяцы) и отдельным визитам (неполные).
+    Returns: {'total_visits': int, 'total_payout': float, 'currency': str,
+              'periods': [{'period_start', 'visits', 'payout'}, ...]}
+    """
+    by_period: dict = {}
+    currency = None
+    for row in counter_rows:
+        period = by_period.setdefault(str(row['period_start']), {'visits': 0, 'payout': 0.0})
+        period['visits'] += int(row.get('visits_count') or 0)
+        period['payout'] += float(row.get('payout_amount') or 0)
+        currency = currency or row.get('currency')
+    for visit in visits:
+        key = counter_period(visit.get('visited_at'))
+        if key is None:
+            continue
+        period = by_period.setdefault(key, {'visits': 0, 'payout': 0.0})
+        period['visits'] += 1
+        period['payout'] += float(visit.get('payout_amount') or 0)
+        currency = currency or visit.get('payout_currency')
+    periods = [
+        {'period_start': key, 'visits': value['visits'], 'payout': round(value['payout'], 2)}
+        for key, value in sorted(by_period.items())
+    ]
+    return {
+        'total_visits': sum(p['visits'] for p in periods),
+        'total_payout': round(sum(p['payout'] for p in periods), 2),
+        'currency': currency or DEFAULT_CURRENCY,
+        'periods': periods,
+    }
+
+
+class ProductVisitCounters:
+    """
+    Счётчики визитов по кросс-абонементам: product_visit_counters (подписка × партнёр × месяц).
+
+    Счётчик увеличивается при подтверждении визита — в RPC record_platform_product_visit или через add();
+    новый месяц начинается новой строкой. rebuild() пересчитывает счётчики по product_visits,
+    release_stale_pending() снимает pending-визиты, брошенные записью без RPC.
+    Лимит визитов клиента к партнёру и сводка партнёра читают счётчики, поэтому их
+    стоимость не зависит от числа визитов в истории.
+    """
+
+    WRITE_CHUNK = 500
+    UPDATE_ATTEMPTS = 10
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    @property
+    def client(self):
+        return self.manager.client
+
+    # --- Чтение -------------------------------------------------------
+
+    def partner_visits(self, subscription_id: int, partner_chat_id: str) -> int:
+        """Сколько подтверждённых визитов к партнёру по подписке (для visit_limit_per_client)."""
+        try:
+            r = (
+                self.client.from_(COUNTERS_TABLE)
+                .select('visits_count')
+                .eq('subscription_id', subscription_id)
+                .eq('partner_chat_id', str(partner_chat_id))
+                .execute()
+            )
+            return sum(int(row.get('visits_count') or 0) for row in r.data or [])
+        except Exception as e:
+            # Таблица счётчиков недоступна (миграция не применена) — считаем визиты
+            logging.error(f"Не удалось прочитать {COUNTERS_TABLE} (подписка {subscription_id}), считаю визиты: {e}")
+        r = (
+            self.client.from_('product_visits')
+            .select('id', count='exact')
+            .eq('subscription_id', subscription_id)
+            .eq('partner_chat_id', str(partner_chat_id))
+            .eq('status', 'confirmed')
+            .limit(1)
+            .execute()
+        )
+        return r.count or 0
+
+    def pending_visits(self, subscription_id: int, partner_chat_id: str) -> int:
+        """Визиты к партнёру по подписке, которые сейчас допускаются (pending, ещё не в счётчиках)."""
+        r = (
+            self.client.from_('product_visits')
+            .select('id', count='exact')
+            .eq('subscription_id', subscription_id)
+            .eq('partner_chat_id', str(partner_chat_id))
+            .eq('status', 'pending')
+            .limit(1)
+            .execute()
+        )
+        return r.count or 0
+
+    def partner_periods(self, partner_chat_id: str, first: Optional[str] = None, before: Optional[str] = None) -> list:
+        """Строки счётчиков партнёра за месяцы first <= period_start < before (YYYY-MM-01; None — без границы)."""
+        def build_query():
+            query = self.client.from_(COUNTERS_TABLE).select(COUNTER_COLUMNS).eq('partner_chat_id', str(partner_chat_id))
+            if first:
+                query = query.gte('period_start', first)
+            if before:
+                query = query.lt('period_start', before)
+            return query
+
+        return self.manager._fetch_all_rows(build_query)
+
+    def partner_summary(self, partner_chat_id: str, period_start: Optional[datetime.date] = None,
+                        period_end: Optional[datetime.date] = None) -> dict:
+        """
+        Сводка партнёра за [period_start, period_end] с теми же границами, что у выборки визитов:
+        полные месяцы внутри периода — из счётчиков, неполные месяцы по краям — по визитам,
+        поэтому объём чтения не больше двух неполных месяцев визитов.
+        Returns: формат summarize()
+        """
+        first, before = full_months(period_start, period_end)
+        if first and before and first >= before:
+            # Период внутри одного-двух неполных месяцев — только визиты
+            return summarize(visits=self._confirmed_visits(partner_chat_id, period_start, period_end))
+
+        counters = self.partner_periods(partner_chat_id, first, before)
+        edges = []
+        if period_start and first != period_start.isoformat():
+            edges += self._confirmed_visits(partner_chat_id, period_start, first, end_inclusive=False)
+        if period_end:
+            edges += self._confirmed_visits(partner_chat_id, before, period_end)
+        return summarize(counters, edges)
+
+    def visits_summary(self, partner_chat_id: str, period_start: Optional[datetime.date] = None,
+                       period_end: Optional[datetime.date] = None) -> dict:
+        """Сводка партнёра по подтверждённым визитам, без счётчиков (таблица счётчиков недоступна)."""
+        return summarize(visits=self._confirmed_visits(partner_chat_id, period_start, period_end))
+
+    # --- Запись -------------------------------------------------------
+
+    def add(self, visit: dict, delta: int = 1) -> bool:
+        """
+        Сдвигает счётчик визита на delta (запись визита без RPC или её откат).
+        Обновление сравнивает прочитанное значение и повторяется при гонке; при неудаче
+        счётчик остаётся неточным до rebuild(). Возвращает True, если счётчик изменён.
+        """
+        period = counter_period(visit.get('visited_at'))
+        amount = float(visit.get('payout_amount') or 0) * delta
+        try:
+            for _attempt in range(self.UPDATE_ATTEMPTS):
+                r = (
+                    self.client.from_(COUNTERS_TABLE)
+                    .select('id, visits_count, payout_amount')
+                    .eq('subscription_id', visit['subscription_id'])
+                    .eq('partner_chat_id', str(visit['partner_chat_id']))
+                    .eq('period_start', period)
+                    .limit(1)
+                    .execute()
+                )
+                if not r.data:
+                    if delta < 0:
+                        return False
+                    created = self.client.from_(COUNTERS_TABLE).upsert({
+                        'subscription_id': visit['subscription_id'],
+                        'partner_chat_id': str(visit['partner_chat_id']),
+                        'product_id': visit.get('product_id'),
+                        'period_start': period,
+                        'visits_count': delta,
+                        'payout_amount': round(amount, 2),
+                        'currency': visit.get('payout_currency') or DEFAULT_CURRENCY,
+                    }, on_conflict='subscription_id,partner_chat_id,period_start', ignore_duplicates=True).execute()
+                    if created.data:
+                        return True
+                    continue
+                row = r.data[0]
+                updated = (
+                    self.client.from_(COUNTERS_TABLE)
+                    .update({
+                        'visits_count': row['visits_count'] + delta,
+                        'payout_amount': round(float(row.get('payout_amount') or 0) + amount, 2),
+                        'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    })
+                    .eq('id', row['id'])
+                    .eq('visits_count', row['visits_count'])
+                    .execute()
+                )
+                if updated.data:
+                    return True
+        except Exception as e:
+            logging.error(f"Не удалось обновить {COUNTERS_TABLE} для визита {visit.get('id')}: {e}")
+            return False
+        logging.warning(f"Счётчик {COUNTERS_TABLE} для визита {visit.get('id')} не обновлён: конкурирующие изменения")
+        return False
+
+    # --- Пересчёт -----------------------------------------------------
+
+    def rebuild(self, partner_chat_id: Optional[str] = None) -> int:
+        """
+        Пересчитывает счётчики по product_visits (после сбоев, ручных правок или до
+        установки миграции). Сначала снимает брошенные pending-визиты (release_stale_pending),
+        затем пробует RPC rebuild_product_visit_counters, иначе пересчитывает на стороне
+        приложения. Возвращает число записанных строк.
+        """
+        self.release_stale_pending(partner_chat_id=partner_chat_id, recount=False)
+        return self._recount(partner_chat_id)
+
+    def release_stale_pending(self, now: Optional[datetime.datetime] = None, partner_chat_id: Optional[str] = None,
+                              recount: bool = True) -> int:
+        """
+        Удаляет pending-визиты старше manager.platform_visit_pending_timeout — запись без RPC,
+        прерванную между допуском и подтверждением. Такой визит мог уже попасть в
+        visits_total_used и в счётчик, поэтому visits_total_used затронутых подписок
+        пересчитывается по подтверждённым визитам (сравнением с прочитанным значением; подписки,
+        у которых сейчас идёт запись визита, пропускаются до следующего запуска), а счётчики
+        затронутых партнёров — rebuild() (если recount). Возвращает число удалённых визитов.
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        cutoff = (now - datetime.timedelta(seconds=self.manager.platform_visit_pending_timeout)).isoformat()
+
+        def build_query():
+            query = (
+                self.client.from_('product_visits')
+                .select('id, subscription_id, partner_chat_id')
+                .eq('status', 'pending')
+                .lt('visited_at', cutoff)
+            )
+            return query.eq('partner_chat_id', str(partner_chat_id)) if partner_chat_id else query
+
+        stale = self.manager._fetch_all_rows(build_query)
+        if not stale:
+            return 0
+        ids = [row['id'] for row in stale]
+        for start in range(0, len(ids), self.WRITE_CHUNK):
+            # status в фильтре: визит, подтверждённый в последний момент, не удаляется
+            self.client.from_('product_visits').delete().in_('id', ids[start:start + self.WRITE_CHUNK]).eq('status', 'pending').execute()
+
+        for subscription_id in sorted({row['subscription_id'] for row in stale if row.get('subscription_id') is not None}):
+            self._recount_subscription(subscription_id, cutoff)
+        if recount:
+            for partner in sorted({str(row['partner_chat_id']) for row in stale if row.get('partner_chat_id')}):
+                self._recount(partner)
+        logging.info(f"Released {len(ids)} stale pending product visits")
+        return len(ids)
+
+    def _recount_subscription(self, subscription_id: int, cutoff: str) -> bool:
+        """visits_total_used подписки = число подтверждённых визитов (если сейчас нет записи визита)."""
+        sub = (
+            self.client.from_('client_product_subscriptions')
+            .select('visits_total_used').eq('id', subscription_id).limit(1).execute()
+        ).data
+        if not sub:
+            return False
+
+        def count(status: str, live: bool = False) -> int:
+            query = (
+                self.client.from_('product_visits')
+                .select('id', count='exact')
+                .eq('subscription_id', subscription_id)
+                .eq('status', status)
+            )
+            if live:
+                query = query.gte('visited_at', cutoff)
+            return query.limit(1).execute().count or 0
+
+        confirmed = count('confirmed')
+        if count('pending', live=True):
+            return False
+        used = sub[0].get('visits_total_used') or 0
+        if used == confirmed:
+            return True
+        updated = (
+            self.client.from_('client_product_subscriptions')
+            .update({'visits_total_used': confirmed})
+            .eq('id', subscription_id)
+            .eq('visits_total_used', used)
+            .execute()
+        )
+        return bool(updated.data)
+
+    def _recount(self, partner_chat_id: Optional[str]) -> int:
+        try:
+            response = self.client.rpc('rebuild_product_visit_counters', {
+                'p_partner_chat_id': str(partner_chat_id) if partner_chat_id else None
+            }).execute()
+            return int(response.data or 0) if not isinstance(response.data, list) else len(response.data)
+        except Exception as e:
+            logging.warning(f"RPC rebuild_product_visit_counters недоступна, пересчитываю в приложении: {e}")
+        return self._rebuild_locally(partner_chat_id)
+
+    def _confirmed_visits(self, partner_chat_id: str, since, until, end_inclusive: bool = True) -> list:
+        """Подтверждённые визиты партнёра с since по until (until — включительно или нет)."""
+        def build_query():
+            query = (
+                self.client.from_('product_visits')
+                .select('id, visited_at, payout_amount, payout_currency')
+                .eq('partner_chat_id', str(partner_chat_id))
+                .eq('status', 'confirmed')
+            )
+            if since:
+                query = query.gte('visited_at', since if isinstance(since, str) else since.isoformat())
+            if until:
+                until_iso = until if isinstance(until, str) else until.isoformat()
+                query = query.lte('visited_at', until_iso) if end_inclusive else query.lt('visited_at', until_iso)
+            return query
+
+        return self.manager._fetch_all_rows(build_query)
+
+    def _rebuild_locally(self, partner_chat_id: Optional[str]) -> int:
+        partner_chat_id = str(partner_chat_id) if partner_chat_id else None
+
+        def build_query():
+            query = self.client.from_('product_visits').select(VISIT_COLUMNS).eq('status', 'confirmed')
+            if partner_chat_id:
+                query = query.eq('partner_chat_id', partner_chat_id)
+            return query
+
+        rows = list(aggregate_visits(self.manager._fetch_all_rows(build_query)).values())
+
+        query = self.client.from_(COUNTERS_TABLE).delete()
+        if partner_chat_id:
+            query = query.eq('partner_chat_id', partner_chat_id)
+        else:
+            query = query.neq('partner_chat_id', '')
+        query.execute()
+        for start in range(0, len(rows), self.WRITE_CHUNK):
+            self.client.from_(COUNTERS_TABLE).insert(rows[start:start + self.WRITE_CHUNK]).execute()
+        return len(rows)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Ночной предрасчёт дашбордов партнеров:
+1) Пересчёт дневных агрегатов за вчерашний день (сверка с transactions)
+2) Расчёт get_partner_stats, статистики по дням, когорт и расширенной статистики
+   всех партнеров за один проход
+3) Запись в analytics_cache — утренние открытия дашбордов читают готовые данные
+
+Запуск по cron раз в день, после полуночи UTC.
+"""
+
+import os
+import sys
+import json
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger("partner_dashboards")
+
+
+def main():
+    from supabase_manager import SupabaseManager
+
+    sm = SupabaseManager()
+    if not sm.client:
+        logger.error("Supabase client not initialized. Check SUPABASE_URL and SUPABASE_KEY.")
+        sys.exit(1)
+
+    refresh_days = int(os.getenv("PARTNER_DASHBOARD_REFRESH_DAYS", "1"))
+    result = sm.precompute_partner_dashboards(refresh_days=refresh_days)
+    if not result:
+        logger.error("Partner dashboards precompute failed")
+        sys.exit(1)
+
+    logger.info("Precomputed dashboards: partners=%s entries=%s", result["partners"], result["entries"])
+    print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Обход подписок на продукты платформы (кросс-абонементы):
+1) Истёкшие активные подписки переводятся в 'expired'
+2) Подписки, истекающие в ближайшие PLATFORM_SUBSCRIPTION_NOTICE_DAYS дней, отмечаются
+   как предупреждённые
+3) По каждой пачке в stdout выводятся компактные события (JSON Lines) для рассылки уведомлений
+4) Брошенные pending-визиты (запись прервалась до подтверждения) удаляются, счётчики
+   подписок и визитов пересчитываются
+
+Запуск по cron раз в день.
+"""
+
+import os
+import sys
+import json
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger("platform_subscriptions")
+
+
+def print_events(events: list):
+    for event in events:
+        print(json.dumps(event, ensure_ascii=False, default=str))
+    sys.stdout.flush()
+
+
+def main():
+    from supabase_manager import SupabaseManager
+
+    sm = SupabaseManager()
+    if not sm.client:
+        logger.error("Supabase client not initialized. Check SUPABASE_URL and SUPABASE_KEY.")
+        sys.exit(1)
+
+    result = sm.sweep_platform_product_subscriptions(notify=print_events)
+    if not result:
+        logger.error("Platform subscriptions sweep failed")
+        sys.exit(1)
+
+    logger.info("Swept subscriptions: expired=%s expiring=%s batches=%s", result["expired"], result["expiring"], result["batches"])
+    logger.info("Released stale pending visits: %s", sm.release_stale_platform_product_visits())
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,24 @@ import os
 import json
 import math
 import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Optional, Union, Dict, List
 from dotenv import load_dotenv
 from supabase import create_client, Client
 from postgrest.exceptions import APIError
 from transaction_queue import TransactionQueue
+from news_view_counter import NewsViewCounter
+from user_data_export import UserDataExporter, EXPORT_SECTIONS
+from user_data_erasure import UserDataEraser, CRITICAL_TABLES
+from partner_data_export import PartnerDataExporter
+from partner_analytics import cohort_analysis, partner_stats_payload, advanced_stats_payload, stats_by_period_payload
+from partner_rollups import PartnerDailyRollups
+from partner_dashboards import PartnerDashboardPrecomputer
+from client_stats import ClientStats, mean_interval_days
+from product_visit_counters import ProductVisitCounters
+from product_subscription_sweeper import ProductSubscriptionSweeper
 import pandas as pd
 import logging
 from dateutil import parser # Добавлена библиотека для безопасного парсинга дат
@@ -50,6 +63,32 @@ COMMISSION_BALANCE_COLUMN = 'commission_balance'
 PARTNER_ID_COLUMN = 'referral_source'
 TRANSACTION_TABLE = 'transactions'
 
+# Максимальный размер страницы для списков сообщений и переписок
+MAX_CONVERSATIONS_PAGE_SIZE = 200
+
+# Лента новостей: колонки для списка, размер страницы и число страниц в кэше.
+# views_count не хранится в кэше страниц (версию ленты он не меняет) и дочитывается при каждом ответе
+NEWS_FEED_COLUMNS = 'id, title, preview_text, image_url, views_count, is_published, created_at'
+MAX_NEWS_FEED_PAGE_SIZE = 100
+NEWS_FEED_CACHE_MAX_PAGES = 256
+
+# Размер страницы при полной выгрузке строк для аналитики (keyset по первичному ключу)
+ANALYTICS_PAGE_SIZE = 1000
+
+# Сколько последних визитов возвращает сводка партнёра по кросс-абонементам со списком визитов
+PRODUCT_VISITS_SUMMARY_LIMIT = 100
+
+# Сколько визитов по платформенным продуктам привязывать к batch выплат одним UPDATE
+PAYOUT_VISITS_UPDATE_CHUNK = 500
+
+# Сколько раз повторять допуск визита без RPC, если параллельный визит изменил счётчик подписки
+# или ещё не завершён, и пауза (в секундах) перед повтором в последнем случае
+PLATFORM_VISIT_ADMISSION_ATTEMPTS = 10
+PLATFORM_VISIT_PENDING_WAIT = 0.05
+
+# Сколько заявок партнеров (и chat_id в одном IN при поиске пригласивших) обрабатывать за раз
+PARTNER_APPROVAL_CHUNK = 200
+
 class SupabaseManager:
     """Управляет всеми взаимодействиями с базой данных Supabase."""
 
@@ -99,6 +138,29 @@ class SupabaseManager:
 
         self._analytics_cache_memory: dict[str, dict[str, Any]] = {}
         self.analytics_cache_ttl = int(os.getenv("ANALYTICS_CACHE_TTL", "300"))
+        # Дашборды партнеров, сверяемые с водяным знаком (в том числе ночной предрасчёт), живут дольше
+        self.analytics_precomputed_ttl = int(os.getenv("ANALYTICS_PRECOMPUTED_TTL", "93600"))
+
+        # Кэш счётчиков непрочитанных: (recipient_type, recipient_chat_id, counterpart_chat_id|None) -> значение
+        self._unread_counts_cache: dict[tuple, dict[str, Any]] = {}
+        self._unread_counts_lock = threading.Lock()
+        self.unread_counts_cache_ttl = int(os.getenv("UNREAD_COUNTS_CACHE_TTL", "30"))
+
+        # Кэш страниц ленты новостей, привязанный к версии ленты
+        self._news_feed_cache: dict[tuple, list[dict]] = {}
+        self._news_feed_cache_version: Optional[str] = None
+        self._news_feed_version: Optional[str] = None
+        self._news_feed_version_checked_at: Optional[datetime.datetime] = None
+        self._news_feed_lock = threading.Lock()
+        self.news_feed_version_ttl = int(os.getenv("NEWS_FEED_VERSION_TTL", "30"))
+
+        # Повторное сканирование у того же партнёра в этом окне не создаёт второй визит по кросс-абонементу
+        self.platform_visit_dedup_seconds = int(os.getenv("PLATFORM_VISIT_DEDUP_SECONDS", "60"))
+        # Pending-визит старше этого (секунд) считается брошенным: запись прервалась до подтверждения
+        self.platform_visit_pending_timeout = int(os.getenv("PLATFORM_VISIT_PENDING_TIMEOUT", "600"))
+
+        # RPC, об отсутствии которых уже предупредили: запасной путь дальше работает без повторных логов
+        self._missing_rpcs: set[str] = set()
 
         transaction_rules_env = os.getenv("TRANSACTION_RULES_JSON")
         if transaction_rules_env:
@@ -134,6 +196,15 @@ class SupabaseManager:
                 logging.error(f"Не удалось разобрать TRANSACTION_LIMITS_JSON: {e}")
 
         self.transaction_queue = TransactionQueue(self, os.getenv("TRANSACTION_QUEUE_PATH"))
+        self.news_view_counter = NewsViewCounter(self)
+        self.user_data_exporter = UserDataExporter(self)
+        self.user_data_eraser = UserDataEraser(self)
+        self.partner_data_exporter = PartnerDataExporter(self)
+        self.partner_rollups = PartnerDailyRollups(self)
+        self.client_stats = ClientStats(self)
+        self.partner_dashboards = PartnerDashboardPrecomputer(self)
+        self.product_visit_counters = ProductVisitCounters(self)
+        self.product_subscription_sweeper = ProductSubscriptionSweeper(self)
         
         # ✅ Welcome Bonus теперь в USD эквиваленте (1 балл = $1 USD)
         # По умолчанию: $5 USD (5 баллов)
@@ -505,11 +576,13 @@ class SupabaseManager:
                 if last_dt.tzinfo is None:
                     last_dt = last_dt.replace(tzinfo=datetime.timezone.utc)
                 last_visit_at = last_dt.isoformat()
+                first_dt = parsed[0] if parsed[0].tzinfo else parsed[0].replace(tzinfo=datetime.timezone.utc)
                 to_upsert.append({
                     "client_chat_id": cid,
                     "partner_chat_id": pid,
                     "visit_count": len(parsed),
                     "avg_interval_days": avg_days,
+                    "first_visit_at": first_dt.isoformat(),
                     "last_visit_at": last_visit_at,
                     "last_computed_at": now_iso,
                 })
@@ -1377,13 +1450,14 @@ class SupabaseManager:
         self._transaction_limits_cache_ts = now
         return self._transaction_limits_cache
 
-    def _get_cache_entry(self, cache_key: str) -> Optional[dict]:
+    def _get_cache_entry(self, cache_key: str, max_age: Optional[int] = None) -> Optional[dict]:
+        ttl = max_age if max_age is not None else self.analytics_cache_ttl
         memory_entry = self._analytics_cache_memory.get(cache_key)
         now = datetime.datetime.now(datetime.timezone.utc)
         if memory_entry:
             updated_at = memory_entry.get('updated_at')
             if isinstance(updated_at, datetime.datetime):
-                if (now - updated_at).total_seconds() <= self.analytics_cache_ttl:
+                if (now - updated_at).total_seconds() <= ttl:
                     return memory_entry.get('payload')
 
         if not self.client:
@@ -1405,7 +1479,7 @@ class SupabaseManager:
                     updated_at_dt = parser.isoparse(updated_at) if isinstance(updated_at, str) else None
                 except Exception:
                     updated_at_dt = None
-                if updated_at_dt and (now - updated_at_dt).total_seconds() <= self.analytics_cache_ttl:
+                if updated_at_dt and (now - updated_at_dt).total_seconds() <= ttl:
                     self._analytics_cache_memory[cache_key] = {
                         'payload': entry.get('payload'),
                         'updated_at': updated_at_dt
@@ -1435,6 +1509,29 @@ class SupabaseManager:
         except Exception as e:
             logging.error(f"Ошибка записи analytics_cache [{cache_key}]: {e}")
 
+    def _set_cache_entries(self, entries: Dict[str, dict], chunk_size: int = 500) -> int:
+        """Записывает пачку записей analytics_cache (upsert частями). Возвращает число записанных."""
+        updated_at = datetime.datetime.now(datetime.timezone.utc)
+        for cache_key, payload in entries.items():
+            self._analytics_cache_memory[cache_key] = {'payload': payload, 'updated_at': updated_at}
+
+        if not self.client:
+            return 0
+
+        rows = [
+            {'cache_key': cache_key, 'payload': payload, 'updated_at': updated_at.isoformat()}
+            for cache_key, payload in entries.items()
+        ]
+        written = 0
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            try:
+                self.client.from_('analytics_cache').upsert(chunk).execute()
+                written += len(chunk)
+            except Exception as e:
+                logging.error(f"Ошибка пакетной записи analytics_cache ({len(chunk)} записей): {e}")
+        return written
+
     def _log_setting_change(self, setting_key: str, old_value: Any, new_value: Any, updated_by: str):
         if not self.client:
             return
@@ -1458,12 +1555,22 @@ class SupabaseManager:
     # -----------------------------------------------------------------
 
     def get_client_analytics(self, client_chat_id: int) -> dict:
-        """Calculates key analytical metrics (LTV, transaction frequency) for a client."""
+        """
+        Calculates key analytical metrics (LTV, transaction frequency) for a client.
+
+        Итоги читаются из накопительных агрегатов client_lifetime_stats и client_visit_stats
+        (поддерживаются триггером на transactions), поэтому число запросов не зависит
+        от истории клиента.
+        """
+        stats = {
+            'ltv_usd': 0.0, 'total_transactions': 0, 'months_active': 0, 'freq_per_month': 0.0, 'reg_date': None,
+            'total_points_earned': 0.0, 'total_points_spent': 0.0, 'last_visit': None,
+            'avg_interval_days': 0.0, 'favorite_partners': []
+        }
         if not self.client:
-            return {'ltv_usd': 0.0, 'total_transactions': 0, 'months_active': 0, 'freq_per_month': 0.0, 'reg_date': None}
+            return stats
 
         client_chat_id = str(client_chat_id)
-        stats = {'ltv_usd': 0.0, 'total_transactions': 0, 'months_active': 0, 'freq_per_month': 0.0, 'reg_date': None}
 
         try:
             user_response = self.client.from_(USER_TABLE).select('reg_date').eq('chat_id', client_chat_id).limit(1).execute()
@@ -1481,29 +1588,56 @@ class SupabaseManager:
             months_active = max(1, round(delta.days / 30.44)) 
             stats['months_active'] = months_active
 
-            # !!! ИСПРАВЛЕНО: Заменено 'date' на 'date_time'
-            txn_response = self.client.from_(TRANSACTION_TABLE).select('operation_type, total_amount, date_time').eq('client_chat_id', client_chat_id).execute()
-            transactions = txn_response.data
-            
-            total_accrual_amount = 0.0
-            total_transactions = 0
-            
-            for txn in transactions:
-                total_transactions += 1
-                if txn.get('operation_type') == 'accrual': 
-                    total_accrual_amount += txn.get('total_amount', 0.0) 
-
-            stats['ltv_usd'] = round(total_accrual_amount, 2)
-            stats['total_transactions'] = total_transactions
+            lifetime, visits = self.client_stats.get(client_chat_id)
+            if lifetime:
+                stats['ltv_usd'] = round(float(lifetime.get('ltv') or 0.0), 2)
+                stats['total_transactions'] = int(lifetime.get('transactions_count') or 0)
+                stats['total_points_earned'] = float(lifetime.get('points_earned') or 0)
+                stats['total_points_spent'] = float(lifetime.get('points_spent') or 0)
+                stats['last_visit'] = lifetime.get('last_transaction_at')
+                stats['avg_interval_days'] = mean_interval_days(
+                    lifetime.get('first_transaction_at'), lifetime.get('last_transaction_at'), stats['total_transactions']
+                )
+            stats['favorite_partners'] = [
+                {
+                    'partner_chat_id': visit['partner_chat_id'],
+                    'visits': int(visit.get('visit_count') or 0),
+                    'last_visit': visit.get('last_visit_at'),
+                    'avg_interval_days': float(visit.get('avg_interval_days') or 0.0)
+                }
+                for visit in visits
+            ]
             
             if months_active > 0:
-                stats['freq_per_month'] = round(total_transactions / months_active, 2)
+                stats['freq_per_month'] = round(stats['total_transactions'] / months_active, 2)
 
         except Exception as e:
             logging.error(f"Error fetching client analytics for {client_chat_id}: {e}")
 
         return stats
 
+    def rebuild_client_stats(self, client_chat_id: Optional[str] = None) -> int:
+        """
+        Пересчитывает накопительные агрегаты клиентов (client_lifetime_stats, client_visit_stats) по transactions.
+
+        Args:
+            client_chat_id: ID клиента; если не задан — все клиенты
+
+        Returns:
+            Количество записанных строк агрегатов
+        """
+        if not self.client:
+            return 0
+
+        try:
+            rows = self.client_stats.rebuild(client_chat_id)
+        except Exception as e:
+            logging.error(f"Error rebuilding client stats: {e}")
+            return 0
+
+        logging.info(f"Client stats rebuilt: {rows} rows (client={client_chat_id})")
+        return rows
+
     def get_client_details_for_partner(self, client_chat_id: int) -> Optional[dict]:
         """Получает основные детали клиента, включая аналитические метрики LTV и Частоту."""
         if not self.client: return None
@@ -1533,53 +1667,39 @@ class SupabaseManager:
         """Собирает ключевую статистику для Партнера."""
         if not self.client: return {}
         partner_chat_id = str(partner_chat_id)
+        # Кеш (в том числе ночной предрасчёт дашбордов) сверяется с водяным знаком партнера
         cache_key = f"partner_stats:{partner_chat_id}"
-        cached = self._get_cache_entry(cache_key)
-        if cached:
+        watermark = self._partner_stats_watermark(partner_chat_id)
+        cached = self._get_dashboard_cache_entry(cache_key, watermark)
+        if cached is not None:
             return cached
 
-        stats = {
-            'total_referrals': 0, 'total_transactions': 0, 'total_accrued_points': 0,
-            'total_spent_usd': 0.0, 'avg_nps_rating': 0.0, 'promoters': 0, 'detractors': 0
-        }
-
         try:
-            referrals_response = self.client.from_(USER_TABLE).select('chat_id').eq(PARTNER_ID_COLUMN, partner_chat_id).execute()
-            stats['total_referrals'] = len(referrals_response.data)
-
-            txn_response = self.client.from_(TRANSACTION_TABLE).select('operation_type, total_amount, earned_points, spent_points').eq('partner_chat_id', partner_chat_id).execute()
-            transactions = txn_response.data
-            
-            stats['total_transactions'] = len(transactions)
-            
-            for txn in transactions:
-                if txn.get('operation_type') == 'accrual': 
-                    stats['total_spent_usd'] += txn.get('total_amount', 0.0) 
-                    
-                if txn.get('operation_type') in ['accrual', 'enrollment_bonus']: 
-                    stats['total_accrued_points'] += txn.get('earned_points', 0) 
-
-            nps_response = self.client.from_('nps_ratings').select('rating').eq('partner_chat_id', partner_chat_id).execute()
-            ratings = [r['rating'] for r in nps_response.data]
-
-            if ratings:
-                stats['avg_nps_rating'] = round(sum(ratings) / len(ratings), 2)
-                stats['promoters'] = sum(1 for r in ratings if r >= 9)
-                stats['detractors'] = sum(1 for r in ratings if r <= 6)
+            if watermark is not None:
+                total_referrals = watermark['clients']
+            else:
+                referrals_response = self.client.from_(USER_TABLE).select('chat_id', count='exact').eq(PARTNER_ID_COLUMN, partner_chat_id).limit(1).execute()
+                total_referrals = referrals_response.count or 0
 
+            # Итоги за всё время — сумма дневных агрегатов partner_daily_stats
+            totals = self.partner_rollups.period_totals(partner_chat_id, include_clients=False)
+            stats = partner_stats_payload(total_referrals, totals)
         except Exception as e:
             logging.error(f"Error fetching partner stats for {partner_chat_id}: {e}")
+            return partner_stats_payload()
 
-        self._set_cache_entry(cache_key, stats)
+        self._set_dashboard_cache_entry(cache_key, watermark, stats)
         return stats
     
-    def get_advanced_partner_stats(self, partner_chat_id: str, period_days: int = 30) -> dict:
+    def get_advanced_partner_stats(self, partner_chat_id: str, period_days: int = 30,
+                                   now: Optional[datetime.datetime] = None) -> dict:
         """
         Расширенная статистика партнера с детальными бизнес-метриками.
         
         Args:
             partner_chat_id: ID партнера
             period_days: Период для анализа в днях (по умолчанию 30)
+            now: Конец периода (по умолчанию текущий момент, UTC)
         
         Returns:
             dict с метриками: средний чек, churn rate, конверсии, тренды и т.д.
@@ -1588,194 +1708,202 @@ class SupabaseManager:
             return {}
         
         partner_chat_id = str(partner_chat_id)
-        # Не используем кеш для NPS метрик, чтобы данные всегда были актуальными
-        # cache_key = f"partner_stats:{partner_chat_id}:{period_days}"
-        # cached = self._get_cache_entry(cache_key)
-        # if cached:
-        #     return cached
-
-        now = datetime.datetime.now(datetime.timezone.utc)
+        # Кеш (в том числе ночной предрасчёт дашбордов) сверяется с водяным знаком партнера,
+        # поэтому новая транзакция, оценка NPS или регистрация клиента сразу делает его неактуальным
+        now = now or datetime.datetime.now(datetime.timezone.utc)
         # Если period_days <= 0, считаем, что нужен "весь период" — берём очень раннюю дату
         if period_days and period_days > 0:
             period_start = now - datetime.timedelta(days=period_days)
         else:
             period_start = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
         
-        stats = {
-            # Базовые метрики
-            'period_days': period_days,
-            'total_clients': 0,
-            'active_clients': 0,  # Клиенты с транзакциями за период
-            'new_clients': 0,  # Новые клиенты за период
-            
-            # Финансовые метрики
-            'total_revenue': 0.0,  # Общий оборот
-            'avg_check': 0.0,  # Средний чек
-            'avg_ltv': 0.0,  # Средний LTV клиента
-            
-            # Транзакционные метрики
-            'total_transactions': 0,
-            'accrual_transactions': 0,  # Количество начислений
-            'redemption_transactions': 0,  # Количество списаний
-            'total_points_accrued': 0,
-            'total_points_redeemed': 0,
-            
-            # Метрики вовлеченности
-            'returning_clients': 0,  # Клиенты с >1 транзакцией за период
-            'avg_frequency': 0.0,  # Средняя частота покупок
-            'churn_rate': 0.0,  # Процент ушедших клиентов
-            
-            # NPS метрики
-            'avg_nps': 0.0,
-            'nps_score': 0,  # Чистый NPS индекс
-            'promoters': 0,
-            'passives': 0,
-            'detractors': 0,
-            'total_promoters': 0,  # Количество промоутеров среди клиентов партнера
-            
-            # Конверсионные метрики
-            'registration_to_first_purchase': 0.0,  # % клиентов с первой покупкой
-            'repeat_purchase_rate': 0.0,  # % повторных покупок
-        }
+        # Окно периода скользит: день его начала входит в ключ, а внутри дня payload отдаётся,
+        # только если из окна не выпало ни одной записи с момента расчёта
+        cache_key = f"partner_advanced_stats:{partner_chat_id}:{period_days}:{period_start.date().isoformat()}"
+        watermark = self._partner_stats_watermark(partner_chat_id)
+        cached = self._get_dashboard_cache_entry(cache_key, watermark, partner_chat_id=partner_chat_id, window_start=period_start)
+        if cached is not None:
+            return cached
         
         try:
-            # Получаем всех клиентов партнера
-            all_clients_response = self.client.from_(USER_TABLE).select('chat_id, reg_date').eq(PARTNER_ID_COLUMN, partner_chat_id).execute()
-            all_clients = all_clients_response.data
-            stats['total_clients'] = len(all_clients)
-            
-            # Новые клиенты за период
-            new_clients = [c for c in all_clients if c.get('reg_date') and parser.isoparse(c['reg_date']) >= period_start]
-            stats['new_clients'] = len(new_clients)
-            
-            # Получаем транзакции за период
-            txn_response = self.client.from_(TRANSACTION_TABLE).select('*').eq('partner_chat_id', partner_chat_id).gte('date_time', period_start.isoformat()).execute()
-            transactions = txn_response.data
-            
-            stats['total_transactions'] = len(transactions)
-            
-            # Анализ транзакций
-            accrual_amounts = []
-            active_clients_set = set()
-            client_transaction_counts = {}
-            client_revenues = {}
-            
-            for txn in transactions:
-                client_id = txn.get('client_chat_id')
-                operation_type = txn.get('operation_type')
-                
-                active_clients_set.add(client_id)
-                client_transaction_counts[client_id] = client_transaction_counts.get(client_id, 0) + 1
+            # Независимые запросы выполняются параллельно: клиенты партнера (счётчики),
+            # итоги за период (полные дни из дневных агрегатов, неполный первый день — из transactions)
+            # и промоутеры среди клиентов партнера
+            def count_clients(registered_since: Optional[datetime.datetime] = None) -> int:
+                query = self.client.from_(USER_TABLE).select('chat_id', count='exact').eq(PARTNER_ID_COLUMN, partner_chat_id)
+                if registered_since:
+                    query = query.gte('reg_date', registered_since.isoformat())
+                return query.limit(1).execute().count or 0
+            
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                # Общее число клиентов уже известно из водяного знака
+                total_clients_future = pool.submit(count_clients) if watermark is None else None
+                new_clients_future = pool.submit(count_clients, period_start)
+                totals_future = pool.submit(self.partner_rollups.period_totals, partner_chat_id, period_start)
+                promoters_future = pool.submit(self._count_partner_promoters, partner_chat_id)
                 
-                if operation_type == 'accrual':
-                    stats['accrual_transactions'] += 1
-                    amount = txn.get('total_amount', 0.0)
-                    stats['total_revenue'] += amount
-                    accrual_amounts.append(amount)
-                    stats['total_points_accrued'] += txn.get('earned_points', 0)
-                    
-                    # Учитываем revenue по клиентам
-                    client_revenues[client_id] = client_revenues.get(client_id, 0.0) + amount
-                    
-                elif operation_type == 'redemption':
-                    stats['redemption_transactions'] += 1
-                    stats['total_points_redeemed'] += txn.get('spent_points', 0)
-                elif operation_type == 'enrollment_bonus':
-                    stats['total_points_accrued'] += txn.get('earned_points', 0)
-            
-            stats['active_clients'] = len(active_clients_set)
-            
-            # Средний чек
-            if accrual_amounts:
-                stats['avg_check'] = round(sum(accrual_amounts) / len(accrual_amounts), 2)
-            
-            # Средний LTV
-            if client_revenues:
-                stats['avg_ltv'] = round(sum(client_revenues.values()) / len(client_revenues), 2)
-            
-            # Клиенты с повторными покупками
-            stats['returning_clients'] = sum(1 for count in client_transaction_counts.values() if count > 1)
-            
-            # Средняя частота покупок (транзакций на активного клиента)
-            if stats['active_clients'] > 0:
-                stats['avg_frequency'] = round(stats['total_transactions'] / stats['active_clients'], 2)
-            
-            # Churn rate (упрощенная формула: клиенты без транзакций за период / всего клиентов)
-            if stats['total_clients'] > 0:
-                inactive_clients = stats['total_clients'] - stats['active_clients']
-                stats['churn_rate'] = round((inactive_clients / stats['total_clients']) * 100, 2)
-            
-            # NPS метрики за период (как в дашборде)
-            nps_response = self.client.from_('nps_ratings').select('rating').eq('partner_chat_id', partner_chat_id).gte('created_at', period_start.isoformat()).execute()
-            nps_ratings = nps_response.data if nps_response.data else []
-            
-            if nps_ratings:
-                # Используем точно такую же логику, как в дашборде
-                # В дашборде: const promoters = npsRatings?.filter(r => r.rating >= 9).length || 0;
-                ratings = [r.get('rating') for r in nps_ratings if r.get('rating') is not None]
-                
-                if ratings:
-                    stats['avg_nps'] = round(sum(ratings) / len(ratings), 2)
-                    # Промоутеры: оценки >= 9 (как в дашборде)
-                    stats['promoters'] = len([r for r in ratings if r >= 9])
-                    # Нейтральные: оценки 7-8
-                    stats['passives'] = len([r for r in ratings if r in [7, 8]])
-                    # Детракторы: оценки <= 6
-                    stats['detractors'] = len([r for r in ratings if r <= 6])
-                    
-                    # Чистый NPS индекс (как в дашборде: Math.round(((promoters - detractors) / totalNPS) * 100))
-                    total_ratings = len(ratings)
-                    if total_ratings > 0:
-                        nps_calculation = ((stats['promoters'] - stats['detractors']) / total_ratings) * 100
-                        stats['nps_score'] = int(round(nps_calculation))
-                    else:
-                        stats['nps_score'] = 0
-                else:
-                    # Если нет валидных оценок
-                    stats['avg_nps'] = 0.0
-                    stats['nps_score'] = 0
-                    stats['promoters'] = 0
-                    stats['passives'] = 0
-                    stats['detractors'] = 0
-            else:
-                # Если нет оценок, устанавливаем нулевые значения
-                stats['avg_nps'] = 0.0
-                stats['nps_score'] = 0
-                stats['promoters'] = 0
-                stats['passives'] = 0
-                stats['detractors'] = 0
-            
-            # Получаем промоутеров партнера (клиенты партнера, которые стали промоутерами)
-            try:
-                # Получаем всех клиентов партнера
-                partner_clients = [c['chat_id'] for c in all_clients]
-                if partner_clients:
-                    # Получаем промоутеров среди клиентов партнера
-                    promoters_response = self.client.from_('promoters').select('client_chat_id').in_('client_chat_id', partner_clients).eq('is_active', True).execute()
-                    stats['total_promoters'] = len(promoters_response.data) if promoters_response.data else 0
-                else:
-                    stats['total_promoters'] = 0
-            except Exception as e:
-                logging.error(f"Error fetching promoters for partner {partner_chat_id}: {e}")
-                stats['total_promoters'] = 0
-            
-            # Конверсионные метрики
-            # Регистрация -> Первая покупка
-            clients_with_purchases = len(client_revenues)
-            if stats['total_clients'] > 0:
-                stats['registration_to_first_purchase'] = round((clients_with_purchases / stats['total_clients']) * 100, 2)
-            
-            # Повторные покупки
-            if clients_with_purchases > 0:
-                stats['repeat_purchase_rate'] = round((stats['returning_clients'] / clients_with_purchases) * 100, 2)
+                stats = advanced_stats_payload(
+                    period_days,
+                    totals_future.result(),
+                    total_clients=total_clients_future.result() if total_clients_future else watermark['clients'],
+                    new_clients=new_clients_future.result(),
+                    total_promoters=promoters_future.result()
+                )
             
         except Exception as e:
             logging.error(f"Error fetching advanced partner stats for {partner_chat_id}: {e}")
+            return advanced_stats_payload(period_days)
         
-        # Не кешируем, чтобы NPS метрики всегда были актуальными
-        # self._set_cache_entry(cache_key, stats)
+        self._set_dashboard_cache_entry(cache_key, watermark, stats, window_start=period_start)
         return stats
     
+    def _partner_stats_watermark(self, partner_chat_id: str) -> Optional[dict]:
+        """
+        Водяной знак данных дашбордов партнера: последние id транзакции и оценки NPS
+        (меняются при каждой новой записи), число клиентов и ревизия из partner_stats_revisions
+        (растёт при изменении и удалении старых транзакций и оценок).
+        """
+        def last_id(table: str):
+            response = self.client.from_(table).select('id').eq('partner_chat_id', partner_chat_id).order('id', desc=True).limit(1).execute()
+            return response.data[0]['id'] if response.data else None
+        
+        def clients_count() -> int:
+            response = self.client.from_(USER_TABLE).select('chat_id', count='exact').eq(PARTNER_ID_COLUMN, partner_chat_id).limit(1).execute()
+            return response.count or 0
+        
+        try:
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                transaction_id = pool.submit(last_id, TRANSACTION_TABLE)
+                nps_id = pool.submit(last_id, 'nps_ratings')
+                clients = pool.submit(clients_count)
+                revision = pool.submit(self._partner_stats_revisions, [partner_chat_id])
+                return {
+                    'transaction_id': transaction_id.result(), 'nps_id': nps_id.result(), 'clients': clients.result(),
+                    'revision': (revision.result() or {}).get(partner_chat_id),
+                }
+        except Exception as e:
+            logging.error(f"Error reading partner stats watermark for {partner_chat_id}: {e}")
+            return None
+    
+    def _partner_stats_revisions(self, partner_chat_ids: Optional[List[str]] = None) -> Optional[dict]:
+        """
+        Ревизии данных дашбордов {partner_chat_id: revision} (нет строки — 0) для списка партнеров
+        или всех (None). Без таблицы partner_stats_revisions — None: водяной знак без ревизии.
+        """
+        try:
+            if partner_chat_ids is None:
+                rows = self._fetch_all_rows(
+                    lambda: self.client.from_('partner_stats_revisions').select('partner_chat_id, revision'),
+                    key='partner_chat_id'
+                )
+                return {str(row['partner_chat_id']): int(row['revision'] or 0) for row in rows}
+            rows = self.client.from_('partner_stats_revisions').select('partner_chat_id, revision')\
+                .in_('partner_chat_id', partner_chat_ids).execute().data or []
+            revisions = {str(chat_id): 0 for chat_id in partner_chat_ids}
+            revisions.update({str(row['partner_chat_id']): int(row['revision'] or 0) for row in rows})
+            return revisions
+        except Exception as e:
+            logging.debug(f"partner_stats_revisions unavailable: {e}")
+            return None
+    
+    @staticmethod
+    def _is_watermark_current(cached: Optional[dict], current: Optional[dict]) -> bool:
+        """
+        Кеш актуален, если после расчёта не появилось новых транзакций и оценок NPS
+        (текущие последние id не больше сохранённых), не изменились число клиентов
+        и ревизия (изменения и удаления старых записей).
+        Сравнение id «не больше», а не «равно»: ночной предрасчёт сохраняет глобальные
+        максимальные id на момент запуска, а не последние id каждого партнера.
+        """
+        if not isinstance(cached, dict) or not current:
+            return False
+        for key in ('transaction_id', 'nps_id'):
+            if current.get(key) is not None and (cached.get(key) is None or current[key] > cached[key]):
+                return False
+        return cached.get('clients') == current.get('clients') and cached.get('revision') == current.get('revision')
+    
+    def _get_dashboard_cache_entry(self, cache_key: str, watermark: Optional[dict], partner_chat_id: Optional[str] = None,
+                                   window_start: Optional[datetime.datetime] = None) -> Optional[dict]:
+        """
+        Payload дашборда из analytics_cache, если он актуален для водяного знака.
+        Для скользящего окна (window_start) payload, посчитанный с другим началом окна,
+        отдаётся, только если между старым и новым началом у партнера нет записей.
+        """
+        if watermark is None:
+            return None
+        cached = self._get_cache_entry(cache_key, max_age=self.analytics_precomputed_ttl)
+        if not cached or not self._is_watermark_current(cached.get('watermark'), watermark):
+            return None
+        if window_start is not None and cached.get('window_start') != window_start.isoformat():
+            try:
+                cached_start = parser.isoparse(cached['window_start'])
+            except Exception:
+                return None
+            if not self._partner_window_slice_empty(partner_chat_id, *sorted((cached_start, window_start))):
+                return None
+        return cached.get('stats')
+    
+    def _set_dashboard_cache_entry(self, cache_key: str, watermark: Optional[dict], stats: dict,
+                                   window_start: Optional[datetime.datetime] = None):
+        if watermark is not None:
+            entry = {'watermark': watermark, 'stats': stats}
+            if window_start is not None:
+                entry['window_start'] = window_start.isoformat()
+            self._set_cache_entry(cache_key, entry)
+    
+    def _partner_window_slice_empty(self, partner_chat_id: str, since: datetime.datetime, until: datetime.datetime) -> bool:
+        """Нет ли у партнера транзакций, оценок NPS и регистраций клиентов в [since, until)."""
+        since_iso, until_iso = since.isoformat(), until.isoformat()
+        checks = (
+            (TRANSACTION_TABLE, 'id', 'partner_chat_id', 'date_time'),
+            ('nps_ratings', 'id', 'partner_chat_id', 'created_at'),
+            (USER_TABLE, 'chat_id', PARTNER_ID_COLUMN, 'reg_date'),
+        )
+        try:
+            for table, key, partner_column, date_column in checks:
+                response = self.client.from_(table).select(key).eq(partner_column, partner_chat_id)\
+                    .gte(date_column, since_iso).lt(date_column, until_iso).limit(1).execute()
+                if response.data:
+                    return False
+            return True
+        except Exception as e:
+            logging.warning(f"Error checking dashboard window for {partner_chat_id}: {e}")
+            return False
+    
+    def _count_partner_promoters(self, partner_chat_id: str) -> int:
+        """Количество активных промоутеров среди клиентов партнера."""
+        try:
+            # Один запрос: промоутеры с join на users по внешнему ключу client_chat_id
+            response = self.client.from_('promoters')\
+                .select(f'id, {USER_TABLE}!inner({PARTNER_ID_COLUMN})', count='exact')\
+                .eq(f'{USER_TABLE}.{PARTNER_ID_COLUMN}', partner_chat_id)\
+                .eq('is_active', True)\
+                .limit(1)\
+                .execute()
+            return response.count or 0
+        except Exception as e:
+            logging.warning(f"Promoters join unavailable, counting by client chunks: {e}")
+        
+        try:
+            clients = self._fetch_all_rows(
+                lambda: self.client.from_(USER_TABLE).select('chat_id').eq(PARTNER_ID_COLUMN, partner_chat_id),
+                key='chat_id'
+            )
+            client_ids = [c['chat_id'] for c in clients]
+            total = 0
+            for start in range(0, len(client_ids), 200):
+                response = self.client.from_('promoters')\
+                    .select('id', count='exact')\
+                    .in_('client_chat_id', client_ids[start:start + 200])\
+                    .eq('is_active', True)\
+                    .limit(1)\
+                    .execute()
+                total += response.count or 0
+            return total
+        except Exception as e:
+            logging.error(f"Error fetching promoters for partner {partner_chat_id}: {e}")
+            return 0
+    
     def get_partner_stats_by_period(self, partner_chat_id: str, start_date: str, end_date: str) -> dict:
         """
         Получает статистику партнера за указанный период (для графиков).
@@ -1800,205 +1928,152 @@ class SupabaseManager:
             logging.error(f"Invalid date format: {e}")
             return {}
         
-        result = {
-            'period': {'start': start_date, 'end': end_date},
-            'daily_stats': [],  # Массив объектов {date, revenue, transactions, clients}
-            'totals': {
-                'revenue': 0.0,
-                'transactions': 0,
-                'unique_clients': 0,
-                'points_accrued': 0
-            }
-        }
+        cache_key = f"partner_stats_by_period:{partner_chat_id}:{start_date}:{end_date}"
+        watermark = self._partner_stats_watermark(partner_chat_id)
+        cached = self._get_dashboard_cache_entry(cache_key, watermark)
+        if cached is not None:
+            return cached
         
         try:
-            # Получаем все транзакции за период
-            txn_response = self.client.from_(TRANSACTION_TABLE).select('*').eq('partner_chat_id', partner_chat_id).gte('date_time', start_dt.isoformat()).lte('date_time', end_dt.isoformat()).execute()
-            transactions = txn_response.data
-            
-            # Группируем по дням
-            daily_data = {}
-            all_clients = set()
-            
-            for txn in transactions:
-                txn_date_str = txn.get('date_time', '')
-                if not txn_date_str:
-                    continue
-                
-                txn_date = parser.isoparse(txn_date_str).date()
-                date_key = txn_date.isoformat()
-                
-                if date_key not in daily_data:
-                    daily_data[date_key] = {
-                        'date': date_key,
-                        'revenue': 0.0,
-                        'transactions': 0,
-                        'clients': set(),
-                        'points_accrued': 0
-                    }
-                
-                daily_data[date_key]['transactions'] += 1
-                daily_data[date_key]['clients'].add(txn.get('client_chat_id'))
-                all_clients.add(txn.get('client_chat_id'))
-                
-                if txn.get('operation_type') == 'accrual':
-                    amount = txn.get('total_amount', 0.0)
-                    daily_data[date_key]['revenue'] += amount
-                    result['totals']['revenue'] += amount
-                
-                if txn.get('operation_type') in ['accrual', 'enrollment_bonus']:
-                    points = txn.get('earned_points', 0)
-                    daily_data[date_key]['points_accrued'] += points
-                    result['totals']['points_accrued'] += points
-            
-            # Преобразуем в массив для фронтенда
-            for date_key in sorted(daily_data.keys()):
-                day_data = daily_data[date_key]
-                result['daily_stats'].append({
-                    'date': day_data['date'],
-                    'revenue': round(day_data['revenue'], 2),
-                    'transactions': day_data['transactions'],
-                    'unique_clients': len(day_data['clients']),
-                    'points_accrued': day_data['points_accrued']
-                })
-            
-            result['totals']['transactions'] = len(transactions)
-            result['totals']['unique_clients'] = len(all_clients)
-            result['totals']['revenue'] = round(result['totals']['revenue'], 2)
-            
+            # Дневные агрегаты за период (дни включительно, UTC)
+            start_day, end_day = start_dt.date().isoformat(), end_dt.date().isoformat()
+            stats_rows = self.partner_rollups.daily_stats(partner_chat_id, start_day, end_day)
+            client_rows = self.partner_rollups.daily_clients(partner_chat_id, start_day, end_day) if stats_rows else []
+            result = stats_by_period_payload(start_date, end_date, stats_rows, client_rows)
         except Exception as e:
             logging.error(f"Error fetching partner stats by period: {e}")
+            return stats_by_period_payload(start_date, end_date)
         
+        self._set_dashboard_cache_entry(cache_key, watermark, result)
         return result
     
-    def export_partner_data_to_csv(self, partner_chat_id: str, period_days: int = 30) -> tuple[bool, str]:
+    def rebuild_partner_daily_stats(self, partner_chat_id: Optional[str] = None, start_date: Optional[str] = None, end_date: Optional[str] = None) -> int:
         """
-        Экспортирует данные партнера в CSV формат.
-        
+        Пересчитывает дневные агрегаты партнеров (partner_daily_stats) по transactions и nps_ratings.
+
         Args:
-            partner_chat_id: ID партнера
-            period_days: Период для экспорта в днях
-        
+            partner_chat_id: ID партнера; если не задан — все партнеры
+            start_date: Первый день (YYYY-MM-DD, включительно)
+            end_date: Последний день (YYYY-MM-DD, включительно)
+
         Returns:
-            tuple[bool, str]: (успех, путь к файлу или сообщение об ошибке)
+            Количество записанных строк агрегатов
         """
         if not self.client:
-            return False, "Database not initialized"
-        
-        partner_chat_id = str(partner_chat_id)
-        now = datetime.datetime.now()
-        period_start = now - datetime.timedelta(days=period_days)
-        
+            return 0
+
         try:
-            # Получаем транзакции
-            txn_response = self.client.from_(TRANSACTION_TABLE).select('*').eq('partner_chat_id', partner_chat_id).gte('date_time', period_start.isoformat()).execute()
-            
-            if not txn_response.data:
-                return False, "No data to export"
-            
-            # Создаем DataFrame
-            df = pd.DataFrame(txn_response.data)
-            
-            # Форматируем колонки для читаемости
-            if 'date_time' in df.columns:
-                df['date_time'] = pd.to_datetime(df['date_time']).dt.strftime('%Y-%m-%d %H:%M:%S')
-            
-            # Переименовываем колонки на русский (опционально)
-            column_mapping = {
-                'date_time': 'Дата и время',
-                'client_chat_id': 'ID клиента',
-                'operation_type': 'Тип операции',
-                'total_amount': 'Сумма (руб)',
-                'earned_points': 'Начислено баллов',
-                'spent_points': 'Списано баллов',
-                'description': 'Описание'
-            }
-            
-            # Выбираем нужные колонки
-            export_columns = [col for col in column_mapping.keys() if col in df.columns]
-            df_export = df[export_columns].rename(columns=column_mapping)
-            
-            # Создаем имя файла
-            filename = f"partner_{partner_chat_id}_export_{now.strftime('%Y%m%d_%H%M%S')}.csv"
-            filepath = os.path.join(os.path.dirname(__file__), 'exports', filename)
-            
-            # Создаем директорию exports если её нет
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
-            
-            # Сохраняем в CSV
-            df_export.to_csv(filepath, index=False, encoding='utf-8-sig')  # utf-8-sig для Excel
-            
-            logging.info(f"Exported data for partner {partner_chat_id} to {filepath}")
-            return True, filepath
-            
+            rows = self.partner_rollups.rebuild(partner_chat_id, start_date, end_date)
+        except Exception as e:
+            logging.error(f"Error rebuilding partner daily stats: {e}")
+            return 0
+
+        if partner_chat_id:
+            self._analytics_cache_memory.pop(f"partner_stats:{partner_chat_id}", None)
+        logging.info(f"Partner daily stats rebuilt: {rows} rows (partner={partner_chat_id}, {start_date}..{end_date})")
+        return rows
+    
+    def precompute_partner_dashboards(self, refresh_days: int = 1) -> dict:
+        """
+        Ночной предрасчёт дашбордов всех партнеров (get_partner_stats, get_partner_stats_by_period,
+        get_partner_cohort_analysis, get_advanced_partner_stats) в analytics_cache.
+
+        Args:
+            refresh_days: сколько последних полных дней пересчитать в partner_daily_stats перед расчётом
+
+        Returns:
+            {'partners': ..., 'entries': ..., 'watermark': ...}; пустой dict при ошибке
+        """
+        if not self.client:
+            return {}
+
+        try:
+            return self.partner_dashboards.run(refresh_days=refresh_days)
         except Exception as e:
-            logging.error(f"Error exporting partner data: {e}")
-            return False, f"Export error: {str(e)}"
+            logging.error(f"Error precomputing partner dashboards: {e}")
+            return {}
     
     def get_partner_cohort_analysis(self, partner_chat_id: str) -> dict:
         """
         Когортный анализ клиентов партнера (по месяцам регистрации).
         
+        Клиенты и начисления партнера загружаются один раз (только нужные колонки),
+        когорты и матрица удержания «когорта × месяц» считаются в pandas.
+        
         Args:
-            partner_chat_id: ID партнера
+            partner_chat_id: Chat ID партнера
         
         Returns:
-            dict с когортными данными
+            {'cohorts': [...], 'retention_matrix': [...]}
         """
         if not self.client:
-            return {}
+            logging.error("Supabase client not initialized")
+            return {'cohorts': []}
         
         partner_chat_id = str(partner_chat_id)
-        
-        result = {
-            'cohorts': [],  # Массив когорт с метриками
-            'retention_matrix': []  # Матрица удержания
-        }
+        cache_key = f"partner_cohorts:{partner_chat_id}"
+        watermark = self._partner_stats_watermark(partner_chat_id)
+        cached = self._get_dashboard_cache_entry(cache_key, watermark)
+        if cached is not None:
+            return cached
         
         try:
-            # Получаем всех клиентов партнера
-            clients_response = self.client.from_(USER_TABLE).select('chat_id, reg_date').eq(PARTNER_ID_COLUMN, partner_chat_id).execute()
-            clients = clients_response.data
-            
+            clients = self._fetch_all_rows(
+                lambda: self.client.from_(USER_TABLE).select('chat_id, reg_date').eq(PARTNER_ID_COLUMN, partner_chat_id),
+                key='chat_id'
+            )
             if not clients:
-                return result
-            
-            # Группируем по месяцам регистрации
-            cohort_groups = {}
-            for client in clients:
-                if not client.get('reg_date'):
-                    continue
-                
-                reg_date = parser.isoparse(client['reg_date'])
-                cohort_month = reg_date.strftime('%Y-%m')
-                
-                if cohort_month not in cohort_groups:
-                    cohort_groups[cohort_month] = []
-                
-                cohort_groups[cohort_month].append(client['chat_id'])
+                return {'cohorts': [], 'retention_matrix': []}
             
-            # Анализируем каждую когорту
-            for cohort_month in sorted(cohort_groups.keys()):
-                client_ids = cohort_groups[cohort_month]
-                
-                # Получаем транзакции для когорты
-                txn_response = self.client.from_(TRANSACTION_TABLE).select('client_chat_id, date_time, total_amount').eq('partner_chat_id', partner_chat_id).in_('client_chat_id', client_ids).execute()
-                
-                cohort_revenue = sum(txn.get('total_amount', 0) for txn in txn_response.data if txn.get('operation_type') == 'accrual')
-                cohort_transactions = len(txn_response.data)
-                
-                result['cohorts'].append({
-                    'month': cohort_month,
-                    'clients_count': len(client_ids),
-                    'total_revenue': round(cohort_revenue, 2),
-                    'total_transactions': cohort_transactions,
-                    'avg_revenue_per_client': round(cohort_revenue / len(client_ids), 2) if client_ids else 0
-                })
+            transactions = self._fetch_all_rows(
+                lambda: self.client.from_(TRANSACTION_TABLE)
+                .select('id, client_chat_id, date_time, total_amount, operation_type')
+                .eq('partner_chat_id', partner_chat_id)
+                .eq('operation_type', 'accrual')
+            )
+            result = cohort_analysis(
+                pd.DataFrame(clients, columns=['chat_id', 'reg_date']),
+                pd.DataFrame(transactions, columns=['id', 'client_chat_id', 'date_time', 'total_amount', 'operation_type'])
+            )
             
+            logging.info(f"Cohort analysis completed for partner {partner_chat_id}: {len(result['cohorts'])} cohorts")
         except Exception as e:
-            logging.error(f"Error in cohort analysis: {e}")
+            logging.error(f"Error in cohort analysis for {partner_chat_id}: {e}")
+            return {'cohorts': []}
         
+        self._set_dashboard_cache_entry(cache_key, watermark, result)
         return result
+
+    @staticmethod
+    def _is_missing_rpc(error: Exception) -> bool:
+        """Ошибка означает, что функции нет в БД (миграция не применена), а не сбой её выполнения."""
+        text = str(error)
+        return 'PGRST202' in text or 'Could not find the function' in text or 'function does not exist' in text
+
+    def _log_rpc_fallback(self, rpc_name: str, error: Exception):
+        """Логирует переход на запасной путь: отсутствие RPC — одно предупреждение, прочие ошибки — каждый раз."""
+        if not self._is_missing_rpc(error):
+            logging.error(f"Error calling RPC {rpc_name}, using fallback: {error}")
+        elif rpc_name not in self._missing_rpcs:
+            self._missing_rpcs.add(rpc_name)
+            logging.warning(f"RPC {rpc_name} не найдена, используется запасной путь: {error}")
+
+    def _fetch_all_rows(self, build_query, key: str = 'id', page_size: int = ANALYTICS_PAGE_SIZE) -> list:
+        """
+        Выгружает все строки запроса страницами по курсору key.
+        build_query() должен возвращать новый запрос с select и фильтрами (key — среди колонок).
+        Останавливается на пустой странице, поэтому не зависит от серверного лимита max-rows.
+        """
+        rows, after = [], None
+        while True:
+            query = build_query()
+            if after is not None:
+                query = query.gt(key, after)
+            page = query.order(key).limit(page_size).execute().data or []
+            if not page:
+                return rows
+            rows.extend(page)
+            after = page[-1][key]
         
     def get_all_clients(self) -> pd.DataFrame:
         """Получает всех клиентов."""
@@ -2290,53 +2365,7 @@ class SupabaseManager:
             # Если партнер был приглашен другим партнером, создаем записи в partner_network
             if referred_by_chat_id:
                 try:
-                    # Проверяем, что пригласивший партнер существует
-                    referrer_check = self.client.from_('partners').select('chat_id').eq('chat_id', str(referred_by_chat_id)).limit(1).execute()
-                    if referrer_check.data:
-                        # Создаем запись уровня 1 (прямое приглашение)
-                        network_data = {
-                            'referrer_chat_id': str(referred_by_chat_id),
-                            'referred_chat_id': str(chat_id),
-                            'level': 1,
-                            'is_active': True
-                        }
-                        # Проверяем существование записи перед вставкой
-                        existing = self.client.from_('partner_network').select('id').eq('referrer_chat_id', str(referred_by_chat_id)).eq('referred_chat_id', str(chat_id)).limit(1).execute()
-                        if not existing.data:
-                            self.client.from_('partner_network').insert(network_data).execute()
-                        
-                        # Создаем записи для уровней 2 и 3 (если есть)
-                        # Уровень 2: пригласивший пригласившего
-                        referrer_2_check = self.client.from_('partners').select('referred_by_chat_id').eq('chat_id', str(referred_by_chat_id)).limit(1).execute()
-                        if referrer_2_check.data and referrer_2_check.data[0].get('referred_by_chat_id'):
-                            referrer_2_id = referrer_2_check.data[0]['referred_by_chat_id']
-                            network_data_2 = {
-                                'referrer_chat_id': str(referrer_2_id),
-                                'referred_chat_id': str(chat_id),
-                                'level': 2,
-                                'is_active': True
-                            }
-                            existing_2 = self.client.from_('partner_network').select('id').eq('referrer_chat_id', str(referrer_2_id)).eq('referred_chat_id', str(chat_id)).limit(1).execute()
-                            if not existing_2.data:
-                                self.client.from_('partner_network').insert(network_data_2).execute()
-                            
-                            # Уровень 3: пригласивший пригласившего пригласившего
-                            referrer_3_check = self.client.from_('partners').select('referred_by_chat_id').eq('chat_id', str(referrer_2_id)).limit(1).execute()
-                            if referrer_3_check.data and referrer_3_check.data[0].get('referred_by_chat_id'):
-                                referrer_3_id = referrer_3_check.data[0]['referred_by_chat_id']
-                                network_data_3 = {
-                                    'referrer_chat_id': str(referrer_3_id),
-                                    'referred_chat_id': str(chat_id),
-                                    'level': 3,
-                                    'is_active': True
-                                }
-                                existing_3 = self.client.from_('partner_network').select('id').eq('referrer_chat_id', str(referrer_3_id)).eq('referred_chat_id', str(chat_id)).limit(1).execute()
-                                if not existing_3.data:
-                                    self.client.from_('partner_network').insert(network_data_3).execute()
-                        
-                        logging.info(f"Созданы записи в partner_network для партнера {chat_id}, приглашенного партнером {referred_by_chat_id}")
-                    else:
-                        logging.warning(f"Пригласивший партнер {referred_by_chat_id} не найден в системе")
+                    self._create_partner_network_links({str(chat_id): str(referred_by_chat_id)})
                 except Exception as e:
                     logging.error(f"Ошибка создания записей в partner_network для партнера {chat_id}: {e}")
                     # Не прерываем процесс одобрения, если ошибка в создании сети
@@ -2346,6 +2375,137 @@ class SupabaseManager:
             logging.error(f"Error approving partner: {e}")
             return False
 
+    def approve_partners(self, chat_ids: List[Union[int, str]]) -> dict:
+        """
+        Одобряет несколько заявок партнеров за один проход. На каждую пачку из PARTNER_APPROVAL_CHUNK
+        заявок — одна выборка заявок, одно обновление статуса и один upsert в partners; после всех
+        пачек — одно построение partner_network для всех приглашенных партнеров.
+
+        Returns:
+            {'approved': [chat_id, ...], 'not_found': [chat_id, ...], 'network_links': int}
+        """
+        result = {'approved': [], 'not_found': [], 'network_links': 0}
+        if not self.client:
+            return result
+        chat_ids = list(dict.fromkeys(str(chat_id) for chat_id in chat_ids))
+        # Сеть строится после всех пачек: пригласивший может быть одобрен в более поздней пачке
+        referred_by: Dict[str, str] = {}
+        for start in range(0, len(chat_ids), PARTNER_APPROVAL_CHUNK):
+            chunk = chat_ids[start:start + PARTNER_APPROVAL_CHUNK]
+            try:
+                apps = self.client.from_('partner_applications').select('*').in_('chat_id', chunk).execute().data or []
+                found = {str(app['chat_id']): app for app in apps}
+                result['not_found'].extend(chat_id for chat_id in chunk if chat_id not in found)
+                if not found:
+                    continue
+                self.client.from_('partner_applications').update({'status': 'Approved'}).in_('chat_id', list(found)).execute()
+                self.client.from_('partners').upsert(
+                    [self._partner_record(chat_id, app) for chat_id, app in found.items()], on_conflict='chat_id'
+                ).execute()
+                result['approved'].extend(found)
+            except Exception as e:
+                logging.error(f"Error approving partners {chunk[0]}..{chunk[-1]}: {e}")
+                continue
+            referred_by.update(
+                (chat_id, str(app['referred_by_chat_id']))
+                for chat_id, app in found.items() if app.get('referred_by_chat_id')
+            )
+
+        if referred_by:
+            try:
+                result['network_links'] = self._create_partner_network_links(referred_by)
+            except Exception as e:
+                logging.error(f"Ошибка создания записей в partner_network для {len(referred_by)} партнеров: {e}")
+        if result['not_found']:
+            logging.error(f"approve_partners: applications not found for {result['not_found']}")
+        return result
+
+    def _referral_chains(self, table: str, rpc_name: str, chat_ids: List[str], depth: int = 3) -> Dict[str, List[str]]:
+        """
+        Цепочки пригласивших (по table.referred_by_chat_id) для нескольких chat_id одним поиском:
+        {chat_id: [chat_id, пригласивший chat_id, пригласивший пригласившего, ...]} длиной до depth.
+        В цепочку попадают только строки, которые есть в table; цепочка обрывается
+        на первой отсутствующей (для отсутствующего chat_id — пустой список).
+
+        Сначала RPC rpc_name (рекурсивный запрос, строки chat_id, ancestor_chat_id, depth),
+        без неё — по одному запросу к table на уровень сразу для всех цепочек.
+        """
+        chat_ids = list(dict.fromkeys(str(chat_id) for chat_id in chat_ids))
+        try:
+            rows = self.client.rpc(rpc_name, {'p_chat_ids': chat_ids, 'p_depth': depth}).execute().data or []
+            chains: Dict[str, List[str]] = {chat_id: [] for chat_id in chat_ids}
+            for row in sorted(rows, key=lambda r: r['depth']):
+                chains.setdefault(str(row['chat_id']), []).append(str(row['ancestor_chat_id']))
+            return chains
+        except Exception as e:
+            logging.warning(f"RPC {rpc_name} недоступна, ищу пригласивших запросами: {e}")
+
+        # chat_id -> chat_id пригласившего (None, если не приглашен); общий для всех цепочек
+        referrers: Dict[str, Optional[str]] = {}
+        frontier = set(chat_ids)
+        for _ in range(depth):
+            frontier -= set(referrers)
+            if not frontier:
+                break
+            pending = sorted(frontier)
+            for start in range(0, len(pending), PARTNER_APPROVAL_CHUNK):
+                rows = (
+                    self.client.from_(table)
+                    .select('chat_id, referred_by_chat_id')
+                    .in_('chat_id', pending[start:start + PARTNER_APPROVAL_CHUNK])
+                    .execute().data or []
+                )
+                for row in rows:
+                    referrers[str(row['chat_id'])] = str(row['referred_by_chat_id']) if row.get('referred_by_chat_id') else None
+            frontier = {referrers[chat_id] for chat_id in pending if referrers.get(chat_id)}
+
+        chains = {}
+        for chat_id in chat_ids:
+            chain, current = [], chat_id
+            while current in referrers and current not in chain and len(chain) < depth:
+                chain.append(current)
+                current = referrers[current]
+            chains[chat_id] = chain
+        return chains
+
+    @staticmethod
+    def _referral_link_rows(referred_by: Dict[str, str], chains: Dict[str, List[str]]) -> List[dict]:
+        """
+        Строки связей (referrer_chat_id, referred_chat_id, level, is_active) для приглашенных
+        ({chat_id: chat_id пригласившего}) по цепочкам пригласивших из _referral_chains.
+        Связь с самим собой (цикл в цепочке) и все уровни выше нее не создаются.
+        """
+        rows = []
+        for chat_id, referrer_chat_id in referred_by.items():
+            for level, ancestor_chat_id in enumerate(chains.get(referrer_chat_id) or [], start=1):
+                if ancestor_chat_id == chat_id:
+                    break
+                rows.append({
+                    'referrer_chat_id': ancestor_chat_id,
+                    'referred_chat_id': chat_id,
+                    'level': level,
+                    'is_active': True
+                })
+        return rows
+
+    def _create_partner_network_links(self, referred_by: Dict[str, str]) -> int:
+        """
+        Создает записи partner_network уровней 1-3 для приглашенных партнеров
+        ({chat_id нового партнера: chat_id пригласившего}): пригласившие ищутся одним
+        поиском цепочек для всех партнеров, записи пишутся одним идемпотентным upsert
+        (существующие связи не меняются). Возвращает число записей в upsert.
+        """
+        chains = self._referral_chains('partners', 'get_partner_referral_chains', sorted(set(referred_by.values())))
+        for referrer_chat_id in sorted({r for r in referred_by.values() if not chains.get(r)}):
+            logging.warning(f"Пригласивший партнер {referrer_chat_id} не найден в системе")
+        rows = self._referral_link_rows(referred_by, chains)
+        if rows:
+            self.client.from_('partner_network').upsert(
+                rows, on_conflict='referrer_chat_id,referred_chat_id', ignore_duplicates=True
+            ).execute()
+            logging.info(f"Созданы записи в partner_network для {len(referred_by)} партнеров ({len(rows)} связей)")
+        return len(rows)
+
     def reject_partner(self, chat_id: int) -> bool:
         """Отклоняет заявку партнера."""
         if not self.client: return False
@@ -2371,18 +2531,7 @@ class SupabaseManager:
                 
             app_data = app_response.data[0]
             
-            # Формируем запись для partners, копируя только доступные поля из заявки
-            record = {
-                'chat_id': str(partner_chat_id),
-                'name': app_data.get('name') or app_data.get('contact_person') or 'Партнер',
-                'company_name': app_data.get('company_name', ''),
-                'business_type': app_data.get('business_type'),
-                'city': app_data.get('city', ''),
-                'district': app_data.get('district', ''),
-                'username': app_data.get('username'),  # Копируем username мастера
-                'booking_url': app_data.get('booking_url'),  # Копируем ссылку на бронирование
-                'referred_by_chat_id': app_data.get('referred_by_chat_id')  # Копируем chat_id пригласившего партнера
-            }
+            record = self._partner_record(partner_chat_id, app_data)
             
             # upsert по chat_id — если строка есть, не меняем другие поля
             self.client.from_('partners').upsert(record, on_conflict='chat_id').execute()
@@ -2391,6 +2540,21 @@ class SupabaseManager:
             logging.error(f"ensure_partner_record failed for {partner_chat_id}: {e}")
             return False
 
+    @staticmethod
+    def _partner_record(partner_chat_id: str, app_data: dict) -> dict:
+        """Запись для partners, копирующая только доступные поля из заявки."""
+        return {
+            'chat_id': str(partner_chat_id),
+            'name': app_data.get('name') or app_data.get('contact_person') or 'Партнер',
+            'company_name': app_data.get('company_name', ''),
+            'business_type': app_data.get('business_type'),
+            'city': app_data.get('city', ''),
+            'district': app_data.get('district', ''),
+            'username': app_data.get('username'),  # Копируем username мастера
+            'booking_url': app_data.get('booking_url'),  # Копируем ссылку на бронирование
+            'referred_by_chat_id': app_data.get('referred_by_chat_id')  # Копируем chat_id пригласившего партнера
+        }
+
     def set_partner_business_type(self, partner_chat_id: str, business_type: str) -> bool:
         """Устанавливает категорию услуг партнёра (business_type) в tables partner_applications и partners."""
         if not self.client:
@@ -3168,32 +3332,6 @@ class SupabaseManager:
         if not self.client:
             return False, None
         
-        # #region agent log
-        try:
-            import json as _json
-            _payload = {
-                "sessionId": "debug-session",
-                "runId": "pre-fix",
-                "hypothesisId": "H1-H5",
-                "location": "supabase_manager.py:create_news:entry",
-                "message": "Entered create_news",
-                "data": {
-                    "has_title": bool(news_data.get("title")),
-                    "has_content": bool(news_data.get("content")),
-                    "keys": sorted(list(news_data.keys())),
-                },
-                "timestamp": __import__("time").time(),
-            }
-            logging.info(f"[DEBUG] {_json.dumps(_payload, ensure_ascii=False)}")
-            try:
-                with open("/Users/ghbi/Downloads/loyalitybot/.cursor/debug.log", "a", encoding="utf-8") as _f:
-                    _f.write(_json.dumps(_payload, ensure_ascii=False) + "\n")
-            except Exception:
-                pass
-        except Exception:
-            pass
-        # #endregion agent log
-        
         try:
             # Валидация обязательных полей
             if not news_data.get('title') or not news_data.get('content'):
@@ -3223,69 +3361,12 @@ class SupabaseManager:
             if news_data.get('content_en'):
                 record['content_en'] = news_data['content_en']
             
-            # #region agent log
-            try:
-                import json as _json
-                _payload = {
-                    "sessionId": "debug-session",
-                    "runId": "pre-fix",
-                    "hypothesisId": "H2-H4",
-                    "location": "supabase_manager.py:create_news:before_insert",
-                    "message": "Before insert into news",
-                    "data": {
-                        "has_title_en": "title_en" in record,
-                        "has_preview_text_en": "preview_text_en" in record,
-                        "has_content_en": "content_en" in record,
-                        "record_keys": sorted(list(record.keys())),
-                    },
-                    "timestamp": __import__("time").time(),
-                }
-                _log_msg = f"[DEBUG] {_json.dumps(_payload, ensure_ascii=False)}"
-                logging.info(_log_msg)
-                print(_log_msg, flush=True)  # Гарантированный вывод в stdout
-                try:
-                    with open("/Users/ghbi/Downloads/loyalitybot/.cursor/debug.log", "a", encoding="utf-8") as _f:
-                        _f.write(_json.dumps(_payload, ensure_ascii=False) + "\n")
-                except Exception:
-                    pass
-            except Exception:
-                pass
-            # #endregion agent log
-            
             try:
                 # Пытаемся вставить запись с переводами
                 result = self.client.from_('news').insert(record).execute()
             except Exception as e:
                 # Если колонок _en ещё нет в БД, пробуем вставить запись без переводов
-                _warn_msg = f"Failed to insert news with translations, retrying without *_en columns. Error: {e}"
-                logging.warning(_warn_msg)
-                print(f"[WARNING] {_warn_msg}", flush=True)
-                
-                # #region agent log
-                try:
-                    import json as _json
-                    _payload = {
-                        "sessionId": "debug-session",
-                        "runId": "pre-fix",
-                        "hypothesisId": "H2-H3",
-                        "location": "supabase_manager.py:create_news:retry_without_translations",
-                        "message": "Retry insert without *_en columns after error",
-                        "data": {
-                            "error_str": str(e)[:500],
-                        },
-                        "timestamp": __import__("time").time(),
-                    }
-                    _log_msg = f"[DEBUG] {_json.dumps(_payload, ensure_ascii=False)}"
-                    logging.error(_log_msg)
-                    print(_log_msg, flush=True)
-                    try:
-                        with open("/Users/ghbi/Downloads/loyalitybot/.cursor/debug.log", "a", encoding="utf-8") as _f:
-                            _f.write(_json.dumps(_payload, ensure_ascii=False) + "\n")
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-                # #endregion agent log
+                logging.warning(f"Failed to insert news with translations, retrying without *_en columns. Error: {e}")
 
                 record.pop('title_en', None)
                 record.pop('preview_text_en', None)
@@ -3295,64 +3376,13 @@ class SupabaseManager:
             if result.data and len(result.data) > 0:
                 news_id = result.data[0]['id']
                 logging.info(f"News created successfully with ID: {news_id}")
-                
-                # #region agent log
-                try:
-                    import json as _json
-                    _payload = {
-                        "sessionId": "debug-session",
-                        "runId": "pre-fix",
-                        "hypothesisId": "H1-H4",
-                        "location": "supabase_manager.py:create_news:success",
-                        "message": "News created successfully",
-                        "data": {
-                            "news_id": news_id,
-                        },
-                        "timestamp": __import__("time").time(),
-                    }
-                    logging.info(f"[DEBUG] {_json.dumps(_payload, ensure_ascii=False)}")
-                    try:
-                        with open("/Users/ghbi/Downloads/loyalitybot/.cursor/debug.log", "a", encoding="utf-8") as _f:
-                            _f.write(_json.dumps(_payload, ensure_ascii=False) + "\n")
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-                # #endregion agent log
-
+                self._invalidate_news_feed_cache()
                 return True, news_id
             
             return False, None
             
         except Exception as e:
             logging.error(f"Error creating news: {e}")
-            
-            # #region agent log
-            try:
-                import json as _json
-                _payload = {
-                    "sessionId": "debug-session",
-                    "runId": "pre-fix",
-                    "hypothesisId": "H1-H5",
-                    "location": "supabase_manager.py:create_news:exception",
-                    "message": "Exception in create_news",
-                    "data": {
-                        "error_str": str(e)[:500],
-                    },
-                    "timestamp": __import__("time").time(),
-                }
-                _log_msg = f"[DEBUG] {_json.dumps(_payload, ensure_ascii=False)}"
-                logging.error(_log_msg)
-                print(_log_msg, flush=True)  # Гарантированный вывод в stdout
-                try:
-                    with open("/Users/ghbi/Downloads/loyalitybot/.cursor/debug.log", "a", encoding="utf-8") as _f:
-                        _f.write(_json.dumps(_payload, ensure_ascii=False) + "\n")
-                except Exception:
-                    pass
-            except Exception:
-                pass
-            # #endregion agent log
-
             return False, None
 
     def get_all_news(self, published_only: bool = True) -> pd.DataFrame:
@@ -3381,6 +3411,115 @@ class SupabaseManager:
             logging.error(f"Error getting news: {e}")
             return pd.DataFrame()
 
+    def get_news_feed(
+        self,
+        limit: int = 20,
+        before: Optional[tuple] = None,
+        published_only: bool = True
+    ) -> list[dict]:
+        """
+        Получает страницу ленты новостей только с колонками для списка.
+        
+        Полный текст и переводы не загружаются — для них есть get_news_by_id.
+        Страницы кэшируются в памяти и сбрасываются при смене версии ленты
+        (app_settings.news_feed_version, её увеличивает триггер на news). Просмотры
+        версию не меняют, поэтому для страницы из кэша views_count дочитывается по id.
+        
+        Args:
+            limit: Размер страницы (не более MAX_NEWS_FEED_PAGE_SIZE)
+            before: Курсор (created_at, id) последней новости предыдущей страницы
+            published_only: Если True, возвращает только опубликованные новости
+        
+        Returns:
+            Список новостей, новые первыми
+        """
+        if not self.client:
+            return []
+        
+        limit = max(1, min(int(limit), MAX_NEWS_FEED_PAGE_SIZE))
+        cache_key = (published_only, limit, tuple(before) if before else None)
+        version = self._get_news_feed_version()
+        
+        # Без версии (миграция не применена) кэш не используется
+        if version is not None:
+            with self._news_feed_lock:
+                if self._news_feed_cache_version != version:
+                    self._news_feed_cache.clear()
+                    self._news_feed_cache_version = version
+                cached = self._news_feed_cache.get(cache_key)
+            if cached is not None:
+                return self._with_news_views(cached)
+        
+        try:
+            query = self.client.from_('news').select(NEWS_FEED_COLUMNS)
+            
+            if published_only:
+                query = query.eq('is_published', True)
+            
+            if before:
+                created_at, news_id = before
+                query = query\
+                    .lte('created_at', created_at)\
+                    .or_(f"created_at.lt.{created_at},and(created_at.eq.{created_at},id.lt.{int(news_id)})")
+            
+            response = query\
+                .order('created_at', desc=True)\
+                .order('id', desc=True)\
+                .limit(limit)\
+                .execute()
+            items = response.data or []
+        except Exception as e:
+            logging.error(f"Error getting news feed: {e}")
+            return []
+        
+        with self._news_feed_lock:
+            if version is not None and self._news_feed_cache_version == version:
+                if len(self._news_feed_cache) >= NEWS_FEED_CACHE_MAX_PAGES:
+                    self._news_feed_cache.pop(next(iter(self._news_feed_cache)))
+                self._news_feed_cache[cache_key] = [
+                    {key: value for key, value in item.items() if key != 'views_count'} for item in items
+                ]
+        return [dict(item) for item in items]
+
+    def _with_news_views(self, items: list[dict]) -> list[dict]:
+        """Копии новостей из кэша страниц с актуальным views_count (один запрос по id)."""
+        views = {}
+        if items:
+            try:
+                response = self.client.from_('news')\
+                    .select('id, views_count')\
+                    .in_('id', [item['id'] for item in items])\
+                    .execute()
+                views = {row['id']: row.get('views_count') for row in response.data or []}
+            except Exception as e:
+                logging.warning(f"Error getting news views for cached feed page: {e}")
+        return [dict(item, views_count=views.get(item['id'])) for item in items]
+
+    @staticmethod
+    def get_news_cursor(news: dict) -> tuple:
+        """Возвращает курсор (created_at, id) новости для get_news_feed."""
+        return (news.get('created_at'), news.get('id'))
+
+    def _get_news_feed_version(self) -> Optional[str]:
+        """Версия ленты новостей; перечитывается из БД не чаще раза в news_feed_version_ttl секунд."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._news_feed_lock:
+            checked_at = self._news_feed_version_checked_at
+            if checked_at and (now - checked_at).total_seconds() <= self.news_feed_version_ttl:
+                return self._news_feed_version
+        
+        version = self.get_app_setting('news_feed_version')
+        with self._news_feed_lock:
+            self._news_feed_version = version
+            self._news_feed_version_checked_at = now
+        return version
+
+    def _invalidate_news_feed_cache(self):
+        with self._news_feed_lock:
+            self._news_feed_cache.clear()
+            self._news_feed_cache_version = None
+            self._news_feed_version_checked_at = None
+
     def get_news_by_id(self, news_id: int) -> Optional[dict]:
         """
         Получает новость по ID.
@@ -3426,6 +3565,7 @@ class SupabaseManager:
             
             self.client.from_('news').update(updates).eq('id', news_id).execute()
             logging.info(f"News {news_id} updated successfully")
+            self._invalidate_news_feed_cache()
             return True
             
         except Exception as e:
@@ -3448,6 +3588,7 @@ class SupabaseManager:
         try:
             self.client.from_('news').delete().eq('id', news_id).execute()
             logging.info(f"News {news_id} deleted successfully")
+            self._invalidate_news_feed_cache()
             return True
             
         except Exception as e:
@@ -3458,30 +3599,23 @@ class SupabaseManager:
         """
         Увеличивает счетчик просмотров новости.
         
+        Просмотр попадает в буфер NewsViewCounter и записывается в БД агрегированным
+        атомарным инкрементом раз в NEWS_VIEWS_FLUSH_INTERVAL секунд и при остановке.
+        
         Args:
             news_id: ID новости
         
         Returns:
-            True если успешно, False иначе
+            True если просмотр учтён, False иначе
         """
         if not self.client:
             return False
         
-        try:
-            # Получаем текущее количество просмотров
-            news = self.get_news_by_id(news_id)
-            if not news:
-                return False
-            
-            current_views = news.get('views_count', 0)
-            new_views = current_views + 1
-            
-            self.client.from_('news').update({'views_count': new_views}).eq('id', news_id).execute()
-            return True
-            
-        except Exception as e:
-            logging.error(f"Error incrementing views for news {news_id}: {e}")
-            return False
+        return self.news_view_counter.record(news_id)
+
+    def flush_news_views(self) -> int:
+        """Немедленно записывает накопленные просмотры новостей. Возвращает число записанных просмотров."""
+        return self.news_view_counter.flush()
 
     # -----------------------------------------------------------------
     # GDPR COMPLIANCE METHODS
@@ -3491,6 +3625,9 @@ class SupabaseManager:
         """
         Экспортирует все данные пользователя в соответствии с GDPR (Right to Data Portability).
         
+        Разделы читаются параллельно. Для пользователей с большой историей
+        используйте export_user_data_archive — он не держит данные в памяти.
+        
         Args:
             chat_id: Telegram chat ID пользователя
         
@@ -3501,73 +3638,40 @@ class SupabaseManager:
             logging.error("Supabase client not initialized")
             return None
         
+        legacy_sections = {
+            'client_data', 'partner_data', 'transactions', 'partner_transactions',
+            'partner_applications', 'partner_services', 'partner_promotions'
+        }
+        sections = [section for section in EXPORT_SECTIONS if section[0] in legacy_sections]
+        exporter = self.user_data_exporter
+        
+        def fetch(section):
+            name, table, column, cursor_column = section
+            try:
+                return name, [row for page in exporter.iter_section(table, column, cursor_column, str(chat_id)) for row in page]
+            except Exception as e:
+                logging.warning(f"No {name} found for {chat_id}: {e}")
+                return name, []
+        
         try:
+            with ThreadPoolExecutor(max_workers=max(exporter.max_workers, 1)) as pool:
+                fetched = dict(pool.map(fetch, sections))
+            
             user_data = {
                 'export_date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
                 'chat_id': chat_id,
-                'client_data': None,
-                'partner_data': None,
-                'transactions': [],
-                'partner_applications': []
+                'client_data': (fetched['client_data'] or [None])[0],
+                'partner_data': (fetched['partner_data'] or [None])[0],
+                'transactions': fetched['transactions'],
+                'partner_applications': fetched['partner_applications']
             }
-            
-            # 1. Данные клиента
-            try:
-                client_response = self.client.from_('clients').select('*').eq('chat_id', chat_id).execute()
-                if client_response.data:
-                    user_data['client_data'] = client_response.data[0]
-            except Exception as e:
-                logging.warning(f"No client data found for {chat_id}: {e}")
-            
-            # 2. Данные партнера
-            try:
-                partner_response = self.client.from_('partners').select('*').eq('chat_id', chat_id).execute()
-                if partner_response.data:
-                    user_data['partner_data'] = partner_response.data[0]
-            except Exception as e:
-                logging.warning(f"No partner data found for {chat_id}: {e}")
-            
-            # 3. Транзакции (как клиента)
-            try:
-                transactions_response = self.client.from_('transactions').select('*').eq('client_chat_id', chat_id).execute()
-                if transactions_response.data:
-                    user_data['transactions'] = transactions_response.data
-            except Exception as e:
-                logging.warning(f"No transactions found for {chat_id}: {e}")
-            
-            # 4. Транзакции (как партнера)
-            try:
-                partner_trans_response = self.client.from_('transactions').select('*').eq('partner_chat_id', chat_id).execute()
-                if partner_trans_response.data:
-                    user_data['partner_transactions'] = partner_trans_response.data
-            except Exception as e:
-                logging.warning(f"No partner transactions found for {chat_id}: {e}")
-            
-            # 5. Заявки на партнерство
-            try:
-                applications_response = self.client.from_('partner_applications').select('*').eq('chat_id', chat_id).execute()
-                if applications_response.data:
-                    user_data['partner_applications'] = applications_response.data
-            except Exception as e:
-                logging.warning(f"No partner applications found for {chat_id}: {e}")
-            
-            # 6. Услуги партнера
-            if user_data['partner_data']:
-                try:
-                    services_response = self.client.from_('services').select('*').eq('partner_chat_id', chat_id).execute()
-                    if services_response.data:
-                        user_data['partner_services'] = services_response.data
-                except Exception as e:
-                    logging.warning(f"No services found for partner {chat_id}: {e}")
-            
-            # 7. Акции партнера
+            if fetched['partner_transactions']:
+                user_data['partner_transactions'] = fetched['partner_transactions']
             if user_data['partner_data']:
-                try:
-                    promotions_response = self.client.from_('promotions').select('*').eq('partner_chat_id', chat_id).execute()
-                    if promotions_response.data:
-                        user_data['partner_promotions'] = promotions_response.data
-                except Exception as e:
-                    logging.warning(f"No promotions found for partner {chat_id}: {e}")
+                if fetched['partner_services']:
+                    user_data['partner_services'] = fetched['partner_services']
+                if fetched['partner_promotions']:
+                    user_data['partner_promotions'] = fetched['partner_promotions']
             
             logging.info(f"Successfully exported data for user {chat_id}")
             return user_data
@@ -3576,11 +3680,34 @@ class SupabaseManager:
             logging.error(f"Error exporting user data for {chat_id}: {e}")
             return None
 
+    def export_user_data_archive(self, chat_id: str, output_dir: Optional[str] = None) -> Optional[str]:
+        """
+        Экспортирует данные пользователя (GDPR) в zip-архив на диске.
+        
+        Разделы (профиль, транзакции, сообщения, рефералы, NPS и т.д.) читаются
+        параллельно и постранично, каждый пишется в свой JSON Lines файл;
+        manifest.json содержит число строк и контрольную сумму каждого раздела.
+        
+        Returns:
+            Путь к архиву или None в случае ошибки
+        """
+        if not self.client:
+            logging.error("Supabase client not initialized")
+            return None
+        
+        try:
+            return self.user_data_exporter.export_to_archive(str(chat_id), output_dir)
+        except Exception as e:
+            logging.error(f"Error exporting user data archive for {chat_id}: {e}")
+            return None
+
     def delete_user_data(self, chat_id: str) -> dict:
         """
         Полностью удаляет все данные пользователя из системы в соответствии с GDPR (Right to be Forgotten).
         
         ВНИМАНИЕ: Это действие необратимо!
+        Транзакции не удаляются, а анонимизируются (финансовая отчетность).
+        Для массового удаления используйте enqueue_user_erasure + process_erasure_queue.
         
         Args:
             chat_id: Telegram chat ID пользователя
@@ -3600,72 +3727,13 @@ class SupabaseManager:
         }
         
         try:
-            # 1. Удаление услуг партнера (если есть)
-            try:
-                self.client.from_('services').delete().eq('partner_chat_id', chat_id).execute()
-                deletion_results['tables_deleted']['services'] = 'deleted'
-                logging.info(f"Deleted services for {chat_id}")
-            except Exception as e:
-                deletion_results['tables_deleted']['services'] = f'error: {str(e)}'
-                logging.warning(f"Error deleting services for {chat_id}: {e}")
-            
-            # 2. Удаление акций партнера (если есть)
-            try:
-                self.client.from_('promotions').delete().eq('partner_chat_id', chat_id).execute()
-                deletion_results['tables_deleted']['promotions'] = 'deleted'
-                logging.info(f"Deleted promotions for {chat_id}")
-            except Exception as e:
-                deletion_results['tables_deleted']['promotions'] = f'error: {str(e)}'
-                logging.warning(f"Error deleting promotions for {chat_id}: {e}")
-            
-            # 3. Анонимизация транзакций (не удаляем, чтобы не нарушить финансовую отчетность)
-            # Заменяем chat_id на "DELETED_USER" для соблюдения GDPR
-            try:
-                # Транзакции как клиента
-                self.client.from_('transactions').update({
-                    'client_chat_id': 'DELETED_USER',
-                    'description': 'User data deleted per GDPR request'
-                }).eq('client_chat_id', chat_id).execute()
-                
-                # Транзакции как партнера
-                self.client.from_('transactions').update({
-                    'partner_chat_id': 'DELETED_USER'
-                }).eq('partner_chat_id', chat_id).execute()
-                
-                deletion_results['tables_deleted']['transactions'] = 'anonymized'
-                logging.info(f"Anonymized transactions for {chat_id}")
-            except Exception as e:
-                deletion_results['tables_deleted']['transactions'] = f'error: {str(e)}'
-                deletion_results['success'] = False
-                logging.error(f"Error anonymizing transactions for {chat_id}: {e}")
-            
-            # 4. Удаление заявок на партнерство
-            try:
-                self.client.from_('partner_applications').delete().eq('chat_id', chat_id).execute()
-                deletion_results['tables_deleted']['partner_applications'] = 'deleted'
-                logging.info(f"Deleted partner applications for {chat_id}")
-            except Exception as e:
-                deletion_results['tables_deleted']['partner_applications'] = f'error: {str(e)}'
-                logging.warning(f"Error deleting partner applications for {chat_id}: {e}")
-            
-            # 5. Удаление данных партнера
-            try:
-                self.client.from_('partners').delete().eq('chat_id', chat_id).execute()
-                deletion_results['tables_deleted']['partners'] = 'deleted'
-                logging.info(f"Deleted partner data for {chat_id}")
-            except Exception as e:
-                deletion_results['tables_deleted']['partners'] = f'error: {str(e)}'
-                logging.warning(f"Error deleting partner data for {chat_id}: {e}")
-            
-            # 6. Удаление данных клиента (последним, т.к. может быть FK)
-            try:
-                self.client.from_('clients').delete().eq('chat_id', chat_id).execute()
-                deletion_results['tables_deleted']['clients'] = 'deleted'
-                logging.info(f"Deleted client data for {chat_id}")
-            except Exception as e:
-                deletion_results['tables_deleted']['clients'] = f'error: {str(e)}'
+            deletion_results['tables_deleted'] = self.user_data_eraser.erase([chat_id])
+            failed = {
+                table for table, status in deletion_results['tables_deleted'].items()
+                if str(status).startswith('error')
+            }
+            if failed & CRITICAL_TABLES or not deletion_results['tables_deleted'].get('clients'):
                 deletion_results['success'] = False
-                logging.error(f"Error deleting client data for {chat_id}: {e}")
             
             if deletion_results['success']:
                 logging.info(f"Successfully deleted all data for user {chat_id}")
@@ -3680,18 +3748,61 @@ class SupabaseManager:
             deletion_results['error'] = str(e)
             return deletion_results
 
+    def enqueue_user_erasure(self, chat_ids: List[str], requested_by: Optional[str] = None) -> int:
+        """
+        Ставит пользователей в очередь GDPR-удаления (gdpr_erasure_requests).
+        Повторная постановка уже поставленного пользователя ничего не меняет.
+        
+        Returns:
+            Количество переданных уникальных chat_id (0 при ошибке)
+        """
+        if not self.client:
+            logging.error("Supabase client not initialized")
+            return 0
+        try:
+            return self.user_data_eraser.enqueue(chat_ids, requested_by)
+        except Exception as e:
+            logging.error(f"Error enqueueing GDPR erasure for {len(chat_ids)} users: {e}")
+            return 0
+
+    def process_erasure_queue(self, max_batches: Optional[int] = None) -> dict:
+        """
+        Обрабатывает очередь GDPR-удаления пачками (по одному запросу на таблицу и пачку).
+        Незавершённые пачки остаются в очереди и повторяются при следующем вызове.
+        
+        Returns:
+            {'batches': int, 'completed': int, 'failed': int}
+        """
+        if not self.client:
+            logging.error("Supabase client not initialized")
+            return {'batches': 0, 'completed': 0, 'failed': 0}
+        try:
+            return self.user_data_eraser.process_pending(max_batches)
+        except Exception as e:
+            logging.error(f"Error processing GDPR erasure queue: {e}")
+            return {'batches': 0, 'completed': 0, 'failed': 0, 'error': str(e)}
+
     # -----------------------------------------------------------------
     # PARTNER ANALYTICS METHODS
     # -----------------------------------------------------------------
     # Примечание: get_advanced_partner_stats определена выше (строка 1086)
     
-    def export_partner_data_to_csv(self, partner_chat_id: str, period_days: int = 90) -> tuple:
+    def export_partner_data(self, partner_chat_id: str, period_days: int = 90, fmt: str = 'csv',
+                            columns: Optional[List[str]] = None, output_dir: Optional[str] = None,
+                            now: Optional[datetime.datetime] = None) -> tuple:
         """
-        Экспортирует данные партнера в CSV файл.
+        Экспортирует транзакции партнера в CSV или Parquet файл.
+        
+        Строки читаются постранично и сразу пишутся на диск, число строк в файле
+        сверяется с источником.
         
         Args:
             partner_chat_id: Chat ID партнера
-            period_days: Количество дней для экспорта
+            period_days: Количество дней для экспорта (<= 0 — вся история)
+            fmt: 'csv' или 'parquet'
+            columns: Колонки экспорта (см. partner_data_export.EXPORT_COLUMNS)
+            output_dir: Каталог для файла (по умолчанию временный каталог системы)
+            now: Момент отсчёта периода (по умолчанию — сейчас)
         
         Returns:
             Tuple[bool, str]: (success, filepath_or_error_message)
@@ -3701,125 +3812,28 @@ class SupabaseManager:
             return False, "Database not available"
         
         try:
-            import csv
-            import tempfile
-            
-            # Определяем период
-            now = datetime.datetime.now(datetime.timezone.utc)
-            period_start = now - datetime.timedelta(days=period_days)
-            
-            # Получаем транзакции
-            transactions_response = self.client.from_('transactions').select('*').eq('partner_chat_id', partner_chat_id).gte('date_time', period_start.isoformat()).order('date_time', desc=True).execute()
-            transactions = transactions_response.data if transactions_response.data else []
-            
-            if not transactions:
-                return False, "Нет данных за указанный период"
-            
-            # Создаем временный CSV файл
-            temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.csv', encoding='utf-8-sig', newline='')
-            
-            # Заголовки
-            fieldnames = [
-                'Дата и время',
-                'Тип операции',
-                'Клиент ID',
-                'Сумма чека ($)',
-                'Изменение баллов',
-                'Баланс после',
-                'Описание'
-            ]
-            
-            writer = csv.DictWriter(temp_file, fieldnames=fieldnames)
-            writer.writeheader()
-            
-            # Записываем данные
-            for txn in transactions:
-                writer.writerow({
-                    'Дата и время': txn.get('date_time', ''),
-                    'Тип операции': 'Начисление' if txn.get('operation_type') == 'accrual' else 'Списание',
-                    'Клиент ID': txn.get('client_chat_id', ''),
-                    'Сумма чека ($)': txn.get('total_amount', 0),
-                    'Изменение баллов': txn.get('points_change', 0),
-                    'Баланс после': txn.get('balance_after', 0),
-                    'Описание': txn.get('description', '')
-                })
-            
-            temp_file.close()
-            
-            logging.info(f"CSV export created for partner {partner_chat_id}: {len(transactions)} transactions")
-            return True, temp_file.name
-            
+            path, rows = self.partner_data_exporter.export(partner_chat_id, period_days, fmt, columns, output_dir, now)
         except Exception as e:
-            logging.error(f"Error exporting partner data to CSV for {partner_chat_id}: {e}")
+            logging.error(f"Error exporting partner data for {partner_chat_id}: {e}")
             return False, str(e)
+        
+        if not path:
+            return False, "Нет данных за указанный период"
+        return True, path
     
-    def get_partner_cohort_analysis(self, partner_chat_id: str) -> dict:
+    def export_partner_data_to_csv(self, partner_chat_id: str, period_days: int = 90) -> tuple:
         """
-        Проводит когортный анализ клиентов партнера.
-        Группирует клиентов по месяцам регистрации и анализирует их поведение.
+        Экспортирует данные партнера в CSV файл.
         
         Args:
             partner_chat_id: Chat ID партнера
+            period_days: Количество дней для экспорта
         
         Returns:
-            Словарь с когортными данными
+            Tuple[bool, str]: (success, filepath_or_error_message)
         """
-        if not self.client:
-            logging.error("Supabase client not initialized")
-            return {'cohorts': []}
-        
-        try:
-            # Получаем всех клиентов партнера
-            clients_response = self.client.from_('clients').select('chat_id, reg_date').eq('referrer_chat_id', partner_chat_id).execute()
-            clients = clients_response.data if clients_response.data else []
-            
-            if not clients:
-                return {'cohorts': []}
-            
-            # Группируем клиентов по месяцам регистрации
-            cohort_groups = {}
-            
-            for client in clients:
-                if not client.get('reg_date'):
-                    continue
-                
-                reg_date = parser.parse(client['reg_date'])
-                cohort_month = f"{reg_date.year}-{str(reg_date.month).zfill(2)}"
-                
-                if cohort_month not in cohort_groups:
-                    cohort_groups[cohort_month] = []
-                
-                cohort_groups[cohort_month].append(client['chat_id'])
-            
-            # Анализируем каждую когорту
-            cohorts = []
-            
-            for cohort_month, client_ids in sorted(cohort_groups.items()):
-                # Получаем транзакции для клиентов этой когорты
-                transactions_response = self.client.from_('transactions').select('*').eq('partner_chat_id', partner_chat_id).in_('client_chat_id', client_ids).execute()
-                transactions = transactions_response.data if transactions_response.data else []
-                
-                accrual_transactions = [t for t in transactions if t.get('operation_type') == 'accrual']
-                
-                total_revenue = sum(float(t.get('total_amount', 0)) for t in accrual_transactions)
-                total_transactions = len(accrual_transactions)
-                
-                cohorts.append({
-                    'month': cohort_month,
-                    'clients_count': len(client_ids),
-                    'total_revenue': round(total_revenue, 2),
-                    'total_transactions': total_transactions,
-                    'avg_revenue_per_client': round(total_revenue / len(client_ids), 2) if client_ids else 0,
-                    'avg_transactions_per_client': round(total_transactions / len(client_ids), 2) if client_ids else 0
-                })
-            
-            logging.info(f"Cohort analysis completed for partner {partner_chat_id}: {len(cohorts)} cohorts")
-            return {'cohorts': cohorts}
-            
-        except Exception as e:
-            logging.error(f"Error in cohort analysis for {partner_chat_id}: {e}")
-            return {'cohorts': []}
-
+        return self.export_partner_data(partner_chat_id, period_days, fmt='csv')
+    
     # ============================================
     # НАСТРОЙКИ ПРИЛОЖЕНИЯ
     # ============================================
@@ -3936,53 +3950,30 @@ class SupabaseManager:
             logging.error(f"Error get_chat_id_by_referral_code: {e}")
             return None
 
-    def _create_referral_tree_links(self, new_user_chat_id: str, direct_referrer_chat_id: str):
-        """Создаёт связи в referral_tree для всех уровней (до 3 уровней вверх)."""
-        if not self.client:
-            return
+    def _create_referral_tree_links(self, new_user_chat_id: str, direct_referrer_chat_id: str) -> int:
+        """
+        Создаёт связи в referral_tree для всех уровней (до 3 уровней вверх): цепочка рефереров —
+        один поиск (RPC get_user_referral_chains или по запросу к users на уровень), связи — один
+        идемпотентный upsert, поэтому параллельные регистрации не создают дублей.
+        Возвращает число связей в upsert.
+        """
+        if not self.client or not direct_referrer_chat_id:
+            return 0
         
         try:
-            # Уровень 1: прямой реферер
-            tree_data_1 = {
-                'referrer_chat_id': direct_referrer_chat_id,
-                'referred_chat_id': new_user_chat_id,
-                'level': 1,
-                'is_active': True
-            }
-            # Проверяем, не существует ли уже связь
-            existing = self.client.from_('referral_tree').select('id').eq('referrer_chat_id', direct_referrer_chat_id).eq('referred_chat_id', new_user_chat_id).limit(1).execute()
-            if not existing.data:
-                self.client.from_('referral_tree').insert(tree_data_1).execute()
-            
-            # Уровень 2: реферер реферера
-            referrer_2_data = self.client.from_(USER_TABLE).select('referred_by_chat_id').eq('chat_id', direct_referrer_chat_id).limit(1).execute()
-            if referrer_2_data.data and referrer_2_data.data[0].get('referred_by_chat_id'):
-                referrer_2_id = referrer_2_data.data[0]['referred_by_chat_id']
-                tree_data_2 = {
-                    'referrer_chat_id': referrer_2_id,
-                    'referred_chat_id': new_user_chat_id,
-                    'level': 2,
-                    'is_active': True
-                }
-                existing_2 = self.client.from_('referral_tree').select('id').eq('referrer_chat_id', referrer_2_id).eq('referred_chat_id', new_user_chat_id).limit(1).execute()
-                if not existing_2.data:
-                    self.client.from_('referral_tree').insert(tree_data_2).execute()
-                
-                # Уровень 3: реферер реферера реферера
-                referrer_3_data = self.client.from_(USER_TABLE).select('referred_by_chat_id').eq('chat_id', referrer_2_id).limit(1).execute()
-                if referrer_3_data.data and referrer_3_data.data[0].get('referred_by_chat_id'):
-                    referrer_3_id = referrer_3_data.data[0]['referred_by_chat_id']
-                    tree_data_3 = {
-                        'referrer_chat_id': referrer_3_id,
-                        'referred_chat_id': new_user_chat_id,
-                        'level': 3,
-                        'is_active': True
-                    }
-                    existing_3 = self.client.from_('referral_tree').select('id').eq('referrer_chat_id', referrer_3_id).eq('referred_chat_id', new_user_chat_id).limit(1).execute()
-                    if not existing_3.data:
-                        self.client.from_('referral_tree').insert(tree_data_3).execute()
+            referred_by = {str(new_user_chat_id): str(direct_referrer_chat_id)}
+            chains = self._referral_chains(USER_TABLE, 'get_user_referral_chains', [str(direct_referrer_chat_id)])
+            rows = self._referral_link_rows(referred_by, chains)
+            if not rows:
+                logging.warning(f"Реферер {direct_referrer_chat_id} не найден, связи referral_tree для {new_user_chat_id} не созданы")
+                return 0
+            self.client.from_('referral_tree').upsert(
+                rows, on_conflict='referrer_chat_id,referred_chat_id', ignore_duplicates=True
+            ).execute()
+            return len(rows)
         except Exception as e:
             logging.error(f"Error creating referral tree links: {e}")
+            return 0
 
     def _build_referral_tree(self, referred_chat_id: str, level: int = 1, max_level: int = 3) -> list:
         """Строит дерево рефералов для начисления бонусов (от приглашённого к пригласившему)."""
@@ -5433,6 +5424,11 @@ class SupabaseManager:
             if result.data and len(result.data) > 0:
                 message_id = result.data[0].get('id')
                 logging.info(f"Message saved: ID={message_id}, client={client_chat_id}, partner={partner_chat_id}, sender={sender_type}")
+                # Счётчик в БД обновляет триггер, здесь — только локальный кэш
+                if sender_type == 'client':
+                    self._adjust_cached_unread_count('partner', partner_chat_id, client_chat_id, 1)
+                else:
+                    self._adjust_cached_unread_count('client', client_chat_id, partner_chat_id, 1)
                 return message_id
             return None
         except Exception as e:
@@ -5444,15 +5440,22 @@ class SupabaseManager:
         client_chat_id: str, 
         partner_chat_id: str, 
         limit: int = 50,
-        offset: int = 0
+        offset: int = 0,
+        before: Optional[tuple] = None,
+        after: Optional[tuple] = None
     ) -> list[dict]:
         """Получает историю переписки между клиентом и партнёром.
         
+        Для прокрутки используется курсор (created_at, id) — см. get_message_cursor.
+        Курсор не зависит от глубины истории и новых сообщений, в отличие от offset.
+        
         Args:
             client_chat_id: Chat ID клиента
             partner_chat_id: Chat ID партнёра
-            limit: Максимальное количество сообщений
-            offset: Смещение для пагинации
+            limit: Максимальное количество сообщений (не более MAX_CONVERSATIONS_PAGE_SIZE)
+            offset: Смещение для пагинации (устаревшее, используется только без курсора)
+            before: Курсор — вернуть сообщения старше указанного
+            after: Курсор — вернуть сообщения новее указанного
         
         Returns:
             Список сообщений, отсортированных по дате (старые первыми)
@@ -5460,12 +5463,40 @@ class SupabaseManager:
         if not self.client:
             return []
         
+        limit = max(1, min(int(limit), MAX_CONVERSATIONS_PAGE_SIZE))
+        
         try:
-            result = self.client.from_('messages')\
+            query = self.client.from_('messages')\
                 .select('*')\
                 .eq('client_chat_id', str(client_chat_id))\
-                .eq('partner_chat_id', str(partner_chat_id))\
+                .eq('partner_chat_id', str(partner_chat_id))
+            
+            if before:
+                created_at, message_id = before
+                # lte ограничивает диапазон индекса, or_ уточняет порядок внутри одной метки времени
+                result = query\
+                    .lte('created_at', created_at)\
+                    .or_(f"created_at.lt.{created_at},and(created_at.eq.{created_at},id.lt.{int(message_id)})")\
+                    .order('created_at', desc=True)\
+                    .order('id', desc=True)\
+                    .limit(limit)\
+                    .execute()
+                return list(reversed(result.data or []))
+            
+            if after:
+                created_at, message_id = after
+                result = query\
+                    .gte('created_at', created_at)\
+                    .or_(f"created_at.gt.{created_at},and(created_at.eq.{created_at},id.gt.{int(message_id)})")\
+                    .order('created_at', desc=False)\
+                    .order('id', desc=False)\
+                    .limit(limit)\
+                    .execute()
+                return result.data or []
+            
+            result = query\
                 .order('created_at', desc=False)\
+                .order('id', desc=False)\
                 .range(offset, offset + limit - 1)\
                 .execute()
             
@@ -5474,6 +5505,11 @@ class SupabaseManager:
             logging.error(f"Error getting conversation: {e}", exc_info=True)
             return []
 
+    @staticmethod
+    def get_message_cursor(message: dict) -> tuple:
+        """Возвращает курсор (created_at, id) сообщения для get_conversation."""
+        return (message.get('created_at'), message.get('id'))
+
     def mark_message_as_read(self, message_id: int) -> bool:
         """Отмечает сообщение как прочитанное.
         
@@ -5487,10 +5523,16 @@ class SupabaseManager:
             return False
         
         try:
-            self.client.from_('messages')\
+            result = self.client.from_('messages')\
                 .update({'is_read': True})\
                 .eq('id', message_id)\
                 .execute()
+            rows = result.data if isinstance(result.data, list) else []
+            for row in rows:
+                if row.get('sender_type') == 'client':
+                    self._invalidate_unread_cache('partner', row.get('partner_chat_id'))
+                else:
+                    self._invalidate_unread_cache('client', row.get('client_chat_id'))
             return True
         except Exception as e:
             logging.error(f"Error marking message as read: {e}", exc_info=True)
@@ -5528,6 +5570,10 @@ class SupabaseManager:
                 .eq('is_read', False)\
                 .execute()
             
+            if reader_type == 'client':
+                self._reset_cached_unread_count('client', client_chat_id, partner_chat_id)
+            else:
+                self._reset_cached_unread_count('partner', partner_chat_id, client_chat_id)
             return True
         except Exception as e:
             logging.error(f"Error marking conversation as read: {e}", exc_info=True)
@@ -5540,9 +5586,13 @@ class SupabaseManager:
     ) -> int:
         """Получает количество непрочитанных сообщений.
         
+        Значение берётся из локального кэша или из message_unread_counters
+        (один запрос по первичному ключу); счётчики поддерживает триггер на messages.
+        
         Args:
             client_chat_id: Chat ID клиента (если нужно для клиента)
-            partner_chat_id: Chat ID партнёра (если нужно для партнёра)
+            partner_chat_id: Chat ID партнёра (если нужно для партнёра).
+                Вместе с client_chat_id — непрочитанные клиентом сообщения от этого партнёра
         
         Returns:
             Количество непрочитанных сообщений
@@ -5550,6 +5600,40 @@ class SupabaseManager:
         if not self.client:
             return 0
         
+        if client_chat_id:
+            cache_key = ('client', str(client_chat_id), str(partner_chat_id) if partner_chat_id else None)
+        elif partner_chat_id:
+            cache_key = ('partner', str(partner_chat_id), None)
+        else:
+            return self._count_unread_messages_from_messages(client_chat_id, partner_chat_id)
+        
+        cached = self._get_cached_unread_count(cache_key)
+        if cached is not None:
+            return cached
+        
+        recipient_type, recipient_chat_id, counterpart_chat_id = cache_key
+        try:
+            query = self.client.from_('message_unread_counters')\
+                .select('unread_count')\
+                .eq('recipient_type', recipient_type)\
+                .eq('recipient_chat_id', recipient_chat_id)
+            if counterpart_chat_id:
+                query = query.eq('counterpart_chat_id', counterpart_chat_id)
+            result = query.execute()
+            count = sum(int(row.get('unread_count') or 0) for row in (result.data or []))
+        except Exception as e:
+            logging.error(f"Error reading message_unread_counters: {e}")
+            count = self._count_unread_messages_from_messages(client_chat_id, partner_chat_id)
+        
+        self._set_cached_unread_count(cache_key, count)
+        return count
+
+    def _count_unread_messages_from_messages(
+        self,
+        client_chat_id: str = None,
+        partner_chat_id: str = None
+    ) -> int:
+        """Считает непрочитанные сообщения напрямую по таблице messages (запасной путь)."""
         try:
             query = self.client.from_('messages')\
                 .select('id', count='exact')\
@@ -5558,8 +5642,9 @@ class SupabaseManager:
             if client_chat_id:
                 query = query.eq('client_chat_id', str(client_chat_id))\
                             .eq('sender_type', 'partner')
-            
-            if partner_chat_id:
+                if partner_chat_id:
+                    query = query.eq('partner_chat_id', str(partner_chat_id))
+            elif partner_chat_id:
                 query = query.eq('partner_chat_id', str(partner_chat_id))\
                             .eq('sender_type', 'client')
             
@@ -5569,62 +5654,177 @@ class SupabaseManager:
             logging.error(f"Error getting unread messages count: {e}", exc_info=True)
             return 0
 
-    def get_partner_conversations(self, partner_chat_id: str) -> list[dict]:
-        """Получает список всех переписок партнёра с непрочитанными сообщениями.
+    def reconcile_unread_counters(self, recipient_chat_id: Optional[str] = None) -> int:
+        """Пересчитывает message_unread_counters по таблице messages и сбрасывает локальный кэш.
+        
+        Args:
+            recipient_chat_id: Chat ID получателя; если не задан — пересчитываются все счётчики
+        
+        Returns:
+            Количество исправленных строк счётчиков
+        """
+        if not self.client:
+            return 0
+        
+        try:
+            result = self.client.rpc('reconcile_message_unread_counters', {
+                'p_recipient_chat_id': str(recipient_chat_id) if recipient_chat_id else None
+            }).execute()
+            updated = int(result.data or 0) if not isinstance(result.data, list) else len(result.data)
+        except Exception as e:
+            logging.error(f"Error reconciling message_unread_counters: {e}")
+            return 0
+        
+        with self._unread_counts_lock:
+            if recipient_chat_id:
+                for key in [k for k in self._unread_counts_cache if k[1] == str(recipient_chat_id)]:
+                    del self._unread_counts_cache[key]
+            else:
+                self._unread_counts_cache.clear()
+        return updated
+
+    def _get_cached_unread_count(self, cache_key: tuple) -> Optional[int]:
+        with self._unread_counts_lock:
+            entry = self._unread_counts_cache.get(cache_key)
+            if not entry:
+                return None
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if (now - entry['updated_at']).total_seconds() > self.unread_counts_cache_ttl:
+                del self._unread_counts_cache[cache_key]
+                return None
+            return entry['count']
+
+    def _set_cached_unread_count(self, cache_key: tuple, count: int):
+        with self._unread_counts_lock:
+            self._unread_counts_cache[cache_key] = {
+                'count': max(0, int(count)),
+                'updated_at': datetime.datetime.now(datetime.timezone.utc)
+            }
+
+    def _adjust_cached_unread_count(self, recipient_type: str, recipient_chat_id: str, counterpart_chat_id: str, delta: int):
+        """Сдвигает закэшированные значения (по паре и общее) без обращения к БД."""
+        recipient_chat_id = str(recipient_chat_id)
+        with self._unread_counts_lock:
+            for key in ((recipient_type, recipient_chat_id, str(counterpart_chat_id)), (recipient_type, recipient_chat_id, None)):
+                entry = self._unread_counts_cache.get(key)
+                if entry:
+                    entry['count'] = max(0, entry['count'] + delta)
+
+    def _reset_cached_unread_count(self, recipient_type: str, recipient_chat_id: str, counterpart_chat_id: str):
+        """Обнуляет счётчик пары в кэше; общее значение получателя пересчитается при следующем чтении."""
+        recipient_chat_id = str(recipient_chat_id)
+        with self._unread_counts_lock:
+            self._unread_counts_cache.pop((recipient_type, recipient_chat_id, None), None)
+            self._unread_counts_cache[(recipient_type, recipient_chat_id, str(counterpart_chat_id))] = {
+                'count': 0,
+                'updated_at': datetime.datetime.now(datetime.timezone.utc)
+            }
+
+    def _invalidate_unread_cache(self, recipient_type: str, recipient_chat_id: Optional[str]):
+        if not recipient_chat_id:
+            return
+        recipient_chat_id = str(recipient_chat_id)
+        with self._unread_counts_lock:
+            for key in [k for k in self._unread_counts_cache if k[0] == recipient_type and k[1] == recipient_chat_id]:
+                del self._unread_counts_cache[key]
+
+    def get_partner_conversations(
+        self,
+        partner_chat_id: str,
+        limit: int = 50,
+        before_activity_at: Optional[str] = None,
+        before_client_chat_id: Optional[str] = None
+    ) -> list[dict]:
+        """Получает страницу переписок партнёра с последним сообщением и количеством непрочитанных.
+        
+        Число запросов не зависит от количества клиентов: основной путь — одна RPC
+        get_partner_conversations_page, запасной — два запроса (сообщения и непрочитанные).
         
         Args:
             partner_chat_id: Chat ID партнёра
+            limit: Размер страницы (не более MAX_CONVERSATIONS_PAGE_SIZE)
+            before_activity_at: Курсор — last_activity_at последней переписки предыдущей страницы
+            before_client_chat_id: Курсор — client_chat_id последней переписки предыдущей страницы
         
         Returns:
-            Список переписок с информацией о последнем сообщении и количестве непрочитанных
+            Список переписок (новые первыми) с полями client_chat_id, last_message,
+            last_activity_at и unread_count
         """
         if not self.client:
             return []
         
+        limit = max(1, min(int(limit), MAX_CONVERSATIONS_PAGE_SIZE))
+        
         try:
-            # Получаем все уникальные клиенты, с которыми есть переписка
-            result = self.client.from_('messages')\
-                .select('client_chat_id')\
-                .eq('partner_chat_id', str(partner_chat_id))\
-                .execute()
-            
-            if not result.data:
+            result = self.client.rpc('get_partner_conversations_page', {
+                'p_partner_chat_id': str(partner_chat_id),
+                'p_limit': limit,
+                'p_before_activity_at': before_activity_at,
+                'p_before_client_chat_id': before_client_chat_id,
+            }).execute()
+            return [
+                {
+                    'client_chat_id': row.get('client_chat_id'),
+                    'last_message': row.get('last_message'),
+                    'last_activity_at': row.get('last_activity_at'),
+                    'unread_count': int(row.get('unread_count') or 0),
+                }
+                for row in (result.data or [])
+            ]
+        except Exception as e:
+            self._log_rpc_fallback('get_partner_conversations_page', e)
+        
+        # Fallback: последнее сообщение по каждому клиенту — обходом сообщений партнёра страницами
+        # по id (только нужные колонки), затем полные строки и непрочитанные только для страницы
+        try:
+            partner_id = str(partner_chat_id)
+            latest: dict[str, tuple] = {}
+            for msg in self._fetch_all_rows(
+                lambda: self.client.from_('messages')
+                    .select('id, client_chat_id, created_at')
+                    .eq('partner_chat_id', partner_id)
+            ):
+                client_id = msg.get('client_chat_id')
+                position = (msg.get('created_at') or '', msg['id'])
+                if client_id and (client_id not in latest or position > latest[client_id]):
+                    latest[client_id] = position
+            
+            ordered = sorted(latest.items(), key=lambda item: (item[1][0], item[0]), reverse=True)
+            if before_activity_at:
+                cursor = (before_activity_at, before_client_chat_id or '')
+                ordered = [item for item in ordered if (item[1][0], item[0]) < cursor]
+            page = ordered[:limit]
+            if not page:
                 return []
             
-            client_ids = list(set([msg.get('client_chat_id') for msg in result.data if msg.get('client_chat_id')]))
-            
-            conversations = []
-            for client_id in client_ids:
-                # Получаем последнее сообщение
-                last_msg_result = self.client.from_('messages')\
-                    .select('*')\
-                    .eq('client_chat_id', client_id)\
-                    .eq('partner_chat_id', str(partner_chat_id))\
-                    .order('created_at', desc=True)\
-                    .limit(1)\
-                    .execute()
-                
-                if last_msg_result.data:
-                    last_msg = last_msg_result.data[0]
-                    
-                    # Получаем количество непрочитанных сообщений от этого клиента
-                    unread_result = self.client.from_('messages')\
-                        .select('id', count='exact')\
-                        .eq('client_chat_id', client_id)\
-                        .eq('partner_chat_id', str(partner_chat_id))\
-                        .eq('sender_type', 'client')\
-                        .eq('is_read', False)\
-                        .execute()
-                    
-                    unread_count = unread_result.count if hasattr(unread_result, 'count') else len(unread_result.data or [])
-                    
-                    conversations.append({
-                        'client_chat_id': client_id,
-                        'last_message': last_msg,
-                        'unread_count': unread_count
-                    })
-            
-            return conversations
+            page_clients = [client_id for client_id, _ in page]
+            messages_result = self.client.from_('messages')\
+                .select('*')\
+                .in_('id', [position[1] for _, position in page])\
+                .execute()
+            last_messages = {msg['id']: msg for msg in messages_result.data or []}
+            
+            unread_counts: dict[str, int] = {}
+            for msg in self._fetch_all_rows(
+                lambda: self.client.from_('messages')
+                    .select('id, client_chat_id')
+                    .eq('partner_chat_id', partner_id)
+                    .eq('sender_type', 'client')
+                    .eq('is_read', False)
+                    .in_('client_chat_id', page_clients)
+            ):
+                client_id = msg.get('client_chat_id')
+                unread_counts[client_id] = unread_counts.get(client_id, 0) + 1
+            
+            return [
+                {
+                    'client_chat_id': client_id,
+                    'last_message': last_messages.get(position[1]),
+                    'last_activity_at': position[0] or None,
+                    'unread_count': unread_counts.get(client_id, 0),
+                }
+                for client_id, position in page
+            ]
         except Exception as e:
             logging.error(f"Error getting partner conversations: {e}", exc_info=True)
             return []
@@ -5971,14 +6171,16 @@ class SupabaseManager:
     ) -> dict:
         """
         Проверяет, может ли клиент пройти к партнёру по продукту (кросс-абонемент).
+        Только чтение: для допуска и записи визита используйте record_platform_product_visit.
         Returns: {
             'allowed': bool,
             'subscription': dict | None,
+            'partner': dict | None (строка platform_product_partners),
             'error': str (если not allowed)
         }
         """
         if not self.client:
-            return {"allowed": False, "subscription": None, "error": "DB is not initialized."}
+            return {"allowed": False, "subscription": None, "partner": None, "error": "DB is not initialized."}
         try:
             now = datetime.datetime.now(datetime.timezone.utc)
             # Активная подписка по этому продукту у клиента
@@ -5994,7 +6196,7 @@ class SupabaseManager:
                 .execute()
             )
             if not sub_r.data:
-                return {"allowed": False, "subscription": None, "error": "Нет активного абонемента по этому продукту."}
+                return {"allowed": False, "subscription": None, "partner": None, "error": "Нет активного абонемента по этому продукту."}
             sub = sub_r.data[0]
             # Партнёр входит в продукт
             pp_r = (
@@ -6007,33 +6209,27 @@ class SupabaseManager:
                 .execute()
             )
             if not pp_r.data:
-                return {"allowed": False, "subscription": sub, "error": "Эта студия не входит в ваш абонемент."}
+                return {"allowed": False, "subscription": sub, "partner": None, "error": "Эта студия не входит в ваш абонемент."}
             pp = pp_r.data[0]
             product = self.get_platform_product(product_id)
             if not product:
-                return {"allowed": False, "subscription": sub, "error": "Продукт не найден."}
+                return {"allowed": False, "subscription": sub, "partner": pp, "error": "Продукт не найден."}
             # Лимит общих визитов по подписке
             max_total = product.get('max_visits_total')
             if max_total is not None and sub.get('visits_total_used', 0) >= max_total:
-                return {"allowed": False, "subscription": sub, "error": "Исчерпан лимит визитов по абонементу."}
-            # Лимит визитов к этому партнёру по подписке
+                return {"allowed": False, "subscription": sub, "partner": pp, "error": "Исчерпан лимит визитов по абонементу."}
+            # Лимит визитов к этому партнёру по подписке: подтверждённые — по счётчикам
+            # product_visit_counters, плюс визиты в процессе допуска (pending), которых в счётчиках ещё нет
             limit_per_partner = pp.get('visit_limit_per_client')
             if limit_per_partner is not None:
-                count_r = (
-                    self.client.from_('product_visits')
-                    .select('id')
-                    .eq('subscription_id', sub['id'])
-                    .eq('partner_chat_id', str(partner_chat_id))
-                    .eq('status', 'confirmed')
-                    .execute()
-                )
-                count = len(count_r.data or [])
-                if count >= limit_per_partner:
-                    return {"allowed": False, "subscription": sub, "error": f"Лимит визитов в эту студию ({limit_per_partner}) исчерпан."}
-            return {"allowed": True, "subscription": sub, "error": None}
+                used_here = self.product_visit_counters.partner_visits(sub['id'], partner_chat_id)
+                used_here += self.product_visit_counters.pending_visits(sub['id'], partner_chat_id)
+                if used_here >= limit_per_partner:
+                    return {"allowed": False, "subscription": sub, "partner": pp, "error": f"Лимит визитов в эту студию ({limit_per_partner}) исчерпан."}
+            return {"allowed": True, "subscription": sub, "partner": pp, "error": None}
         except Exception as e:
             logging.error(f"check_platform_product_visit_allowed: {e}", exc_info=True)
-            return {"allowed": False, "subscription": None, "error": str(e)}
+            return {"allowed": False, "subscription": None, "partner": None, "error": str(e)}
 
     def record_platform_product_visit(
         self,
@@ -6043,50 +6239,133 @@ class SupabaseManager:
         source: str = 'bot_manual',
     ) -> dict:
         """
-        Проверяет право и записывает визит по кросс-абонементу. Начисляет payout в product_visits.
+        Проверяет право и записывает визит по кросс-абонементу одной операцией. Начисляет payout в product_visits.
+        Основной путь — RPC record_platform_product_visit: один запрос, подписка блокируется
+        на время проверки лимитов и записи, поэтому одновременные сканирования не превышают лимиты.
+        Повторное сканирование у того же партнёра в течение platform_visit_dedup_seconds
+        возвращает уже записанный визит (duplicate=True) вместо второго допуска.
         Returns: {
             'success': bool,
             'visit': dict | None,
+            'duplicate': bool,
             'error': str (если success=False)
         }
         """
         if not self.client:
-            return {"success": False, "visit": None, "error": "DB is not initialized."}
-        try:
+            return {"success": False, "visit": None, "duplicate": False, "error": "DB is not initialized."}
+        try:
+            r = self.client.rpc('record_platform_product_visit', {
+                'p_client_chat_id': str(client_chat_id),
+                'p_partner_chat_id': str(partner_chat_id),
+                'p_product_id': product_id,
+                'p_source': source,
+                'p_dedup_seconds': self.platform_visit_dedup_seconds,
+            }).execute()
+            data = (r.data[0] if isinstance(r.data, list) and r.data else r.data) or {}
+            return {
+                "success": bool(data.get('success')),
+                "visit": data.get('visit'),
+                "duplicate": bool(data.get('duplicate')),
+                "error": data.get('error'),
+            }
+        except Exception as e:
+            # Сбой или таймаут на стороне клиента: RPC могла уже записать визит — повтор запросами
+            # допустил бы его второй раз, поэтому запасной путь — только при отсутствии функции
+            if not self._is_missing_rpc(e):
+                logging.error(f"record_platform_product_visit RPC: {e}")
+                return {"success": False, "visit": None, "duplicate": False, "error": str(e)}
+            self._log_rpc_fallback('record_platform_product_visit', e)
+        try:
+            return self._record_platform_product_visit_queries(client_chat_id, partner_chat_id, product_id, source)
+        except Exception as e:
+            logging.error(f"record_platform_product_visit: {e}", exc_info=True)
+            return {"success": False, "visit": None, "duplicate": False, "error": str(e)}
+
+    def _record_platform_product_visit_queries(
+        self,
+        client_chat_id: str,
+        partner_chat_id: str,
+        product_id: int,
+        source: str,
+    ) -> dict:
+        """
+        Запись визита без RPC. Визит (в статусе pending) записывается до увеличения
+        visits_total_used, а счётчик подписки меняется сравнением с прочитанным значением:
+        если параллельный визит успел его изменить, своя запись удаляется и проверка
+        повторяется с учётом чужого визита. Только после успешного обновления подписки
+        визит попадает в product_visit_counters и подтверждается, поэтому откаченные визиты
+        счётчики не искажают; повторное сканирование, заставшее незавершённый визит,
+        дожидается его результата. Если процесс прервётся после обновления подписки, но до
+        подтверждения, визит останется pending, уже учтённым в visits_total_used и, возможно,
+        в счётчике: такие визиты снимает release_stale_platform_product_visits().
+        """
+        for _attempt in range(PLATFORM_VISIT_ADMISSION_ATTEMPTS):
+            recent = self._find_recent_platform_product_visit(client_chat_id, partner_chat_id, product_id)
+            if recent and recent.get('status') == 'confirmed':
+                return {"success": True, "visit": recent, "duplicate": True, "error": None}
+            if recent:
+                time.sleep(PLATFORM_VISIT_PENDING_WAIT)
+                continue
             check = self.check_platform_product_visit_allowed(client_chat_id, partner_chat_id, product_id)
             if not check["allowed"]:
-                return {"success": False, "visit": None, "error": check.get("error", "Визит не разрешён.")}
+                return {"success": False, "visit": None, "duplicate": False, "error": check.get("error") or "Визит не разрешён."}
             sub = check["subscription"]
-            pp_list = self.get_platform_product_partners(product_id)
-            pp = next((p for p in pp_list if str(p.get('partner_chat_id')) == str(partner_chat_id)), None)
-            if not pp:
-                return {"success": False, "visit": None, "error": "Партнёр не найден в продукте."}
-            payout_amount = float(pp.get('payout_per_visit', 0))
-            payout_currency = 'RUB'
+            pp = check["partner"]
             visit_row = {
                 'subscription_id': sub['id'],
                 'product_id': product_id,
                 'client_chat_id': str(client_chat_id),
                 'partner_chat_id': str(partner_chat_id),
+                'visited_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
                 'source': source,
-                'status': 'confirmed',
-                'payout_amount': payout_amount,
-                'payout_currency': payout_currency,
+                'status': 'pending',
+                'payout_amount': float(pp.get('payout_per_visit', 0)),
+                'payout_currency': 'RUB',
                 'payout_status': 'not_processed',
             }
             ins = self.client.from_('product_visits').insert(visit_row).execute()
             if not ins.data:
-                return {"success": False, "visit": None, "error": "Не удалось создать запись визита."}
+                return {"success": False, "visit": None, "duplicate": False, "error": "Не удалось создать запись визита."}
             visit = ins.data[0]
-            # Увеличить visits_total_used у подписки
-            new_used = (sub.get('visits_total_used') or 0) + 1
-            self.client.from_('client_product_subscriptions').update({
-                'visits_total_used': new_used,
-            }).eq('id', sub['id']).execute()
-            return {"success": True, "visit": visit, "error": None}
-        except Exception as e:
-            logging.error(f"record_platform_product_visit: {e}", exc_info=True)
-            return {"success": False, "visit": None, "error": str(e)}
+            used = sub.get('visits_total_used') or 0
+            claimed = (
+                self.client.from_('client_product_subscriptions')
+                .update({'visits_total_used': used + 1})
+                .eq('id', sub['id'])
+                .eq('visits_total_used', used)
+                .execute()
+            )
+            if claimed.data:
+                # Визит допущен: учитываем его в счётчике до подтверждения, чтобы параллельная
+                # проверка лимита видела его либо в счётчике, либо среди pending
+                self.product_visit_counters.add(visit)
+                confirmed = self.client.from_('product_visits').update({'status': 'confirmed'}).eq('id', visit['id']).execute()
+                visit = confirmed.data[0] if confirmed.data else {**visit, 'status': 'confirmed'}
+                return {"success": True, "visit": visit, "duplicate": False, "error": None}
+            self.client.from_('product_visits').delete().eq('id', visit['id']).execute()
+        return {"success": False, "visit": None, "duplicate": False, "error": "Абонемент сейчас используется, попробуйте ещё раз."}
+
+    def _find_recent_platform_product_visit(self, client_chat_id: str, partner_chat_id: str, product_id: int) -> Optional[dict]:
+        """
+        Визит клиента к партнёру по продукту за последние platform_visit_dedup_seconds
+        (повторное сканирование), включая ещё не подтверждённый параллельный визит.
+        """
+        if self.platform_visit_dedup_seconds <= 0:
+            return None
+        since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.platform_visit_dedup_seconds)
+        r = (
+            self.client.from_('product_visits')
+            .select('*')
+            .eq('client_chat_id', str(client_chat_id))
+            .eq('partner_chat_id', str(partner_chat_id))
+            .eq('product_id', product_id)
+            .in_('status', ['confirmed', 'pending'])
+            .gte('visited_at', since.isoformat())
+            .order('visited_at', desc=True)
+            .limit(1)
+            .execute()
+        )
+        return r.data[0] if r.data else None
 
     def get_client_active_platform_subscriptions(self, client_chat_id: str) -> List[dict]:
         """Активные подписки клиента на продукты платформы."""
@@ -6153,37 +6432,106 @@ class SupabaseManager:
             logging.error(f"create_client_product_subscription: {e}", exc_info=True)
             return {"success": False, "subscription": None, "error": str(e)}
 
+    def sweep_platform_product_subscriptions(self, notify=None, now: Optional[datetime.datetime] = None) -> dict:
+        """
+        Переводит истёкшие подписки на продукты платформы в 'expired' и отмечает
+        истекающие в ближайшие дни (см. ProductSubscriptionSweeper).
+
+        Args:
+            notify: callable(events) — вызывается по каждой странице с компактным списком событий
+            now: момент обхода (по умолчанию — текущее время UTC)
+
+        Returns:
+            {'expired': int, 'expiring': int, 'batches': int}; пустой dict при ошибке
+        """
+        if not self.client:
+            return {}
+        try:
+            result = self.product_subscription_sweeper.sweep(now=now, notify=notify)
+        except Exception as e:
+            logging.error(f"Error sweeping platform product subscriptions: {e}", exc_info=True)
+            return {}
+        logging.info(f"Platform product subscriptions swept: {result}")
+        return result
+
+    def release_stale_platform_product_visits(self, now: Optional[datetime.datetime] = None) -> int:
+        """
+        Удаляет pending-визиты старше platform_visit_pending_timeout (запись без RPC прервалась
+        до подтверждения) и пересчитывает visits_total_used и счётчики затронутых подписок
+        и партнёров (см. ProductVisitCounters.release_stale_pending).
+
+        Returns:
+            Количество удалённых визитов
+        """
+        if not self.client:
+            return 0
+        try:
+            return self.product_visit_counters.release_stale_pending(now=now)
+        except Exception as e:
+            logging.error(f"Error releasing stale product visits: {e}")
+            return 0
+
     def get_partner_product_visits_summary(
         self,
         partner_chat_id: str,
         period_start: Optional[datetime.date] = None,
         period_end: Optional[datetime.date] = None,
+        include_visits: bool = False,
+        visits_limit: int = PRODUCT_VISITS_SUMMARY_LIMIT,
     ) -> dict:
         """
         Сводка по визитам и выплатам партнёра за период (для партнёрского кабинета).
-        Returns: {'total_visits': int, 'total_payout': float, 'currency': str, 'visits': list}
+        Итоги и помесячная разбивка читаются из product_visit_counters (полные месяцы) и
+        product_visits (неполные месяцы по краям периода), поэтому их стоимость не зависит
+        от истории. С include_visits=True добавляются последние visits_limit визитов периода.
+        Returns: {'total_visits': int, 'total_payout': float, 'currency': str, 'periods': list, 'visits': list}
         """
+        empty = {"total_visits": 0, "total_payout": 0.0, "currency": "RUB", "periods": [], "visits": []}
         if not self.client:
-            return {"total_visits": 0, "total_payout": 0.0, "currency": "RUB", "visits": []}
+            return empty
         try:
-            q = (
-                self.client.from_('product_visits')
-                .select('*')
-                .eq('partner_chat_id', str(partner_chat_id))
-                .eq('status', 'confirmed')
-            )
-            if period_start:
-                q = q.gte('visited_at', period_start.isoformat())
-            if period_end:
-                q = q.lte('visited_at', period_end.isoformat())
-            r = q.order('visited_at', desc=True).execute()
-            visits = list(r.data) if r.data else []
-            total_payout = sum(float(v.get('payout_amount', 0)) for v in visits)
-            currency = visits[0].get('payout_currency', 'RUB') if visits else 'RUB'
-            return {"total_visits": len(visits), "total_payout": total_payout, "currency": currency, "visits": visits}
+            try:
+                summary = self.product_visit_counters.partner_summary(partner_chat_id, period_start, period_end)
+            except Exception as e:
+                logging.error(f"get_partner_product_visits_summary: счётчики недоступны, считаю по визитам: {e}")
+                summary = self.product_visit_counters.visits_summary(partner_chat_id, period_start, period_end)
+            visits = []
+            if include_visits:
+                q = (
+                    self.client.from_('product_visits')
+                    .select('*')
+                    .eq('partner_chat_id', str(partner_chat_id))
+                    .eq('status', 'confirmed')
+                )
+                if period_start:
+                    q = q.gte('visited_at', period_start.isoformat())
+                if period_end:
+                    q = q.lte('visited_at', period_end.isoformat())
+                visits = q.order('visited_at', desc=True).limit(visits_limit).execute().data or []
+            return {**summary, "visits": visits}
         except Exception as e:
             logging.error(f"get_partner_product_visits_summary: {e}")
-            return {"total_visits": 0, "total_payout": 0.0, "currency": "RUB", "visits": []}
+            return empty
+
+    def rebuild_product_visit_counters(self, partner_chat_id: Optional[str] = None) -> int:
+        """
+        Пересчитывает product_visit_counters по product_visits.
+
+        Args:
+            partner_chat_id: ID партнера; если не задан — все партнеры
+
+        Returns:
+            Количество записанных строк счётчиков
+        """
+        if not self.client:
+            return 0
+        try:
+            rows = self.product_visit_counters.rebuild(partner_chat_id)
+        except Exception as e:
+            logging.error(f"Error rebuilding product visit counters: {e}")
+            return 0
+        logging.info(f"Product visit counters rebuilt: {rows} rows (partner={partner_chat_id})")
+        return rows
 
     def aggregate_platform_product_payouts(
         self,
@@ -6191,55 +6539,100 @@ class SupabaseManager:
         period_end: datetime.date,
     ) -> dict:
         """
-        Собирает визиты с payout_status='not_processed' за период, создаёт batch и items,
-        обновляет product_visits.payout_batch_id и payout_status.
-        Returns: {'success': bool, 'batch_id': int | None, 'items_count': int, 'error': str}
+        Собирает визиты с payout_status='not_processed' за период в draft batch выплат:
+        привязывает визиты к batch и пересчитывает items по всем визитам batch.
+        Основной путь — RPC aggregate_platform_product_payouts (одна транзакция),
+        без неё — пакетные запросы. Повторный запуск за период дополняет тот же
+        draft batch и не удваивает суммы.
+        Returns: {'success': bool, 'batch_id': int | None, 'items_count': int, 'visits_count': int, 'error': str}
         """
         if not self.client:
-            return {"success": False, "batch_id": None, "items_count": 0, "error": "DB is not initialized."}
+            return {"success": False, "batch_id": None, "items_count": 0, "visits_count": 0, "error": "DB is not initialized."}
+        start_iso = period_start.isoformat()
+        end_iso = period_end.isoformat()
         try:
-            start_iso = period_start.isoformat()
-            end_iso = period_end.isoformat()
-            r = (
-                self.client.from_('product_visits')
-                .select('id, partner_chat_id, payout_amount, payout_currency')
+            r = self.client.rpc('aggregate_platform_product_payouts', {
+                'p_period_start': start_iso,
+                'p_period_end': end_iso,
+            }).execute()
+            data = (r.data[0] if isinstance(r.data, list) and r.data else r.data) or {}
+            return {
+                "success": True,
+                "batch_id": data.get('batch_id'),
+                "items_count": int(data.get('items_count') or 0),
+                "visits_count": int(data.get('visits_count') or 0),
+                "error": None,
+            }
+        except Exception as e:
+            logging.warning(f"RPC aggregate_platform_product_payouts недоступна, агрегирую пакетными запросами: {e}")
+        try:
+            visits = self._fetch_all_rows(
+                lambda: self.client.from_('product_visits')
+                .select('id')
                 .eq('payout_status', 'not_processed')
                 .eq('status', 'confirmed')
                 .gte('visited_at', start_iso)
                 .lte('visited_at', end_iso)
+            )
+            # Незакрытый batch за период дополняется, а не дублируется
+            draft = (
+                self.client.from_('partner_payout_batches')
+                .select('id')
+                .eq('period_start', start_iso)
+                .eq('period_end', end_iso)
+                .eq('status', 'draft')
+                .order('id')
+                .limit(1)
                 .execute()
             )
-            visits = list(r.data) if r.data else []
-            if not visits:
-                return {"success": True, "batch_id": None, "items_count": 0, "error": None}
-            batch_row = {'period_start': start_iso, 'period_end': end_iso, 'status': 'draft'}
-            batch_ins = self.client.from_('partner_payout_batches').insert(batch_row).execute()
-            if not batch_ins.data:
-                return {"success": False, "batch_id": None, "items_count": 0, "error": "Не удалось создать batch."}
-            batch_id = batch_ins.data[0]['id']
+            if draft.data:
+                batch_id = draft.data[0]['id']
+            elif not visits:
+                return {"success": True, "batch_id": None, "items_count": 0, "visits_count": 0, "error": None}
+            else:
+                batch_row = {'period_start': start_iso, 'period_end': end_iso, 'status': 'draft'}
+                batch_ins = self.client.from_('partner_payout_batches').insert(batch_row).execute()
+                if not batch_ins.data:
+                    return {"success": False, "batch_id": None, "items_count": 0, "visits_count": 0, "error": "Не удалось создать batch."}
+                batch_id = batch_ins.data[0]['id']
+            visit_ids = [v['id'] for v in visits]
+            for i in range(0, len(visit_ids), PAYOUT_VISITS_UPDATE_CHUNK):
+                self.client.from_('product_visits').update({
+                    'payout_status': 'included_in_batch',
+                    'payout_batch_id': batch_id,
+                }).in_('id', visit_ids[i:i + PAYOUT_VISITS_UPDATE_CHUNK]).eq('payout_status', 'not_processed').execute()
+            # Items считаются по всем визитам batch, поэтому перезапуск после сбоя их не удваивает
+            linked = self._fetch_all_rows(
+                lambda: self.client.from_('product_visits')
+                .select('id, partner_chat_id, payout_amount, payout_currency')
+                .eq('payout_batch_id', batch_id)
+            )
             by_partner: Dict[str, Dict[str, Any]] = {}
-            for v in visits:
+            for v in linked:
                 pid = str(v['partner_chat_id'])
                 if pid not in by_partner:
                     by_partner[pid] = {'total_visits': 0, 'total_payout_amount': 0, 'currency': v.get('payout_currency', 'RUB')}
                 by_partner[pid]['total_visits'] += 1
                 by_partner[pid]['total_payout_amount'] += float(v.get('payout_amount', 0))
-            for pid, agg in by_partner.items():
-                self.client.from_('partner_payout_items').insert({
-                    'batch_id': batch_id,
-                    'partner_chat_id': pid,
-                    'total_visits': agg['total_visits'],
-                    'total_payout_amount': round(agg['total_payout_amount'], 2),
-                    'currency': agg['currency'],
-                    'status': 'pending',
-                }).execute()
-            visit_ids = [v['id'] for v in visits]
-            for vid in visit_ids:
-                self.client.from_('product_visits').update({
-                    'payout_status': 'included_in_batch',
-                    'payout_batch_id': batch_id,
-                }).eq('id', vid).execute()
-            return {"success": True, "batch_id": batch_id, "items_count": len(by_partner), "error": None}
+            # Как в RPC: статус существующих items не трогаем, новые создаются в 'pending'
+            existing = {
+                str(row['partner_chat_id']) for row in self._fetch_all_rows(
+                    lambda: self.client.from_('partner_payout_items').select('id, partner_chat_id').eq('batch_id', batch_id)
+                )
+            }
+            items = [{
+                'batch_id': batch_id,
+                'partner_chat_id': pid,
+                'total_visits': agg['total_visits'],
+                'total_payout_amount': round(agg['total_payout_amount'], 2),
+                'currency': agg['currency'],
+            } for pid, agg in by_partner.items()]
+            updated = [item for item in items if item['partner_chat_id'] in existing]
+            created = [dict(item, status='pending') for item in items if item['partner_chat_id'] not in existing]
+            for rows in (updated, created):
+                if rows:
+                    self.client.from_('partner_payout_items').upsert(rows, on_conflict='batch_id,partner_chat_id').execute()
+            return {"success": True, "batch_id": batch_id, "items_count": len(items), "visits_count": len(visit_ids), "error": None}
         except Exception as e:
             logging.error(f"aggregate_platform_product_payouts: {e}", exc_info=True)
-            return {"success": False, "batch_id": None, "items_count": 0, "error": str(e)}
\ No newline at end of file
+            return {"success": False, "batch_id": None, "items_count": 0, "visits_count": 0, "error": str(e)}
\ No newline at end of file
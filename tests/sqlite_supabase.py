@@ -0,0 +1,333 @@
+"""
+Локальный Supabase-клиент поверх SQLite для тестов и бенчмарков.
+
+Поддерживает подмножество PostgREST-билдера, которое использует SupabaseManager:
+select / insert / upsert / update / delete, фильтры eq, neq, lt, lte, gt, gte,
+like, in_, is_, or_, сортировку, limit и range, а также rpc() с зарегистрированными
+Python-функциями. Каждый execute() учитывается в счётчике queries — это позволяет
+проверять количество обращений к БД.
+"""
+
+import json
+import sqlite3
+import threading
+from typing import Any, Callable, Optional
+
+
+class FakeResponse:
+    def __init__(self, data: Any, count: Optional[int] = None):
+        self.data = data
+        self.count = count
+
+
+class FakeRPC:
+    def __init__(self, db: 'SqliteSupabase', name: str, params: dict):
+        self._db = db
+        self._name = name
+        self._params = params or {}
+
+    def execute(self) -> FakeResponse:
+        self._db.record_query('rpc', self._name)
+        handler = self._db.rpc_handlers.get(self._name)
+        if handler is None:
+            raise Exception(f"Could not find the function public.{self._name}")
+        with self._db.lock:
+            return FakeResponse(handler(self._db, self._params))
+
+
+def _split_top_level(expr: str) -> list[str]:
+    parts, depth, current = [], 0, ''
+    for ch in expr:
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        if ch == ',' and depth == 0:
+            parts.append(current)
+            current = ''
+        else:
+            current += ch
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _quoted(columns) -> str:
+    return ', '.join('"' + c + '"' for c in columns)
+
+
+_OPERATORS = {'eq': '=', 'neq': '!=', 'lt': '<', 'lte': '<=', 'gt': '>', 'gte': '>='}
+
+
+def _parse_condition(expr: str) -> tuple[str, list]:
+    """Разбирает выражение or_/and() PostgREST в SQL."""
+    expr = expr.strip()
+    for group in ('and', 'or'):
+        if expr.startswith(f'{group}(') and expr.endswith(')'):
+            inner = [_parse_condition(p) for p in _split_top_level(expr[len(group) + 1:-1])]
+            sql = f' {group.upper()} '.join(f'({s})' for s, _ in inner)
+            return sql, [v for _, vals in inner for v in vals]
+    column, op, value = expr.split('.', 2)
+    if op == 'is':
+        return f'"{column}" IS {"NULL" if value == "null" else value.upper()}', []
+    if op == 'in':
+        values = [v.strip().strip('"') for v in value.strip('()').split(',') if v.strip()]
+        return f'"{column}" IN ({", ".join("?" for _ in values)})', values
+    return f'"{column}" {_OPERATORS[op]} ?', [value]
+
+
+class FakeQuery:
+    def __init__(self, db: 'SqliteSupabase', table: str):
+        self._db = db
+        self._table = table
+        self._mode = 'select'
+        self._columns = '*'
+        self._count = None
+        self._payload: Any = None
+        self._on_conflict: Optional[str] = None
+        self._ignore_duplicates = False
+        self._where: list[tuple[str, list]] = []
+        self._order: list[str] = []
+        self._limit: Optional[int] = None
+        self._offset: Optional[int] = None
+
+    # --- операции -------------------------------------------------------
+    def select(self, columns: str = '*', count: Optional[str] = None):
+        self._mode = 'select'
+        self._columns = columns
+        self._count = count
+        return self
+
+    def insert(self, rows):
+        self._mode = 'insert'
+        self._payload = rows
+        return self
+
+    def upsert(self, rows, on_conflict: Optional[str] = None, ignore_duplicates: bool = False, **_kwargs):
+        self._mode = 'upsert'
+        self._payload = rows
+        self._on_conflict = on_conflict
+        self._ignore_duplicates = ignore_duplicates
+        return self
+
+    def update(self, values: dict):
+        self._mode = 'update'
+        self._payload = values
+        return self
+
+    def delete(self):
+        self._mode = 'delete'
+        return self
+
+    # --- фильтры --------------------------------------------------------
+    def _filter(self, column: str, op: str, value):
+        self._where.append((f'"{column}" {op} ?', [self._db.adapt(value)]))
+        return self
+
+    def eq(self, column, value):
+        return self._filter(column, '=', value)
+
+    def neq(self, column, value):
+        return self._filter(column, '!=', value)
+
+    def lt(self, column, value):
+        return self._filter(column, '<', value)
+
+    def lte(self, column, value):
+        return self._filter(column, '<=', value)
+
+    def gt(self, column, value):
+        return self._filter(column, '>', value)
+
+    def gte(self, column, value):
+        return self._filter(column, '>=', value)
+
+    def like(self, column, pattern):
+        return self._filter(column, 'LIKE', pattern)
+
+    def in_(self, column, values):
+        values = [self._db.adapt(v) for v in values]
+        if not values:
+            self._where.append(('0', []))
+        else:
+            self._where.append((f'"{column}" IN ({", ".join("?" for _ in values)})', values))
+        return self
+
+    def is_(self, column, value):
+        self._where.append((f'"{column}" IS {"NULL" if value in (None, "null") else value}', []))
+        return self
+
+    def or_(self, filters: str):
+        parts = [_parse_condition(p) for p in _split_top_level(filters)]
+        self._where.append((' OR '.join(f'({s})' for s, _ in parts), [v for _, vals in parts for v in vals]))
+        return self
+
+    def order(self, column: str, desc: bool = False, **_kwargs):
+        self._order.append(f'"{column}" {"DESC" if desc else "ASC"}')
+        return self
+
+    def limit(self, size: int):
+        self._limit = size
+        return self
+
+    def range(self, start: int, end: int):
+        self._offset = start
+        self._limit = end - start + 1
+        return self
+
+    # --- выполнение -----------------------------------------------------
+    def _where_sql(self) -> tuple[str, list]:
+        if not self._where:
+            return '', []
+        sql = ' WHERE ' + ' AND '.join(f'({s})' for s, _ in self._where)
+        return sql, [v for _, vals in self._where for v in vals]
+
+    def execute(self) -> FakeResponse:
+        self._db.record_query(self._mode, self._table)
+        with self._db.lock:
+            return getattr(self, f'_execute_{self._mode}')()
+
+    def _execute_select(self) -> FakeResponse:
+        if '(' in self._columns:
+            # Встроенные связи PostgREST (table!inner(...)) не эмулируются — как при отсутствии связи
+            raise Exception(f"Could not find a relationship in the schema cache: {self._columns}")
+        where, params = self._where_sql()
+        columns = '*' if self._columns.strip() == '*' else ', '.join(
+            f'"{c.strip()}"' for c in self._columns.split(',') if c.strip()
+        )
+        sql = f'SELECT {columns} FROM "{self._table}"{where}'
+        if self._order:
+            sql += ' ORDER BY ' + ', '.join(self._order)
+        if self._limit is not None:
+            sql += f' LIMIT {int(self._limit)}'
+            if self._offset:
+                sql += f' OFFSET {int(self._offset)}'
+        rows = self._db.fetch(sql, params, self._table)
+        count = None
+        if self._count:
+            count = self._db.conn.execute(f'SELECT COUNT(*) FROM "{self._table}"{where}', params).fetchone()[0]
+        return FakeResponse(rows, count)
+
+    def _rows(self) -> list[dict]:
+        return self._payload if isinstance(self._payload, list) else [self._payload]
+
+    def _execute_insert(self) -> FakeResponse:
+        inserted = []
+        for row in self._rows():
+            columns = list(row.keys())
+            sql = (
+                f'INSERT INTO "{self._table}" ({_quoted(columns)}) '
+                f'VALUES ({", ".join("?" for _ in columns)}) RETURNING *'
+            )
+            inserted.extend(self._db.fetch(sql, [self._db.adapt(row[c]) for c in columns], self._table))
+        self._db.conn.commit()
+        return FakeResponse(inserted)
+
+    def _execute_upsert(self) -> FakeResponse:
+        conflict = self._on_conflict or ','.join(self._db.primary_key(self._table))
+        conflict_cols = [c.strip() for c in conflict.split(',')]
+        result = []
+        for row in self._rows():
+            columns = list(row.keys())
+            updates = [c for c in columns if c not in conflict_cols]
+            action = 'DO NOTHING' if self._ignore_duplicates or not updates else \
+                'DO UPDATE SET ' + ', '.join(f'"{c}" = excluded."{c}"' for c in updates)
+            sql = (
+                f'INSERT INTO "{self._table}" ({_quoted(columns)}) '
+                f'VALUES ({", ".join("?" for _ in columns)}) '
+                f'ON CONFLICT ({_quoted(conflict_cols)}) {action} RETURNING *'
+            )
+            result.extend(self._db.fetch(sql, [self._db.adapt(row[c]) for c in columns], self._table))
+        self._db.conn.commit()
+        return FakeResponse(result)
+
+    def _execute_update(self) -> FakeResponse:
+        where, params = self._where_sql()
+        columns = list(self._payload.keys())
+        assignments = ', '.join(f'"{c}" = ?' for c in columns)
+        sql = f'UPDATE "{self._table}" SET {assignments}{where} RETURNING *'
+        rows = self._db.fetch(sql, [self._db.adapt(self._payload[c]) for c in columns] + params, self._table)
+        self._db.conn.commit()
+        return FakeResponse(rows)
+
+    def _execute_delete(self) -> FakeResponse:
+        where, params = self._where_sql()
+        rows = self._db.fetch(f'DELETE FROM "{self._table}"{where} RETURNING *', params, self._table)
+        self._db.conn.commit()
+        return FakeResponse(rows)
+
+
+class SqliteSupabase:
+    """Минимальная замена supabase.Client поверх SQLite."""
+
+    def __init__(self, path: str = ':memory:'):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.queries: list[tuple[str, str]] = []
+        self.rpc_handlers: dict[str, Callable[['SqliteSupabase', dict], Any]] = {}
+        self._column_types: dict[str, dict[str, str]] = {}
+
+    # --- служебное ------------------------------------------------------
+    def executescript(self, script: str):
+        with self.lock:
+            self.conn.executescript(script)
+            self._column_types.clear()
+
+    def record_query(self, kind: str, target: str):
+        with self.lock:
+            self.queries.append((kind, target))
+
+    def reset_queries(self):
+        with self.lock:
+            self.queries.clear()
+
+    @property
+    def query_count(self) -> int:
+        return len(self.queries)
+
+    def register_rpc(self, name: str, handler: Callable[['SqliteSupabase', dict], Any]):
+        self.rpc_handlers[name] = handler
+
+    @staticmethod
+    def adapt(value):
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, ensure_ascii=False)
+        if isinstance(value, bool):
+            return int(value)
+        return value
+
+    def column_types(self, table: str) -> dict[str, str]:
+        if table not in self._column_types:
+            info = self.conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+            self._column_types[table] = {row[1]: (row[2] or '').upper() for row in info}
+        return self._column_types[table]
+
+    def primary_key(self, table: str) -> list[str]:
+        info = self.conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+        return [row[1] for row in sorted(info, key=lambda r: r[5]) if row[5]]
+
+    def fetch(self, sql: str, params: list, table: str) -> list[dict]:
+        cursor = self.conn.execute(sql, params)
+        names = [d[0] for d in cursor.description] if cursor.description else []
+        types = self.column_types(table)
+        rows = []
+        for raw in cursor.fetchall():
+            row = {}
+            for name, value in zip(names, raw):
+                col_type = types.get(name, '')
+                if col_type == 'JSON' and isinstance(value, str):
+                    value = json.loads(value)
+                elif col_type == 'BOOLEAN' and value is not None:
+                    value = bool(value)
+                row[name] = value
+            rows.append(row)
+        return rows
+
+    # --- API клиента ----------------------------------------------------
+    def from_(self, table: str) -> FakeQuery:
+        return FakeQuery(self, table)
+
+    table = from_
+
+    def rpc(self, name: str, params: Optional[dict] = None) -> FakeRPC:
+        return FakeRPC(self, name, params)
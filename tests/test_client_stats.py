@@ -0,0 +1,210 @@
+"""
+Unit-тесты для накопительных агрегатов клиента (client_stats.py и get_client_analytics)
+"""
+
+import os
+import random
+import datetime
+import pytest
+from unittest.mock import patch
+from supabase_manager import SupabaseManager
+from client_stats import aggregate_client_transactions, mean_interval_days
+from tests.sqlite_supabase import SqliteSupabase
+
+
+CLIENT_STATS_SCHEMA = """
+CREATE TABLE users (chat_id TEXT PRIMARY KEY, reg_date TEXT, referral_source TEXT);
+CREATE TABLE partners (chat_id TEXT PRIMARY KEY);
+CREATE TABLE transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    client_chat_id TEXT, partner_chat_id TEXT, date_time TEXT,
+    total_amount REAL, earned_points REAL, spent_points REAL, operation_type TEXT
+);
+CREATE TABLE client_lifetime_stats (
+    client_chat_id TEXT PRIMARY KEY, transactions_count INTEGER, ltv REAL, points_earned REAL, points_spent REAL,
+    first_transaction_at TEXT, last_transaction_at TEXT, updated_at TEXT
+);
+CREATE TABLE client_visit_stats (
+    client_chat_id TEXT, partner_chat_id TEXT, visit_count INTEGER, avg_interval_days REAL,
+    first_visit_at TEXT, last_visit_at TEXT, last_computed_at TEXT,
+    PRIMARY KEY (client_chat_id, partner_chat_id)
+);
+"""
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+
+
+def _client_manager(transactions: int, clients: int = 5, seed: int = 11) -> SupabaseManager:
+    rng = random.Random(seed)
+    db = SqliteSupabase()
+    db.executescript(CLIENT_STATS_SCHEMA)
+    db.conn.executemany(
+        'INSERT INTO users VALUES (?, ?, ?)',
+        ((f'C{i}', (NOW - datetime.timedelta(days=400)).isoformat(), 'P1') for i in range(clients))
+    )
+    db.conn.executemany('INSERT INTO partners VALUES (?)', ((f'P{i}',) for i in range(4)))
+    db.conn.executemany(
+        'INSERT INTO transactions (client_chat_id, partner_chat_id, date_time, total_amount, earned_points, spent_points, operation_type) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (
+            (
+                f'C{rng.randrange(clients)}', f'P{rng.randrange(4)}',
+                (NOW - datetime.timedelta(seconds=rng.randrange(365 * 86400))).isoformat(),
+                round(rng.uniform(1, 100), 2), rng.randrange(0, 10), rng.randrange(0, 5),
+                rng.choice(['accrual', 'accrual', 'redemption', 'enrollment_bonus'])
+            )
+            for _ in range(transactions)
+        )
+    )
+    db.conn.commit()
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _raw(manager: SupabaseManager, client_chat_id: str) -> list:
+    rows = manager.client.conn.execute('SELECT * FROM transactions WHERE client_chat_id = ? ORDER BY date_time', (client_chat_id,))
+    columns = [c[0] for c in rows.description]
+    return [dict(zip(columns, row)) for row in rows.fetchall()]
+
+
+class TestAggregation:
+    """Тесты свёртки транзакций клиента"""
+
+    def test_aggregate_client_transactions(self):
+        lifetime, visits = aggregate_client_transactions([
+            {'client_chat_id': 'a', 'partner_chat_id': 'P', 'date_time': '2025-03-01T10:00:00+00:00',
+             'operation_type': 'accrual', 'total_amount': 10.0, 'earned_points': 1},
+            {'client_chat_id': 'a', 'partner_chat_id': 'P', 'date_time': '2025-03-11T10:00:00+00:00',
+             'operation_type': 'redemption', 'total_amount': 5.0, 'spent_points': 3},
+            {'client_chat_id': 'a', 'partner_chat_id': 'P', 'date_time': '2025-03-04T10:00:00+00:00',
+             'operation_type': 'accrual', 'total_amount': 2.5, 'earned_points': 2},
+            {'client_chat_id': 'a', 'partner_chat_id': 'Q', 'date_time': '2025-02-01T10:00:00',
+             'operation_type': 'enrollment_bonus', 'earned_points': 5},
+        ])
+
+        assert lifetime['a'] == {
+            'client_chat_id': 'a', 'transactions_count': 4, 'ltv': 12.5, 'points_earned': 8.0, 'points_spent': 3.0,
+            'first_transaction_at': '2025-02-01T10:00:00+00:00', 'last_transaction_at': '2025-03-11T10:00:00+00:00'
+        }
+        # Приветственный бонус — не визит
+        assert list(visits) == [('a', 'P')]
+        assert visits[('a', 'P')]['visit_count'] == 3
+        assert visits[('a', 'P')]['avg_interval_days'] == 5.0
+
+    def test_mean_interval_days(self):
+        assert mean_interval_days('2025-03-01T00:00:00+00:00', '2025-03-31T00:00:00+00:00', 4) == 10.0
+        assert mean_interval_days('2025-03-01T00:00:00+00:00', '2025-03-01T00:00:00+00:00', 1) == 0.0
+        assert mean_interval_days(None, '2025-03-01', 3) == 0.0
+
+
+class TestClientAnalytics:
+    """get_client_analytics читает накопительные агрегаты"""
+
+    def test_analytics_match_raw_transactions(self):
+        manager = _client_manager(transactions=3000)
+        manager.rebuild_client_stats()
+        transactions = _raw(manager, 'C1')
+
+        stats = manager.get_client_analytics('C1')
+
+        assert stats['total_transactions'] == len(transactions)
+        assert stats['ltv_usd'] == pytest.approx(sum(t['total_amount'] for t in transactions if t['operation_type'] == 'accrual'), abs=0.011)
+        assert stats['total_points_spent'] == sum(t['spent_points'] for t in transactions if t['operation_type'] == 'redemption')
+        assert stats['last_visit'] == transactions[-1]['date_time']
+        assert stats['freq_per_month'] == round(len(transactions) / stats['months_active'], 2)
+
+        visits = {}
+        for txn in transactions:
+            if txn['operation_type'] in ('accrual', 'redemption'):
+                visits.setdefault(txn['partner_chat_id'], []).append(txn['date_time'])
+        favorite = stats['favorite_partners'][0]
+        assert favorite['visits'] == max(len(v) for v in visits.values())
+        dates = visits[favorite['partner_chat_id']]
+        assert favorite['last_visit'] == dates[-1]
+        assert favorite['avg_interval_days'] == mean_interval_days(dates[0], dates[-1], len(dates))
+        assert len(stats['favorite_partners']) == 3
+
+    def test_constant_query_count(self):
+        """Число запросов не зависит от истории клиента"""
+        counts = []
+        for transactions in (50, 5000):
+            manager = _client_manager(transactions=transactions)
+            manager.rebuild_client_stats()
+            manager.client.reset_queries()
+            manager.get_client_analytics('C1')
+            counts.append(manager.client.query_count)
+            assert ('select', 'transactions') not in manager.client.queries
+        assert counts == [3, 3]
+
+    def test_visit_interval_matches_churn_stats(self):
+        """Средний интервал совпадает с пакетным compute_client_visit_stats"""
+        manager = _client_manager(transactions=400)
+        manager.compute_client_visit_stats()
+        batch = dict(manager.client.conn.execute(
+            "SELECT partner_chat_id, avg_interval_days FROM client_visit_stats WHERE client_chat_id = 'C2'"
+        ).fetchall())
+
+        manager.rebuild_client_stats('C2')
+
+        rebuilt = manager.client.conn.execute(
+            "SELECT partner_chat_id, avg_interval_days FROM client_visit_stats WHERE client_chat_id = 'C2'"
+        ).fetchall()
+        assert {pid: pytest.approx(avg, abs=0.011) for pid, avg in rebuilt if pid in batch} == batch
+
+    def test_missing_tables_fall_back_to_raw_rows(self):
+        manager = _client_manager(transactions=300)
+        manager.client.conn.executescript('DROP TABLE client_lifetime_stats; DROP TABLE client_visit_stats;')
+        transactions = _raw(manager, 'C1')
+
+        stats = manager.get_client_analytics('C1')
+
+        assert stats['total_transactions'] == len(transactions)
+        assert stats['favorite_partners']
+
+    def test_rebuild_uses_rpc_when_available(self):
+        manager = _client_manager(transactions=10)
+        calls = []
+        manager.client.register_rpc('rebuild_client_stats', lambda db, params: calls.append(params) or 4)
+
+        assert manager.rebuild_client_stats('C1') == 4
+        assert calls == [{'p_client_chat_id': 'C1'}]
+
+    def test_local_rebuild_skips_anonymized_and_unknown_partners(self):
+        manager = _client_manager(transactions=600)
+        conn = manager.client.conn
+        conn.execute("UPDATE transactions SET client_chat_id = 'DELETED_USER' WHERE client_chat_id = 'C3'")
+        conn.execute("UPDATE transactions SET partner_chat_id = 'DELETED_USER' WHERE partner_chat_id = 'P2'")
+        conn.execute("DELETE FROM partners WHERE chat_id = 'P3'")
+
+        manager.rebuild_client_stats()
+
+        lifetime = {row[0] for row in conn.execute('SELECT client_chat_id FROM client_lifetime_stats')}
+        assert lifetime == {'C0', 'C1', 'C2', 'C4'}
+        partners = {row[0] for row in conn.execute('SELECT DISTINCT partner_chat_id FROM client_visit_stats')}
+        assert partners == {'P0', 'P1'}
+        # Анонимизированные транзакции остаются в числе транзакций клиента
+        assert manager.get_client_analytics('C1')['total_transactions'] == len(_raw(manager, 'C1'))
+
+    def test_full_local_rebuild_keeps_timestamps_and_drops_stale_clients(self):
+        manager = _client_manager(transactions=300)
+        manager.rebuild_client_stats()
+        conn = manager.client.conn
+        conn.execute("DELETE FROM transactions WHERE client_chat_id = 'C4'")
+
+        manager.rebuild_client_stats()
+
+        assert conn.execute("SELECT COUNT(*) FROM client_lifetime_stats WHERE client_chat_id = 'C4'").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM client_visit_stats WHERE client_chat_id = 'C4'").fetchone()[0] == 0
+        assert conn.execute('SELECT COUNT(*) FROM client_visit_stats WHERE last_computed_at IS NULL').fetchone()[0] == 0
+        assert conn.execute('SELECT COUNT(*) FROM client_lifetime_stats WHERE updated_at IS NULL').fetchone()[0] == 0
+
+    def test_unknown_client(self):
+        manager = _client_manager(transactions=10)
+        stats = manager.get_client_analytics('missing')
+        assert stats['total_transactions'] == 0 and stats['favorite_partners'] == []
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
@@ -0,0 +1,303 @@
+"""
+Unit-тесты для системы сообщений SupabaseManager
+"""
+
+import os
+import time
+import datetime
+import statistics
+import pytest
+from unittest.mock import Mock, patch, MagicMock
+from supabase_manager import SupabaseManager, MAX_CONVERSATIONS_PAGE_SIZE
+from tests.sqlite_supabase import SqliteSupabase
+
+
+@pytest.fixture
+def mock_supabase():
+    """Фикстура для мокирования Supabase клиента"""
+    with patch('supabase_manager.create_client') as mock_create:
+        mock_client = MagicMock()
+        mock_create.return_value = mock_client
+        yield mock_client
+
+
+@pytest.fixture
+def manager(mock_supabase):
+    """Фикстура для создания экземпляра SupabaseManager с мок-клиентом"""
+    with patch.dict(os.environ, {
+        'SUPABASE_URL': 'https://test.supabase.co',
+        'SUPABASE_KEY': 'test-key',
+    }):
+        manager = SupabaseManager()
+        manager.transaction_queue = MagicMock()
+        return manager
+
+
+MESSAGES_SCHEMA = """
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    client_chat_id TEXT NOT NULL,
+    partner_chat_id TEXT NOT NULL,
+    sender_type TEXT NOT NULL,
+    message_text TEXT,
+    message_type TEXT DEFAULT 'text',
+    is_read BOOLEAN DEFAULT 0,
+    created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+CREATE INDEX idx_messages_conversation_keyset ON messages(client_chat_id, partner_chat_id, created_at, id);
+"""
+
+
+def _sqlite_manager(total_messages: int) -> SupabaseManager:
+    """SupabaseManager поверх SQLite с одной перепиской на total_messages сообщений."""
+    db = SqliteSupabase()
+    db.executescript(MESSAGES_SCHEMA)
+    base = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+    # Каждые два сообщения делят одну секунду, чтобы курсор проверял и id
+    db.conn.executemany(
+        "INSERT INTO messages (client_chat_id, partner_chat_id, sender_type, message_text, created_at) VALUES (?, ?, ?, ?, ?)",
+        (
+            ('c1', 'p1', 'client' if i % 2 else 'partner', f'msg {i}', (base + datetime.timedelta(seconds=i // 2)).isoformat())
+            for i in range(total_messages)
+        )
+    )
+    db.conn.commit()
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _conversation_rows(count: int) -> list[dict]:
+    return [
+        {
+            'client_chat_id': str(1000 + i),
+            'last_message': {'id': i, 'message_text': f'msg {i}'},
+            'last_activity_at': f'2026-01-01T00:00:{59 - (i % 60):02d}+00:00',
+            'unread_count': i % 3,
+        }
+        for i in range(count)
+    ]
+
+
+class TestPartnerConversations:
+    """Тесты списка переписок партнёра"""
+
+    @pytest.mark.parametrize('clients', [1, 10, 500])
+    def test_query_count_independent_of_conversations(self, manager, mock_supabase, clients):
+        """get_partner_conversations: один RPC-вызов при любом числе клиентов"""
+        mock_supabase.rpc.return_value.execute.return_value = Mock(data=_conversation_rows(clients))
+
+        result = manager.get_partner_conversations('partner_1', limit=MAX_CONVERSATIONS_PAGE_SIZE)
+
+        assert len(result) == clients
+        assert mock_supabase.rpc.call_count == 1
+        assert mock_supabase.from_.call_count == 0
+
+    def test_passes_cursor_and_caps_limit(self, manager, mock_supabase):
+        """get_partner_conversations: курсор передаётся в RPC, limit ограничен"""
+        mock_supabase.rpc.return_value.execute.return_value = Mock(data=[])
+
+        manager.get_partner_conversations(
+            'partner_1',
+            limit=10_000,
+            before_activity_at='2026-01-01T00:00:00+00:00',
+            before_client_chat_id='42',
+        )
+
+        name, params = mock_supabase.rpc.call_args[0]
+        assert name == 'get_partner_conversations_page'
+        assert params['p_limit'] == MAX_CONVERSATIONS_PAGE_SIZE
+        assert params['p_before_activity_at'] == '2026-01-01T00:00:00+00:00'
+        assert params['p_before_client_chat_id'] == '42'
+
+    def test_fallback_pages_messages_and_warns_once(self, caplog):
+        """get_partner_conversations: без RPC — обход сообщений страницами и одно предупреждение"""
+        db = SqliteSupabase()
+        db.executescript(MESSAGES_SCHEMA)
+        base = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+        # 2500 сообщений (больше страницы выгрузки) у трёх клиентов; последним пишет c2, затем c1, затем c3
+        db.conn.executemany(
+            "INSERT INTO messages (client_chat_id, partner_chat_id, sender_type, is_read, created_at) VALUES (?, 'p1', ?, ?, ?)",
+            (
+                (('c3', 'c1', 'c2')[min(i // 1000, 2)], 'client', i % 500 != 0, (base + datetime.timedelta(seconds=i)).isoformat())
+                for i in range(2500)
+            )
+        )
+        db.conn.execute("INSERT INTO messages (client_chat_id, partner_chat_id, sender_type, created_at) VALUES ('c1', 'p2', 'client', ?)", (base.isoformat(),))
+        db.conn.commit()
+        with patch.dict(os.environ, {}, clear=True):
+            manager = SupabaseManager()
+        manager.client = db
+
+        with caplog.at_level('WARNING'):
+            result = manager.get_partner_conversations('p1', limit=2)
+            next_page = manager.get_partner_conversations(
+                'p1',
+                limit=2,
+                before_activity_at=result[-1]['last_activity_at'],
+                before_client_chat_id=result[-1]['client_chat_id'],
+            )
+
+        assert [c['client_chat_id'] for c in result] == ['c2', 'c1']
+        assert result[0]['last_message']['id'] == 2500
+        assert result[0]['last_message']['sender_type'] == 'client'
+        assert [c['unread_count'] for c in result] == [1, 2]
+        assert [(c['client_chat_id'], c['unread_count']) for c in next_page] == [('c3', 2)]
+        # Сообщения читаются страницами по 1000 строк, а не одним запросом без лимита
+        assert db.queries.count(('select', 'messages')) > 4
+        missing = [r for r in caplog.records if 'get_partner_conversations_page' in r.getMessage()]
+        assert len(missing) == 1 and missing[0].levelname == 'WARNING'
+
+    def test_no_client_returns_empty(self, manager):
+        """get_partner_conversations: без клиента БД возвращает пустой список"""
+        manager.client = None
+        assert manager.get_partner_conversations('partner_1') == []
+
+
+class TestUnreadCounters:
+    """Тесты счётчиков непрочитанных сообщений"""
+
+    def test_reads_counter_table_once_then_cache(self, manager, mock_supabase):
+        """get_unread_messages_count: один запрос к счётчикам, повторное чтение — из кэша"""
+        counters = mock_supabase.from_.return_value.select.return_value.eq.return_value.eq.return_value
+        counters.execute.return_value = Mock(data=[{'unread_count': 2}, {'unread_count': 3}])
+
+        assert manager.get_unread_messages_count(partner_chat_id='partner_1') == 5
+        assert manager.get_unread_messages_count(partner_chat_id='partner_1') == 5
+
+        mock_supabase.from_.assert_called_once_with('message_unread_counters')
+        assert counters.execute.call_count == 1
+
+    def test_pair_counter_filters_counterpart(self, manager, mock_supabase):
+        """get_unread_messages_count: клиент + партнёр — счётчик конкретной пары"""
+        pair = mock_supabase.from_.return_value.select.return_value.eq.return_value.eq.return_value.eq.return_value
+        pair.execute.return_value = Mock(data=[{'unread_count': 4}])
+
+        assert manager.get_unread_messages_count(client_chat_id='c1', partner_chat_id='p1') == 4
+        mock_supabase.from_.return_value.select.return_value.eq.return_value.eq.return_value.eq \
+            .assert_called_once_with('counterpart_chat_id', 'p1')
+
+    def test_save_message_increments_cached_count(self, manager, mock_supabase):
+        """save_message: увеличивает закэшированный счётчик получателя без запросов"""
+        manager._set_cached_unread_count(('partner', 'p1', None), 1)
+        mock_supabase.from_.return_value.insert.return_value.execute.return_value = Mock(data=[{'id': 10}])
+
+        manager.save_message('c1', 'p1', 'client', 'hi')
+
+        assert manager.get_unread_messages_count(partner_chat_id='p1') == 2
+        assert mock_supabase.from_.call_count == 1
+
+    def test_mark_conversation_as_read_resets_pair(self, manager, mock_supabase):
+        """mark_conversation_as_read: обнуляет счётчик пары и сбрасывает общий"""
+        manager._set_cached_unread_count(('client', 'c1', 'p1'), 3)
+        manager._set_cached_unread_count(('client', 'c1', None), 7)
+
+        assert manager.mark_conversation_as_read('c1', 'p1', 'client') is True
+
+        assert manager._get_cached_unread_count(('client', 'c1', 'p1')) == 0
+        assert manager._get_cached_unread_count(('client', 'c1', None)) is None
+
+    def test_mark_message_as_read_invalidates_recipient(self, manager, mock_supabase):
+        """mark_message_as_read: сбрасывает кэш получателя прочитанного сообщения"""
+        manager._set_cached_unread_count(('partner', 'p1', None), 3)
+        mock_supabase.from_.return_value.update.return_value.eq.return_value.execute.return_value = Mock(
+            data=[{'id': 1, 'sender_type': 'client', 'client_chat_id': 'c1', 'partner_chat_id': 'p1'}]
+        )
+
+        assert manager.mark_message_as_read(1) is True
+        assert manager._get_cached_unread_count(('partner', 'p1', None)) is None
+
+    def test_cache_entry_expires(self, manager):
+        """Кэш счётчиков живёт не дольше UNREAD_COUNTS_CACHE_TTL"""
+        manager.unread_counts_cache_ttl = 0
+        manager._set_cached_unread_count(('client', 'c1', None), 3)
+        manager._unread_counts_cache[('client', 'c1', None)]['updated_at'] -= datetime.timedelta(seconds=1)
+        assert manager._get_cached_unread_count(('client', 'c1', None)) is None
+
+    def test_fallback_to_messages_count(self, manager, mock_supabase):
+        """get_unread_messages_count: при ошибке таблицы счётчиков считает по messages"""
+        mock_supabase.from_.side_effect = [Exception('relation does not exist'), MagicMock()]
+        manager._count_unread_messages_from_messages = Mock(return_value=6)
+
+        assert manager.get_unread_messages_count(client_chat_id='c1') == 6
+        manager._count_unread_messages_from_messages.assert_called_once_with('c1', None)
+
+    def test_reconcile_clears_cache(self, manager, mock_supabase):
+        """reconcile_unread_counters: вызывает RPC сверки и очищает кэш"""
+        manager._set_cached_unread_count(('client', 'c1', None), 3)
+        mock_supabase.rpc.return_value.execute.return_value = Mock(data=2)
+
+        assert manager.reconcile_unread_counters() == 2
+        mock_supabase.rpc.assert_called_once_with('reconcile_message_unread_counters', {'p_recipient_chat_id': None})
+        assert manager._unread_counts_cache == {}
+
+
+class TestConversationKeysetPagination:
+    """Тесты курсорной пагинации get_conversation"""
+
+    def test_scroll_back_visits_every_message_once(self):
+        """get_conversation: прокрутка назад по курсору без пропусков и дублей"""
+        manager = _sqlite_manager(25)
+        page = manager.get_conversation('c1', 'p1', limit=10, offset=15)
+        seen = [m['id'] for m in page]
+        while page:
+            page = manager.get_conversation('c1', 'p1', limit=10, before=manager.get_message_cursor(page[0]))
+            seen = [m['id'] for m in page] + seen
+        assert seen == list(range(1, 26))
+
+    def test_scroll_forward_and_new_messages(self):
+        """get_conversation: курсор after не сдвигается при вставке новых сообщений"""
+        manager = _sqlite_manager(6)
+        first = manager.get_conversation('c1', 'p1', limit=3)
+        manager.save_message('c1', 'p1', 'client', 'late')
+        rest = manager.get_conversation('c1', 'p1', limit=10, after=manager.get_message_cursor(first[-1]))
+        assert [m['id'] for m in first] == [1, 2, 3]
+        assert [m['id'] for m in rest] == [4, 5, 6, 7]
+
+    def test_page_size_capped(self, manager, mock_supabase):
+        """get_conversation: размер страницы ограничен MAX_CONVERSATIONS_PAGE_SIZE"""
+        builder = mock_supabase.from_.return_value.select.return_value.eq.return_value.eq.return_value
+        keyset = builder.lte.return_value.or_
+        keyset.return_value.order.return_value.order.return_value.limit.return_value.execute.return_value = Mock(data=[])
+
+        manager.get_conversation('c1', 'p1', limit=100_000, before=('2026-01-01T00:00:00+00:00', 5))
+
+        builder.lte.assert_called_once_with('created_at', '2026-01-01T00:00:00+00:00')
+        keyset.assert_called_once_with(
+            'created_at.lt.2026-01-01T00:00:00+00:00,and(created_at.eq.2026-01-01T00:00:00+00:00,id.lt.5)'
+        )
+        keyset.return_value.order.return_value.order.return_value.limit.assert_called_once_with(MAX_CONVERSATIONS_PAGE_SIZE)
+
+    @pytest.mark.slow
+    def test_benchmark_latency_flat_over_100k_messages(self):
+        """Бенчмарк: время страницы по курсору не растёт с глубиной истории (100k сообщений)"""
+        total = 100_000
+        manager = _sqlite_manager(total)
+
+        def measure(call) -> float:
+            samples = []
+            for _ in range(5):
+                started = time.perf_counter()
+                call()
+                samples.append(time.perf_counter() - started)
+            return statistics.median(samples)
+
+        def cursor_at(message_id: int) -> tuple:
+            row = manager.client.conn.execute('SELECT created_at, id FROM messages WHERE id = ?', (message_id,)).fetchone()
+            return (row[0], row[1])
+
+        keyset_shallow = measure(lambda: manager.get_conversation('c1', 'p1', limit=50, before=cursor_at(total)))
+        keyset_deep = measure(lambda: manager.get_conversation('c1', 'p1', limit=50, before=cursor_at(100)))
+        offset_shallow = measure(lambda: manager.get_conversation('c1', 'p1', limit=50, offset=total - 100))
+        offset_deep = measure(lambda: manager.get_conversation('c1', 'p1', limit=50, offset=50))
+
+        assert len(manager.get_conversation('c1', 'p1', limit=50, before=cursor_at(100))) == 50
+        # Для offset «свежие» страницы — самые глубокие (OFFSET ~ 100k), курсор от этого не зависит
+        assert keyset_deep < offset_shallow
+        assert keyset_shallow < offset_shallow
+        assert max(keyset_shallow, keyset_deep) < 5 * min(keyset_shallow, keyset_deep) + 0.002
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
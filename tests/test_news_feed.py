@@ -0,0 +1,180 @@
+"""
+Unit-тесты для ленты новостей SupabaseManager
+"""
+
+import os
+import time
+import datetime
+import tracemalloc
+import pytest
+from unittest.mock import patch
+from supabase_manager import SupabaseManager, NEWS_FEED_COLUMNS, MAX_NEWS_FEED_PAGE_SIZE
+from tests.sqlite_supabase import SqliteSupabase
+
+
+NEWS_SCHEMA = """
+CREATE TABLE news (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    content TEXT NOT NULL,
+    preview_text TEXT,
+    image_url TEXT,
+    author_chat_id TEXT,
+    is_published BOOLEAN DEFAULT 1,
+    views_count INTEGER DEFAULT 0,
+    title_en TEXT,
+    preview_text_en TEXT,
+    content_en TEXT,
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE INDEX idx_news_feed ON news(is_published, created_at DESC, id DESC);
+CREATE TABLE app_settings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    setting_key TEXT UNIQUE NOT NULL,
+    setting_value TEXT NOT NULL,
+    updated_by TEXT,
+    updated_at TEXT
+);
+INSERT INTO app_settings (setting_key, setting_value) VALUES ('news_feed_version', '1');
+"""
+
+
+def _news_manager(posts: int, body_size: int = 200) -> SupabaseManager:
+    db = SqliteSupabase()
+    db.executescript(NEWS_SCHEMA)
+    base = datetime.datetime(2025, 1, 1)
+    body = 'x' * body_size
+    db.conn.executemany(
+        "INSERT INTO news (title, content, preview_text, content_en, is_published, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            (f'title {i}', body, f'preview {i}', body, 0 if i % 10 == 0 else 1, (base + datetime.timedelta(minutes=i // 2)).isoformat())
+            for i in range(1, posts + 1)
+        )
+    )
+    db.conn.commit()
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _bump_version(manager: SupabaseManager):
+    """Имитирует триггер bump_news_feed_version из другого процесса"""
+    manager.client.conn.execute(
+        "UPDATE app_settings SET setting_value = CAST(setting_value AS INTEGER) + 1 WHERE setting_key = 'news_feed_version'"
+    )
+    manager.client.conn.commit()
+
+
+class TestNewsFeed:
+    """Тесты get_news_feed"""
+
+    def test_projects_list_columns_only(self):
+        """get_news_feed: не загружает текст и переводы"""
+        manager = _news_manager(5)
+        page = manager.get_news_feed(limit=10)
+        expected = {c.strip() for c in NEWS_FEED_COLUMNS.split(',')}
+        assert page and all(set(item) == expected for item in page)
+        assert 'content' in manager.get_news_by_id(page[0]['id'])
+
+    def test_cursor_pagination_covers_published_news(self):
+        """get_news_feed: курсор проходит все опубликованные новости без дублей"""
+        manager = _news_manager(45)
+        seen, before = [], None
+        while True:
+            page = manager.get_news_feed(limit=7, before=before)
+            if not page:
+                break
+            seen.extend(item['id'] for item in page)
+            before = manager.get_news_cursor(page[-1])
+        expected = [i for i in range(45, 0, -1) if i % 10 != 0]
+        assert seen == expected
+
+    def test_cached_page_served_without_feed_query(self):
+        """get_news_feed: повторное чтение при той же версии — из кэша, дочитываются только просмотры"""
+        manager = _news_manager(10)
+        first = manager.get_news_feed(limit=5)
+        manager.client.reset_queries()
+
+        second = manager.get_news_feed(limit=5)
+
+        assert second == first
+        assert manager.client.queries == [('select', 'news')]
+
+    def test_cached_page_reports_fresh_views(self):
+        """get_news_feed: просмотры не меняют версию ленты, но в ответе из кэша актуальны"""
+        manager = _news_manager(10)
+        first = manager.get_news_feed(limit=5)
+        manager.client.conn.execute('UPDATE news SET views_count = views_count + 7 WHERE id = ?', (first[0]['id'],))
+        manager.client.conn.commit()
+
+        second = manager.get_news_feed(limit=5)
+
+        assert second[0]['views_count'] == first[0]['views_count'] + 7
+        assert [item['id'] for item in second] == [item['id'] for item in first]
+
+    def test_version_change_invalidates_cache(self):
+        """get_news_feed: смена версии ленты (другой процесс) сбрасывает кэш после TTL"""
+        manager = _news_manager(10)
+        manager.news_feed_version_ttl = 0
+        manager.get_news_feed(limit=5)
+        manager.client.conn.execute("UPDATE news SET title = 'edited' WHERE id = 9")
+        _bump_version(manager)
+
+        page = manager.get_news_feed(limit=5)
+
+        assert page[0]['title'] == 'edited'
+
+    def test_create_and_update_invalidate_local_cache(self):
+        """create_news/update_news: локальный кэш ленты сбрасывается сразу"""
+        manager = _news_manager(3)
+        manager.get_news_feed(limit=5)
+
+        ok, news_id = manager.create_news({'title': 'fresh', 'content': 'body'})
+        assert ok is True
+        assert manager.get_news_feed(limit=5)[0]['id'] == news_id
+
+        manager.update_news(news_id, {'title': 'renamed'})
+        assert manager.get_news_feed(limit=5)[0]['title'] == 'renamed'
+
+    def test_create_news_does_not_write_debug_file(self):
+        """create_news: не пишет отладочный лог в файл"""
+        manager = _news_manager(0)
+        with patch('builtins.open') as mocked_open:
+            ok, _ = manager.create_news({'title': 't', 'content': 'c'})
+        assert ok is True
+        mocked_open.assert_not_called()
+
+    def test_page_size_capped(self):
+        """get_news_feed: размер страницы ограничен MAX_NEWS_FEED_PAGE_SIZE"""
+        manager = _news_manager(MAX_NEWS_FEED_PAGE_SIZE * 2)
+        assert len(manager.get_news_feed(limit=10_000)) == MAX_NEWS_FEED_PAGE_SIZE
+
+    @pytest.mark.slow
+    def test_benchmark_feed_vs_get_all_news_10k(self):
+        """Бенчмарк: лента против get_all_news на 10k новостей (время и пиковая память)"""
+        manager = _news_manager(10_000, body_size=4000)
+
+        def measure(call):
+            tracemalloc.start()
+            started = time.perf_counter()
+            result = call()
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return result, elapsed, peak
+
+        all_news, before_time, before_peak = measure(lambda: manager.get_all_news())
+        page, after_time, after_peak = measure(lambda: manager.get_news_feed(limit=20))
+        _, cached_time, _ = measure(lambda: manager.get_news_feed(limit=20))
+
+        assert len(all_news) == 9_000
+        assert len(page) == 20
+        assert after_time < before_time
+        assert after_peak * 20 < before_peak
+        assert cached_time <= after_time
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
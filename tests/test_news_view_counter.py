@@ -0,0 +1,183 @@
+"""
+Unit-тесты для news_view_counter.py
+Буферизация просмотров новостей и пакетная запись
+"""
+
+import os
+import sys
+import threading
+import pytest
+from unittest.mock import Mock, MagicMock, patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from news_view_counter import NewsViewCounter
+from supabase_manager import SupabaseManager
+from tests.sqlite_supabase import SqliteSupabase
+
+
+NEWS_SCHEMA = """
+CREATE TABLE news (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    views_count INTEGER DEFAULT 0
+);
+"""
+
+
+def _increment_news_views_batch(db: SqliteSupabase, params: dict) -> int:
+    """Аналог RPC increment_news_views_batch: атомарный UPDATE views_count = views_count + delta"""
+    rows = 0
+    for item in params['p_views']:
+        cursor = db.conn.execute(
+            'UPDATE news SET views_count = COALESCE(views_count, 0) + ? WHERE id = ?',
+            (item['delta'], item['news_id'])
+        )
+        rows += cursor.rowcount
+    db.conn.commit()
+    return rows
+
+
+@pytest.fixture
+def sqlite_db():
+    db = SqliteSupabase()
+    db.executescript(NEWS_SCHEMA)
+    db.conn.executemany('INSERT INTO news (title) VALUES (?)', [('first',), ('second',), ('third',)])
+    db.conn.commit()
+    db.register_rpc('increment_news_views_batch', _increment_news_views_batch)
+    return db
+
+
+def _views(db: SqliteSupabase) -> dict:
+    return dict(db.conn.execute('SELECT id, views_count FROM news').fetchall())
+
+
+class TestNewsViewCounterBuffer:
+    """Тесты буфера просмотров"""
+
+    def test_views_aggregated_into_single_rpc(self, sqlite_db):
+        """Просмотры копятся в памяти и записываются одним RPC-вызовом"""
+        counter = NewsViewCounter(Mock(client=sqlite_db), flush_interval=0, max_pending=10_000)
+        for _ in range(50):
+            counter.record(1)
+        for _ in range(7):
+            counter.record(2)
+
+        assert sqlite_db.query_count == 0
+        assert counter.flush() == 57
+        assert sqlite_db.queries == [('rpc', 'increment_news_views_batch')]
+        assert _views(sqlite_db) == {1: 50, 2: 7, 3: 0}
+
+    def test_flush_when_max_pending_reached(self, sqlite_db):
+        """Досрочный сброс при накоплении max_pending просмотров"""
+        counter = NewsViewCounter(Mock(client=sqlite_db), flush_interval=0, max_pending=5)
+        for _ in range(5):
+            counter.record(3)
+
+        assert counter.pending() == {}
+        assert _views(sqlite_db)[3] == 5
+
+    def test_failed_flush_keeps_views(self):
+        """При ошибке БД просмотры возвращаются в буфер"""
+        client = MagicMock()
+        client.rpc.return_value.execute.side_effect = Exception('db down')
+        counter = NewsViewCounter(Mock(client=client), flush_interval=0, max_pending=100)
+        counter.record(1, views=3)
+
+        assert counter.flush() == 0
+        assert counter.pending() == {1: 3}
+
+    def test_failed_flush_backs_off_and_caps_buffer(self):
+        """После ошибки просмотры копятся без синхронных повторов, буфер ограничен числом новостей"""
+        client = MagicMock()
+        client.rpc.return_value.execute.side_effect = Exception('db down')
+        counter = NewsViewCounter(Mock(client=client), flush_interval=0, max_pending=2, max_news=3, retry_cooldown=60)
+        counter.record(1)
+        counter.record(1)
+        assert client.rpc.call_count == 1
+
+        for news_id in (1, 2, 3, 2, 1):
+            assert counter.record(news_id) is True
+        assert counter.record(4) is False
+        assert client.rpc.call_count == 1
+        assert counter.pending() == {1: 4, 2: 2, 3: 1}
+        # Фоновый сброс тоже ждёт окончания паузы, явный — нет
+        assert counter.flush(force=False) == 0 and client.rpc.call_count == 1
+        client.rpc.return_value.execute.side_effect = None
+        assert counter.flush() == 7
+        assert counter.record(4) is True
+
+    def test_unknown_news_ids_are_skipped(self, sqlite_db):
+        """Некорректные id не попадают в буфер, неизвестные отбрасываются при записи"""
+        counter = NewsViewCounter(Mock(client=sqlite_db), flush_interval=0, max_pending=100)
+        assert counter.record('abc') is False and counter.record(0) is False
+        counter.record(1)
+        counter.record(999)
+
+        counter.flush()
+
+        assert _views(sqlite_db) == {1: 1, 2: 0, 3: 0}
+
+    def test_stop_flushes_remaining_views(self, sqlite_db):
+        """stop() записывает остаток буфера (вызывается и при завершении процесса)"""
+        counter = NewsViewCounter(Mock(client=sqlite_db), flush_interval=60, max_pending=100)
+        counter.record(2, views=4)
+        counter.stop()
+
+        assert _views(sqlite_db)[2] == 4
+        assert counter._thread is None or not counter._thread.is_alive()
+
+    def test_background_flush_interval(self, sqlite_db):
+        """Фоновый поток сбрасывает буфер не реже flush_interval"""
+        counter = NewsViewCounter(Mock(client=sqlite_db), flush_interval=0.05, max_pending=100)
+        counter.record(1)
+        counter._stop_event.wait(0.5)
+        try:
+            assert _views(sqlite_db)[1] == 1
+        finally:
+            counter.stop()
+
+    def test_interval_from_env(self):
+        """Интервал и порог сброса настраиваются через окружение"""
+        with patch.dict(os.environ, {'NEWS_VIEWS_FLUSH_INTERVAL': '2.5', 'NEWS_VIEWS_MAX_PENDING': '42'}):
+            counter = NewsViewCounter(Mock(client=None))
+        assert counter.flush_interval == 2.5
+        assert counter.max_pending == 42
+
+
+class TestIncrementNewsViewsConcurrency:
+    """Параллельный подсчёт просмотров через SupabaseManager"""
+
+    def test_concurrent_views_exact_counts(self, sqlite_db):
+        """Параллельные просмотры дают точные итоговые значения"""
+        with patch.dict(os.environ, {}, clear=True):
+            manager = SupabaseManager()
+        manager.client = sqlite_db
+        manager.news_view_counter = NewsViewCounter(manager, flush_interval=0.01, max_pending=37)
+
+        threads_count, views_per_thread = 16, 250
+
+        def worker(index: int):
+            for i in range(views_per_thread):
+                assert manager.increment_news_views(1 + (index + i) % 3) is True
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(threads_count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        manager.news_view_counter.stop()
+
+        views = _views(sqlite_db)
+        assert sum(views.values()) == threads_count * views_per_thread
+        expected = {1: 0, 2: 0, 3: 0}
+        for index in range(threads_count):
+            for i in range(views_per_thread):
+                expected[1 + (index + i) % 3] += 1
+        assert views == expected
+        assert all(kind == 'rpc' for kind, _ in sqlite_db.queries)
+        assert sqlite_db.query_count < threads_count * views_per_thread
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
@@ -0,0 +1,184 @@
+"""
+Unit-тесты для когортного анализа партнера (partner_analytics.cohort_analysis и
+SupabaseManager.get_partner_cohort_analysis)
+"""
+
+import os
+import time
+import random
+import datetime
+import pytest
+import pandas as pd
+from unittest.mock import patch
+from dateutil import parser
+from supabase_manager import SupabaseManager
+from partner_analytics import cohort_analysis
+from tests.sqlite_supabase import SqliteSupabase
+
+
+ANALYTICS_SCHEMA = """
+CREATE TABLE users (chat_id TEXT PRIMARY KEY, name TEXT, reg_date TEXT, referral_source TEXT);
+CREATE INDEX idx_users_referral_source ON users(referral_source, chat_id);
+CREATE TABLE transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    client_chat_id TEXT, partner_chat_id TEXT, date_time TEXT,
+    total_amount REAL, earned_points REAL, spent_points REAL, operation_type TEXT, description TEXT
+);
+CREATE INDEX idx_transactions_partner ON transactions(partner_chat_id, operation_type, id);
+"""
+
+
+def _analytics_manager(clients: int, transactions: int, seed: int = 7) -> SupabaseManager:
+    rng = random.Random(seed)
+    db = SqliteSupabase()
+    db.executescript(ANALYTICS_SCHEMA)
+    start = datetime.datetime(2024, 1, 1)
+    users = []
+    for i in range(clients):
+        reg = start + datetime.timedelta(days=rng.randrange(0, 540))
+        users.append((f'C{i}', f'client {i}', None if i % 50 == 0 else reg.isoformat(), 'P1' if i % 10 else 'P2'))
+    db.conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?)', users)
+    db.conn.executemany(
+        'INSERT INTO transactions (client_chat_id, partner_chat_id, date_time, total_amount, earned_points, spent_points, operation_type, description) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (
+            (
+                f'C{rng.randrange(clients)}', 'P1' if rng.random() < 0.9 else 'P2',
+                (start + datetime.timedelta(days=rng.randrange(0, 600), minutes=rng.randrange(1440))).isoformat(),
+                round(rng.uniform(1, 200), 2), 1.0, 0.0,
+                rng.choice(['accrual', 'accrual', 'accrual', 'redemption']), 'x' * 40
+            )
+            for _ in range(transactions)
+        )
+    )
+    db.conn.commit()
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _reference_cohorts(manager: SupabaseManager, partner_chat_id: str) -> list:
+    """Прежний алгоритм: запрос транзакций на каждую когорту и подсчёт в Python"""
+    clients = manager.client.from_('users').select('chat_id, reg_date').eq('referral_source', partner_chat_id).execute().data
+    groups = {}
+    for client in clients:
+        if not client.get('reg_date'):
+            continue
+        reg_date = parser.parse(client['reg_date'])
+        groups.setdefault(f"{reg_date.year}-{str(reg_date.month).zfill(2)}", []).append(client['chat_id'])
+    cohorts = []
+    for month, ids in sorted(groups.items()):
+        txns = manager.client.from_('transactions').select('*').eq('partner_chat_id', partner_chat_id).in_('client_chat_id', ids).execute().data
+        accrual = [t for t in txns if t.get('operation_type') == 'accrual']
+        revenue = sum(float(t.get('total_amount', 0)) for t in accrual)
+        cohorts.append({
+            'month': month,
+            'clients_count': len(ids),
+            'total_revenue': round(revenue, 2),
+            'total_transactions': len(accrual),
+            'avg_revenue_per_client': round(revenue / len(ids), 2),
+            'avg_transactions_per_client': round(len(accrual) / len(ids), 2)
+        })
+    return cohorts
+
+
+def _count(manager: SupabaseManager, sql: str) -> int:
+    return manager.client.conn.execute(sql).fetchone()[0]
+
+
+def _approx(cohorts: list) -> list:
+    """Порядок суммирования отличается — сравниваем округлённые суммы с точностью до копейки"""
+    return [{k: pytest.approx(v, abs=0.011) if isinstance(v, float) else v for k, v in c.items()} for c in cohorts]
+
+
+class TestCohortAnalysis:
+    """Тесты cohort_analysis"""
+
+    def test_retention_matrix(self):
+        clients = pd.DataFrame([
+            {'chat_id': 'a', 'reg_date': '2025-01-10T10:00:00'},
+            {'chat_id': 'b', 'reg_date': '2025-01-20T10:00:00+03:00'},
+            {'chat_id': 'c', 'reg_date': '2025-02-01T00:30:00'},
+            {'chat_id': 'd', 'reg_date': None},
+        ])
+        transactions = pd.DataFrame([
+            {'client_chat_id': 'a', 'date_time': '2025-01-11', 'total_amount': 10.0, 'operation_type': 'accrual'},
+            {'client_chat_id': 'b', 'date_time': '2025-01-25', 'total_amount': 5.0, 'operation_type': 'accrual'},
+            {'client_chat_id': 'a', 'date_time': '2025-03-02', 'total_amount': 7.5, 'operation_type': 'accrual'},
+            {'client_chat_id': 'a', 'date_time': '2025-03-09', 'total_amount': 1.0, 'operation_type': 'redemption'},
+            {'client_chat_id': 'c', 'date_time': '2025-02-03', 'total_amount': 3.0, 'operation_type': 'accrual'},
+            {'client_chat_id': 'd', 'date_time': '2025-02-03', 'total_amount': 99.0, 'operation_type': 'accrual'},
+        ])
+
+        result = cohort_analysis(clients, transactions, as_of=datetime.datetime(2025, 3, 15))
+
+        assert result['cohorts'] == [
+            {'month': '2025-01', 'clients_count': 2, 'total_revenue': 22.5, 'total_transactions': 3,
+             'avg_revenue_per_client': 11.25, 'avg_transactions_per_client': 1.5},
+            {'month': '2025-02', 'clients_count': 1, 'total_revenue': 3.0, 'total_transactions': 1,
+             'avg_revenue_per_client': 3.0, 'avg_transactions_per_client': 1.0},
+        ]
+        january = result['retention_matrix'][0]
+        assert [(p['period'], p['active_clients'], p['retention_rate'], p['revenue']) for p in january['periods']] == [
+            (0, 2, 100.0, 15.0), (1, 0, 0.0, 0.0), (2, 1, 50.0, 7.5)
+        ]
+        assert len(result['retention_matrix'][1]['periods']) == 2
+
+    def test_empty_inputs(self):
+        empty = pd.DataFrame(columns=['client_chat_id', 'date_time', 'total_amount', 'operation_type'])
+        assert cohort_analysis(pd.DataFrame(columns=['chat_id', 'reg_date']), empty) == {'cohorts': [], 'retention_matrix': []}
+        result = cohort_analysis(pd.DataFrame([{'chat_id': 'a', 'reg_date': '2025-01-01'}]), empty, as_of=datetime.datetime(2025, 1, 2))
+        assert result['cohorts'][0]['total_transactions'] == 0
+
+
+class TestGetPartnerCohortAnalysis:
+    """Тесты SupabaseManager.get_partner_cohort_analysis"""
+
+    def test_matches_previous_implementation(self):
+        manager = _analytics_manager(clients=600, transactions=8000)
+        expected = _reference_cohorts(manager, 'P1')
+
+        result = manager.get_partner_cohort_analysis('P1')
+
+        assert len(expected) > 12
+        assert _approx(result['cohorts']) == expected
+        assert len(result['retention_matrix']) == len(expected)
+
+    def test_constant_query_count(self):
+        """Запросов столько, сколько страниц, а не когорт"""
+        manager = _analytics_manager(clients=600, transactions=3000)
+        manager.client.reset_queries()
+
+        accruals = _count(manager, "SELECT COUNT(*) FROM transactions WHERE partner_chat_id = 'P1' AND operation_type = 'accrual'")
+
+        manager.get_partner_cohort_analysis('P1')
+
+        # Страницы по 1000 строк и одна пустая в конце плюс по запросу на водяной знак кеша
+        assert manager.client.queries.count(('select', 'users')) == 3
+        assert manager.client.queries.count(('select', 'transactions')) == accruals // 1000 + 3
+
+    def test_no_clients(self):
+        manager = _analytics_manager(clients=0, transactions=0)
+        assert manager.get_partner_cohort_analysis('P1') == {'cohorts': [], 'retention_matrix': []}
+
+    @pytest.mark.slow
+    def test_benchmark_1m_transactions(self):
+        """Бенчмарк: 1M транзакций партнера"""
+        manager = _analytics_manager(clients=20_000, transactions=1_000_000)
+
+        started = time.perf_counter()
+        reference = _reference_cohorts(manager, 'P1')
+        reference_time = time.perf_counter() - started
+
+        manager.client.reset_queries()
+        started = time.perf_counter()
+        result = manager.get_partner_cohort_analysis('P1')
+        engine_time = time.perf_counter() - started
+
+        assert _approx(result['cohorts']) == reference
+        assert engine_time < reference_time
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
@@ -0,0 +1,220 @@
+"""
+Unit-тесты для ночного предрасчёта дашбордов партнеров (partner_dashboards.py)
+"""
+
+import json
+import datetime
+import pytest
+from tests.test_partner_rollups import _rollup_manager, NOW
+
+
+def _cached_payloads(manager) -> dict:
+    rows = manager.client.conn.execute('SELECT cache_key, payload FROM analytics_cache').fetchall()
+    return {key: json.loads(payload) for key, payload in rows}
+
+
+def _approx(value):
+    if isinstance(value, dict):
+        return {k: _approx(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_approx(v) for v in value]
+    if isinstance(value, float):
+        return pytest.approx(value, abs=0.011)
+    return value
+
+
+def _spread_partners(manager, partners: int):
+    """Раскладывает клиентов и транзакции по partners партнерам."""
+    conn = manager.client.conn
+    conn.execute("UPDATE users SET referral_source = 'P' || (CAST(SUBSTR(chat_id, 2) AS INTEGER) % ?)", (partners,))
+    conn.execute("UPDATE transactions SET partner_chat_id = 'P' || (id % ?)", (partners,))
+    conn.execute("UPDATE nps_ratings SET partner_chat_id = 'P' || (id % ?)", (partners,))
+    conn.commit()
+
+
+class TestPartnerDashboardPrecompute:
+    """Предрасчёт дашбордов всех партнеров"""
+
+    def test_payloads_match_interactive_stats(self):
+        reference = _rollup_manager(clients=300, transactions=6000)
+        reference.rebuild_partner_daily_stats()
+        manager = _rollup_manager(clients=300, transactions=6000)
+        manager.rebuild_partner_daily_stats()
+
+        manager.partner_dashboards.periods = (7, 30, 90, 0)
+        summary = manager.partner_dashboards.run(now=NOW)
+        cached = _cached_payloads(manager)
+
+        assert summary['partners'] == 2
+        chart_start = (NOW.date() - datetime.timedelta(days=30)).isoformat()
+        for partner in ('P1', 'P2'):
+            expected = {
+                f'partner_stats:{partner}': reference.get_partner_stats(partner),
+                f'partner_stats_by_period:{partner}:{chart_start}:{NOW.date().isoformat()}':
+                    reference.get_partner_stats_by_period(partner, chart_start, NOW.date().isoformat()),
+                f'partner_cohorts:{partner}': reference.get_partner_cohort_analysis(partner),
+            }
+            for period_days in (7, 30, 90, 0):
+                window_start = (NOW - datetime.timedelta(days=period_days)).date().isoformat() if period_days else '1970-01-01'
+                expected[f'partner_advanced_stats:{partner}:{period_days}:{window_start}'] = \
+                    reference.get_advanced_partner_stats(partner, period_days, now=NOW)
+
+            for key, payload in expected.items():
+                assert cached[key]['stats'] == _approx(payload), key
+                assert cached[key]['watermark']['clients'] == (240 if partner == 'P1' else 60)
+
+    def test_query_count_does_not_depend_on_partner_count(self):
+        counts = []
+        for partners in (3, 60):
+            manager = _rollup_manager(clients=120, transactions=600, days=30)
+            _spread_partners(manager, partners)
+            manager.rebuild_partner_daily_stats()
+            manager.client.reset_queries()
+
+            summary = manager.partner_dashboards.run(now=NOW, refresh_days=0)
+
+            assert summary['partners'] == partners
+            counts.append(len([q for q in manager.client.queries if q[0] == 'select']))
+        assert counts[0] == counts[1]
+
+    def test_cache_written_in_batches(self):
+        manager = _rollup_manager(clients=600, transactions=1200, days=30)
+        _spread_partners(manager, 100)
+        manager.rebuild_partner_daily_stats()
+        manager.client.reset_queries()
+
+        summary = manager.precompute_partner_dashboards(refresh_days=0)
+
+        # 100 партнеров × (stats, by-period, когорты, 3 периода) = 600 записей — две пачки
+        assert summary['entries'] == 600
+        assert manager.client.queries.count(('upsert', 'analytics_cache')) == 2
+
+        manager.partner_dashboards.periods = (7, 30, 90, 0)
+        summary = manager.precompute_partner_dashboards(refresh_days=0)
+
+        # Плюс весь период: 700 записей — ещё две пачки
+        assert summary['entries'] == 700
+        assert manager.client.queries.count(('upsert', 'analytics_cache')) == 4
+
+    def test_default_periods_precompute_all_time_dashboards(self):
+        """Без периода 0 общая статистика и когорты считаются по агрегатам старше окна"""
+        reference = _rollup_manager(clients=300, transactions=6000)
+        reference.rebuild_partner_daily_stats()
+        manager = _rollup_manager(clients=300, transactions=6000)
+        manager.rebuild_partner_daily_stats()
+        assert manager.partner_dashboards.periods == (7, 30, 90)
+
+        manager.partner_dashboards.run(now=NOW)
+        cached = _cached_payloads(manager)
+
+        for partner in ('P1', 'P2'):
+            assert cached[f'partner_stats:{partner}']['stats'] == _approx(reference.get_partner_stats(partner))
+            assert cached[f'partner_cohorts:{partner}']['stats'] == _approx(reference.get_partner_cohort_analysis(partner))
+
+    def test_history_read_separately_from_the_window(self):
+        manager = _rollup_manager(clients=100, transactions=1000, days=30)
+        manager.rebuild_partner_daily_stats()
+        old_day = (NOW.date() - datetime.timedelta(days=200)).isoformat()
+        conn = manager.client.conn
+        conn.execute("INSERT INTO partner_daily_stats (partner_chat_id, stat_date, currency, transactions_count) VALUES ('OLD', ?, 'USD', 1)", (old_day,))
+        conn.execute("INSERT INTO partner_daily_nps (partner_chat_id, stat_date, ratings_count) VALUES ('OLD', ?, 1)", (old_day,))
+        calls = []
+        read = manager.partner_rollups.all_partners_daily
+        manager.partner_rollups.all_partners_daily = lambda *args, **kwargs: calls.append((args, kwargs)) or read(*args, **kwargs)
+
+        summary = manager.partner_dashboards.run(now=NOW, refresh_days=0)
+
+        window_start = (NOW.date() - datetime.timedelta(days=90)).isoformat()
+        assert calls == [((window_start,), {}), ((), {'before': window_start})]
+        assert summary['partners'] == 3
+        cached = _cached_payloads(manager)
+        assert cached['partner_stats:OLD']['stats']['total_transactions'] == 1
+        assert not any(key.startswith('partner_advanced_stats:OLD:') and cached[key]['stats']['total_transactions']
+                       for key in cached)
+
+    def test_refresh_rebuilds_previous_day(self):
+        manager = _rollup_manager(clients=10, transactions=50)
+        calls = []
+        manager.client.register_rpc('rebuild_partner_daily_stats', lambda db, params: calls.append(params) or 0)
+
+        manager.partner_dashboards.run(now=NOW)
+
+        yesterday = (NOW.date() - datetime.timedelta(days=1)).isoformat()
+        assert calls == [{'p_partner_chat_id': None, 'p_from': yesterday, 'p_to': yesterday}]
+
+    def test_interactive_requests_hit_precomputed_entries(self):
+        manager = _rollup_manager(clients=100, transactions=1000)
+        manager.rebuild_partner_daily_stats()
+        manager.partner_dashboards.periods = (7, 30, 90, 0)
+        manager.partner_dashboards.run(now=NOW)
+        # Новый процесс: кеш в памяти пуст, читаем analytics_cache
+        manager._analytics_cache_memory.clear()
+
+        manager.client.reset_queries()
+        stats = manager.get_advanced_partner_stats('P1', period_days=30, now=NOW)
+        manager.get_partner_stats('P1')
+        manager.get_partner_cohort_analysis('P1')
+
+        assert stats['total_clients'] == 80
+        tables = {table for kind, table in manager.client.queries}
+        assert tables == {'transactions', 'nps_ratings', 'users', 'partner_stats_revisions', 'analytics_cache'}
+        # По одному последнему id транзакций на каждый дашборд — только водяной знак
+        assert manager.client.queries.count(('select', 'transactions')) == 3
+
+    def test_precomputed_entry_reused_later_the_same_day(self):
+        """Окно сдвинулось внутри дня: пустой срез проверяется тремя запросами с limit 1"""
+        manager = _rollup_manager(clients=100, transactions=1000, days=30)
+        manager.rebuild_partner_daily_stats()
+        run_at = NOW.replace(hour=0, minute=5)
+        manager.partner_dashboards.run(now=run_at)
+        manager._analytics_cache_memory.clear()
+        # Срез, выпадающий из окна за этот час, пуст
+        since = run_at - datetime.timedelta(days=7)
+        bounds = (since.isoformat(), (since + datetime.timedelta(hours=1)).isoformat())
+        conn = manager.client.conn
+        conn.execute('DELETE FROM transactions WHERE date_time >= ? AND date_time < ?', bounds)
+        conn.execute('DELETE FROM nps_ratings WHERE created_at >= ? AND created_at < ?', bounds)
+        conn.execute('UPDATE users SET reg_date = ? WHERE reg_date >= ? AND reg_date < ?', (bounds[1],) + bounds)
+        conn.execute('DELETE FROM partner_stats_revisions')
+
+        manager.client.reset_queries()
+        manager.get_advanced_partner_stats('P1', period_days=7, now=run_at + datetime.timedelta(hours=1))
+
+        assert ('select', 'partner_daily_stats') not in manager.client.queries
+        assert manager.client.queries.count(('select', 'transactions')) == 2
+
+    def test_new_data_invalidates_precomputed_entries(self):
+        manager = _rollup_manager(clients=100, transactions=1000)
+        manager.rebuild_partner_daily_stats()
+        manager.partner_dashboards.periods = (30, 0)
+        manager.partner_dashboards.run()
+        precomputed = manager.get_partner_stats('P1')
+
+        manager.client.conn.execute("INSERT INTO users VALUES ('NEW', ?, 'P1')", (NOW.isoformat(),))
+        assert manager.get_partner_stats('P1')['total_referrals'] == precomputed['total_referrals'] + 1
+
+        manager.client.conn.execute(
+            "INSERT INTO transactions (client_chat_id, partner_chat_id, date_time, currency, total_amount, earned_points, spent_points, operation_type) "
+            "VALUES ('NEW', 'P1', ?, 'USD', 50.0, 5, 0, 'accrual')", (NOW.isoformat(),)
+        )
+        manager.rebuild_partner_daily_stats('P1', NOW.date().isoformat(), NOW.date().isoformat())
+        assert manager.get_partner_stats('P1')['total_transactions'] == precomputed['total_transactions'] + 1
+
+    def test_other_partner_activity_keeps_entries_valid(self):
+        manager = _rollup_manager(clients=100, transactions=1000)
+        manager.rebuild_partner_daily_stats()
+        manager.partner_dashboards.periods = (30, 0)
+        manager.partner_dashboards.run()
+
+        manager.client.conn.execute(
+            "INSERT INTO transactions (client_chat_id, partner_chat_id, date_time, currency, total_amount, earned_points, spent_points, operation_type) "
+            "VALUES ('C1', 'P2', ?, 'USD', 50.0, 5, 0, 'accrual')", (NOW.isoformat(),)
+        )
+        manager.client.reset_queries()
+        manager.get_partner_stats('P1')
+
+        assert ('select', 'partner_daily_stats') not in manager.client.queries
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
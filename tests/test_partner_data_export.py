@@ -0,0 +1,163 @@
+"""
+Unit-тесты для потокового экспорта транзакций партнера (partner_data_export.py)
+"""
+
+import os
+import csv
+import random
+import datetime
+import tracemalloc
+import pytest
+from unittest.mock import patch
+from supabase_manager import SupabaseManager
+from partner_data_export import PartnerDataExporter, ExportMismatchError
+from tests.sqlite_supabase import SqliteSupabase
+
+
+EXPORT_SCHEMA = """
+CREATE TABLE transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    client_chat_id TEXT, partner_chat_id TEXT, date_time TEXT, currency TEXT,
+    total_amount REAL, earned_points REAL, spent_points REAL, operation_type TEXT, description TEXT
+);
+"""
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+
+
+def _export_manager(transactions: int, days: int = 180, seed: int = 5) -> SupabaseManager:
+    rng = random.Random(seed)
+    db = SqliteSupabase()
+    db.executescript(EXPORT_SCHEMA)
+    db.conn.executemany(
+        'INSERT INTO transactions (client_chat_id, partner_chat_id, date_time, currency, total_amount, earned_points, spent_points, operation_type, description) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (
+            (
+                f'C{rng.randrange(500)}', 'P1' if rng.random() < 0.9 else 'P2',
+                (NOW - datetime.timedelta(seconds=rng.randrange(days * 86400))).isoformat(), 'USD',
+                round(rng.uniform(1, 100), 2), rng.randrange(0, 10), rng.randrange(0, 5),
+                rng.choice(['accrual', 'redemption', 'enrollment_bonus']), 'Покупка, "кофе"'
+            )
+            for _ in range(transactions)
+        )
+    )
+    db.conn.commit()
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _source_count(manager, partner_chat_id: str, period_days: int) -> int:
+    since = (NOW - datetime.timedelta(days=period_days)).isoformat()
+    return manager.client.conn.execute(
+        'SELECT COUNT(*) FROM transactions WHERE partner_chat_id = ? AND date_time >= ?', (partner_chat_id, since)
+    ).fetchone()[0]
+
+
+class TestPartnerDataExport:
+    """Экспорт пишет страницы на диск и сверяет число строк"""
+
+    def test_csv_row_count_matches_source(self, tmp_path):
+        manager = _export_manager(transactions=2500)
+
+        success, path = manager.export_partner_data('P1', 90, output_dir=str(tmp_path), now=NOW)
+
+        assert success
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            rows = list(csv.reader(f))
+        assert rows[0] == ['Дата и время', 'ID клиента', 'Тип операции', 'Сумма чека', 'Начислено баллов', 'Списано баллов', 'Описание']
+        assert len(rows) - 1 == _source_count(manager, 'P1', 90)
+        assert rows[1][6] == 'Покупка, "кофе"'
+        assert {r[2] for r in rows[1:]} == {'Начисление', 'Списание', 'Приветственный бонус'}
+
+    def test_parquet_with_column_projection(self, tmp_path):
+        pq = pytest.importorskip('pyarrow.parquet')
+        manager = _export_manager(transactions=2500)
+
+        success, path = manager.export_partner_data('P1', 30, fmt='parquet', columns=['date_time', 'total_amount'], output_dir=str(tmp_path), now=NOW)
+
+        assert success and path.endswith('.parquet')
+        table = pq.read_table(path)
+        assert table.column_names == ['date_time', 'total_amount']
+        assert table.num_rows == _source_count(manager, 'P1', 30)
+        assert str(table.schema.field('date_time').type) == 'timestamp[us, tz=UTC]'
+
+    def test_reads_only_projected_columns_by_pages(self, tmp_path):
+        manager = _export_manager(transactions=2500)
+        exporter = PartnerDataExporter(manager, page_size=500)
+        selects = []
+        original = manager.client.from_
+
+        def tracking_from(table):
+            query = original(table)
+            select = query.select
+            query.select = lambda columns='*', **kwargs: selects.append(columns) or select(columns, **kwargs)
+            return query
+
+        manager.client.from_ = tracking_from
+        path, rows = exporter.export('P1', 0, columns=['client_chat_id'], output_dir=str(tmp_path))
+
+        assert rows == _source_count(manager, 'P1', 10_000)
+        # Последний id, страницы по 500 строк и count для сверки
+        assert len(selects) == 1 + (rows // 500 + 1) + 1
+        assert set(selects[1:-1]) == {'id, client_chat_id'}
+
+    def test_rows_added_during_export_are_excluded(self, tmp_path):
+        manager = _export_manager(transactions=1200)
+        exporter = PartnerDataExporter(manager, page_size=500)
+        expected = _source_count(manager, 'P1', 90)
+        pages = exporter.iter_pages
+
+        def iter_pages(*args):
+            for page in pages(*args):
+                manager.client.conn.execute(
+                    "INSERT INTO transactions (client_chat_id, partner_chat_id, date_time, operation_type) VALUES ('C1', 'P1', ?, 'accrual')",
+                    (NOW.isoformat(),)
+                )
+                yield page
+
+        exporter.iter_pages = iter_pages
+        path, rows = exporter.export('P1', 90, output_dir=str(tmp_path), now=NOW)
+
+        assert rows == expected
+
+    def test_mismatch_fails_without_leaving_file(self, tmp_path):
+        manager = _export_manager(transactions=300)
+        exporter = manager.partner_data_exporter
+        exporter._count = lambda *args: 1
+
+        with pytest.raises(ExportMismatchError):
+            exporter.export('P1', 90, output_dir=str(tmp_path))
+        assert os.listdir(tmp_path) == []
+        assert manager.export_partner_data('P1', 90, output_dir=str(tmp_path))[0] is False
+
+    def test_csv_wrapper_writes_to_temp_dir(self, tmp_path):
+        manager = _export_manager(transactions=50)
+
+        with patch('tempfile.tempdir', str(tmp_path)):
+            success, path = manager.export_partner_data_to_csv('P1', period_days=0)
+
+        assert success and os.path.dirname(path) == str(tmp_path)
+
+    def test_no_data_and_bad_arguments(self, tmp_path):
+        manager = _export_manager(transactions=10)
+        assert manager.export_partner_data('missing', output_dir=str(tmp_path)) == (False, "Нет данных за указанный период")
+        assert manager.export_partner_data('P1', fmt='xlsx')[0] is False
+        assert manager.export_partner_data('P1', columns=['balance'])[0] is False
+
+    def test_memory_does_not_grow_with_rows(self, tmp_path):
+        peaks = []
+        for transactions in (2000, 20000):
+            manager = _export_manager(transactions=transactions, days=30)
+            exporter = PartnerDataExporter(manager, page_size=500)
+            tracemalloc.start()
+            exporter.export('P1', 0, output_dir=str(tmp_path))
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        assert peaks[1] < peaks[0] * 2
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
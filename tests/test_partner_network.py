@@ -0,0 +1,150 @@
+"""
+Unit-тесты для построения сети партнеров при одобрении заявок (approve_partner / approve_partners)
+"""
+
+import os
+import pytest
+from unittest.mock import patch
+from supabase_manager import SupabaseManager
+from tests.sqlite_supabase import SqliteSupabase
+
+
+NETWORK_SCHEMA = """
+CREATE TABLE partner_applications (
+    chat_id TEXT PRIMARY KEY, name TEXT, contact_person TEXT, company_name TEXT, business_type TEXT,
+    city TEXT, district TEXT, username TEXT, booking_url TEXT, referred_by_chat_id TEXT,
+    status TEXT DEFAULT 'Pending'
+);
+CREATE TABLE partners (
+    chat_id TEXT PRIMARY KEY, name TEXT, company_name TEXT, business_type TEXT, city TEXT,
+    district TEXT, username TEXT, booking_url TEXT, referred_by_chat_id TEXT
+);
+CREATE TABLE partner_network (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, referrer_chat_id TEXT, referred_chat_id TEXT,
+    level INTEGER, is_active BOOLEAN DEFAULT 1,
+    UNIQUE (referrer_chat_id, referred_chat_id)
+);
+"""
+
+
+def _manager(applications) -> SupabaseManager:
+    """applications: [(chat_id, referred_by_chat_id), ...] — заявки в статусе Pending."""
+    db = SqliteSupabase()
+    db.executescript(NETWORK_SCHEMA)
+    db.conn.executemany(
+        'INSERT INTO partner_applications (chat_id, name, referred_by_chat_id) VALUES (?, ?, ?)',
+        ((chat_id, f'Партнер {chat_id}', referrer) for chat_id, referrer in applications)
+    )
+    db.conn.commit()
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _network(manager) -> set:
+    return set(manager.client.conn.execute(
+        'SELECT referrer_chat_id, referred_chat_id, level FROM partner_network'
+    ).fetchall())
+
+
+class TestPartnerNetwork:
+    """Связи уровней 1-3 и число запросов"""
+
+    def test_approve_partner_links_three_levels(self):
+        manager = _manager([('A', None), ('B', 'A'), ('C', 'B'), ('D', 'C'), ('E', 'D')])
+        for chat_id in 'ABCD':
+            assert manager.approve_partner(chat_id)
+        manager.client.reset_queries()
+
+        assert manager.approve_partner('E') is True
+
+        assert {row for row in _network(manager) if row[1] == 'E'} == {('D', 'E', 1), ('C', 'E', 2), ('B', 'E', 3)}
+        assert manager.client.queries.count(('upsert', 'partner_network')) == 1
+        # Ни одной проверки существования связи перед вставкой
+        assert ('select', 'partner_network') not in manager.client.queries
+        status = manager.client.conn.execute("SELECT status FROM partner_applications WHERE chat_id = 'E'").fetchone()[0]
+        assert status == 'Approved'
+
+    def test_bulk_approval_uses_constant_queries(self):
+        # Корневой партнер и по 60 приглашенных на каждом из трех уровней ниже
+        applications = [('R', None)]
+        for level, parent in ((1, 'R'), (2, 'L1_0'), (3, 'L2_0')):
+            applications += [(f'L{level}_{i}', parent) for i in range(60)]
+        small, large = _manager(applications[:4]), _manager(applications)
+        query_counts = []
+        for manager, apps in ((small, applications[:4]), (large, applications)):
+            manager.client.reset_queries()
+            result = manager.approve_partners([chat_id for chat_id, _ in apps] + ['missing'])
+            assert result['not_found'] == ['missing']
+            assert len(result['approved']) == len(apps)
+            query_counts.append(manager.client.query_count)
+
+        assert query_counts[0] == query_counts[1]
+        assert large.client.queries.count(('upsert', 'partner_network')) == 1
+        network = _network(large)
+        assert len(network) == 60 + 120 + 180
+        assert {('L2_0', 'L3_5', 1), ('L1_0', 'L3_5', 2), ('R', 'L3_5', 3)} <= network
+
+    def test_referrer_approved_in_later_chunk(self):
+        manager = _manager([('A', None), ('B', 'A'), ('C', 'B')])
+
+        with patch('supabase_manager.PARTNER_APPROVAL_CHUNK', 1):
+            result = manager.approve_partners(['C', 'B', 'A'])
+
+        assert result['approved'] == ['C', 'B', 'A']
+        assert _network(manager) == {('A', 'B', 1), ('B', 'C', 1), ('A', 'C', 2)}
+        assert result['network_links'] == 3
+        assert manager.client.queries.count(('upsert', 'partner_network')) == 1
+
+    def test_repeat_approval_is_idempotent(self):
+        manager = _manager([('A', None), ('B', 'A'), ('C', 'B')])
+        manager.approve_partners(['A', 'B', 'C'])
+        manager.client.conn.execute("UPDATE partner_network SET is_active = 0 WHERE referred_chat_id = 'C' AND level = 2")
+        manager.client.conn.commit()
+
+        result = manager.approve_partners(['A', 'B', 'C'])
+
+        assert result['approved'] == ['A', 'B', 'C']
+        assert _network(manager) == {('A', 'B', 1), ('B', 'C', 1), ('A', 'C', 2)}
+        # Существующая связь не перезаписывается
+        assert manager.client.conn.execute(
+            "SELECT is_active FROM partner_network WHERE referred_chat_id = 'C' AND level = 2"
+        ).fetchone()[0] == 0
+
+    def test_unknown_referrer_and_cycle(self):
+        manager = _manager([('A', 'ghost'), ('B', 'A'), ('X', 'Y'), ('Y', 'X')])
+
+        result = manager.approve_partners(['A', 'B', 'X', 'Y'])
+
+        assert len(result['approved']) == 4
+        # ghost не партнер — связи A нет, цепочка B обрывается на A
+        assert ('A', 'B', 1) in _network(manager)
+        assert not any(row[1] == 'A' for row in _network(manager))
+        # Взаимное приглашение не создает связь партнера с самим собой
+        assert {row for row in _network(manager) if row[1] in ('X', 'Y')} == {('Y', 'X', 1), ('X', 'Y', 1)}
+
+    def test_rpc_chains_are_used_when_available(self):
+        manager = _manager([('A', None), ('B', 'A'), ('C', 'B')])
+        manager.approve_partners(['A', 'B'])
+        calls = []
+
+        def chains(db, params):
+            calls.append(params)
+            return [
+                {'chat_id': 'B', 'ancestor_chat_id': 'A', 'depth': 1},
+                {'chat_id': 'B', 'ancestor_chat_id': 'B', 'depth': 0},
+            ]
+
+        manager.client.register_rpc('get_partner_referral_chains', chains)
+        manager.client.reset_queries()
+
+        manager.approve_partners(['C'])
+
+        assert calls == [{'p_chat_ids': ['B'], 'p_depth': 3}]
+        assert ('select', 'partners') not in manager.client.queries
+        assert {row for row in _network(manager) if row[1] == 'C'} == {('B', 'C', 1), ('A', 'C', 2)}
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
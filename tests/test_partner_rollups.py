@@ -0,0 +1,407 @@
+"""
+Unit-тесты для дневных агрегатов партнера (partner_rollups.py и статистика партнера в SupabaseManager)
+"""
+
+import os
+import time
+import random
+import threading
+import datetime
+import pytest
+from unittest.mock import patch
+from dateutil import parser
+from supabase_manager import SupabaseManager
+from partner_rollups import aggregate_transactions, aggregate_nps, stat_date
+from tests.sqlite_supabase import SqliteSupabase
+
+
+ROLLUP_SCHEMA = """
+CREATE TABLE users (chat_id TEXT PRIMARY KEY, reg_date TEXT, referral_source TEXT);
+CREATE TABLE transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    client_chat_id TEXT, partner_chat_id TEXT, date_time TEXT, currency TEXT,
+    total_amount REAL, earned_points REAL, spent_points REAL, operation_type TEXT, description TEXT
+);
+CREATE INDEX idx_transactions_partner ON transactions(partner_chat_id, date_time);
+CREATE TABLE nps_ratings (id INTEGER PRIMARY KEY AUTOINCREMENT, client_chat_id TEXT, partner_chat_id TEXT, rating INTEGER, created_at TEXT);
+CREATE TABLE promoters (client_chat_id TEXT PRIMARY KEY, is_active BOOLEAN);
+CREATE TABLE analytics_cache (cache_key TEXT PRIMARY KEY, payload JSON, updated_at TEXT);
+CREATE TABLE partner_daily_stats (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    partner_chat_id TEXT, stat_date TEXT, currency TEXT,
+    revenue REAL, points_accrued REAL, points_spent REAL,
+    transactions_count INTEGER, accrual_count INTEGER, redemption_count INTEGER, unique_clients INTEGER,
+    updated_at TEXT,
+    UNIQUE (partner_chat_id, stat_date, currency)
+);
+CREATE TABLE partner_daily_clients (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    partner_chat_id TEXT, stat_date TEXT, currency TEXT, client_chat_id TEXT,
+    transactions_count INTEGER, accrual_count INTEGER, revenue REAL,
+    UNIQUE (partner_chat_id, stat_date, currency, client_chat_id)
+);
+CREATE TABLE partner_daily_nps (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    partner_chat_id TEXT, stat_date TEXT,
+    ratings_count INTEGER, ratings_sum INTEGER, promoters INTEGER, passives INTEGER, detractors INTEGER,
+    UNIQUE (partner_chat_id, stat_date)
+);
+CREATE TABLE partner_stats_revisions (partner_chat_id TEXT PRIMARY KEY, revision INTEGER NOT NULL DEFAULT 0, updated_at TEXT);
+-- Как триггеры миграции: изменение или удаление строк сдвигает ревизию партнера
+CREATE TRIGGER transactions_revision_update AFTER UPDATE ON transactions BEGIN
+    INSERT INTO partner_stats_revisions (partner_chat_id, revision) VALUES (OLD.partner_chat_id, 1)
+    ON CONFLICT (partner_chat_id) DO UPDATE SET revision = revision + 1;
+END;
+CREATE TRIGGER transactions_revision_delete AFTER DELETE ON transactions BEGIN
+    INSERT INTO partner_stats_revisions (partner_chat_id, revision) VALUES (OLD.partner_chat_id, 1)
+    ON CONFLICT (partner_chat_id) DO UPDATE SET revision = revision + 1;
+END;
+CREATE TRIGGER nps_ratings_revision_update AFTER UPDATE ON nps_ratings BEGIN
+    INSERT INTO partner_stats_revisions (partner_chat_id, revision) VALUES (OLD.partner_chat_id, 1)
+    ON CONFLICT (partner_chat_id) DO UPDATE SET revision = revision + 1;
+END;
+"""
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+
+
+def _rollup_manager(clients: int, transactions: int, days: int = 400, seed: int = 3) -> SupabaseManager:
+    rng = random.Random(seed)
+    db = SqliteSupabase()
+    db.executescript(ROLLUP_SCHEMA)
+
+    def moment():
+        return (NOW - datetime.timedelta(seconds=rng.randrange(days * 86400))).isoformat()
+
+    db.conn.executemany(
+        'INSERT INTO users VALUES (?, ?, ?)',
+        ((f'C{i}', moment(), 'P1' if i % 5 else 'P2') for i in range(clients))
+    )
+    operations = ['accrual', 'accrual', 'accrual', 'redemption', 'enrollment_bonus']
+    db.conn.executemany(
+        'INSERT INTO transactions (client_chat_id, partner_chat_id, date_time, currency, total_amount, earned_points, spent_points, operation_type, description) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (
+            (
+                f'C{rng.randrange(clients)}', 'P1' if rng.random() < 0.8 else 'P2', moment(),
+                'VND' if rng.random() < 0.1 else 'USD', round(rng.uniform(1, 100), 2),
+                rng.randrange(0, 10), rng.randrange(0, 5), rng.choice(operations), 'x' * 40
+            )
+            for _ in range(transactions)
+        )
+    )
+    db.conn.executemany(
+        'INSERT INTO nps_ratings (client_chat_id, partner_chat_id, rating, created_at) VALUES (?, ?, ?, ?)',
+        ((f'C{rng.randrange(clients)}', 'P1', rng.randrange(0, 11), moment()) for _ in range(transactions // 10))
+    )
+    db.conn.executemany('INSERT INTO promoters VALUES (?, ?)', ((f'C{i}', True) for i in range(0, clients, 7)))
+    db.conn.commit()
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _raw_transactions(manager: SupabaseManager, partner_chat_id: str, since: str = '', until: str = '9999') -> list:
+    rows = manager.client.conn.execute(
+        'SELECT * FROM transactions WHERE partner_chat_id = ? AND date_time >= ? AND date_time <= ? ORDER BY id',
+        (partner_chat_id, since, until)
+    )
+    columns = [c[0] for c in rows.description]
+    return [dict(zip(columns, row)) for row in rows.fetchall()]
+
+
+def _reference_advanced(manager: SupabaseManager, partner_chat_id: str, period_days: int) -> dict:
+    """Прежний расчёт get_advanced_partner_stats по всем транзакциям периода"""
+    period_start = NOW - datetime.timedelta(days=period_days)
+    transactions = _raw_transactions(manager, partner_chat_id, period_start.isoformat())
+    revenue, accruals, redemptions, accrued, redeemed = 0.0, 0, 0, 0, 0
+    counts, revenues = {}, {}
+    for txn in transactions:
+        client_id = txn['client_chat_id']
+        counts[client_id] = counts.get(client_id, 0) + 1
+        if txn['operation_type'] == 'accrual':
+            accruals += 1
+            revenue += txn['total_amount']
+            accrued += txn['earned_points']
+            revenues[client_id] = revenues.get(client_id, 0.0) + txn['total_amount']
+        elif txn['operation_type'] == 'redemption':
+            redemptions += 1
+            redeemed += txn['spent_points']
+        elif txn['operation_type'] == 'enrollment_bonus':
+            accrued += txn['earned_points']
+    ratings = [r[0] for r in manager.client.conn.execute(
+        'SELECT rating FROM nps_ratings WHERE partner_chat_id = ? AND created_at >= ?', (partner_chat_id, period_start.isoformat())
+    )]
+    clients = manager.client.conn.execute('SELECT chat_id, reg_date FROM users WHERE referral_source = ?', (partner_chat_id,)).fetchall()
+    promoters = manager.client.conn.execute(
+        'SELECT COUNT(*) FROM promoters p JOIN users u ON u.chat_id = p.client_chat_id WHERE u.referral_source = ? AND p.is_active',
+        (partner_chat_id,)
+    ).fetchone()[0]
+    promoters_nps = sum(1 for r in ratings if r >= 9)
+    detractors_nps = sum(1 for r in ratings if r <= 6)
+    returning = sum(1 for c in counts.values() if c > 1)
+    return {
+        'period_days': period_days,
+        'total_clients': len(clients),
+        'new_clients': sum(1 for _, reg_date in clients if reg_date >= period_start.isoformat()),
+        'churn_rate': round((len(clients) - len(counts)) / len(clients) * 100, 2) if clients else 0.0,
+        'avg_frequency': round(len(transactions) / len(counts), 2) if counts else 0.0,
+        'nps_score': int(round((promoters_nps - detractors_nps) / len(ratings) * 100)) if ratings else 0,
+        'total_promoters': promoters,
+        'registration_to_first_purchase': round(len(revenues) / len(clients) * 100, 2) if clients else 0.0,
+        'repeat_purchase_rate': round(returning / len(revenues) * 100, 2) if revenues else 0.0,
+        'total_transactions': len(transactions), 'accrual_transactions': accruals, 'redemption_transactions': redemptions,
+        'total_revenue': revenue, 'total_points_accrued': accrued, 'total_points_redeemed': redeemed,
+        'active_clients': len(counts), 'avg_check': round(revenue / accruals, 2) if accruals else 0.0,
+        'avg_ltv': round(sum(revenues.values()) / len(revenues), 2) if revenues else 0.0,
+        'returning_clients': returning,
+        'avg_nps': round(sum(ratings) / len(ratings), 2) if ratings else 0.0,
+        'promoters': promoters_nps, 'passives': sum(1 for r in ratings if r in (7, 8)),
+        'detractors': detractors_nps,
+    }
+
+
+class TestAggregation:
+    """Тесты свёртки транзакций и оценок"""
+
+    def test_aggregate_transactions(self):
+        stats, clients = aggregate_transactions([
+            {'partner_chat_id': 'P', 'client_chat_id': 'a', 'date_time': '2025-03-01T23:30:00-02:00', 'currency': None,
+             'operation_type': 'accrual', 'total_amount': 10.0, 'earned_points': 1},
+            {'partner_chat_id': 'P', 'client_chat_id': 'a', 'date_time': '2025-03-02T08:00:00+00:00', 'currency': 'USD',
+             'operation_type': 'redemption', 'total_amount': 5.0, 'spent_points': 3},
+            {'partner_chat_id': 'P', 'client_chat_id': 'b', 'date_time': '2025-03-02T09:00:00+00:00', 'currency': 'USD',
+             'operation_type': 'enrollment_bonus', 'total_amount': 0, 'earned_points': 5},
+            {'partner_chat_id': 'P', 'client_chat_id': 'b', 'date_time': None, 'operation_type': 'accrual'},
+        ])
+
+        assert list(stats) == [('P', '2025-03-02', 'USD')]
+        row = stats[('P', '2025-03-02', 'USD')]
+        assert (row['transactions_count'], row['accrual_count'], row['redemption_count'], row['unique_clients']) == (3, 1, 1, 2)
+        assert (row['revenue'], row['points_accrued'], row['points_spent']) == (10.0, 6.0, 3.0)
+        assert clients[('P', '2025-03-02', 'USD', 'a')]['transactions_count'] == 2
+
+    def test_aggregate_nps_and_days(self):
+        nps = aggregate_nps([
+            {'partner_chat_id': 'P', 'rating': r, 'created_at': '2025-03-02T10:00:00'} for r in (10, 9, 8, 6, 0)
+        ])
+        assert nps[('P', '2025-03-02')] == {
+            'partner_chat_id': 'P', 'stat_date': '2025-03-02', 'ratings_count': 5, 'ratings_sum': 33,
+            'promoters': 2, 'passives': 1, 'detractors': 2
+        }
+        assert stat_date('bad') is None
+
+
+class TestPartnerStatsFromRollups:
+    """Дашборды партнера читают дневные агрегаты"""
+
+    @pytest.mark.parametrize('period_days', [1, 30, 365, 0])
+    def test_advanced_stats_match_raw_transactions(self, period_days):
+        manager = _rollup_manager(clients=300, transactions=6000)
+        manager.rebuild_partner_daily_stats()
+        expected = _reference_advanced(manager, 'P1', period_days if period_days else 100 * 365)
+        expected['period_days'] = period_days
+
+        stats = manager.get_advanced_partner_stats('P1', period_days=period_days, now=NOW)
+
+        assert stats == {key: pytest.approx(value, abs=0.011) for key, value in expected.items()}
+        assert stats['total_clients'] == 240
+
+    def test_period_stats_match_raw_transactions(self):
+        manager = _rollup_manager(clients=300, transactions=6000)
+        manager.rebuild_partner_daily_stats()
+        start, end = (NOW - datetime.timedelta(days=60)).date(), (NOW - datetime.timedelta(days=10)).date()
+        transactions = _raw_transactions(manager, 'P1', start.isoformat(), (end + datetime.timedelta(days=1)).isoformat())
+
+        result = manager.get_partner_stats_by_period('P1', start.isoformat(), end.isoformat())
+
+        days = {}
+        for txn in transactions:
+            days.setdefault(parser.isoparse(txn['date_time']).date().isoformat(), []).append(txn)
+        assert [d['date'] for d in result['daily_stats']] == sorted(days)
+        for day in result['daily_stats']:
+            txns = days[day['date']]
+            assert day['transactions'] == len(txns)
+            assert day['unique_clients'] == len({t['client_chat_id'] for t in txns})
+            assert day['revenue'] == pytest.approx(sum(t['total_amount'] for t in txns if t['operation_type'] == 'accrual'), abs=0.011)
+        assert result['totals']['transactions'] == len(transactions)
+        assert result['totals']['unique_clients'] == len({t['client_chat_id'] for t in transactions})
+
+    def test_partner_stats_all_time(self):
+        manager = _rollup_manager(clients=100, transactions=2000)
+        manager.rebuild_partner_daily_stats()
+        transactions = _raw_transactions(manager, 'P1')
+
+        stats = manager.get_partner_stats('P1')
+
+        assert stats['total_referrals'] == 80
+        assert stats['total_transactions'] == len(transactions)
+        assert stats['total_spent_usd'] == pytest.approx(sum(t['total_amount'] for t in transactions if t['operation_type'] == 'accrual'))
+        assert stats['total_accrued_points'] == sum(t['earned_points'] for t in transactions if t['operation_type'] in ('accrual', 'enrollment_bonus'))
+
+    def test_dashboards_do_not_scan_transactions(self):
+        """Полные дни читаются из агрегатов: число запросов не зависит от длины периода"""
+        manager = _rollup_manager(clients=300, transactions=6000)
+        manager.rebuild_partner_daily_stats()
+        start = (NOW - datetime.timedelta(days=90)).date().isoformat()
+
+        manager.client.reset_queries()
+        manager.get_partner_stats_by_period('P1', start, NOW.date().isoformat())
+        # Из transactions читается только последний id для проверки кеша
+        assert manager.client.queries.count(('select', 'transactions')) == 1
+
+        manager.client.reset_queries()
+        manager.get_advanced_partner_stats('P1', period_days=30)
+        short_period = list(manager.client.queries)
+        manager.client.reset_queries()
+        manager.get_advanced_partner_stats('P1', period_days=365)
+        # Транзакции читаются только за неполный первый день (страница и пустая страница в конце)
+        # плюс последний id для проверки кеша
+        assert manager.client.queries.count(('select', 'transactions')) == short_period.count(('select', 'transactions')) == 3
+
+    def test_rebuild_scoped_to_partner_and_days(self):
+        manager = _rollup_manager(clients=50, transactions=500)
+        manager.rebuild_partner_daily_stats()
+        day = _raw_transactions(manager, 'P1')[0]['date_time'][:10]
+        manager.client.conn.execute("UPDATE partner_daily_stats SET transactions_count = 0")
+
+        manager.rebuild_partner_daily_stats('P1', day, day)
+
+        rows = manager.client.conn.execute(
+            "SELECT partner_chat_id, stat_date, SUM(transactions_count) FROM partner_daily_stats "
+            "WHERE transactions_count > 0 GROUP BY partner_chat_id, stat_date"
+        ).fetchall()
+        assert [(r[0], r[1]) for r in rows] == [('P1', day)]
+        assert rows[0][2] == len(_raw_transactions(manager, 'P1', day, day + 'T99'))
+
+    def test_rebuild_uses_rpc_when_available(self):
+        manager = _rollup_manager(clients=10, transactions=50)
+        calls = []
+        manager.client.register_rpc('rebuild_partner_daily_stats', lambda db, params: calls.append(params) or 7)
+
+        assert manager.rebuild_partner_daily_stats('P1', '2025-01-01') == 7
+        assert calls == [{'p_partner_chat_id': 'P1', 'p_from': '2025-01-01', 'p_to': None}]
+
+    def test_missing_rollup_tables_fall_back_to_raw_rows(self):
+        manager = _rollup_manager(clients=100, transactions=1500)
+        expected = _reference_advanced(manager, 'P1', 30)
+        manager.client.conn.executescript(
+            'DROP TABLE partner_daily_stats; DROP TABLE partner_daily_clients; DROP TABLE partner_daily_nps;'
+        )
+
+        stats = manager.get_advanced_partner_stats('P1', period_days=30, now=NOW)
+
+        for key, value in expected.items():
+            assert stats[key] == pytest.approx(value, abs=0.011), key
+
+    def test_advanced_stats_cached_until_new_transaction(self):
+        manager = _rollup_manager(clients=100, transactions=1000)
+        manager.rebuild_partner_daily_stats()
+        first = manager.get_advanced_partner_stats('P1', period_days=30, now=NOW)
+
+        manager.client.reset_queries()
+        assert manager.get_advanced_partner_stats('P1', period_days=30, now=NOW) == first
+        # Попадание в кеш: только запросы водяного знака
+        assert sorted(manager.client.queries) == [
+            ('select', 'nps_ratings'), ('select', 'partner_stats_revisions'), ('select', 'transactions'), ('select', 'users')
+        ]
+
+        manager.client.conn.execute(
+            "INSERT INTO transactions (client_chat_id, partner_chat_id, date_time, currency, total_amount, earned_points, spent_points, operation_type) "
+            "VALUES ('C1', 'P1', ?, 'USD', 1000.0, 10, 0, 'accrual')", (NOW.isoformat(),)
+        )
+        manager.rebuild_partner_daily_stats('P1', NOW.date().isoformat(), NOW.date().isoformat())
+
+        updated = manager.get_advanced_partner_stats('P1', period_days=30, now=NOW)
+        assert updated['total_transactions'] == first['total_transactions'] + 1
+        assert updated['total_revenue'] == pytest.approx(first['total_revenue'] + 1000.0)
+
+        manager.client.conn.execute("INSERT INTO nps_ratings (client_chat_id, partner_chat_id, rating, created_at) VALUES ('C1', 'P1', 10, ?)", (NOW.isoformat(),))
+        manager.rebuild_partner_daily_stats('P1', NOW.date().isoformat(), NOW.date().isoformat())
+        assert manager.get_advanced_partner_stats('P1', period_days=30, now=NOW)['promoters'] == updated['promoters'] + 1
+
+    def test_updated_or_deleted_transaction_invalidates_cache(self):
+        manager = _rollup_manager(clients=100, transactions=1000)
+        manager.rebuild_partner_daily_stats()
+        first = manager.get_advanced_partner_stats('P1', period_days=30, now=NOW)
+        txn_id, day = manager.client.conn.execute(
+            "SELECT id, date_time FROM transactions WHERE partner_chat_id = 'P1' AND operation_type = 'accrual' "
+            "AND date_time >= ? ORDER BY id LIMIT 1", ((NOW - datetime.timedelta(days=20)).isoformat(),)
+        ).fetchone()
+
+        manager.client.conn.execute("UPDATE transactions SET total_amount = total_amount + 500 WHERE id = ?", (txn_id,))
+        manager.rebuild_partner_daily_stats('P1', day[:10], day[:10])
+        updated = manager.get_advanced_partner_stats('P1', period_days=30, now=NOW)
+        assert updated['total_revenue'] == pytest.approx(first['total_revenue'] + 500.0)
+
+        manager.client.conn.execute("DELETE FROM transactions WHERE id = ?", (txn_id,))
+        manager.rebuild_partner_daily_stats('P1', day[:10], day[:10])
+        assert manager.get_advanced_partner_stats('P1', period_days=30, now=NOW)['total_transactions'] == first['total_transactions'] - 1
+
+    def test_cached_window_slides_with_time(self):
+        manager = _rollup_manager(clients=100, transactions=1000)
+        manager.rebuild_partner_daily_stats()
+        first = manager.get_advanced_partner_stats('P1', period_days=30, now=NOW)
+
+        # Через двое суток транзакции начала окна выпадают из периода — кеш не должен их показывать
+        later = NOW + datetime.timedelta(days=2)
+        shifted = manager.get_advanced_partner_stats('P1', period_days=30, now=later)
+
+        assert shifted['total_transactions'] < first['total_transactions']
+        assert shifted['total_transactions'] == len(_raw_transactions(manager, 'P1', (later - datetime.timedelta(days=30)).isoformat()))
+
+    def test_points_totals_are_integers(self):
+        manager = _rollup_manager(clients=50, transactions=500)
+        manager.rebuild_partner_daily_stats()
+
+        stats = manager.get_advanced_partner_stats('P1', period_days=365, now=NOW)
+
+        assert isinstance(stats['total_points_accrued'], int)
+        assert isinstance(stats['total_points_redeemed'], int)
+
+    def test_advanced_stats_sub_queries_run_concurrently(self):
+        manager = _rollup_manager(clients=50, transactions=200)
+        active = {'now': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def slow(call):
+            def wrapper(*args, **kwargs):
+                with lock:
+                    active['now'] += 1
+                    active['max'] = max(active['max'], active['now'])
+                time.sleep(0.05)
+                try:
+                    return call(*args, **kwargs)
+                finally:
+                    with lock:
+                        active['now'] -= 1
+            return wrapper
+
+        manager.partner_rollups.period_totals = slow(manager.partner_rollups.period_totals)
+        manager._count_partner_promoters = slow(manager._count_partner_promoters)
+
+        stats = manager.get_advanced_partner_stats('P1', period_days=30)
+
+        assert active['max'] == 2
+        assert stats['total_clients'] == 40
+
+    @pytest.mark.slow
+    def test_benchmark_dashboard_latency_by_period(self):
+        """Бенчмарк: 500k транзакций — дашборд по агрегатам против полного чтения транзакций"""
+        manager = _rollup_manager(clients=5000, transactions=500_000, days=730)
+        manager.rebuild_partner_daily_stats()
+
+        for period_days in (7, 90, 730):
+            expected = _reference_advanced(manager, 'P1', period_days)
+            expected['period_days'] = period_days
+            manager.client.reset_queries()
+            stats = manager.get_advanced_partner_stats('P1', period_days=period_days, now=NOW)
+
+            assert stats == {key: pytest.approx(value, abs=0.011) for key, value in expected.items()}
+            # Из transactions — только неполный первый день и последний id для проверки кеша
+            assert manager.client.queries.count(('select', 'transactions')) <= 3
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
@@ -0,0 +1,156 @@
+"""
+Unit-тесты для агрегации выплат по платформенным продуктам (aggregate_platform_product_payouts)
+"""
+
+import os
+import datetime
+import pytest
+from unittest.mock import patch
+from supabase_manager import SupabaseManager
+from tests.sqlite_supabase import SqliteSupabase
+
+
+PAYOUTS_SCHEMA = """
+CREATE TABLE product_visits (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, subscription_id INTEGER, product_id INTEGER,
+    client_chat_id TEXT, partner_chat_id TEXT, visited_at TEXT, status TEXT DEFAULT 'confirmed',
+    payout_amount REAL, payout_currency TEXT DEFAULT 'RUB',
+    payout_status TEXT DEFAULT 'not_processed', payout_batch_id INTEGER
+);
+CREATE TABLE partner_payout_batches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, period_start TEXT, period_end TEXT, status TEXT DEFAULT 'draft'
+);
+CREATE TABLE partner_payout_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, batch_id INTEGER, partner_chat_id TEXT,
+    total_visits INTEGER, total_payout_amount REAL, currency TEXT, status TEXT,
+    UNIQUE (batch_id, partner_chat_id)
+);
+"""
+
+PERIOD_START = datetime.date(2026, 9, 1)
+PERIOD_END = datetime.date(2026, 9, 30)
+
+
+def _manager() -> SupabaseManager:
+    db = SqliteSupabase()
+    db.executescript(PAYOUTS_SCHEMA)
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _add_visits(manager, count: int, day: int = 10, status: str = 'confirmed'):
+    manager.client.conn.executemany(
+        'INSERT INTO product_visits (partner_chat_id, client_chat_id, visited_at, status, payout_amount) VALUES (?, ?, ?, ?, ?)',
+        ((f'P{i % 3}', f'C{i}', f'2026-09-{day:02d}T12:00:00', status, 150.0) for i in range(count))
+    )
+    manager.client.conn.commit()
+
+
+def _items(manager) -> list:
+    return manager.client.conn.execute(
+        'SELECT batch_id, partner_chat_id, total_visits, total_payout_amount FROM partner_payout_items ORDER BY partner_chat_id'
+    ).fetchall()
+
+
+class TestAggregatePlatformProductPayouts:
+    """Пакетная агрегация визитов в batch выплат (без RPC)"""
+
+    def test_aggregates_with_set_based_queries(self):
+        manager = _manager()
+        _add_visits(manager, 1200)
+        _add_visits(manager, 5, status='rejected')
+        manager.client.reset_queries()
+
+        result = manager.aggregate_platform_product_payouts(PERIOD_START, PERIOD_END)
+
+        assert result['success'] and result['batch_id'] == 1
+        assert (result['items_count'], result['visits_count']) == (3, 1200)
+        assert _items(manager) == [(1, 'P0', 400, 60000.0), (1, 'P1', 400, 60000.0), (1, 'P2', 400, 60000.0)]
+        linked = manager.client.conn.execute(
+            "SELECT COUNT(*) FROM product_visits WHERE payout_batch_id = 1 AND payout_status = 'included_in_batch'"
+        ).fetchone()[0]
+        assert linked == 1200
+        # Визиты привязываются пачками, items — одним upsert, а не запросом на строку
+        queries = manager.client.queries
+        assert queries.count(('update', 'product_visits')) == 3
+        assert queries.count(('upsert', 'partner_payout_items')) == 1
+        assert manager.client.query_count < 15
+
+    def test_rerun_extends_draft_batch_without_doubling(self):
+        manager = _manager()
+        _add_visits(manager, 6)
+        first = manager.aggregate_platform_product_payouts(PERIOD_START, PERIOD_END)
+
+        again = manager.aggregate_platform_product_payouts(PERIOD_START, PERIOD_END)
+        assert again['batch_id'] == first['batch_id'] and again['visits_count'] == 0
+        assert _items(manager) == [(1, 'P0', 2, 300.0), (1, 'P1', 2, 300.0), (1, 'P2', 2, 300.0)]
+
+        _add_visits(manager, 2, day=20)
+        manager.aggregate_platform_product_payouts(PERIOD_START, PERIOD_END)
+
+        assert _items(manager) == [(1, 'P0', 3, 450.0), (1, 'P1', 3, 450.0), (1, 'P2', 2, 300.0)]
+        assert manager.client.conn.execute('SELECT COUNT(*) FROM partner_payout_batches').fetchone()[0] == 1
+
+    def test_rerun_keeps_item_status(self):
+        manager = _manager()
+        _add_visits(manager, 6)
+        manager.aggregate_platform_product_payouts(PERIOD_START, PERIOD_END)
+        manager.client.conn.execute("UPDATE partner_payout_items SET status = 'paid' WHERE partner_chat_id = 'P0'")
+        manager.client.conn.commit()
+
+        _add_visits(manager, 4, day=20)
+        manager.aggregate_platform_product_payouts(PERIOD_START, PERIOD_END)
+
+        statuses = dict(manager.client.conn.execute('SELECT partner_chat_id, status FROM partner_payout_items').fetchall())
+        assert statuses == {'P0': 'paid', 'P1': 'pending', 'P2': 'pending'}
+        assert [item[2] for item in _items(manager)] == [4, 3, 3]
+
+    def test_rerun_after_interrupted_linking(self):
+        manager = _manager()
+        _add_visits(manager, 10)
+        # Прошлый запуск создал batch и успел привязать часть визитов, но не записал items
+        manager.client.conn.execute(
+            "INSERT INTO partner_payout_batches (period_start, period_end, status) VALUES ('2026-09-01', '2026-09-30', 'draft')"
+        )
+        manager.client.conn.execute(
+            "UPDATE product_visits SET payout_status = 'included_in_batch', payout_batch_id = 1 WHERE id <= 4"
+        )
+        manager.client.conn.commit()
+
+        result = manager.aggregate_platform_product_payouts(PERIOD_START, PERIOD_END)
+
+        assert result['batch_id'] == 1 and result['visits_count'] == 6
+        assert [item[2] for item in _items(manager)] == [4, 3, 3]
+
+    def test_sent_batch_is_not_reopened(self):
+        manager = _manager()
+        _add_visits(manager, 3)
+        manager.aggregate_platform_product_payouts(PERIOD_START, PERIOD_END)
+        manager.client.conn.execute("UPDATE partner_payout_batches SET status = 'sent'")
+        manager.client.conn.commit()
+
+        assert manager.aggregate_platform_product_payouts(PERIOD_START, PERIOD_END)['batch_id'] is None
+
+        _add_visits(manager, 1, day=25)
+        result = manager.aggregate_platform_product_payouts(PERIOD_START, PERIOD_END)
+        assert (result['batch_id'], result['items_count'], result['visits_count']) == (2, 1, 1)
+
+    def test_uses_rpc_when_available(self):
+        manager = _manager()
+        calls = []
+        manager.client.register_rpc(
+            'aggregate_platform_product_payouts',
+            lambda db, params: calls.append(params) or {'batch_id': 7, 'items_count': 2, 'visits_count': 40}
+        )
+
+        result = manager.aggregate_platform_product_payouts(PERIOD_START, PERIOD_END)
+
+        assert calls == [{'p_period_start': '2026-09-01', 'p_period_end': '2026-09-30'}]
+        assert (result['batch_id'], result['items_count'], result['visits_count']) == (7, 2, 40)
+        assert manager.client.queries == [('rpc', 'aggregate_platform_product_payouts')]
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
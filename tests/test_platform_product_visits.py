@@ -0,0 +1,269 @@
+"""
+Unit-тесты для допуска по кросс-абонементу (record_platform_product_visit):
+лимиты, повторное сканирование, одновременные сканирования и число обращений к БД
+"""
+
+import os
+import time
+import datetime
+import threading
+import pytest
+from unittest.mock import patch
+from supabase_manager import SupabaseManager
+from tests.sqlite_supabase import SqliteSupabase
+
+
+VISITS_SCHEMA = """
+CREATE TABLE platform_products (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, max_visits_total INTEGER, is_active BOOLEAN DEFAULT 1
+);
+CREATE TABLE platform_product_partners (
+    product_id INTEGER, partner_chat_id TEXT, payout_per_visit REAL DEFAULT 0,
+    visit_limit_per_client INTEGER, is_active BOOLEAN DEFAULT 1,
+    PRIMARY KEY (product_id, partner_chat_id)
+);
+CREATE TABLE client_product_subscriptions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, client_chat_id TEXT, product_id INTEGER,
+    valid_until TEXT, status TEXT DEFAULT 'active', visits_total_used INTEGER DEFAULT 0
+);
+CREATE TABLE product_visits (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, subscription_id INTEGER, product_id INTEGER,
+    client_chat_id TEXT, partner_chat_id TEXT, visited_at TEXT, source TEXT, status TEXT,
+    payout_amount REAL, payout_currency TEXT, payout_status TEXT, payout_batch_id INTEGER
+);
+CREATE TABLE product_visit_counters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, subscription_id INTEGER, partner_chat_id TEXT, product_id INTEGER,
+    period_start TEXT, visits_count INTEGER, payout_amount REAL, currency TEXT, updated_at TEXT,
+    UNIQUE (subscription_id, partner_chat_id, period_start)
+);
+"""
+
+
+def _manager(max_visits_total=None, visit_limit_per_client=None, partners=3, dedup_seconds=0) -> SupabaseManager:
+    db = SqliteSupabase()
+    db.executescript(VISITS_SCHEMA)
+    db.conn.execute('INSERT INTO platform_products (name, max_visits_total) VALUES (?, ?)', ('Кросс-абонемент', max_visits_total))
+    db.conn.executemany(
+        'INSERT INTO platform_product_partners (product_id, partner_chat_id, payout_per_visit, visit_limit_per_client) VALUES (1, ?, 250, ?)',
+        ((f'P{i}', visit_limit_per_client) for i in range(partners))
+    )
+    valid_until = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=30)).isoformat()
+    db.conn.execute("INSERT INTO client_product_subscriptions (client_chat_id, product_id, valid_until) VALUES ('C1', 1, ?)", (valid_until,))
+    db.conn.commit()
+    with patch.dict(os.environ, {'PLATFORM_VISIT_DEDUP_SECONDS': str(dedup_seconds)}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _record_visit_rpc(db, params):
+    """
+    SQLite-аналог RPC record_platform_product_visit для проверки разбора ответа.
+
+    Выполняется под глобальной блокировкой фейка целиком, поэтому блокировку подписки
+    (FOR UPDATE) в SQL-функции не проверяет: конкурентность здесь доказана только для
+    запасного пути запросами (TestRecordVisitWithoutRPC).
+    """
+    def fail(error):
+        return {'success': False, 'visit': None, 'duplicate': False, 'error': error}
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    sub = db.conn.execute(
+        "SELECT id, visits_total_used FROM client_product_subscriptions WHERE client_chat_id = ? AND product_id = ? "
+        "AND status = 'active' AND valid_until >= ? ORDER BY valid_until DESC LIMIT 1",
+        (params['p_client_chat_id'], params['p_product_id'], now.isoformat())
+    ).fetchone()
+    if not sub:
+        return fail('Нет активного абонемента по этому продукту.')
+    pp = db.conn.execute(
+        'SELECT payout_per_visit, visit_limit_per_client FROM platform_product_partners WHERE product_id = ? AND partner_chat_id = ? AND is_active',
+        (params['p_product_id'], params['p_partner_chat_id'])
+    ).fetchone()
+    if not pp:
+        return fail('Эта студия не входит в ваш абонемент.')
+    if params['p_dedup_seconds'] > 0:
+        since = now - datetime.timedelta(seconds=params['p_dedup_seconds'])
+        recent = db.fetch(
+            "SELECT * FROM product_visits WHERE subscription_id = ? AND partner_chat_id = ? AND status = 'confirmed' "
+            "AND visited_at >= ? ORDER BY visited_at DESC LIMIT 1",
+            [sub[0], params['p_partner_chat_id'], since.isoformat()], 'product_visits'
+        )
+        if recent:
+            return {'success': True, 'visit': recent[0], 'duplicate': True, 'error': None}
+    max_total = db.conn.execute('SELECT max_visits_total FROM platform_products WHERE id = ?', (params['p_product_id'],)).fetchone()[0]
+    if max_total is not None and sub[1] >= max_total:
+        return fail('Исчерпан лимит визитов по абонементу.')
+    if pp[1] is not None:
+        used = db.conn.execute(
+            'SELECT COALESCE(SUM(visits_count), 0) FROM product_visit_counters WHERE subscription_id = ? AND partner_chat_id = ?',
+            (sub[0], params['p_partner_chat_id'])
+        ).fetchone()[0]
+        if used >= pp[1]:
+            return fail(f'Лимит визитов в эту студию ({pp[1]}) исчерпан.')
+    visit = db.fetch(
+        "INSERT INTO product_visits (subscription_id, product_id, client_chat_id, partner_chat_id, visited_at, source, status, "
+        "payout_amount, payout_currency, payout_status) VALUES (?, ?, ?, ?, ?, ?, 'confirmed', ?, 'RUB', 'not_processed') RETURNING *",
+        [sub[0], params['p_product_id'], params['p_client_chat_id'], params['p_partner_chat_id'], now.isoformat(), params['p_source'], pp[0]],
+        'product_visits'
+    )[0]
+    db.conn.execute('UPDATE client_product_subscriptions SET visits_total_used = visits_total_used + 1 WHERE id = ?', (sub[0],))
+    db.conn.execute(
+        "INSERT INTO product_visit_counters (subscription_id, partner_chat_id, product_id, period_start, visits_count, payout_amount, currency) "
+        "VALUES (?, ?, ?, ?, 1, ?, 'RUB') ON CONFLICT (subscription_id, partner_chat_id, period_start) "
+        "DO UPDATE SET visits_count = visits_count + 1, payout_amount = payout_amount + excluded.payout_amount",
+        (sub[0], params['p_partner_chat_id'], params['p_product_id'], now.date().replace(day=1).isoformat(), pp[0])
+    )
+    db.conn.commit()
+    return {'success': True, 'visit': visit, 'duplicate': False, 'error': None}
+
+
+def _with_latency(db, seconds: float):
+    """Каждый запрос к фейку задерживается на seconds — имитация сетевого round trip."""
+    original = db.record_query
+
+    def record_query(kind, target):
+        time.sleep(seconds)
+        original(kind, target)
+    return patch.object(db, 'record_query', side_effect=record_query)
+
+
+def _scan_concurrently(manager, partners: list) -> list:
+    barrier = threading.Barrier(len(partners))
+    results = [None] * len(partners)
+
+    def scan(index, partner):
+        barrier.wait()
+        results[index] = manager.record_platform_product_visit('C1', partner, 1, source='qr')
+
+    threads = [threading.Thread(target=scan, args=(i, p)) for i, p in enumerate(partners)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _counts(manager) -> tuple:
+    conn = manager.client.conn
+    visits = conn.execute("SELECT COUNT(*) FROM product_visits WHERE status = 'confirmed'").fetchone()[0]
+    used = conn.execute('SELECT visits_total_used FROM client_product_subscriptions WHERE id = 1').fetchone()[0]
+    counted = conn.execute('SELECT COALESCE(SUM(visits_count), 0) FROM product_visit_counters').fetchone()[0]
+    assert counted == visits
+    return visits, used
+
+
+class TestRecordVisitWithoutRPC:
+    """Допуск запросами, когда RPC недоступна"""
+
+    def test_records_visit_and_counts_round_trips(self):
+        manager = _manager(visit_limit_per_client=2)
+        manager.client.reset_queries()
+
+        result = manager.record_platform_product_visit('C1', 'P0', 1, source='qr')
+
+        assert result['success'] and not result['duplicate']
+        assert (result['visit']['payout_amount'], result['visit']['source']) == (250.0, 'qr')
+        assert _counts(manager) == (1, 1)
+        # rpc + подписка, партнёр, продукт, счётчики и pending-визиты, вставка визита, подписка,
+        # счётчик визита (чтение и запись), подтверждение визита
+        assert manager.client.query_count == 11
+        assert manager.client.queries.count(('select', 'product_visits')) == 1
+
+    def test_limits(self):
+        manager = _manager(max_visits_total=3, visit_limit_per_client=2)
+
+        assert [manager.record_platform_product_visit('C1', 'P0', 1)['success'] for _ in range(3)] == [True, True, False]
+        assert manager.record_platform_product_visit('C1', 'P0', 1)['error'] == 'Лимит визитов в эту студию (2) исчерпан.'
+        assert manager.record_platform_product_visit('C1', 'P1', 1)['success']
+        assert manager.record_platform_product_visit('C1', 'P2', 1)['error'] == 'Исчерпан лимит визитов по абонементу.'
+        assert manager.record_platform_product_visit('C1', 'P9', 1)['error'] == 'Эта студия не входит в ваш абонемент.'
+        assert _counts(manager) == (3, 3)
+
+    def test_concurrent_scans_do_not_exceed_total_limit(self):
+        manager = _manager(max_visits_total=3, partners=12)
+
+        with _with_latency(manager.client, 0.002):
+            results = _scan_concurrently(manager, [f'P{i}' for i in range(12)])
+
+        assert sum(r['success'] for r in results) == 3
+        assert _counts(manager) == (3, 3)
+
+    def test_concurrent_scans_respect_partner_limit(self):
+        manager = _manager(visit_limit_per_client=1)
+
+        with _with_latency(manager.client, 0.002):
+            results = _scan_concurrently(manager, ['P0'] * 6)
+
+        assert sum(r['success'] for r in results) == 1
+        assert _counts(manager) == (1, 1)
+
+    def test_double_scan_returns_existing_visit(self):
+        manager = _manager(dedup_seconds=60)
+
+        with _with_latency(manager.client, 0.002):
+            results = _scan_concurrently(manager, ['P0'] * 4)
+
+        assert all(r['success'] for r in results)
+        assert sum(not r['duplicate'] for r in results) == 1
+        assert len({r['visit']['id'] for r in results}) == 1
+        assert _counts(manager) == (1, 1)
+        # Визит к другому партнёру — не повтор
+        assert manager.record_platform_product_visit('C1', 'P1', 1)['duplicate'] is False
+
+
+class TestRecordVisitRPC:
+    """Допуск через RPC record_platform_product_visit"""
+
+    def test_single_round_trip(self):
+        manager = _manager(dedup_seconds=60)
+        calls = []
+        manager.client.register_rpc('record_platform_product_visit', lambda db, params: calls.append(params) or _record_visit_rpc(db, params))
+        manager.client.reset_queries()
+
+        result = manager.record_platform_product_visit('C1', 'P0', 1, source='qr')
+
+        assert result['success'] and result['visit']['partner_chat_id'] == 'P0'
+        assert manager.client.queries == [('rpc', 'record_platform_product_visit')]
+        assert calls == [{
+            'p_client_chat_id': 'C1', 'p_partner_chat_id': 'P0', 'p_product_id': 1,
+            'p_source': 'qr', 'p_dedup_seconds': 60,
+        }]
+        assert manager.record_platform_product_visit('C1', 'P0', 1)['duplicate'] is True
+
+    def test_rpc_failure_does_not_fall_back(self):
+        """Таймаут после отправки: RPC могла записать визит, повтор запросами его бы удвоил"""
+        manager = _manager(partners=1)
+
+        def timeout(db, params):
+            raise TimeoutError('The read operation timed out')
+
+        manager.client.register_rpc('record_platform_product_visit', timeout)
+        manager.client.reset_queries()
+
+        result = manager.record_platform_product_visit('C1', 'P0', 1)
+
+        assert result['success'] is False and 'timed out' in result['error']
+        assert manager.client.queries == [('rpc', 'record_platform_product_visit')]
+        assert _counts(manager) == (0, 0)
+
+    @pytest.mark.slow
+    def test_benchmark_admission_latency(self):
+        """Бенчмарк: 100 сканирований при round trip 5 мс — запросами против одного RPC"""
+        timings = {}
+        for name, use_rpc in (('queries', False), ('rpc', True)):
+            manager = _manager(visit_limit_per_client=1000, partners=1)
+            if use_rpc:
+                manager.client.register_rpc('record_platform_product_visit', _record_visit_rpc)
+            manager.client.reset_queries()
+            with _with_latency(manager.client, 0.005):
+                started = time.perf_counter()
+                for _ in range(100):
+                    assert manager.record_platform_product_visit('C1', 'P0', 1)['success']
+                timings[name] = (time.perf_counter() - started, manager.client.query_count / 100)
+
+        assert timings['rpc'][1] == 1
+        assert timings['rpc'][0] * 3 < timings['queries'][0]
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
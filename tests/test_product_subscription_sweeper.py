@@ -0,0 +1,148 @@
+"""
+Unit-тесты для обхода подписок на продукты платформы по сроку действия (product_subscription_sweeper.py)
+"""
+
+import os
+import datetime
+import tracemalloc
+import pytest
+from unittest.mock import patch
+from supabase_manager import SupabaseManager
+from product_subscription_sweeper import ProductSubscriptionSweeper
+from tests.sqlite_supabase import SqliteSupabase
+
+
+SUBSCRIPTIONS_SCHEMA = """
+CREATE TABLE client_product_subscriptions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, client_chat_id TEXT, product_id INTEGER,
+    valid_until TEXT, status TEXT DEFAULT 'active', visits_total_used INTEGER DEFAULT 0,
+    expiry_notified_at TEXT
+);
+CREATE INDEX idx_active_expiry ON client_product_subscriptions(valid_until, id) WHERE status = 'active';
+"""
+
+NOW = datetime.datetime(2026, 10, 19, 3, 0, tzinfo=datetime.timezone.utc)
+
+
+def _manager(offsets_days, status: str = 'active') -> SupabaseManager:
+    """Подписки, истекающие через offsets_days дней от NOW (отрицательные — уже истекли)."""
+    db = SqliteSupabase()
+    db.executescript(SUBSCRIPTIONS_SCHEMA)
+    _add(db, offsets_days, status)
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _add(db, offsets_days, status: str = 'active'):
+    db.conn.executemany(
+        'INSERT INTO client_product_subscriptions (client_chat_id, product_id, valid_until, status) VALUES (?, 1, ?, ?)',
+        ((f'C{i}', (NOW + datetime.timedelta(days=offset)).isoformat(), status) for i, offset in enumerate(offsets_days))
+    )
+    db.conn.commit()
+
+
+def _statuses(manager) -> dict:
+    return dict(manager.client.conn.execute(
+        'SELECT status, COUNT(*) FROM client_product_subscriptions GROUP BY status'
+    ).fetchall())
+
+
+class TestSubscriptionSweep:
+    """Истечение и предупреждение об окончании"""
+
+    def test_expires_and_marks_in_pages(self):
+        # 250 истекли, 120 истекают в течение 3 дней, 30 — позже
+        manager = _manager([-1 - i % 40 for i in range(250)] + [0.5 + i % 2 for i in range(120)] + [10] * 30)
+        sweeper = ProductSubscriptionSweeper(manager, batch_size=100, notice_days=3)
+        batches = []
+        manager.client.reset_queries()
+
+        result = sweeper.sweep(now=NOW, notify=batches.append)
+
+        assert result == {'expired': 250, 'expiring': 120, 'batches': 5}
+        assert _statuses(manager) == {'expired': 250, 'active': 150}
+        notified = manager.client.conn.execute(
+            'SELECT COUNT(*) FROM client_product_subscriptions WHERE expiry_notified_at IS NOT NULL'
+        ).fetchone()[0]
+        assert notified == 120
+        # Пачка — одна выборка и один UPDATE; плюс по пустой выборке на каждый этап
+        assert manager.client.queries.count(('update', 'client_product_subscriptions')) == 5
+        assert manager.client.query_count == 12
+        assert [len(b) for b in batches] == [100, 100, 50, 100, 20]
+        assert batches[0][0] == {
+            'event': 'expired', 'subscription_id': batches[0][0]['subscription_id'], 'client_chat_id': batches[0][0]['client_chat_id'],
+            'product_id': 1, 'valid_until': batches[0][0]['valid_until'],
+        }
+        assert {e['event'] for e in batches[-1]} == {'expiring'}
+
+    def test_rerun_emits_nothing_new(self):
+        manager = _manager([-2, -1, 1, 2, 5])
+        manager.product_subscription_sweeper.notice_days = 3
+        first = manager.sweep_platform_product_subscriptions(now=NOW)
+
+        events = []
+        again = manager.sweep_platform_product_subscriptions(notify=events.extend, now=NOW)
+
+        assert (first['expired'], first['expiring']) == (2, 2)
+        assert again == {'expired': 0, 'expiring': 0, 'batches': 0} and events == []
+        # Через два дня: одна подписка истекла, подписка на 5 дней вошла в окно предупреждения
+        later = manager.sweep_platform_product_subscriptions(notify=events.extend, now=NOW + datetime.timedelta(days=2, hours=1))
+        assert (later['expired'], later['expiring']) == (2, 1)
+        assert sorted(e['event'] for e in events) == ['expired', 'expired', 'expiring']
+
+    def test_failed_notification_leaves_page_for_next_run(self):
+        manager = _manager([-1, -1, -1])
+        sweeper = ProductSubscriptionSweeper(manager, batch_size=2, notice_days=3)
+
+        def failing(events):
+            raise ConnectionError('telegram down')
+
+        with pytest.raises(ConnectionError):
+            sweeper.sweep(now=NOW, notify=failing)
+        assert _statuses(manager) == {'active': 3}
+        assert sweeper.sweep(now=NOW)['expired'] == 3
+
+    def test_cancelled_and_pending_are_untouched(self):
+        manager = _manager([-1, 1])
+        _add(manager.client, [-1, 1], status='cancelled')
+
+        result = manager.sweep_platform_product_subscriptions(now=NOW)
+
+        assert (result['expired'], result['expiring']) == (1, 1)
+        assert _statuses(manager) == {'active': 1, 'cancelled': 2, 'expired': 1}
+
+    @pytest.mark.slow
+    def test_benchmark_one_million_subscriptions(self):
+        """Бенчмарк: 1M подписок (300k истекли, 100k истекают) — время и пиковая память обхода"""
+        db = SqliteSupabase()
+        db.executescript(SUBSCRIPTIONS_SCHEMA)
+        offsets = ((-(i % 90) - 1) if i % 10 < 3 else (1 if i % 10 == 3 else 30 + i % 300) for i in range(1_000_000))
+        db.conn.executemany(
+            "INSERT INTO client_product_subscriptions (client_chat_id, product_id, valid_until) VALUES (?, 1, ?)",
+            ((f'C{i}', (NOW + datetime.timedelta(days=offset)).isoformat()) for i, offset in enumerate(offsets))
+        )
+        db.conn.commit()
+        with patch.dict(os.environ, {}, clear=True):
+            manager = SupabaseManager()
+        manager.client = db
+        sweeper = ProductSubscriptionSweeper(manager, batch_size=1000, notice_days=3)
+        emitted = {'count': 0, 'largest': 0}
+
+        def notify(events):
+            emitted['count'] += len(events)
+            emitted['largest'] = max(emitted['largest'], len(events))
+
+        tracemalloc.start()
+        result = sweeper.sweep(now=NOW, notify=notify)
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        assert (result['expired'], result['expiring']) == (300_000, 100_000)
+        assert emitted == {'count': 400_000, 'largest': 1000}
+        assert peak < 20 * 1024 * 1024
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
@@ -0,0 +1,284 @@
+"""
+Unit-тесты для счётчиков визитов по кросс-абонементам (product_visit_counters.py)
+"""
+
+import os
+import datetime
+import pytest
+from unittest.mock import patch
+from supabase_manager import SupabaseManager
+from product_visit_counters import counter_period, aggregate_visits
+from tests.sqlite_supabase import SqliteSupabase
+
+
+COUNTERS_SCHEMA = """
+CREATE TABLE platform_products (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, max_visits_total INTEGER, is_active BOOLEAN DEFAULT 1
+);
+CREATE TABLE platform_product_partners (
+    product_id INTEGER, partner_chat_id TEXT, payout_per_visit REAL DEFAULT 0,
+    visit_limit_per_client INTEGER, is_active BOOLEAN DEFAULT 1,
+    PRIMARY KEY (product_id, partner_chat_id)
+);
+CREATE TABLE client_product_subscriptions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, client_chat_id TEXT, product_id INTEGER,
+    valid_until TEXT, status TEXT DEFAULT 'active', visits_total_used INTEGER DEFAULT 0
+);
+CREATE TABLE product_visits (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, subscription_id INTEGER, product_id INTEGER,
+    client_chat_id TEXT, partner_chat_id TEXT, visited_at TEXT, source TEXT, status TEXT,
+    payout_amount REAL, payout_currency TEXT, payout_status TEXT, payout_batch_id INTEGER
+);
+"""
+
+COUNTERS_TABLE_SCHEMA = """
+CREATE TABLE product_visit_counters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, subscription_id INTEGER, partner_chat_id TEXT, product_id INTEGER,
+    period_start TEXT, visits_count INTEGER, payout_amount REAL, currency TEXT, updated_at TEXT,
+    UNIQUE (subscription_id, partner_chat_id, period_start)
+);
+"""
+
+
+def _manager(with_counters: bool = True, subscriptions: int = 2, visit_limit_per_client=None) -> SupabaseManager:
+    db = SqliteSupabase()
+    db.executescript(COUNTERS_SCHEMA + (COUNTERS_TABLE_SCHEMA if with_counters else ''))
+    db.conn.execute("INSERT INTO platform_products (name) VALUES ('Кросс-абонемент')")
+    db.conn.executemany(
+        'INSERT INTO platform_product_partners (product_id, partner_chat_id, payout_per_visit, visit_limit_per_client) VALUES (1, ?, 200, ?)',
+        (('P1', visit_limit_per_client), ('P2', visit_limit_per_client))
+    )
+    valid_until = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=30)).isoformat()
+    db.conn.executemany(
+        'INSERT INTO client_product_subscriptions (client_chat_id, product_id, valid_until) VALUES (?, 1, ?)',
+        ((f'C{i}', valid_until) for i in range(1, subscriptions + 1))
+    )
+    db.conn.commit()
+    with patch.dict(os.environ, {'PLATFORM_VISIT_DEDUP_SECONDS': '0'}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _history(manager, visits: int, month: str = '2026-08'):
+    """Исторические визиты напрямую в product_visits (без счётчиков)."""
+    manager.client.conn.executemany(
+        "INSERT INTO product_visits (subscription_id, product_id, client_chat_id, partner_chat_id, visited_at, status, "
+        "payout_amount, payout_currency) VALUES (?, 1, ?, 'P1', ?, 'confirmed', 200, 'RUB')",
+        ((1 + i % 2, f'C{1 + i % 2}', f'{month}-{1 + i % 28:02d}T10:00:00+00:00') for i in range(visits))
+    )
+    manager.client.conn.commit()
+
+
+class TestCounterHelpers:
+    """Период счётчика и свёртка визитов"""
+
+    def test_counter_period_is_utc_month(self):
+        assert counter_period('2026-09-30T23:30:00-03:00') == '2026-10-01'
+        assert counter_period(datetime.date(2026, 9, 15)) == '2026-09-01'
+        assert counter_period(None) is None and counter_period('not a date') is None
+
+    def test_aggregate_visits_rolls_over_by_month(self):
+        rows = aggregate_visits([
+            {'subscription_id': 1, 'partner_chat_id': 'P1', 'visited_at': '2026-08-31T12:00:00+00:00', 'payout_amount': 200},
+            {'subscription_id': 1, 'partner_chat_id': 'P1', 'visited_at': '2026-09-01T08:00:00+00:00', 'payout_amount': 200},
+            {'subscription_id': 1, 'partner_chat_id': 'P1', 'visited_at': '2026-09-02T08:00:00+00:00', 'payout_amount': 150.5},
+        ])
+        assert {key: (row['visits_count'], row['payout_amount']) for key, row in rows.items()} == {
+            (1, 'P1', '2026-08-01'): (1, 200.0),
+            (1, 'P1', '2026-09-01'): (2, 350.5),
+        }
+
+
+class TestProductVisitCounters:
+    """Счётчики при записи визита, сводка и пересчёт"""
+
+    def test_recording_maintains_counters(self):
+        manager = _manager()
+        for client, partner in (('C1', 'P1'), ('C1', 'P1'), ('C1', 'P2'), ('C2', 'P1')):
+            assert manager.record_platform_product_visit(client, partner, 1)['success']
+
+        rows = manager.client.conn.execute(
+            'SELECT subscription_id, partner_chat_id, visits_count, payout_amount FROM product_visit_counters ORDER BY subscription_id, partner_chat_id'
+        ).fetchall()
+        assert rows == [(1, 'P1', 2, 400.0), (1, 'P2', 1, 200.0), (2, 'P1', 1, 200.0)]
+        assert manager.product_visit_counters.partner_visits(1, 'P1') == 2
+
+    def test_partner_limit_uses_counters(self):
+        manager = _manager(visit_limit_per_client=2)
+        _history(manager, 40)
+        manager.rebuild_product_visit_counters()
+        manager.client.reset_queries()
+
+        result = manager.record_platform_product_visit('C1', 'P1', 1)
+
+        assert result['error'] == 'Лимит визитов в эту студию (2) исчерпан.'
+        # История визитов не читается: из product_visits — только число визитов в процессе допуска
+        assert manager.client.queries.count(('select', 'product_visits')) == 1
+
+    def test_counter_updated_only_after_admission(self):
+        manager = _manager()
+        conn = manager.client.conn
+        claimed = []
+        add = manager.product_visit_counters.add
+
+        def tracking_add(visit, delta=1):
+            claimed.append((delta, conn.execute('SELECT visits_total_used FROM client_product_subscriptions WHERE id = 1').fetchone()[0]))
+            return add(visit, delta)
+
+        manager.product_visit_counters.add = tracking_add
+        conn.execute(
+            "INSERT INTO product_visits (subscription_id, product_id, client_chat_id, partner_chat_id, visited_at, status, payout_amount) "
+            "VALUES (1, 1, 'C1', 'P1', '2026-08-10T10:00:00+00:00', 'pending', 200)"
+        )
+
+        assert manager.record_platform_product_visit('C1', 'P1', 1)['success']
+        assert manager.record_platform_product_visit('C1', 'P1', 1)['success']
+
+        # Счётчик меняется только для допущенных визитов, после увеличения visits_total_used;
+        # брошенный pending-визит в счётчики не попадает
+        assert claimed == [(1, 1), (1, 2)]
+        assert manager.product_visit_counters.partner_visits(1, 'P1') == 2
+
+    def test_visit_abandoned_before_confirmation_is_released(self):
+        """Процесс умер после допуска и счётчика, но до подтверждения: ночной обход снимает визит"""
+        manager = _manager(visit_limit_per_client=1)
+        add = manager.product_visit_counters.add
+
+        def add_then_die(visit, delta=1):
+            add(visit, delta)
+            raise KeyboardInterrupt
+
+        with patch.object(manager.product_visit_counters, 'add', side_effect=add_then_die):
+            with pytest.raises(KeyboardInterrupt):
+                manager.record_platform_product_visit('C1', 'P1', 1)
+        conn = manager.client.conn
+        assert conn.execute("SELECT status FROM product_visits").fetchall() == [('pending',)]
+        assert conn.execute('SELECT visits_total_used FROM client_product_subscriptions WHERE id = 1').fetchone()[0] == 1
+        assert manager.product_visit_counters.partner_visits(1, 'P1') == 1
+
+        # Пока визит свежий, он считается идущей записью и не трогается
+        assert manager.release_stale_platform_product_visits() == 0
+        later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=manager.platform_visit_pending_timeout + 1)
+        assert manager.release_stale_platform_product_visits(now=later) == 1
+
+        assert conn.execute('SELECT COUNT(*) FROM product_visits').fetchone()[0] == 0
+        assert conn.execute('SELECT visits_total_used FROM client_product_subscriptions WHERE id = 1').fetchone()[0] == 0
+        assert manager.product_visit_counters.partner_visits(1, 'P1') == 0
+        assert manager.record_platform_product_visit('C1', 'P1', 1)['success']
+
+    def test_release_skips_subscription_with_visit_in_progress(self):
+        manager = _manager()
+        _history(manager, 4)
+        conn = manager.client.conn
+        conn.execute('UPDATE client_product_subscriptions SET visits_total_used = 5 WHERE id = 1')
+        now = datetime.datetime.now(datetime.timezone.utc)
+        conn.executemany(
+            "INSERT INTO product_visits (subscription_id, product_id, client_chat_id, partner_chat_id, visited_at, status, payout_amount) "
+            "VALUES (1, 1, 'C1', 'P1', ?, 'pending', 200)",
+            [((now - datetime.timedelta(hours=1)).isoformat(),), (now.isoformat(),)]
+        )
+        conn.commit()
+
+        assert manager.release_stale_platform_product_visits(now=now) == 1
+        # Свежий pending-визит — запись идёт: visits_total_used пересчитает следующий запуск
+        assert conn.execute('SELECT visits_total_used FROM client_product_subscriptions WHERE id = 1').fetchone()[0] == 5
+        conn.execute("DELETE FROM product_visits WHERE status = 'pending'")
+        conn.commit()
+        conn.execute(
+            "INSERT INTO product_visits (subscription_id, product_id, client_chat_id, partner_chat_id, visited_at, status, payout_amount) "
+            "VALUES (1, 1, 'C1', 'P1', ?, 'pending', 200)", ((now - datetime.timedelta(hours=1)).isoformat(),)
+        )
+        conn.commit()
+        assert manager.rebuild_product_visit_counters('P1') == 2
+        assert conn.execute('SELECT visits_total_used FROM client_product_subscriptions WHERE id = 1').fetchone()[0] == 2
+
+    def test_pending_visits_count_towards_partner_limit(self):
+        manager = _manager(visit_limit_per_client=1)
+        manager.client.conn.execute(
+            "INSERT INTO product_visits (subscription_id, product_id, client_chat_id, partner_chat_id, visited_at, status, payout_amount) "
+            "VALUES (1, 1, 'C1', 'P1', '2026-08-10T10:00:00+00:00', 'pending', 200)"
+        )
+
+        assert manager.record_platform_product_visit('C1', 'P1', 1)['error'] == 'Лимит визитов в эту студию (1) исчерпан.'
+
+    def test_summary_reads_counters_with_constant_queries(self):
+        small, large = _manager(), _manager()
+        _history(small, 10)
+        _history(large, 3000)
+        _history(large, 500, month='2026-09')
+        query_counts = []
+        for manager in (small, large):
+            manager.rebuild_product_visit_counters()
+            manager.client.reset_queries()
+            summary = manager.get_partner_product_visits_summary('P1', datetime.date(2026, 8, 1), datetime.date(2026, 9, 1))
+            assert summary['periods'][0]['period_start'] == '2026-08-01'
+            query_counts.append(manager.client.query_count)
+        assert query_counts[0] == query_counts[1]
+
+        summary = large.get_partner_product_visits_summary('P1', datetime.date(2026, 8, 1), datetime.date(2026, 9, 30))
+        assert (summary['total_visits'], summary['total_payout'], summary['currency']) == (3500, 700000.0, 'RUB')
+        assert summary['periods'] == [
+            {'period_start': '2026-08-01', 'visits': 3000, 'payout': 600000.0},
+            {'period_start': '2026-09-01', 'visits': 500, 'payout': 100000.0},
+        ]
+        assert summary['visits'] == []
+
+    def test_visit_list_is_limited_and_totals_come_from_counters(self):
+        manager = _manager()
+        _history(manager, 3000)
+        manager.rebuild_product_visit_counters()
+        manager.client.reset_queries()
+
+        summary = manager.get_partner_product_visits_summary('P1', include_visits=True, visits_limit=20)
+
+        assert summary['total_visits'] == 3000
+        assert len(summary['visits']) == 20
+        assert summary['visits'][0]['visited_at'] >= summary['visits'][-1]['visited_at']
+        # Итоги — из счётчиков, из product_visits читается только страница списка
+        assert manager.client.queries.count(('select', 'product_visits')) == 1
+
+    @pytest.mark.parametrize('period', [
+        (datetime.date(2026, 8, 10), datetime.date(2026, 9, 5)),
+        (datetime.date(2026, 8, 10), datetime.date(2026, 8, 20)),
+        (datetime.date(2026, 7, 1), datetime.date(2026, 10, 1)),
+        (None, datetime.date(2026, 9, 12)),
+        (datetime.date(2026, 8, 28), None),
+    ])
+    def test_summary_keeps_exact_period_bounds(self, period):
+        manager = _manager()
+        _history(manager, 300)
+        _history(manager, 200, month='2026-09')
+        manager.rebuild_product_visit_counters()
+
+        from_counters = manager.get_partner_product_visits_summary('P1', *period)
+        from_visits = manager.product_visit_counters.visits_summary('P1', *period)
+
+        for key in ('total_visits', 'total_payout', 'periods'):
+            assert from_counters[key] == from_visits[key], key
+        listed = manager.get_partner_product_visits_summary('P1', *period, include_visits=True, visits_limit=1000)
+        assert from_counters['total_visits'] == len(listed['visits'])
+
+    def test_rebuild_fixes_drift(self):
+        manager = _manager()
+        _history(manager, 12)
+        assert manager.rebuild_product_visit_counters() == 2
+        manager.client.conn.execute('UPDATE product_visit_counters SET visits_count = 99')
+        manager.client.conn.commit()
+
+        assert manager.rebuild_product_visit_counters('P1') == 2
+        assert manager.product_visit_counters.partner_visits(1, 'P1') == 6
+        assert manager.get_partner_product_visits_summary('P1')['total_visits'] == 12
+
+    def test_without_counters_table_falls_back_to_visits(self):
+        manager = _manager(with_counters=False, visit_limit_per_client=3)
+        _history(manager, 6)
+
+        assert manager.record_platform_product_visit('C1', 'P1', 1)['error'] == 'Лимит визитов в эту студию (3) исчерпан.'
+        assert manager.record_platform_product_visit('C1', 'P2', 1)['success']
+        summary = manager.get_partner_product_visits_summary('P1')
+        assert (summary['total_visits'], summary['total_payout']) == (6, 1200.0)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
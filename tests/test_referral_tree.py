@@ -0,0 +1,109 @@
+"""
+Unit-тесты для связей реферального дерева клиентов (_create_referral_tree_links)
+"""
+
+import os
+import threading
+import pytest
+from unittest.mock import patch
+from supabase_manager import SupabaseManager
+from tests.sqlite_supabase import SqliteSupabase
+
+
+REFERRAL_SCHEMA = """
+CREATE TABLE users (
+    chat_id TEXT PRIMARY KEY, name TEXT, referred_by_chat_id TEXT
+);
+CREATE TABLE referral_tree (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, referrer_chat_id TEXT, referred_chat_id TEXT,
+    level INTEGER, is_active BOOLEAN DEFAULT 1,
+    UNIQUE (referrer_chat_id, referred_chat_id)
+);
+"""
+
+
+def _manager(users) -> SupabaseManager:
+    """users: [(chat_id, referred_by_chat_id), ...]"""
+    db = SqliteSupabase()
+    db.executescript(REFERRAL_SCHEMA)
+    db.conn.executemany('INSERT INTO users (chat_id, referred_by_chat_id) VALUES (?, ?)', users)
+    db.conn.commit()
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _tree(manager, referred_chat_id: str) -> set:
+    return set(manager.client.conn.execute(
+        'SELECT referrer_chat_id, level FROM referral_tree WHERE referred_chat_id = ?', (referred_chat_id,)
+    ).fetchall())
+
+
+class TestReferralTreeLinks:
+    """Уровни 1-3, идемпотентность и число запросов"""
+
+    def test_links_three_levels_with_one_write(self):
+        manager = _manager([('U1', None), ('U2', 'U1'), ('U3', 'U2'), ('U4', 'U3'), ('NEW', 'U4')])
+        manager.client.reset_queries()
+
+        assert manager._create_referral_tree_links('NEW', 'U4') == 3
+
+        assert _tree(manager, 'NEW') == {('U4', 1), ('U3', 2), ('U2', 3)}
+        # Без RPC: запрос к users на каждый уровень цепочки и один upsert
+        assert manager.client.queries.count(('select', 'users')) == 3
+        assert manager.client.queries.count(('upsert', 'referral_tree')) == 1
+        assert ('select', 'referral_tree') not in manager.client.queries
+        assert ('insert', 'referral_tree') not in manager.client.queries
+
+    def test_short_chain_stops_early(self):
+        manager = _manager([('U1', None), ('NEW', 'U1')])
+        manager.client.reset_queries()
+
+        assert manager._create_referral_tree_links('NEW', 'U1') == 1
+
+        assert _tree(manager, 'NEW') == {('U1', 1)}
+        assert manager.client.queries.count(('select', 'users')) == 1
+
+    def test_repeat_and_concurrent_calls_do_not_duplicate(self):
+        manager = _manager([('U1', None), ('U2', 'U1'), ('NEW', 'U2')])
+        errors = []
+
+        def link():
+            try:
+                manager._create_referral_tree_links('NEW', 'U2')
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=link) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert manager.client.conn.execute("SELECT COUNT(*) FROM referral_tree WHERE referred_chat_id = 'NEW'").fetchone()[0] == 2
+        assert _tree(manager, 'NEW') == {('U2', 1), ('U1', 2)}
+
+    def test_unknown_referrer_creates_nothing(self):
+        manager = _manager([('NEW', 'ghost')])
+
+        assert manager._create_referral_tree_links('NEW', 'ghost') == 0
+        assert ('upsert', 'referral_tree') not in manager.client.queries
+
+    def test_rpc_chain_is_single_lookup(self):
+        manager = _manager([('U1', None), ('U2', 'U1'), ('NEW', 'U2')])
+        manager.client.register_rpc('get_user_referral_chains', lambda db, params: [
+            {'chat_id': 'U2', 'ancestor_chat_id': 'U1', 'depth': 1},
+            {'chat_id': 'U2', 'ancestor_chat_id': 'U2', 'depth': 0},
+        ])
+        manager.client.reset_queries()
+
+        assert manager._create_referral_tree_links('NEW', 'U2') == 2
+
+        assert manager.client.queries == [('rpc', 'get_user_referral_chains'), ('upsert', 'referral_tree')]
+        assert _tree(manager, 'NEW') == {('U2', 1), ('U1', 2)}
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
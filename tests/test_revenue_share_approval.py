@@ -0,0 +1,142 @@
+"""
+Unit-тесты для пакетного одобрения Revenue Share (PartnerRevenueShare.approve_pending_payments)
+"""
+
+import os
+import datetime
+import pytest
+from decimal import Decimal
+from unittest.mock import patch
+from supabase_manager import SupabaseManager
+from partner_revenue_share import PartnerRevenueShare
+from tests.sqlite_supabase import SqliteSupabase
+
+
+APPROVAL_SCHEMA = """
+CREATE TABLE partner_revenue_share (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, partner_chat_id TEXT, final_amount REAL,
+    period_start TEXT, period_end TEXT, status TEXT,
+    approval_run_id INTEGER, approved_by TEXT, approved_at TEXT
+);
+CREATE TABLE revenue_share_approval_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, period_start TEXT, period_end TEXT, approved_by TEXT,
+    status TEXT, approved_count INTEGER, total_amount REAL, last_payment_id INTEGER,
+    started_at TEXT, finished_at TEXT
+);
+"""
+
+PERIOD_START = datetime.date(2026, 9, 1)
+PERIOD_END = datetime.date(2026, 9, 30)
+
+
+def _approval(payments: int) -> PartnerRevenueShare:
+    db = SqliteSupabase()
+    db.executescript(APPROVAL_SCHEMA)
+    db.conn.executemany(
+        "INSERT INTO partner_revenue_share (partner_chat_id, final_amount, period_start, period_end, status) VALUES (?, ?, ?, ?, 'pending')",
+        ((f'P{i % 7}', 1.5 + i, PERIOD_START.isoformat(), PERIOD_END.isoformat()) for i in range(payments))
+    )
+    # Другой период — не трогаем
+    db.conn.execute("INSERT INTO partner_revenue_share (partner_chat_id, final_amount, period_start, period_end, status) VALUES ('P0', 9, '2026-08-01', '2026-08-31', 'pending')")
+    db.conn.commit()
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return PartnerRevenueShare(manager)
+
+
+def _statuses(revenue_share) -> dict:
+    return dict(revenue_share.db.client.conn.execute(
+        "SELECT status, COUNT(*) FROM partner_revenue_share WHERE period_start = ? GROUP BY status", (PERIOD_START.isoformat(),)
+    ).fetchall())
+
+
+def _runs(revenue_share) -> list:
+    return revenue_share.db.client.conn.execute(
+        'SELECT id, status, approved_count, total_amount FROM revenue_share_approval_runs ORDER BY id'
+    ).fetchall()
+
+
+class TestBulkApproval:
+    """Одобрение pending выплат за период"""
+
+    def test_approves_period_in_chunks_with_one_run_record(self):
+        revenue_share = _approval(payments=25)
+        client = revenue_share.db.client
+        client.reset_queries()
+
+        result = revenue_share.approve_pending_payments(PERIOD_START, PERIOD_END, chunk_size=10)
+
+        assert result['approved_count'] == 25
+        assert result['total_amount'] == sum(Decimal(str(1.5 + i)) for i in range(25))
+        assert _statuses(revenue_share) == {'approved': 25}
+        assert _runs(revenue_share) == [(1, 'completed', 25, float(result['total_amount']))]
+        # Три пачки — три UPDATE выплат, а не 25
+        assert client.queries.count(('update', 'partner_revenue_share')) == 3
+        linked = client.conn.execute('SELECT COUNT(*) FROM partner_revenue_share WHERE approval_run_id = 1').fetchone()[0]
+        assert linked == 25
+        other = client.conn.execute("SELECT status FROM partner_revenue_share WHERE period_start = '2026-08-01'").fetchone()
+        assert other == ('pending',)
+
+    def test_interrupted_run_is_resumed(self):
+        revenue_share = _approval(payments=25)
+        client = revenue_share.db.client
+        original_from = client.from_
+        updates = []
+
+        def failing_from(table):
+            query = original_from(table)
+            if table == 'partner_revenue_share':
+                original_update = query.update
+
+                def update(values):
+                    updates.append(values)
+                    if len(updates) == 2:
+                        raise ConnectionError('connection reset')
+                    return original_update(values)
+                query.update = update
+            return query
+
+        with patch.object(client, 'from_', side_effect=failing_from), patch.object(client, 'table', side_effect=failing_from):
+            with pytest.raises(ConnectionError):
+                revenue_share.approve_pending_payments(PERIOD_START, PERIOD_END, chunk_size=10)
+
+        assert _statuses(revenue_share) == {'approved': 10, 'pending': 15}
+        assert _runs(revenue_share)[0][1] == 'running'
+
+        result = revenue_share.approve_pending_payments(PERIOD_START, PERIOD_END, chunk_size=10)
+
+        assert result['resumed'] is True and result['run_id'] == 1
+        assert result['approved_count'] == 25
+        assert _statuses(revenue_share) == {'approved': 25}
+        assert [run[:3] for run in _runs(revenue_share)] == [(1, 'completed', 25)]
+
+    def test_rerun_after_completion_approves_only_new_rows(self):
+        revenue_share = _approval(payments=5)
+        revenue_share.approve_pending_payments(PERIOD_START, PERIOD_END)
+        revenue_share.db.client.conn.execute(
+            "INSERT INTO partner_revenue_share (partner_chat_id, final_amount, period_start, period_end, status) VALUES ('P1', 4, ?, ?, 'pending')",
+            (PERIOD_START.isoformat(), PERIOD_END.isoformat())
+        )
+        revenue_share.db.client.conn.commit()
+
+        result = revenue_share.approve_pending_payments(PERIOD_START, PERIOD_END)
+
+        assert result['approved_count'] == 1 and result['resumed'] is False
+        assert [run[1:3] for run in _runs(revenue_share)] == [('completed', 5), ('completed', 1)]
+
+    def test_manual_approval_of_single_payment(self):
+        revenue_share = _approval(payments=3)
+
+        assert revenue_share.approve_payment(2, approved_by='admin_42') is True
+        assert revenue_share.approve_payment(2) is False  # уже одобрена
+
+        row = revenue_share.db.client.conn.execute(
+            'SELECT status, approved_by, approval_run_id FROM partner_revenue_share WHERE id = 2'
+        ).fetchone()
+        assert row == ('approved', 'admin_42', None)
+        assert revenue_share.approve_pending_payments(PERIOD_START, PERIOD_END)['approved_count'] == 2
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
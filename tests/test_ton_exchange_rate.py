@@ -0,0 +1,236 @@
+"""
+Unit-тесты для курса TON/USD с кешем и предохранителями (ton_exchange_rate.py)
+Все источники — локальные заглушки, сеть не используется
+"""
+
+import os
+import datetime
+import pytest
+from decimal import Decimal
+from unittest.mock import patch
+from supabase_manager import SupabaseManager
+from ton_payment_service import TONPaymentService
+from ton_exchange_rate import CircuitBreaker, TONExchangeRateProvider, DEFAULT_TON_USD_RATE
+from tests.sqlite_supabase import SqliteSupabase
+
+
+class FakeClock:
+    def __init__(self, now: float = 1_800_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+class FakeSource:
+    """Источник курса: отдаёт rate или падает, если down."""
+
+    def __init__(self, rate='2.50', down: bool = False, fetched_at=None):
+        self.rate = rate
+        self.down = down
+        self.fetched_at = fetched_at
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.down:
+            raise TimeoutError('read timed out')
+        if self.fetched_at is not None:
+            return Decimal(self.rate), self.fetched_at
+        return Decimal(self.rate)
+
+
+def _provider(clock, *sources, **kwargs) -> TONExchangeRateProvider:
+    options = {'ttl': 60, 'max_stale_age': 3600, 'failure_threshold': 2, 'backoff': 30, 'max_backoff': 120}
+    options.update(kwargs)
+    return TONExchangeRateProvider(list(sources), clock=clock, **options)
+
+
+class TestCircuitBreaker:
+    """Размыкание и экспоненциальная пауза"""
+
+    def test_opens_after_threshold_and_doubles_backoff(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=2, backoff=10, max_backoff=25, clock=clock)
+
+        breaker.record_failure()
+        assert breaker.state == 'closed'
+        breaker.record_failure()
+        assert breaker.state == 'open' and not breaker.allow()
+
+        clock.advance(10)
+        assert breaker.state == 'half_open' and breaker.allow()
+        # Пробная попытка не удалась — пауза удваивается
+        breaker.record_failure()
+        clock.advance(19)
+        assert not breaker.allow()
+        clock.advance(1)
+        assert breaker.allow()
+
+        breaker.record_failure()
+        clock.advance(24)
+        assert not breaker.allow()  # 40 с ограничены max_backoff = 25
+        clock.advance(1)
+        breaker.record_success()
+        assert breaker.state == 'closed' and breaker.trips == 0
+
+
+class TestExchangeRateProvider:
+    """Кеш, порядок источников и устаревший курс"""
+
+    def test_cached_within_ttl(self):
+        clock = FakeClock()
+        source = FakeSource()
+        provider = _provider(clock, ('binance', source))
+
+        first = provider.quote()
+        clock.advance(59)
+        assert provider.quote() == first
+        assert source.calls == 1
+
+        clock.advance(2)
+        provider.quote()
+        assert source.calls == 2
+
+    def test_falls_through_to_next_source_with_provenance(self):
+        clock = FakeClock()
+        provider = _provider(clock, ('binance', FakeSource(down=True)), ('coingecko', FakeSource('2.75')))
+
+        quote = provider.quote()
+
+        assert quote['rate'] == Decimal('2.75') and quote['source'] == 'coingecko' and quote['stale'] is False
+        assert quote['fetched_at'] == datetime.datetime.fromtimestamp(clock.now, tz=datetime.timezone.utc)
+
+    def test_open_breaker_skips_source(self):
+        clock = FakeClock()
+        down = FakeSource(down=True)
+        backup = FakeSource('3.00')
+        provider = _provider(clock, ('binance', down), ('coingecko', backup), ttl=0)
+
+        for _ in range(5):
+            assert provider.quote()['source'] == 'coingecko'
+        # Две ошибки подряд разомкнули предохранитель — дальше binance не вызывается
+        assert down.calls == 2
+        assert provider.breakers['binance'].state == 'open'
+
+        clock.advance(30)
+        down.down = False
+        assert provider.quote()['source'] == 'binance'
+        assert provider.breakers['binance'].state == 'closed'
+
+    def test_serves_stale_rate_within_max_age(self):
+        clock = FakeClock()
+        source = FakeSource('2.40')
+        provider = _provider(clock, ('binance', source))
+        fresh = provider.quote()
+
+        source.down = True
+        clock.advance(600)
+        stale = provider.quote()
+
+        assert stale['stale'] is True
+        assert (stale['rate'], stale['source'], stale['fetched_at']) == (fresh['rate'], 'binance', fresh['fetched_at'])
+
+        clock.advance(3600)
+        expired = provider.quote()
+        assert expired['rate'] == DEFAULT_TON_USD_RATE and expired['source'] == 'default'
+
+    def test_old_database_rate_is_only_a_stale_fallback(self):
+        clock = FakeClock()
+        saved = clock.now - 1800
+        database = FakeSource('2.20', fetched_at=saved)
+        binance = FakeSource('2.60')
+        provider = _provider(clock, ('database', database), ('binance', binance))
+
+        assert provider.quote()['source'] == 'binance'
+
+        provider.invalidate()
+        binance.down = True
+        quote = provider.quote()
+        assert (quote['rate'], quote['source'], quote['stale']) == (Decimal('2.20'), 'database', True)
+        assert quote['fetched_at'].timestamp() == saved
+
+    def test_invalid_rate_counts_as_failure(self):
+        clock = FakeClock()
+        provider = _provider(clock, ('binance', FakeSource('0')), ('coingecko', FakeSource('2.5')))
+        assert provider.quote()['source'] == 'coingecko'
+        assert provider.breakers['binance'].failures == 1
+
+
+class FakeHTTPResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+def _service(binance_up: bool = True):
+    db = SqliteSupabase()
+    db.executescript(
+        'CREATE TABLE ton_exchange_rates (id INTEGER PRIMARY KEY AUTOINCREMENT, rate REAL, source TEXT, '
+        'effective_from TEXT, effective_until TEXT)'
+    )
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+        manager.client = db
+        service = TONPaymentService(manager)
+    requests_made = []
+
+    def fake_get(url, timeout=None):
+        requests_made.append(url)
+        if 'binance' in url:
+            if not binance_up:
+                raise ConnectionError('binance down')
+            return FakeHTTPResponse({'price': '2.5'})
+        return FakeHTTPResponse({'the-open-network': {'usd': 2.7}})
+
+    return service, db, requests_made, fake_get
+
+
+class TestTONPaymentServiceRate:
+    """Курс в TONPaymentService"""
+
+    def test_external_rate_saved_and_cached(self):
+        service, db, requests_made, fake_get = _service()
+        with patch('ton_payment_service.requests.get', side_effect=fake_get):
+            conversion = service.usd_to_ton(Decimal('25'))
+            service.usd_to_ton(Decimal('10'))
+
+        assert conversion['ton_amount'] == Decimal('10') and conversion['exchange_rate'] == Decimal('2.5')
+        assert conversion['rate_source'] == 'binance'
+        assert isinstance(conversion['rate_fetched_at'], datetime.datetime)
+        assert len(requests_made) == 1
+        assert db.conn.execute('SELECT rate, source FROM ton_exchange_rates WHERE effective_until IS NULL').fetchall() == [(2.5, 'binance')]
+
+    def test_recent_database_rate_avoids_http(self):
+        service, db, requests_made, fake_get = _service()
+        db.conn.execute(
+            "INSERT INTO ton_exchange_rates (rate, source, effective_from) VALUES (2.9, 'binance', ?)",
+            (datetime.datetime.now().isoformat(),)
+        )
+        db.conn.commit()
+        with patch('ton_payment_service.requests.get', side_effect=fake_get):
+            quote = service.get_ton_exchange_quote()
+
+        assert (quote['rate'], quote['source']) == (Decimal('2.9'), 'database')
+        assert requests_made == []
+
+    def test_provider_down_does_not_stall_each_call(self):
+        service, db, requests_made, fake_get = _service(binance_up=False)
+        service.rate_provider.ttl = 0
+        with patch('ton_payment_service.requests.get', side_effect=fake_get):
+            sources = [service.get_ton_exchange_quote()['source'] for _ in range(10)]
+
+        assert set(sources) == {'coingecko'}
+        assert len([url for url in requests_made if 'binance' in url]) == service.rate_provider.breakers['binance'].failure_threshold
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
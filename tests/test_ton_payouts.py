@@ -0,0 +1,343 @@
+"""
+Unit-тесты для пакетных TON выплат (ton_payouts.py)
+"""
+
+import os
+import time
+import datetime
+import pytest
+from decimal import Decimal
+from unittest.mock import patch
+from supabase_manager import SupabaseManager
+from ton_payment_service import TONPaymentService
+from ton_exchange_rate import TONExchangeRateProvider
+from ton_payouts import TONPayoutPipeline, aggregate_pending_commissions, payout_idempotency_key
+from tests.sqlite_supabase import SqliteSupabase
+
+
+PAYOUT_SCHEMA = """
+CREATE TABLE partners (chat_id TEXT PRIMARY KEY, ton_wallet_address TEXT, ton_payments_enabled BOOLEAN);
+CREATE TABLE partner_revenue_share (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, partner_chat_id TEXT, final_amount REAL, amount_usd REAL,
+    period_start TEXT, period_end TEXT, status TEXT, ton_tx_hash TEXT, ton_payment_id INTEGER
+);
+CREATE TABLE referral_rewards (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, referrer_chat_id TEXT, reward_type TEXT, amount_usd REAL,
+    status TEXT, ton_tx_hash TEXT, ton_payment_id INTEGER
+);
+CREATE TABLE ton_payments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, idempotency_key TEXT UNIQUE, partner_chat_id TEXT,
+    revenue_share_id INTEGER, referral_reward_id INTEGER, payment_type TEXT, amount_usd REAL, amount_nano INTEGER, ton_amount REAL,
+    exchange_rate REAL, exchange_rate_source TEXT, exchange_rate_fetched_at TEXT, ton_tx_hash TEXT, ton_tx_lt INTEGER, ton_block_seqno INTEGER, from_address TEXT,
+    to_address TEXT, status TEXT, comment TEXT, error_message TEXT, sent_at TEXT, last_retry_at TEXT
+);
+"""
+
+PERIOD_START = datetime.date(2026, 9, 1)
+PERIOD_END = datetime.date(2026, 9, 30)
+
+
+class FakeWallet:
+    """Локальный кошелёк: фиксирует пачки и имитирует задержку сети на каждую отправку."""
+
+    address = 'EQ_PLATFORM'
+
+    def __init__(self, latency: float = 0.0, failing: tuple = (), broken: bool = False):
+        self.latency = latency
+        self.failing = set(failing)
+        self.broken = broken
+        self.batches = []
+
+    def send_batch(self, messages: list) -> list:
+        time.sleep(self.latency)
+        self.batches.append(messages)
+        if self.broken:
+            raise ConnectionError('liteserver timeout')
+        return [
+            {'success': False, 'error': 'bounced'} if m['to_address'] in self.failing else
+            {'success': True, 'tx_hash': f"hash_{m['idempotency_key']}", 'tx_lt': 1, 'block_seqno': 2}
+            for m in messages
+        ]
+
+    @property
+    def sent(self) -> list:
+        return [m['idempotency_key'] for batch in self.batches for m in batch]
+
+
+def _mark_paid(db, params):
+    rows = 0
+    for item in params['p_items']:
+        rows += db.conn.execute(
+            "UPDATE partner_revenue_share SET status = 'paid_ton', ton_tx_hash = ?, ton_payment_id = ? "
+            "WHERE id = ? AND status = 'approved'",
+            (item['ton_tx_hash'], item['ton_payment_id'], item['id'])
+        ).rowcount
+    db.conn.commit()
+    return rows
+
+
+def _pending_commissions(db, params):
+    rows = db.conn.execute(
+        "SELECT referrer_chat_id, SUM(amount_usd), COUNT(*), MIN(id), MAX(id) FROM referral_rewards "
+        "WHERE status = 'pending' AND reward_type LIKE 'commission_%' GROUP BY referrer_chat_id"
+    ).fetchall()
+    return [
+        {'referrer_chat_id': r[0], 'total_usd': r[1], 'rewards_count': r[2], 'min_reward_id': r[3], 'max_reward_id': r[4]}
+        for r in rows
+    ]
+
+
+def _mark_rewards_paid(db, params):
+    rows = 0
+    for item in params['p_items']:
+        rows += db.conn.execute(
+            "UPDATE referral_rewards SET status = 'paid_ton', ton_tx_hash = ?, ton_payment_id = ? "
+            "WHERE referrer_chat_id = ? AND id <= ? AND status = 'pending' AND reward_type LIKE 'commission_%'",
+            (item['ton_tx_hash'], item['ton_payment_id'], item['referrer_chat_id'], item['max_reward_id'])
+        ).rowcount
+    db.conn.commit()
+    return rows
+
+
+def _add_rewards(manager, rewards: int, partners: int, amount: float = 3.0):
+    manager.client.conn.executemany(
+        "INSERT INTO referral_rewards (referrer_chat_id, reward_type, amount_usd, status) VALUES (?, ?, ?, 'pending')",
+        ((f'P{i % partners}', f'commission_l{1 + i % 3}', amount) for i in range(rewards))
+    )
+    manager.client.conn.commit()
+
+
+def _payout_manager(payments: int, partners: int = 10, rpc: bool = True) -> SupabaseManager:
+    db = SqliteSupabase()
+    db.executescript(PAYOUT_SCHEMA)
+    db.conn.executemany(
+        'INSERT INTO partners VALUES (?, ?, ?)',
+        ((f'P{i}', f'EQ_WALLET_{i}', True) for i in range(partners))
+    )
+    db.conn.executemany(
+        'INSERT INTO partner_revenue_share (partner_chat_id, final_amount, amount_usd, period_start, period_end, status) '
+        "VALUES (?, ?, ?, ?, ?, 'approved')",
+        ((f'P{i % partners}', 20.0 + i, 20.0 + i, PERIOD_START.isoformat(), PERIOD_END.isoformat()) for i in range(payments))
+    )
+    db.conn.commit()
+    if rpc:
+        db.register_rpc('mark_revenue_share_paid_ton', _mark_paid)
+        db.register_rpc('get_pending_referral_commissions', _pending_commissions)
+        db.register_rpc('mark_referral_rewards_paid_ton', _mark_rewards_paid)
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _pipeline(manager, wallet, batch_size=4):
+    with patch.dict(os.environ, {}, clear=True):
+        service = TONPaymentService(manager)
+    service.rate_provider = TONExchangeRateProvider([('fake', lambda: Decimal('2.5'))])
+    return TONPayoutPipeline(manager, service, wallet=wallet, batch_size=batch_size)
+
+
+def _statuses(manager) -> dict:
+    return dict(manager.client.conn.execute('SELECT status, COUNT(*) FROM partner_revenue_share GROUP BY status').fetchall())
+
+
+class TestRevenueSharePayouts:
+    """Пакетная выплата Revenue Share"""
+
+    def test_pays_all_approved_in_batches(self):
+        manager = _payout_manager(payments=10)
+        wallet = FakeWallet()
+
+        summary = _pipeline(manager, wallet, batch_size=4).pay_revenue_share(PERIOD_START, PERIOD_END)
+
+        assert summary['processed'] == 10 and summary['failed'] == 0
+        assert summary['total_usd'] == sum(Decimal(20 + i) for i in range(10))
+        assert [len(b) for b in wallet.batches] == [4, 4, 2]
+        assert _statuses(manager) == {'paid_ton': 10}
+        row = manager.client.conn.execute(
+            "SELECT amount_nano, exchange_rate, exchange_rate_source, status, from_address, ton_tx_hash FROM ton_payments "
+            "WHERE idempotency_key = ?", (payout_idempotency_key('revenue_share', 1),)
+        ).fetchone()
+        assert row == (8_000_000_000, 2.5, 'fake', 'sent', 'EQ_PLATFORM', 'hash_revenue_share:1')
+
+    def test_exchange_rate_resolved_once_per_run(self):
+        manager = _payout_manager(payments=12)
+        pipeline = _pipeline(manager, FakeWallet())
+        calls = []
+        # Без кеша в провайдере: каждый запрос курса идёт в источник
+        pipeline.ton_service.rate_provider = TONExchangeRateProvider([('fake', lambda: calls.append(1) or Decimal('2.5'))], ttl=0)
+
+        pipeline.pay_revenue_share(PERIOD_START, PERIOD_END)
+
+        assert calls == [1]
+
+    def test_queries_grow_with_batches_not_payments(self):
+        counts = []
+        for payments in (20, 200):
+            manager = _payout_manager(payments=payments, partners=50)
+            manager.client.reset_queries()
+            _pipeline(manager, FakeWallet(), batch_size=100).pay_revenue_share(PERIOD_START, PERIOD_END)
+            counts.append(manager.client.query_count)
+        # 2 страницы начислений + кошельки + существующие ключи, затем на пачку: резерв, результаты, статусы
+        assert counts == [4 + 3 * 1, 4 + 3 * 2]
+
+    def test_run_time_independent_of_per_payment_round_trips(self):
+        manager = _payout_manager(payments=40)
+        wallet = FakeWallet(latency=0.05)
+
+        started = time.monotonic()
+        summary = _pipeline(manager, wallet, batch_size=40).pay_revenue_share(PERIOD_START, PERIOD_END)
+        elapsed = time.monotonic() - started
+
+        assert summary['processed'] == 40
+        assert len(wallet.batches) == 1
+        # По отправке на выплату было бы 40 × 50 мс = 2 с
+        assert elapsed < 1.0
+
+    def test_rerun_does_not_pay_twice(self):
+        manager = _payout_manager(payments=6)
+        _pipeline(manager, FakeWallet()).pay_revenue_share(PERIOD_START, PERIOD_END)
+        # Сбой между отправкой и обновлением начисления: выплата уже в ton_payments
+        manager.client.conn.execute("UPDATE partner_revenue_share SET status = 'approved', ton_tx_hash = NULL WHERE id = 2")
+        manager.client.conn.commit()
+        wallet = FakeWallet()
+
+        summary = _pipeline(manager, wallet).pay_revenue_share(PERIOD_START, PERIOD_END)
+
+        assert wallet.batches == []
+        assert summary['recovered'] == 1
+        assert _statuses(manager) == {'paid_ton': 6}
+        assert manager.client.conn.execute('SELECT COUNT(*) FROM ton_payments').fetchone()[0] == 6
+
+    def test_failed_payments_are_retried(self):
+        manager = _payout_manager(payments=4, partners=4)
+        first = _pipeline(manager, FakeWallet(failing=('EQ_WALLET_1',))).pay_revenue_share(PERIOD_START, PERIOD_END)
+        assert first['processed'] == 3 and first['failed'] == 1
+
+        wallet = FakeWallet()
+        second = _pipeline(manager, wallet).pay_revenue_share(PERIOD_START, PERIOD_END)
+
+        assert wallet.sent == [payout_idempotency_key('revenue_share', 2)]
+        assert second['processed'] == 1
+        assert _statuses(manager) == {'paid_ton': 4}
+
+    def test_wallet_error_leaves_batch_in_doubt(self):
+        manager = _payout_manager(payments=3)
+        summary = _pipeline(manager, FakeWallet(broken=True)).pay_revenue_share(PERIOD_START, PERIOD_END)
+        assert summary['in_doubt'] == 3 and summary['processed'] == 0
+
+        # Не отправляем повторно то, что могло уйти в сеть
+        wallet = FakeWallet()
+        again = _pipeline(manager, wallet).pay_revenue_share(PERIOD_START, PERIOD_END)
+        assert wallet.batches == [] and again['in_doubt'] == 3
+        assert _statuses(manager) == {'approved': 3}
+
+    def test_partners_without_wallet_are_skipped(self):
+        manager = _payout_manager(payments=4, partners=4)
+        manager.client.conn.execute("UPDATE partners SET ton_payments_enabled = 0 WHERE chat_id = 'P0'")
+        manager.client.conn.execute("UPDATE partners SET ton_wallet_address = NULL WHERE chat_id = 'P1'")
+        manager.client.conn.commit()
+
+        summary = _pipeline(manager, FakeWallet()).pay_revenue_share(PERIOD_START, PERIOD_END)
+
+        assert summary['skipped'] == 2 and summary['processed'] == 2
+
+    def test_status_fallback_without_rpc(self):
+        manager = _payout_manager(payments=5, rpc=False)
+        summary = _pipeline(manager, FakeWallet()).pay_revenue_share(PERIOD_START, PERIOD_END)
+        assert summary['processed'] == 5
+        assert _statuses(manager) == {'paid_ton': 5}
+
+    def test_nothing_to_pay(self):
+        manager = _payout_manager(payments=0)
+        pipeline = _pipeline(manager, FakeWallet())
+        pipeline.ton_service.rate_provider = TONExchangeRateProvider([('fake', lambda: pytest.fail('rate must not be fetched'))])
+        assert pipeline.pay_revenue_share(PERIOD_START, PERIOD_END)['exchange_rate'] is None
+
+
+class TestReferralCommissionPayouts:
+    """Выплата накопленных реферальных комиссий"""
+
+    def test_aggregate_pending_commissions(self):
+        totals = aggregate_pending_commissions([
+            {'id': 5, 'referrer_chat_id': 'A', 'amount_usd': 1.5},
+            {'id': 2, 'referrer_chat_id': 'A', 'amount_usd': 2.25},
+            {'id': 7, 'referrer_chat_id': 'B', 'amount_usd': None},
+        ])
+        assert totals == [
+            {'referrer_chat_id': 'A', 'total_usd': Decimal('3.75'), 'rewards_count': 2, 'min_reward_id': 2, 'max_reward_id': 5},
+            {'referrer_chat_id': 'B', 'total_usd': Decimal('0'), 'rewards_count': 1, 'min_reward_id': 7, 'max_reward_id': 7},
+        ]
+
+    def test_pays_one_transfer_per_recipient_above_minimum(self):
+        manager = _payout_manager(payments=0, partners=4)
+        _add_rewards(manager, rewards=12, partners=3)  # по 4 комиссии × $3 = $12
+        _add_rewards(manager, rewards=1, partners=1, amount=2.0)  # P0 +$2
+        manager.client.conn.execute("INSERT INTO referral_rewards (referrer_chat_id, reward_type, amount_usd, status) VALUES ('P3', 'commission_l1', 5.0, 'pending')")
+        manager.client.conn.execute("INSERT INTO referral_rewards (referrer_chat_id, reward_type, amount_usd, status) VALUES ('P1', 'registration', 50.0, 'pending')")
+        manager.client.conn.commit()
+        wallet = FakeWallet()
+
+        summary = _pipeline(manager, wallet).pay_referral_commissions(Decimal('10'))
+
+        assert summary['partners'] == 4 and summary['below_minimum'] == 1 and summary['processed'] == 3
+        amounts = dict(manager.client.conn.execute('SELECT partner_chat_id, amount_usd FROM ton_payments').fetchall())
+        assert amounts == {'P0': 14.0, 'P1': 12.0, 'P2': 12.0}
+        paid = manager.client.conn.execute("SELECT COUNT(*) FROM referral_rewards WHERE status = 'paid_ton'").fetchone()[0]
+        assert paid == 13
+        # Ниже порога и не комиссии — остаются pending
+        assert manager.client.conn.execute("SELECT status FROM referral_rewards WHERE id IN (14, 15)").fetchall() == [('pending',), ('pending',)]
+
+    def test_rewards_table_not_scanned_when_aggregated_in_db(self):
+        counts = []
+        for rewards in (30, 3000):
+            manager = _payout_manager(payments=0, partners=3)
+            _add_rewards(manager, rewards=rewards, partners=3)
+            manager.client.reset_queries()
+
+            summary = _pipeline(manager, FakeWallet()).pay_referral_commissions(Decimal('10'))
+
+            assert summary['processed'] == 3
+            assert ('select', 'referral_rewards') not in manager.client.queries
+            assert ('update', 'referral_rewards') not in manager.client.queries
+            counts.append(manager.client.query_count)
+            assert manager.client.conn.execute("SELECT COUNT(*) FROM referral_rewards WHERE status = 'paid_ton'").fetchone()[0] == rewards
+        assert counts[0] == counts[1]
+
+    def test_fallback_streams_rewards_once(self):
+        manager = _payout_manager(payments=0, partners=3, rpc=False)
+        _add_rewards(manager, rewards=2500, partners=3)
+        manager.client.reset_queries()
+
+        summary = _pipeline(manager, FakeWallet()).pay_referral_commissions(Decimal('10'))
+
+        assert summary['processed'] == 3
+        # Страницы по 1000 строк и пустая страница в конце — без повторного чтения на партнера
+        assert manager.client.queries.count(('select', 'referral_rewards')) == 4
+        assert manager.client.queries.count(('update', 'referral_rewards')) == 3
+        assert manager.client.conn.execute("SELECT COUNT(*) FROM referral_rewards WHERE status = 'pending'").fetchone()[0] == 0
+
+    def test_new_rewards_after_crash_do_not_cause_double_payment(self):
+        manager = _payout_manager(payments=0, partners=1)
+        _add_rewards(manager, rewards=5, partners=1)
+        _pipeline(manager, FakeWallet()).pay_referral_commissions(Decimal('10'))
+        # Сбой после отправки: комиссии остались pending, а у партнера появилась новая
+        manager.client.conn.execute("UPDATE referral_rewards SET status = 'pending', ton_tx_hash = NULL, ton_payment_id = NULL")
+        manager.client.conn.commit()
+        _add_rewards(manager, rewards=4, partners=1)
+        wallet = FakeWallet()
+
+        summary = _pipeline(manager, wallet).pay_referral_commissions(Decimal('10'))
+
+        assert wallet.batches == [] and summary['recovered'] == 1
+        pending = manager.client.conn.execute("SELECT COUNT(*) FROM referral_rewards WHERE status = 'pending'").fetchone()[0]
+        assert pending == 4
+
+        # Следующий запуск платит только новые комиссии
+        wallet = FakeWallet()
+        _pipeline(manager, wallet).pay_referral_commissions(Decimal('10'))
+        assert wallet.sent == [payout_idempotency_key('referral_commission', 'P0:6')]
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
@@ -0,0 +1,208 @@
+"""
+Unit-тесты для _legacy/ai_translation/translation_backfill.py
+Потоковый бэкфилл переводов с параллелизмом и чекпоинтами
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, '_legacy', 'ai_translation'))
+
+from translation_cache import TranslationCache, LocalTranslationBackend
+from translation_backfill import BACKFILL_SPECS, TranslationBackfill
+from tests.sqlite_supabase import SqliteSupabase
+
+
+NEWS_SCHEMA = """
+CREATE TABLE news (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    content TEXT NOT NULL,
+    preview_text TEXT,
+    title_en TEXT,
+    preview_text_en TEXT,
+    content_en TEXT
+);
+"""
+
+
+def _apply_translations_batch(db: SqliteSupabase, params: dict) -> int:
+    """Аналог RPC apply_translations_batch"""
+    for column in params['p_columns']:
+        db.conn.executemany(
+            f'UPDATE "{params["p_table"]}" SET "{column}" = ? WHERE id = ?',
+            [(row[column], row['id']) for row in params['p_rows'] if row.get(column) is not None]
+        )
+    db.conn.commit()
+    return len(params['p_rows'])
+
+
+def _news_db(rows: int, translated_every: int = 0) -> SqliteSupabase:
+    db = SqliteSupabase()
+    db.executescript(NEWS_SCHEMA)
+    db.conn.executemany(
+        'INSERT INTO news (title, content, preview_text, title_en, preview_text_en, content_en) VALUES (?, ?, ?, ?, ?, ?)',
+        (
+            (f'заголовок {i}', f'текст {i}', None if i % 3 else f'анонс {i}') +
+            ((f'title {i}', f'preview {i}', f'text {i}') if translated_every and i % translated_every == 0 else (None, None, None))
+            for i in range(1, rows + 1)
+        )
+    )
+    db.conn.commit()
+    db.register_rpc('apply_translations_batch', _apply_translations_batch)
+    return db
+
+
+def _untranslated(db: SqliteSupabase) -> int:
+    return db.conn.execute(
+        'SELECT COUNT(*) FROM news WHERE title_en IS NULL OR preview_text_en IS NULL OR content_en IS NULL'
+    ).fetchone()[0]
+
+
+class TestTranslationBackfill:
+    """Тесты TranslationBackfill"""
+
+    def test_translates_only_untranslated_rows(self):
+        """Переведённые строки не читаются и не переводятся повторно"""
+        db = _news_db(50, translated_every=5)
+        backend = LocalTranslationBackend()
+        backfill = TranslationBackfill(db, TranslationCache(backend, batch_size=100), page_size=20)
+
+        stats = asyncio.run(backfill.run(BACKFILL_SPECS['news']))
+
+        assert stats['rows_scanned'] == 40
+        assert stats['rows_updated'] == 40
+        assert _untranslated(db) == 0
+        row = db.conn.execute('SELECT title_en, preview_text_en, content_en FROM news WHERE id = 1').fetchone()
+        assert row == ('[en] заголовок 1', '[en] текст 1', '[en] текст 1')
+        assert db.conn.execute('SELECT title_en FROM news WHERE id = 5').fetchone()[0] == 'title 5'
+
+    def test_bulk_write_per_page(self):
+        """Одна выборка и одна запись на страницу"""
+        db = _news_db(45)
+        backfill = TranslationBackfill(db, TranslationCache(LocalTranslationBackend(), batch_size=100), page_size=20)
+
+        asyncio.run(backfill.run(BACKFILL_SPECS['news']))
+
+        assert db.queries.count(('select', 'news')) == 3
+        assert db.queries.count(('rpc', 'apply_translations_batch')) == 3
+        assert ('update', 'news') not in db.queries
+
+    def test_row_updates_when_rpc_missing(self):
+        db = _news_db(5)
+        db.rpc_handlers.clear()
+        backfill = TranslationBackfill(db, TranslationCache(LocalTranslationBackend()), page_size=10)
+
+        stats = asyncio.run(backfill.run(BACKFILL_SPECS['news']))
+
+        assert stats['rows_updated'] == 5
+        assert _untranslated(db) == 0
+
+    def test_resumes_from_checkpoint(self, tmp_path):
+        """После сбоя повторный запуск продолжает с последней записанной страницы"""
+        db = _news_db(60)
+        checkpoint = str(tmp_path / 'checkpoint.json')
+        backend = LocalTranslationBackend()
+        calls = {'n': 0}
+        original = backend.translate_batch
+
+        async def flaky(texts, target_lang, source_lang):
+            calls['n'] += 1
+            if calls['n'] == 3:
+                raise RuntimeError('interrupted')
+            return await original(texts, target_lang, source_lang)
+
+        backend.translate_batch = flaky
+        backfill = TranslationBackfill(
+            db, TranslationCache(backend, batch_size=100), page_size=10, concurrency=1, checkpoint_path=checkpoint
+        )
+        # Сбой перевода третьей страницы: строки остаются без перевода, проход продолжается
+        asyncio.run(backfill.run(BACKFILL_SPECS['news']))
+        assert _untranslated(db) == 10
+        with open(checkpoint) as f:
+            assert json.load(f) == {'news:en': None}
+
+        # Прерывание записи: чекпоинт остаётся на последней записанной странице
+        db2 = _news_db(60)
+        write_calls = {'n': 0}
+
+        def failing_write(db_, params):
+            write_calls['n'] += 1
+            if write_calls['n'] == 4:
+                raise KeyboardInterrupt
+            return _apply_translations_batch(db_, params)
+
+        db2.register_rpc('apply_translations_batch', failing_write)
+        backfill2 = TranslationBackfill(
+            db2, TranslationCache(LocalTranslationBackend(), batch_size=100), page_size=10, concurrency=1,
+            checkpoint_path=checkpoint
+        )
+        with pytest.raises(KeyboardInterrupt):
+            asyncio.run(backfill2.run(BACKFILL_SPECS['news']))
+        with open(checkpoint) as f:
+            assert json.load(f) == {'news:en': 30}
+
+        db2.register_rpc('apply_translations_batch', _apply_translations_batch)
+        db2.reset_queries()
+        stats = asyncio.run(backfill2.run(BACKFILL_SPECS['news']))
+
+        assert stats['rows_scanned'] == 30
+        assert _untranslated(db2) == 0
+
+    def test_pages_translated_concurrently(self):
+        """Страницы переводятся параллельно, но не больше concurrency одновременно"""
+        db = _news_db(80)
+        active = {'now': 0, 'max': 0}
+
+        class Backend(LocalTranslationBackend):
+            async def translate_batch(self, texts, target_lang, source_lang):
+                active['now'] += 1
+                active['max'] = max(active['max'], active['now'])
+                try:
+                    return await super().translate_batch(texts, target_lang, source_lang)
+                finally:
+                    active['now'] -= 1
+
+        backend = Backend(latency=0.02)
+        backfill = TranslationBackfill(
+            db, TranslationCache(backend, batch_size=100, max_concurrency=3), page_size=10, concurrency=3
+        )
+        asyncio.run(backfill.run(BACKFILL_SPECS['news']))
+
+        assert _untranslated(db) == 0
+        assert 1 < active['max'] <= 3
+
+    @pytest.mark.slow
+    def test_benchmark_throughput_vs_sequential(self):
+        """Бенчмарк: 500 новостей, бэкенд с задержкой 10мс на запрос"""
+        def run(concurrency: int, batch_size: int, page_size: int):
+            db = _news_db(500)
+            backend = LocalTranslationBackend(latency=0.01)
+            backfill = TranslationBackfill(
+                db,
+                TranslationCache(backend, batch_size=batch_size, max_concurrency=concurrency),
+                page_size=page_size,
+                concurrency=concurrency,
+            )
+            started = time.perf_counter()
+            asyncio.run(backfill.run(BACKFILL_SPECS['news']))
+            elapsed = time.perf_counter() - started
+            assert _untranslated(db) == 0
+            return elapsed, backend.calls
+
+        # Прежний скрипт: один текст на запрос, строки по очереди
+        sequential, sequential_calls = run(concurrency=1, batch_size=1, page_size=100)
+        parallel, parallel_calls = run(concurrency=8, batch_size=20, page_size=50)
+
+        assert parallel_calls * 10 < sequential_calls
+        assert parallel * 10 < sequential
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
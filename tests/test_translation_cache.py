@@ -0,0 +1,257 @@
+"""
+Unit-тесты для _legacy/ai_translation/translation_cache.py
+Кэш переводов по хэшу нормализованного текста и пакетный перевод промахов
+"""
+
+import os
+import sys
+import json
+import asyncio
+import importlib.util
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, '_legacy', 'ai_translation'))
+
+from translation_cache import TranslationCache, LocalTranslationBackend, normalize_text, text_hash
+from tests.sqlite_supabase import SqliteSupabase
+
+
+TRANSLATION_CACHE_SCHEMA = """
+CREATE TABLE translation_cache (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text_hash TEXT NOT NULL,
+    source_lang TEXT NOT NULL,
+    target_lang TEXT NOT NULL,
+    source_text TEXT NOT NULL,
+    translated_text TEXT NOT NULL,
+    created_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+);
+CREATE UNIQUE INDEX idx_translation_cache_unique ON translation_cache (text_hash, source_lang, target_lang);
+"""
+
+
+def _load_ai_helper():
+    """Загружает настоящий ai_helper: другие тесты подменяют его в sys.modules"""
+    spec = importlib.util.spec_from_file_location(
+        'legacy_ai_helper', os.path.join(ROOT, '_legacy', 'ai_translation', 'ai_helper.py')
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def sqlite_db():
+    db = SqliteSupabase()
+    db.executescript(TRANSLATION_CACHE_SCHEMA)
+    return db
+
+
+class TestNormalization:
+    """Тесты ключа кэша"""
+
+    def test_whitespace_variants_share_hash(self):
+        """Отличия только в пробелах и переводах строк не меняют ключ"""
+        assert text_hash("  Привет,\tмир!\r\nКак дела? ") == text_hash("Привет, мир!\nКак дела?")
+        assert normalize_text("a  b \n  c") == "a b\nc"
+
+    def test_different_text_different_hash(self):
+        assert text_hash("Привет") != text_hash("Пока")
+
+
+class TestTranslationCache:
+    """Тесты TranslationCache с детерминированным бэкендом"""
+
+    def test_repeat_translation_costs_no_backend_calls(self):
+        """Повторный перевод того же текста обслуживается из памяти"""
+        backend = LocalTranslationBackend()
+        cache = TranslationCache(backend)
+
+        first = asyncio.run(cache.translate("Привет", "en", "ru"))
+        second = asyncio.run(cache.translate("  Привет ", "en", "ru"))
+
+        assert first == second == "[en] Привет"
+        assert backend.calls == 1
+
+    def test_misses_batched_into_single_request(self):
+        """Промахи одного вызова уходят в бэкенд одним пакетом, дубли — один раз"""
+        backend = LocalTranslationBackend()
+        cache = TranslationCache(backend, batch_size=50)
+
+        result = asyncio.run(cache.translate_many(["один", "два", "один", "", "три"], "en", "ru"))
+
+        assert result == ["[en] один", "[en] два", "[en] один", "", "[en] три"]
+        assert backend.calls == 1
+        assert backend.texts_translated == 3
+
+    def test_concurrent_callers_coalesced(self):
+        """Параллельные translate() объединяются в один запрос к бэкенду"""
+        backend = LocalTranslationBackend()
+        cache = TranslationCache(backend, batch_size=50)
+
+        async def run():
+            return await asyncio.gather(*(cache.translate(f"текст {i % 5}", "en", "ru") for i in range(20)))
+
+        result = asyncio.run(run())
+
+        assert result == [f"[en] текст {i % 5}" for i in range(20)]
+        assert backend.calls == 1
+        assert backend.texts_translated == 5
+
+    def test_backend_receives_original_formatting(self):
+        """Нормализуется только ключ кэша: в бэкенд уходит исходный текст с абзацами"""
+        backend = LocalTranslationBackend()
+        cache = TranslationCache(backend)
+        text = "Заголовок\r\n\r\n  Первый абзац.\n\nВторой  абзац."
+
+        assert asyncio.run(cache.translate(text, "en", "ru")) == f"[en] {text}"
+        assert asyncio.run(cache.translate(normalize_text(text), "en", "ru")) == f"[en] {text}"
+        assert backend.calls == 1
+
+    def test_batch_size_limits_request(self):
+        backend = LocalTranslationBackend()
+        cache = TranslationCache(backend, batch_size=4)
+        asyncio.run(cache.translate_many([f"t{i}" for i in range(10)], "en", "ru"))
+        assert backend.calls == 3
+
+    def test_target_language_is_part_of_key(self):
+        backend = LocalTranslationBackend()
+        cache = TranslationCache(backend)
+        assert asyncio.run(cache.translate("Привет", "en", "ru")) == "[en] Привет"
+        assert asyncio.run(cache.translate("Привет", "de", "ru")) == "[de] Привет"
+        assert backend.calls == 2
+
+    def test_lru_evicts_oldest(self):
+        backend = LocalTranslationBackend()
+        cache = TranslationCache(backend, max_entries=2)
+        asyncio.run(cache.translate_many(["a", "b"], "en", "ru"))
+        asyncio.run(cache.translate("a", "en", "ru"))
+        asyncio.run(cache.translate("c", "en", "ru"))
+
+        assert cache.get_cached(text_hash("a"), "en", "ru") == "[en] a"
+        assert cache.get_cached(text_hash("b"), "en", "ru") is None
+
+    def test_failed_translation_not_cached(self):
+        """Непереведённый текст возвращается как None и не кэшируется"""
+        backend = MagicMock()
+        backend.translate_batch = AsyncMock(side_effect=[[None], ["ok"]])
+        cache = TranslationCache(backend)
+
+        assert asyncio.run(cache.translate("текст", "en", "ru")) is None
+        assert asyncio.run(cache.translate("текст", "en", "ru")) == "ok"
+
+    def test_backend_error_resolves_all_waiters(self):
+        backend = MagicMock()
+        backend.translate_batch = AsyncMock(side_effect=Exception("api down"))
+        cache = TranslationCache(backend)
+        assert asyncio.run(cache.translate_many(["a", "b"], "en", "ru")) == [None, None]
+
+
+class TestTranslationCacheTable:
+    """translation_cache как второй уровень кэша"""
+
+    def test_new_process_reads_table_without_backend(self, sqlite_db):
+        """Перевод, сохранённый одним процессом, переиспользуется другим без обращения к бэкенду"""
+        texts = [f"новость {i}" for i in range(30)]
+        asyncio.run(TranslationCache(LocalTranslationBackend(), db_client=sqlite_db).translate_many(texts, "en", "ru"))
+        assert sqlite_db.conn.execute("SELECT COUNT(*) FROM translation_cache").fetchone()[0] == 30
+
+        backend = LocalTranslationBackend()
+        sqlite_db.reset_queries()
+        result = asyncio.run(TranslationCache(backend, db_client=sqlite_db).translate_many(texts, "en", "ru"))
+
+        assert result == [f"[en] {t}" for t in texts]
+        assert backend.calls == 0
+        assert sqlite_db.queries == [("select", "translation_cache")]
+
+    def test_partial_hits_translate_only_missing(self, sqlite_db):
+        asyncio.run(TranslationCache(LocalTranslationBackend(), db_client=sqlite_db).translate("старый", "en", "ru"))
+
+        backend = LocalTranslationBackend()
+        sqlite_db.reset_queries()
+        asyncio.run(TranslationCache(backend, db_client=sqlite_db).translate_many(["старый", "новый"], "en", "ru"))
+
+        assert backend.texts_translated == 1
+        assert sqlite_db.queries == [("select", "translation_cache"), ("upsert", "translation_cache")]
+
+    def test_db_errors_do_not_break_translation(self):
+        client = MagicMock()
+        client.from_.side_effect = Exception("db down")
+        backend = LocalTranslationBackend()
+        cache = TranslationCache(backend, db_client=client)
+        assert asyncio.run(cache.translate("текст", "en", "ru")) == "[en] текст"
+
+
+class TestTranslateTextAi:
+    """ai_helper.translate_text_ai поверх TranslationCache"""
+
+    def test_returns_original_on_failure(self):
+        ai_helper = _load_ai_helper()
+        backend = MagicMock()
+        backend.translate_batch = AsyncMock(return_value=[None])
+        with patch.object(ai_helper, '_translation_cache', TranslationCache(backend)):
+            assert asyncio.run(ai_helper.translate_text_ai("текст")) == "текст"
+
+    def test_batch_helper_uses_one_backend_call(self):
+        ai_helper = _load_ai_helper()
+        backend = LocalTranslationBackend()
+        with patch.object(ai_helper, '_translation_cache', TranslationCache(backend)):
+            result = asyncio.run(ai_helper.translate_texts_ai(["a", "b", "c"], target_lang="en", source_lang="ru"))
+        assert result == ["[en] a", "[en] b", "[en] c"]
+        assert backend.calls == 1
+
+    def test_assistant_batch_parses_json_array(self):
+        ai_helper = _load_ai_helper()
+        assistant = ai_helper.AIAssistant(api_key="test-key")
+        completion = MagicMock()
+        completion.choices[0].message.content = '```json\n["one", "two"]\n```'
+        assistant.client = MagicMock()
+        assistant.client.chat.completions.create.return_value = completion
+
+        result = asyncio.run(assistant.translate_batch(["один", "два"], "en", "ru"))
+
+        assert result == ["one", "two"]
+        assert assistant.client.chat.completions.create.call_count == 1
+
+    def test_default_batch_stays_within_token_budget(self):
+        """Пакет из TRANSLATION_BATCH_SIZE новостей не запрашивает больше OPENAI_BATCH_MAX_TOKENS"""
+        ai_helper = _load_ai_helper()
+        assistant = ai_helper.AIAssistant(api_key="test-key")
+        assistant.max_tokens, assistant.batch_max_tokens = 500, 4096
+
+        def create(**kwargs):
+            count = len(json.loads(kwargs['messages'][1]['content'].rsplit('\n', 1)[-1]))
+            completion = MagicMock()
+            completion.choices[0].message.content = json.dumps([f"t{i}" for i in range(count)])
+            return completion
+
+        assistant.client = MagicMock()
+        assistant.client.chat.completions.create.side_effect = create
+        texts = [f"Новость {i}. " + "Текст новости. " * 40 for i in range(20)]
+
+        result = asyncio.run(assistant.translate_batch(texts, "en", "ru"))
+
+        calls = assistant.client.chat.completions.create.call_args_list
+        assert all(call.kwargs['max_tokens'] <= 4096 for call in calls)
+        assert 1 < len(calls) < len(texts)
+        assert len(result) == 20 and None not in result
+
+    def test_short_texts_share_one_request(self):
+        ai_helper = _load_ai_helper()
+        assistant = ai_helper.AIAssistant(api_key="test-key")
+        completion = MagicMock()
+        completion.choices[0].message.content = json.dumps([f"t{i}" for i in range(20)])
+        assistant.client = MagicMock()
+        assistant.client.chat.completions.create.return_value = completion
+
+        asyncio.run(assistant.translate_batch([f"слово {i}" for i in range(20)], "en", "ru"))
+
+        assert assistant.client.chat.completions.create.call_count == 1
+        assert assistant.client.chat.completions.create.call_args.kwargs['max_tokens'] <= assistant.batch_max_tokens
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
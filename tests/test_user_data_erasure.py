@@ -0,0 +1,205 @@
+"""
+Unit-тесты для очереди GDPR-удаления (user_data_erasure.py и SupabaseManager.delete_user_data)
+"""
+
+import os
+import time
+import pytest
+from unittest.mock import patch
+from supabase_manager import SupabaseManager
+from user_data_erasure import UserDataEraser, ERASURE_STEPS, DELETED_USER_ID
+from tests.sqlite_supabase import SqliteSupabase
+
+
+ERASURE_SCHEMA = """
+CREATE TABLE clients (chat_id TEXT PRIMARY KEY, name TEXT);
+CREATE TABLE partners (chat_id TEXT PRIMARY KEY, name TEXT);
+CREATE TABLE transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    client_chat_id TEXT, partner_chat_id TEXT, total_amount REAL, description TEXT
+);
+CREATE INDEX idx_transactions_client_chat_id ON transactions(client_chat_id);
+CREATE INDEX idx_transactions_partner_chat_id ON transactions(partner_chat_id);
+CREATE TABLE partner_applications (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id TEXT);
+CREATE INDEX idx_partner_applications_chat_id ON partner_applications(chat_id);
+CREATE TABLE services (id INTEGER PRIMARY KEY AUTOINCREMENT, partner_chat_id TEXT, title TEXT);
+CREATE INDEX idx_services_partner_chat_id ON services(partner_chat_id);
+CREATE TABLE promotions (id INTEGER PRIMARY KEY AUTOINCREMENT, partner_chat_id TEXT, title TEXT);
+CREATE INDEX idx_promotions_partner_chat_id ON promotions(partner_chat_id);
+CREATE TABLE gdpr_erasure_requests (
+    chat_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    requested_by TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    requested_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now')),
+    completed_at TEXT
+);
+"""
+
+
+def _erasure_manager(clients: int, transactions_per_client: int = 3) -> SupabaseManager:
+    db = SqliteSupabase()
+    db.executescript(ERASURE_SCHEMA)
+    db.conn.execute("INSERT INTO partners VALUES ('P1', 'Салон')")
+    db.conn.execute("INSERT INTO services (partner_chat_id, title) VALUES ('P1', 'Стрижка')")
+    db.conn.execute("INSERT INTO promotions (partner_chat_id, title) VALUES ('P1', 'Скидка')")
+    db.conn.execute("INSERT INTO partner_applications (chat_id) VALUES ('P1')")
+    db.conn.executemany('INSERT INTO clients VALUES (?, ?)', ((f'C{i:05d}', f'client {i}') for i in range(clients)))
+    db.conn.executemany(
+        'INSERT INTO transactions (client_chat_id, partner_chat_id, total_amount, description) VALUES (?, ?, ?, ?)',
+        ((f'C{i:05d}', 'P1', 10.0, 'покупка') for i in range(clients) for _ in range(transactions_per_client))
+    )
+    db.conn.commit()
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _erase_user_data_batch(db: SqliteSupabase, params: dict) -> dict:
+    """Аналог RPC erase_user_data_batch (одна транзакция SQLite)"""
+    ids = params['p_chat_ids']
+    marks = ', '.join('?' for _ in ids)
+    with db.conn:
+        for _, table, column, anonymize in ERASURE_STEPS:
+            if anonymize:
+                assignments = ', '.join(f'"{c}" = ?' for c in anonymize)
+                db.conn.execute(f'UPDATE {table} SET {assignments} WHERE {column} IN ({marks})', [*anonymize.values(), *ids])
+            else:
+                db.conn.execute(f'DELETE FROM {table} WHERE {column} IN ({marks})', ids)
+    return {key: 'anonymized' if anonymize else 'deleted' for key, _, _, anonymize in ERASURE_STEPS}
+
+
+def _count(manager: SupabaseManager, sql: str) -> int:
+    return manager.client.conn.execute(sql).fetchone()[0]
+
+
+class TestErasureQueue:
+    """Тесты enqueue_user_erasure / process_erasure_queue"""
+
+    def test_batch_erases_all_users_with_set_based_queries(self):
+        manager = _erasure_manager(1000)
+        manager.user_data_eraser = UserDataEraser(manager, batch_size=500)
+        ids = [f'C{i:05d}' for i in range(1000)]
+
+        assert manager.enqueue_user_erasure(ids + ids[:10], requested_by='admin') == 1000
+        manager.client.reset_queries()
+        stats = manager.process_erasure_queue()
+
+        assert stats == {'batches': 2, 'completed': 1000, 'failed': 0}
+        assert _count(manager, 'SELECT COUNT(*) FROM clients') == 0
+        assert _count(manager, f"SELECT COUNT(*) FROM transactions WHERE client_chat_id = '{DELETED_USER_ID}'") == 3000
+        assert _count(manager, "SELECT COUNT(*) FROM gdpr_erasure_requests WHERE status = 'completed'") == 1000
+        # Партнёр, у которого были эти клиенты, не затронут
+        assert _count(manager, "SELECT COUNT(*) FROM partners") == 1
+        # На пачку из 500: выборка очереди, попытка RPC, 3 chunk по 200 на шаг и на отметку выполнения
+        assert manager.client.query_count == 2 * (1 + 1 + len(ERASURE_STEPS) * 3 + 3) + 1
+
+    def test_pending_not_duplicated_and_completed_requeued(self):
+        """Повторный запрос ожидающего не дублируется, выполненный снова ставится в очередь"""
+        manager = _erasure_manager(5)
+        manager.enqueue_user_erasure(['C00000'])
+        manager.process_erasure_queue()
+        # Пользователь зарегистрировался заново и снова просит удалить данные
+        manager.client.conn.execute("INSERT INTO clients (chat_id, name) VALUES ('C00000', 'again')")
+        manager.client.conn.execute("UPDATE gdpr_erasure_requests SET attempts = 2 WHERE chat_id = 'C00000'")
+        manager.client.conn.commit()
+
+        manager.enqueue_user_erasure(['C00000', 'C00001'], requested_by='support')
+        manager.enqueue_user_erasure(['C00001'])
+        assert manager.client.conn.execute(
+            'SELECT chat_id, status, attempts, completed_at, requested_by FROM gdpr_erasure_requests ORDER BY chat_id'
+        ).fetchall() == [('C00000', 'pending', 0, None, 'support'), ('C00001', 'pending', 0, None, 'support')]
+        stats = manager.process_erasure_queue()
+
+        assert stats['completed'] == 2
+        assert _count(manager, "SELECT COUNT(*) FROM clients") == 3
+
+    def test_failed_batch_retried_on_next_pass(self):
+        """Ошибка критичного шага: клиенты не удаляются, пачка остаётся pending и повторяется"""
+        manager = _erasure_manager(10)
+        manager.enqueue_user_erasure([f'C{i:05d}' for i in range(10)])
+        manager.client.conn.execute('ALTER TABLE transactions RENAME TO transactions_tmp')
+
+        stats = manager.process_erasure_queue()
+
+        assert stats == {'batches': 1, 'completed': 0, 'failed': 10}
+        assert _count(manager, "SELECT COUNT(*) FROM clients") == 10
+        assert _count(manager, "SELECT MIN(attempts) FROM gdpr_erasure_requests WHERE status = 'pending'") == 1
+        assert 'transactions' in manager.client.conn.execute('SELECT last_error FROM gdpr_erasure_requests LIMIT 1').fetchone()[0]
+
+        manager.client.conn.execute('ALTER TABLE transactions_tmp RENAME TO transactions')
+        stats = manager.process_erasure_queue()
+
+        assert stats['completed'] == 10
+        assert _count(manager, "SELECT COUNT(*) FROM clients") == 0
+
+    def test_uses_transactional_rpc_when_available(self):
+        manager = _erasure_manager(50)
+        manager.client.register_rpc('erase_user_data_batch', _erase_user_data_batch)
+        manager.enqueue_user_erasure([f'C{i:05d}' for i in range(50)])
+        manager.client.reset_queries()
+
+        manager.process_erasure_queue()
+
+        assert manager.client.queries == [
+            ('select', 'gdpr_erasure_requests'),
+            ('rpc', 'erase_user_data_batch'),
+            ('update', 'gdpr_erasure_requests'),
+            ('select', 'gdpr_erasure_requests'),
+        ]
+        assert _count(manager, "SELECT COUNT(*) FROM clients") == 0
+
+
+class TestDeleteUserData:
+    """delete_user_data сохраняет прежний формат ответа"""
+
+    def test_single_user_report(self):
+        manager = _erasure_manager(3)
+
+        result = manager.delete_user_data('P1')
+
+        assert result['success'] is True
+        assert result['tables_deleted'] == {
+            'services': 'deleted', 'promotions': 'deleted', 'transactions': 'anonymized',
+            'partner_applications': 'deleted', 'partners': 'deleted', 'clients': 'deleted'
+        }
+        assert _count(manager, f"SELECT COUNT(*) FROM transactions WHERE partner_chat_id = '{DELETED_USER_ID}'") == 9
+        assert _count(manager, "SELECT COUNT(*) FROM services") == 0
+
+    def test_transactions_error_marks_failure(self):
+        manager = _erasure_manager(3)
+        manager.client.conn.execute('DROP TABLE transactions')
+
+        result = manager.delete_user_data('C00000')
+
+        assert result['success'] is False
+        assert result['tables_deleted']['transactions'].startswith('error')
+
+    @pytest.mark.slow
+    def test_benchmark_erase_10k_users(self):
+        """Бенчмарк: удаление 10k клиентов — по одному против очереди пачками"""
+        ids = [f'C{i:05d}' for i in range(10_000)]
+
+        manager = _erasure_manager(10_000)
+        started = time.perf_counter()
+        for chat_id in ids:
+            manager.delete_user_data(chat_id)
+        single_time, single_queries = time.perf_counter() - started, manager.client.query_count
+
+        manager = _erasure_manager(10_000)
+        manager.enqueue_user_erasure(ids)
+        manager.client.reset_queries()
+        started = time.perf_counter()
+        stats = manager.process_erasure_queue()
+        batch_time, batch_queries = time.perf_counter() - started, manager.client.query_count
+
+        assert stats['completed'] == 10_000
+        assert _count(manager, 'SELECT COUNT(*) FROM clients') == 0
+        assert batch_queries * 50 < single_queries
+        assert batch_time < single_time
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
@@ -0,0 +1,192 @@
+"""
+Unit-тесты для GDPR-экспорта (user_data_export.py и SupabaseManager.export_user_data*)
+"""
+
+import os
+import json
+import time
+import zipfile
+import threading
+import tracemalloc
+import pytest
+from unittest.mock import patch
+from supabase_manager import SupabaseManager
+from user_data_export import UserDataExporter, EXPORT_SECTIONS
+from tests.sqlite_supabase import SqliteSupabase
+
+
+GDPR_SCHEMA = """
+CREATE TABLE clients (chat_id TEXT PRIMARY KEY, name TEXT, balance REAL);
+CREATE TABLE partners (chat_id TEXT PRIMARY KEY, name TEXT);
+CREATE TABLE transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    client_chat_id TEXT, partner_chat_id TEXT, total_amount REAL, earned_points REAL, description TEXT
+);
+CREATE INDEX idx_tx_client ON transactions(client_chat_id, id);
+CREATE INDEX idx_tx_partner ON transactions(partner_chat_id, id);
+CREATE TABLE partner_applications (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id TEXT, status TEXT);
+CREATE TABLE services (id INTEGER PRIMARY KEY AUTOINCREMENT, partner_chat_id TEXT, title TEXT);
+CREATE TABLE promotions (id INTEGER PRIMARY KEY AUTOINCREMENT, partner_chat_id TEXT, title TEXT);
+CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, client_chat_id TEXT, partner_chat_id TEXT, message_text TEXT);
+CREATE TABLE referral_tree (id INTEGER PRIMARY KEY AUTOINCREMENT, referrer_chat_id TEXT, referred_chat_id TEXT, level INTEGER);
+CREATE TABLE referral_rewards (id INTEGER PRIMARY KEY AUTOINCREMENT, referrer_chat_id TEXT, referred_chat_id TEXT, points REAL);
+CREATE TABLE nps_ratings (id INTEGER PRIMARY KEY AUTOINCREMENT, client_chat_id TEXT, partner_chat_id TEXT, rating INTEGER);
+"""
+
+
+def _gdpr_manager(transactions: int = 25) -> SupabaseManager:
+    db = SqliteSupabase()
+    db.executescript(GDPR_SCHEMA)
+    db.conn.executescript("""
+        INSERT INTO clients VALUES ('100', 'Анна', 12.5), ('200', 'Борис', 0);
+        INSERT INTO partners VALUES ('100', 'Салон Анны');
+        INSERT INTO partner_applications (chat_id, status) VALUES ('100', 'Approved');
+        INSERT INTO services (partner_chat_id, title) VALUES ('100', 'Стрижка'), ('300', 'Чужая');
+        INSERT INTO promotions (partner_chat_id, title) VALUES ('100', 'Скидка');
+        INSERT INTO messages (client_chat_id, partner_chat_id, message_text) VALUES ('100', '300', 'привет'), ('200', '100', 'здравствуйте');
+        INSERT INTO referral_tree (referrer_chat_id, referred_chat_id, level) VALUES ('100', '200', 1), ('400', '100', 1);
+        INSERT INTO referral_rewards (referrer_chat_id, referred_chat_id, points) VALUES ('100', '200', 5);
+        INSERT INTO nps_ratings (client_chat_id, partner_chat_id, rating) VALUES ('100', '300', 9);
+    """)
+    db.conn.executemany(
+        'INSERT INTO transactions (client_chat_id, partner_chat_id, total_amount, earned_points, description) VALUES (?, ?, ?, ?, ?)',
+        (('100' if i % 2 else '200', '300' if i % 5 else '100', float(i), i / 10, 'x' * 100) for i in range(1, transactions + 1))
+    )
+    db.conn.commit()
+    with patch.dict(os.environ, {}, clear=True):
+        manager = SupabaseManager()
+    manager.client = db
+    return manager
+
+
+def _read_archive(path: str) -> tuple:
+    with zipfile.ZipFile(path) as archive:
+        manifest = json.loads(archive.read('manifest.json'))
+        sections = {
+            name[:-len('.jsonl')]: [json.loads(line) for line in archive.read(name).decode('utf-8').splitlines()]
+            for name in archive.namelist() if name.endswith('.jsonl')
+        }
+    return manifest, sections
+
+
+class TestUserDataArchive:
+    """Тесты export_user_data_archive"""
+
+    def test_archive_contains_all_sections_and_manifest(self, tmp_path):
+        manager = _gdpr_manager(25)
+
+        path = manager.export_user_data_archive('100', output_dir=str(tmp_path))
+
+        manifest, sections = _read_archive(path)
+        assert manifest['chat_id'] == '100'
+        assert manifest['complete'] is True
+        assert {s['name'] for s in manifest['sections']} == {name for name, *_ in EXPORT_SECTIONS}
+        rows = {s['name']: s['rows'] for s in manifest['sections']}
+        assert rows['transactions'] == 13
+        assert rows['partner_transactions'] == 5
+        assert rows['messages_as_client'] == rows['messages_as_partner'] == 1
+        assert rows['referrals'] == rows['referred_by'] == 1
+        assert rows['nps_ratings'] == 1
+        assert rows['partner_services'] == 1
+        assert sections['client_data'] == [{'chat_id': '100', 'name': 'Анна', 'balance': 12.5}]
+        assert [row['id'] for row in sections['transactions']] == list(range(1, 26, 2))
+        assert os.listdir(tmp_path) == [os.path.basename(path)]
+
+    def test_sections_paginated(self, tmp_path):
+        """Раздел читается страницами: в памяти не больше page_size строк"""
+        manager = _gdpr_manager(25)
+        manager.user_data_exporter = UserDataExporter(manager, page_size=4, max_workers=1)
+
+        path = manager.export_user_data_archive('100', output_dir=str(tmp_path))
+
+        _, sections = _read_archive(path)
+        assert len(sections['transactions']) == 13
+        assert manager.client.queries.count(('select', 'transactions')) == 4 + 2
+
+    def test_sections_fetched_concurrently(self, tmp_path):
+        manager = _gdpr_manager(5)
+        exporter = UserDataExporter(manager, max_workers=4)
+        original = exporter.iter_section
+        active = {'now': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def slow_section(*args):
+            with lock:
+                active['now'] += 1
+                active['max'] = max(active['max'], active['now'])
+            time.sleep(0.02)
+            try:
+                yield from original(*args)
+            finally:
+                with lock:
+                    active['now'] -= 1
+
+        exporter.iter_section = slow_section
+        exporter.export_to_archive('100', str(tmp_path))
+
+        assert active['max'] == 4
+
+    def test_failed_section_marked_in_manifest(self, tmp_path):
+        manager = _gdpr_manager(5)
+        manager.client.conn.execute('DROP TABLE nps_ratings')
+
+        path = manager.export_user_data_archive('100', output_dir=str(tmp_path))
+
+        manifest, _ = _read_archive(path)
+        assert manifest['complete'] is False
+        failed = [s for s in manifest['sections'] if 'error' in s]
+        assert [s['name'] for s in failed] == ['nps_ratings']
+
+    def test_no_client_returns_none(self):
+        with patch.dict(os.environ, {}, clear=True):
+            manager = SupabaseManager()
+        manager.client = None
+        assert manager.export_user_data_archive('100') is None
+
+
+class TestExportUserData:
+    """export_user_data сохраняет прежний формат ответа"""
+
+    def test_legacy_shape(self):
+        manager = _gdpr_manager(10)
+
+        data = manager.export_user_data('100')
+
+        assert data['client_data']['name'] == 'Анна'
+        assert data['partner_data']['name'] == 'Салон Анны'
+        assert len(data['transactions']) == 5
+        assert len(data['partner_transactions']) == 2
+        assert [s['title'] for s in data['partner_services']] == ['Стрижка']
+        assert data['partner_applications'][0]['status'] == 'Approved'
+
+    def test_non_partner_has_no_partner_sections(self):
+        manager = _gdpr_manager(10)
+        data = manager.export_user_data('200')
+        assert data['partner_data'] is None
+        assert 'partner_services' not in data
+        assert 'partner_promotions' not in data
+
+    @pytest.mark.slow
+    def test_benchmark_archive_memory_bounded(self, tmp_path):
+        """Бенчмарк: 200k транзакций — пиковая память архива против словаря"""
+        manager = _gdpr_manager(200_000)
+
+        def measure(call):
+            tracemalloc.start()
+            started = time.perf_counter()
+            result = call()
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return result, elapsed, peak
+
+        data, dict_time, dict_peak = measure(lambda: manager.export_user_data('100'))
+        path, archive_time, archive_peak = measure(lambda: manager.export_user_data_archive('100', str(tmp_path)))
+
+        assert len(data['transactions']) == 100_000
+        assert zipfile.is_zipfile(path)
+        assert archive_peak * 10 < dict_peak
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
@@ -0,0 +1,163 @@
+import datetime
+import logging
+import os
+import threading
+import time
+from decimal import Decimal
+from typing import Callable, Optional
+
+
+# Последний резерв, если ни один источник недоступен и кешированный курс слишком стар
+DEFAULT_TON_USD_RATE = Decimal('5.00')
+
+
+def _timestamp(moment) -> Optional[float]:
+    if moment is None:
+        return None
+    if isinstance(moment, (int, float)):
+        return float(moment)
+    if isinstance(moment, str):
+        moment = datetime.datetime.fromisoformat(moment.replace('Z', '+00:00'))
+    # Наивное время (TIMESTAMP без зоны) записывалось через datetime.now() — локальное
+    return moment.timestamp()
+
+
+class CircuitBreaker:
+    """
+    Предохранитель источника курса: после failure_threshold ошибок подряд источник
+    пропускается на время backoff, которое удваивается при каждом повторном размыкании
+    (не больше max_backoff). По истечении паузы пропускается одна пробная попытка.
+    """
+
+    def __init__(self, failure_threshold: int = 3, backoff: float = 30.0, max_backoff: float = 900.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = max(1, failure_threshold)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.failures = 0
+        self.trips = 0
+        self.open_until: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.open_until is None:
+            return 'closed'
+        return 'open' if self.clock() < self.open_until else 'half_open'
+
+    def allow(self) -> bool:
+        return self.state != 'open'
+
+    def record_success(self):
+        self.failures = 0
+        self.trips = 0
+        self.open_until = None
+
+    def record_failure(self):
+        self.failures += 1
+        # Пробная попытка после паузы не удалась — размыкаем сразу
+        if self.open_until is not None or self.failures >= self.failure_threshold:
+            self.trips += 1
+            pause = min(self.max_backoff, self.backoff * (2 ** (self.trips - 1)))
+            self.open_until = self.clock() + pause
+            self.failures = 0
+
+
+class TONExchangeRateProvider:
+    """
+    Курс TON/USD с кешем в памяти и предохранителем на каждый источник.
+
+    Источники опрашиваются по порядку: fetch() возвращает курс или (курс, время получения).
+    Свежий курс (не старше ttl) отдаётся из кеша без обращения к источникам. Если все
+    источники недоступны, отдаётся последний известный курс не старше max_stale_age
+    (stale=True), и только затем — DEFAULT_TON_USD_RATE.
+
+    quote() возвращает dict: rate, source, fetched_at (UTC), stale.
+    """
+
+    def __init__(self, sources: list, ttl: Optional[float] = None, max_stale_age: Optional[float] = None,
+                 failure_threshold: Optional[int] = None, backoff: Optional[float] = None,
+                 max_backoff: Optional[float] = None, clock: Callable[[], float] = time.time,
+                 on_fetch: Optional[Callable[[dict], None]] = None):
+        self.sources = list(sources)
+        # Сколько секунд курс считается свежим
+        self.ttl = float(ttl if ttl is not None else os.getenv("TON_RATE_CACHE_TTL", "60"))
+        # Насколько старый курс допустимо отдать, когда все источники недоступны
+        self.max_stale_age = float(max_stale_age if max_stale_age is not None else os.getenv("TON_RATE_MAX_STALE_AGE", "3600"))
+        failure_threshold = int(failure_threshold if failure_threshold is not None else os.getenv("TON_RATE_BREAKER_FAILURES", "3"))
+        backoff = float(backoff if backoff is not None else os.getenv("TON_RATE_BREAKER_BACKOFF", "30"))
+        max_backoff = float(max_backoff if max_backoff is not None else os.getenv("TON_RATE_BREAKER_MAX_BACKOFF", "900"))
+        self.clock = clock
+        self.on_fetch = on_fetch
+        self.breakers = {
+            name: CircuitBreaker(failure_threshold, backoff, max_backoff, clock=clock)
+            for name, _fetch in self.sources
+        }
+        self._cached: Optional[dict] = None
+        self._cached_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def quote(self) -> dict:
+        with self._lock:
+            now = self.clock()
+            if self._cached is not None and now - self._cached_at < self.ttl:
+                return dict(self._cached)
+
+            fallback = [(self._cached_at, self._cached)] if self._cached is not None else []
+            for name, fetch in self.sources:
+                breaker = self.breakers[name]
+                if not breaker.allow():
+                    continue
+                try:
+                    result = fetch()
+                    rate, fetched_at = result if isinstance(result, tuple) else (result, None)
+                    if rate is None:
+                        continue
+                    rate = Decimal(str(rate))
+                    if rate <= 0:
+                        raise ValueError(f"invalid rate {rate}")
+                except Exception as e:
+                    breaker.record_failure()
+                    logging.warning(f"Не удалось получить курс TON/USD из {name} ({breaker.state}): {e}")
+                    continue
+                breaker.record_success()
+
+                fetched_ts = _timestamp(fetched_at) if fetched_at is not None else now
+                quote = self._quote(rate, name, fetched_ts, stale=False)
+                if now - fetched_ts > self.ttl:
+                    # Источник ответил, но курс в нём устарел (например, последняя запись в БД)
+                    fallback.append((fetched_ts, quote))
+                    continue
+
+                self._cached, self._cached_at = quote, fetched_ts
+                if self.on_fetch:
+                    try:
+                        self.on_fetch(dict(quote))
+                    except Exception as e:
+                        logging.error(f"Ошибка при сохранении курса TON/USD из {name}: {e}")
+                return dict(quote)
+
+            fresh_enough = [(ts, q) for ts, q in fallback if now - ts <= self.max_stale_age]
+            if fresh_enough:
+                fetched_ts, quote = max(fresh_enough, key=lambda item: item[0])
+                logging.warning(
+                    f"Источники курса TON/USD недоступны, использую курс {quote['source']} "
+                    f"возрастом {int(now - fetched_ts)} с: {quote['rate']}"
+                )
+                return {**quote, 'stale': True}
+
+            logging.error(f"Все источники курса недоступны, использую дефолтный: {DEFAULT_TON_USD_RATE}")
+            return self._quote(DEFAULT_TON_USD_RATE, 'default', now, stale=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._cached, self._cached_at = None, None
+
+    @staticmethod
+    def _quote(rate: Decimal, source: str, fetched_ts: float, stale: bool) -> dict:
+        return {
+            'rate': rate,
+            'source': source,
+            'fetched_at': datetime.datetime.fromtimestamp(fetched_ts, tz=datetime.timezone.utc),
+            'stale': stale,
+        }
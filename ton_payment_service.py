@@ -7,6 +7,7 @@ from decimal import Decimal
 from typing import List, Dict, Optional
 from datetime import datetime
 from supabase_manager import SupabaseManager
+from ton_exchange_rate import TONExchangeRateProvider
 
 # Пока используем requests для TON Center API
 # В будущем можно перейти на pytonlib для работы с кошельками
@@ -48,71 +49,73 @@ class TONPaymentService:
             logger.warning("TON_WALLET_ADDRESS не установлен в переменных окружения")
         if not self.wallet_seed:
             logger.warning("TON_WALLET_SEED не установлен в переменных окружения (КРИТИЧНО для отправки транзакций!)")
+        
+        self.rate_provider = TONExchangeRateProvider(
+            sources=[
+                ('database', self._fetch_database_rate),
+                ('binance', self._fetch_binance_rate),
+                ('coingecko', self._fetch_coingecko_rate),
+            ],
+            on_fetch=self._on_rate_fetched
+        )
     
     def get_ton_exchange_rate(self) -> Decimal:
         """
         Получает актуальный курс TON/USD
         
-        Сначала пытается получить из БД, если нет - из внешнего API
-        
         Returns:
             Decimal: Курс TON/USD (1 TON = X USD)
         """
-        try:
-            # 1. Попробовать получить из БД (последний актуальный)
-            result = self.db.client.table('ton_exchange_rates').select('rate').is_(
-                'effective_until', 'null'
-            ).order('effective_from', desc=True).limit(1).execute()
-            
-            if result.data and len(result.data) > 0:
-                rate = Decimal(str(result.data[0]['rate']))
-                logger.debug(f"Курс TON/USD из БД: {rate}")
-                return rate
-        except Exception as e:
-            logger.warning(f"Не удалось получить курс из БД: {e}")
+        return self.get_ton_exchange_quote()['rate']
+    
+    def get_ton_exchange_quote(self) -> Dict[str, any]:
+        """
+        Получает курс TON/USD вместе с источником
         
-        # 2. Получить из внешнего API (Binance)
-        try:
-            response = requests.get(
-                'https://api.binance.com/api/v3/ticker/price?symbol=TONUSDT',
-                timeout=5
-            )
-            if response.status_code == 200:
-                data = response.json()
-                price_usdt = Decimal(str(data['price']))
-                # USDT ≈ USD
-                rate = price_usdt
-                
-                # Сохранить в БД
-                self._save_ton_exchange_rate(rate, 'binance')
-                
-                logger.info(f"Курс TON/USD из Binance: {rate}")
-                return rate
-        except Exception as e:
-            logger.warning(f"Не удалось получить курс из Binance: {e}")
+        Источники: БД (последний сохранённый курс), Binance, CoinGecko. Курс кешируется
+        в памяти, недоступные источники временно пропускаются (см. ton_exchange_rate.py)
         
-        # 3. Fallback на CoinGecko
-        try:
-            response = requests.get(
-                'https://api.coingecko.com/api/v3/simple/price?ids=the-open-network&vs_currencies=usd',
-                timeout=5
-            )
-            if response.status_code == 200:
-                data = response.json()
-                rate = Decimal(str(data['the-open-network']['usd']))
-                
-                # Сохранить в БД
-                self._save_ton_exchange_rate(rate, 'coingecko')
-                
-                logger.info(f"Курс TON/USD из CoinGecko: {rate}")
-                return rate
-        except Exception as e:
-            logger.warning(f"Не удалось получить курс из CoinGecko: {e}")
+        Returns:
+            Dict с ключами:
+                - rate: Курс TON/USD
+                - source: Источник (database, binance, coingecko, default)
+                - fetched_at: Когда курс получен из источника (UTC)
+                - stale: True, если отдан устаревший курс из-за недоступности источников
+        """
+        return self.rate_provider.quote()
+    
+    def _fetch_database_rate(self):
+        """Последний актуальный курс из БД и время, с которого он действует"""
+        result = self.db.client.table('ton_exchange_rates').select('rate, effective_from').is_(
+            'effective_until', 'null'
+        ).order('effective_from', desc=True).limit(1).execute()
         
-        # 4. Fallback на дефолтный курс (если все API недоступны)
-        default_rate = Decimal('5.00')  # Примерный курс (нужно обновлять вручную)
-        logger.error(f"Все источники курса недоступны, использую дефолтный: {default_rate}")
-        return default_rate
+        if not result.data:
+            return None
+        return Decimal(str(result.data[0]['rate'])), result.data[0].get('effective_from')
+    
+    def _fetch_binance_rate(self) -> Decimal:
+        response = requests.get(
+            'https://api.binance.com/api/v3/ticker/price?symbol=TONUSDT',
+            timeout=5
+        )
+        response.raise_for_status()
+        # USDT ≈ USD
+        return Decimal(str(response.json()['price']))
+    
+    def _fetch_coingecko_rate(self) -> Decimal:
+        response = requests.get(
+            'https://api.coingecko.com/api/v3/simple/price?ids=the-open-network&vs_currencies=usd',
+            timeout=5
+        )
+        response.raise_for_status()
+        return Decimal(str(response.json()['the-open-network']['usd']))
+    
+    def _on_rate_fetched(self, quote: Dict[str, any]):
+        """Сохраняет в БД курс, полученный из внешнего API"""
+        if quote['source'] != 'database':
+            logger.info(f"Курс TON/USD из {quote['source']}: {quote['rate']}")
+            self._save_ton_exchange_rate(quote['rate'], quote['source'])
     
     def _save_ton_exchange_rate(self, rate: Decimal, source: str):
         """
@@ -149,15 +152,20 @@ class TONPaymentService:
                 - ton_amount: Сумма в TON
                 - amount_nano: Сумма в нанотонах
                 - exchange_rate: Использованный курс
+                - rate_source: Источник курса
+                - rate_fetched_at: Когда курс получен из источника
         """
-        exchange_rate = self.get_ton_exchange_rate()
+        quote = self.get_ton_exchange_quote()
+        exchange_rate = quote['rate']
         ton_amount = amount_usd / exchange_rate
         amount_nano = int(ton_amount * NANO_TON)
         
         return {
             'ton_amount': ton_amount,
             'amount_nano': amount_nano,
-            'exchange_rate': exchange_rate
+            'exchange_rate': exchange_rate,
+            'rate_source': quote['source'],
+            'rate_fetched_at': quote['fetched_at']
         }
     
     def send_ton_payment(
@@ -300,6 +308,8 @@ class TONPaymentService:
                 'amount_nano': amount_nano,
                 'ton_amount': float(ton_amount),
                 'exchange_rate': float(exchange_rate),
+                'exchange_rate_source': conversion['rate_source'],
+                'exchange_rate_fetched_at': conversion['rate_fetched_at'].isoformat(),
                 'ton_tx_hash': payment_result['tx_hash'],
                 'ton_tx_lt': payment_result.get('tx_lt'),
                 'ton_block_seqno': payment_result.get('block_seqno'),
@@ -408,6 +418,8 @@ class TONPaymentService:
                 'amount_nano': amount_nano,
                 'ton_amount': float(ton_amount),
                 'exchange_rate': float(exchange_rate),
+                'exchange_rate_source': conversion['rate_source'],
+                'exchange_rate_fetched_at': conversion['rate_fetched_at'].isoformat(),
                 'ton_tx_hash': payment_result['tx_hash'],
                 'ton_tx_lt': payment_result.get('tx_lt'),
                 'ton_block_seqno': payment_result.get('block_seqno'),
@@ -0,0 +1,425 @@
+import datetime
+import logging
+import os
+from decimal import Decimal
+from typing import Iterable, Optional
+
+
+NANO_TON = 1_000_000_000
+
+# Выплата зафиксирована в блокчейне — повторно не отправляется.
+# Записи в 'pending'/'sending' могли уйти в сеть без записи результата — их сверяют вручную
+SETTLED_STATUSES = ('sent', 'confirmed')
+
+PAYMENT_COLUMNS = 'id, partner_chat_id, final_amount, amount_usd'
+
+
+def payout_idempotency_key(payment_type: str, source_id) -> str:
+    """Ключ идемпотентности выплаты: один источник (запись начисления) — не больше одной выплаты."""
+    return f"{payment_type}:{source_id}"
+
+
+def aggregate_pending_commissions(rewards: Iterable[dict]) -> list:
+    """Суммирует комиссии по получателю (строки referral_rewards: id, referrer_chat_id, amount_usd)."""
+    totals: dict = {}
+    for reward in rewards:
+        partner_chat_id = str(reward['referrer_chat_id'])
+        total = totals.get(partner_chat_id)
+        if total is None:
+            total = totals[partner_chat_id] = {
+                'referrer_chat_id': partner_chat_id, 'total_usd': Decimal('0'), 'rewards_count': 0,
+                'min_reward_id': reward['id'], 'max_reward_id': reward['id']
+            }
+        total['total_usd'] += Decimal(str(reward.get('amount_usd') or 0))
+        total['rewards_count'] += 1
+        total['min_reward_id'] = min(total['min_reward_id'], reward['id'])
+        total['max_reward_id'] = max(total['max_reward_id'], reward['id'])
+    return list(totals.values())
+
+
+class TONServiceWallet:
+    """
+    Кошелёк по умолчанию: отправляет сообщения пачки через TONPaymentService.send_ton_payment.
+    Бэкенд кошелька принимает пачку сообщений и возвращает результаты в том же порядке.
+    """
+
+    def __init__(self, ton_service):
+        self.ton_service = ton_service
+
+    @property
+    def address(self) -> Optional[str]:
+        return self.ton_service.wallet_address
+
+    def send_batch(self, messages: list) -> list:
+        return [
+            self.ton_service.send_ton_payment(
+                to_address=message['to_address'],
+                amount_nano=message['amount_nano'],
+                comment=message.get('comment')
+            )
+            for message in messages
+        ]
+
+
+class TONPayoutPipeline:
+    """
+    Пакетные выплаты через TON (Revenue Share и реферальные комиссии): один курс на запуск,
+    массовая загрузка начислений и кошельков, отправка пачками и запись статусов одним запросом на пачку.
+
+    Каждая выплата получает ключ идемпотентности (ton_payments.idempotency_key). Перед отправкой
+    пачка резервируется в ton_payments со статусом 'sending'; повторный запуск не отправляет
+    выплаты, которые уже зарезервированы или отправлены, а только дописывает статус источника
+    (partner_revenue_share или referral_rewards).
+    """
+
+    IN_CHUNK = 200
+
+    def __init__(self, manager, ton_service, wallet=None, batch_size: Optional[int] = None):
+        self.manager = manager
+        self.ton_service = ton_service
+        self.wallet = wallet or TONServiceWallet(ton_service)
+        # Сообщений в одной отправке кошелька (WalletV4 принимает до 4)
+        self.batch_size = max(1, int(batch_size if batch_size is not None else os.getenv("TON_PAYOUT_BATCH_SIZE", "4")))
+
+    @property
+    def client(self):
+        return self.manager.client
+
+    def pay_revenue_share(self, period_start: datetime.date, period_end: datetime.date) -> dict:
+        """
+        Выплачивает approved Revenue Share за период.
+
+        Returns:
+            dict: processed, failed, skipped, in_doubt, recovered, total_usd, exchange_rate, rate_source
+        """
+        summary = self._summary()
+
+        def build_query():
+            return (
+                self.client.table('partner_revenue_share')
+                .select(PAYMENT_COLUMNS)
+                .eq('period_start', period_start.isoformat())
+                .eq('period_end', period_end.isoformat())
+                .eq('status', 'approved')
+                .is_('ton_tx_hash', 'null')
+            )
+
+        payments = self.manager._fetch_all_rows(build_query)
+        if not payments:
+            return summary
+
+        # Один курс на весь запуск: все выплаты считаются по одному снимку
+        quote = self._rate_snapshot(summary)
+        wallets = self._load_wallets({p['partner_chat_id'] for p in payments})
+
+        payouts = []
+        for payment in payments:
+            amount_usd = Decimal(str(payment.get('amount_usd') or payment.get('final_amount') or 0))
+            payout = self._build_payout(
+                'revenue_share', payment['partner_chat_id'], wallets.get(payment['partner_chat_id']), amount_usd, quote,
+                source_key=payment['id'], revenue_share_id=payment['id'], comment=f"Revenue Share #{payment['id']}"
+            )
+            if payout is None:
+                summary['skipped'] += 1
+            else:
+                payouts.append(payout)
+
+        self._pay(payouts, summary, self._mark_revenue_share_paid)
+        logging.info(
+            f"Revenue Share TON payouts: {summary['processed']} sent, {summary['failed']} failed, "
+            f"{summary['skipped']} skipped, {summary['in_doubt']} in doubt at rate {quote['rate']} ({quote['source']})"
+        )
+        return summary
+
+    def pay_referral_commissions(self, min_amount_usd: Decimal = Decimal('10.00')) -> dict:
+        """
+        Выплачивает накопленные реферальные комиссии: одна выплата на получателя,
+        если его сумма pending-комиссий не меньше min_amount_usd.
+
+        Returns:
+            dict: как pay_revenue_share, плюс partners (получателей с комиссиями) и below_minimum
+        """
+        summary = {**self._summary(), 'partners': 0, 'below_minimum': 0}
+        totals = self.pending_referral_commissions()
+        summary['partners'] = len(totals)
+
+        eligible = [t for t in totals if t['total_usd'] >= min_amount_usd]
+        summary['below_minimum'] = len(totals) - len(eligible)
+        if not eligible:
+            return summary
+
+        quote = self._rate_snapshot(summary)
+        wallets = self._load_wallets({t['referrer_chat_id'] for t in eligible})
+
+        payouts = []
+        for total in eligible:
+            partner_chat_id = total['referrer_chat_id']
+            # Ключ — первая неоплаченная комиссия: после сбоя повторный запуск получит тот же ключ,
+            # даже если у партнера появились новые комиссии
+            payout = self._build_payout(
+                'referral_commission', partner_chat_id, wallets.get(partner_chat_id), total['total_usd'], quote,
+                source_key=f"{partner_chat_id}:{total['min_reward_id']}", referral_reward_id=total['max_reward_id'],
+                comment=f"Batch referral commissions for {partner_chat_id}"
+            )
+            if payout is None:
+                summary['skipped'] += 1
+            else:
+                payouts.append(payout)
+
+        self._pay(payouts, summary, self._mark_referral_rewards_paid)
+        logging.info(
+            f"Referral commission TON payouts: {summary['processed']} sent, {summary['failed']} failed, "
+            f"{summary['below_minimum']} below minimum, {summary['in_doubt']} in doubt at rate {quote['rate']} ({quote['source']})"
+        )
+        return summary
+
+    def pending_referral_commissions(self) -> list:
+        """
+        Pending-комиссии, сгруппированные по получателю: referrer_chat_id, total_usd, rewards_count,
+        min_reward_id, max_reward_id. Группировка выполняется в БД (RPC get_pending_referral_commissions);
+        без RPC строки читаются по курсору id и суммируются за один проход.
+        """
+        try:
+            response = self.client.rpc('get_pending_referral_commissions', {}).execute()
+            return [
+                {**row, 'referrer_chat_id': str(row['referrer_chat_id']), 'total_usd': Decimal(str(row.get('total_usd') or 0))}
+                for row in response.data or []
+            ]
+        except Exception as e:
+            logging.warning(f"get_pending_referral_commissions RPC unavailable, aggregating rows: {e}")
+
+        def build_query():
+            return (
+                self.client.table('referral_rewards')
+                .select('id, referrer_chat_id, amount_usd')
+                .eq('status', 'pending')
+                .like('reward_type', 'commission_%')
+            )
+
+        return aggregate_pending_commissions(self.manager._fetch_all_rows(build_query))
+
+    # --- Отправка пачки ---------------------------------------------------
+
+    @staticmethod
+    def _summary() -> dict:
+        return {
+            'processed': 0, 'failed': 0, 'skipped': 0, 'in_doubt': 0, 'recovered': 0,
+            'total_usd': Decimal('0'), 'exchange_rate': None, 'rate_source': None
+        }
+
+    def _rate_snapshot(self, summary: dict) -> dict:
+        quote = self.ton_service.get_ton_exchange_quote()
+        summary['exchange_rate'] = quote['rate']
+        summary['rate_source'] = quote['source']
+        return quote
+
+    def _pay(self, payouts: list, summary: dict, mark_paid):
+        existing = self._load_existing([p['idempotency_key'] for p in payouts])
+        to_send, settled = [], []
+        for payout in payouts:
+            record = existing.get(payout['idempotency_key'])
+            if record is None or record['status'] == 'failed':
+                to_send.append(payout)
+            elif record['status'] in SETTLED_STATUSES:
+                # Прошлый запуск отправил выплату, но не успел обновить источник
+                settled.append(self._paid_item(payout, record['ton_tx_hash'], record['id'], record.get('referral_reward_id')))
+            else:
+                summary['in_doubt'] += 1
+                logging.warning(f"TON выплата {payout['idempotency_key']} в статусе {record['status']}, требуется сверка с блокчейном")
+        if settled:
+            mark_paid(settled)
+            summary['recovered'] = len(settled)
+
+        for start in range(0, len(to_send), self.batch_size):
+            self._send_batch(to_send[start:start + self.batch_size], existing, summary, mark_paid)
+
+    def _send_batch(self, batch: list, existing: dict, summary: dict, mark_paid):
+        claimed = self._reserve(batch, existing)
+        summary['in_doubt'] += len(batch) - len(claimed)
+        if not claimed:
+            return
+
+        messages = [
+            {
+                'to_address': payout['to_address'],
+                'amount_nano': payout['amount_nano'],
+                'comment': payout['comment'],
+                'idempotency_key': payout['idempotency_key'],
+            }
+            for payout in claimed
+        ]
+        try:
+            results = self.wallet.send_batch(messages)
+        except Exception as e:
+            # Неизвестно, ушли ли сообщения: записи остаются в 'sending' и не отправляются повторно
+            logging.error(f"Ошибка отправки пачки TON выплат ({len(claimed)} шт.), требуется сверка: {e}")
+            summary['in_doubt'] += len(claimed)
+            return
+
+        now = datetime.datetime.now().isoformat()
+        rows, paid = [], []
+        for payout, result in zip(claimed, results):
+            row = self._ton_payment_row(payout)
+            if result.get('success'):
+                row.update({
+                    'status': 'sent', 'ton_tx_hash': result.get('tx_hash'), 'ton_tx_lt': result.get('tx_lt'),
+                    'ton_block_seqno': result.get('block_seqno'), 'sent_at': now, 'error_message': None
+                })
+                paid.append(self._paid_item(payout, result.get('tx_hash'), payout['ton_payment_id']))
+                summary['processed'] += 1
+                summary['total_usd'] += payout['amount_usd']
+            else:
+                row.update({'status': 'failed', 'error_message': result.get('error'), 'last_retry_at': now})
+                summary['failed'] += 1
+                logging.error(f"Ошибка TON выплаты {payout['idempotency_key']}: {result.get('error')}")
+            rows.append(row)
+        # Результаты без ответа кошелька остаются в 'sending'
+        summary['in_doubt'] += len(claimed) - len(rows)
+
+        if rows:
+            self.client.table('ton_payments').upsert(rows, on_conflict='idempotency_key').execute()
+        if paid:
+            mark_paid(paid)
+
+    def _reserve(self, batch: list, existing: dict) -> list:
+        """Резервирует выплаты пачки в ton_payments; возвращает те, что удалось занять этому запуску."""
+        now = datetime.datetime.now().isoformat()
+        fresh = [p for p in batch if p['idempotency_key'] not in existing]
+        retries = [p['idempotency_key'] for p in batch if p['idempotency_key'] in existing]
+
+        claimed = {}
+        if fresh:
+            rows = [{**self._ton_payment_row(p), 'status': 'sending'} for p in fresh]
+            # Строки, уже созданные параллельным запуском, не возвращаются
+            response = self.client.table('ton_payments').upsert(
+                rows, on_conflict='idempotency_key', ignore_duplicates=True
+            ).execute()
+            claimed.update({row['idempotency_key']: row['id'] for row in response.data or []})
+        if retries:
+            response = self.client.table('ton_payments').update({
+                'status': 'sending', 'error_message': None, 'last_retry_at': now
+            }).in_('idempotency_key', retries).eq('status', 'failed').execute()
+            claimed.update({row['idempotency_key']: row['id'] for row in response.data or []})
+
+        result = []
+        for payout in batch:
+            if payout['idempotency_key'] in claimed:
+                payout['ton_payment_id'] = claimed[payout['idempotency_key']]
+                result.append(payout)
+        return result
+
+    # --- Загрузка и запись ------------------------------------------------
+
+    def _build_payout(self, payment_type: str, partner_chat_id: str, partner: Optional[dict], amount_usd: Decimal,
+                      quote: dict, source_key, comment: str, revenue_share_id=None,
+                      referral_reward_id=None) -> Optional[dict]:
+        if not partner:
+            logging.error(f"Партнер {partner_chat_id} не найден ({payment_type} {source_key})")
+            return None
+        if not partner.get('ton_payments_enabled'):
+            logging.info(f"TON выплаты отключены для партнера {partner_chat_id}")
+            return None
+        if not partner.get('ton_wallet_address'):
+            logging.warning(f"У партнера {partner_chat_id} не указан TON кошелек")
+            return None
+        if amount_usd <= 0:
+            logging.warning(f"Некорректная сумма выплаты {payment_type} {source_key}: {amount_usd}")
+            return None
+
+        exchange_rate = quote['rate']
+        ton_amount = amount_usd / exchange_rate
+        return {
+            'idempotency_key': payout_idempotency_key(payment_type, source_key),
+            'revenue_share_id': revenue_share_id,
+            'referral_reward_id': referral_reward_id,
+            'partner_chat_id': partner_chat_id,
+            'payment_type': payment_type,
+            'amount_usd': amount_usd,
+            'amount_nano': int(ton_amount * NANO_TON),
+            'ton_amount': ton_amount,
+            'exchange_rate': exchange_rate,
+            'exchange_rate_source': quote['source'],
+            'exchange_rate_fetched_at': quote['fetched_at'].isoformat(),
+            'from_address': getattr(self.wallet, 'address', None),
+            'to_address': partner['ton_wallet_address'],
+            'comment': comment,
+        }
+
+    @staticmethod
+    def _paid_item(payout: dict, ton_tx_hash, ton_payment_id, referral_reward_id=None) -> dict:
+        """Элемент для перевода источника выплаты в paid_ton."""
+        item = {'ton_tx_hash': ton_tx_hash, 'ton_payment_id': ton_payment_id}
+        if payout['payment_type'] == 'revenue_share':
+            item['id'] = payout['revenue_share_id']
+        else:
+            # Оплачены комиссии получателя до последней, вошедшей в выплату
+            item['referrer_chat_id'] = payout['partner_chat_id']
+            item['max_reward_id'] = referral_reward_id or payout['referral_reward_id']
+        return item
+
+    @staticmethod
+    def _ton_payment_row(payout: dict) -> dict:
+        row = {
+            'idempotency_key': payout['idempotency_key'],
+            'revenue_share_id': payout['revenue_share_id'],
+            'referral_reward_id': payout['referral_reward_id'],
+            'partner_chat_id': payout['partner_chat_id'],
+            'payment_type': payout['payment_type'],
+            'amount_usd': float(payout['amount_usd']),
+            'amount_nano': payout['amount_nano'],
+            'ton_amount': float(payout['ton_amount']),
+            'exchange_rate': float(payout['exchange_rate']),
+            'exchange_rate_source': payout['exchange_rate_source'],
+            'exchange_rate_fetched_at': payout['exchange_rate_fetched_at'],
+            'from_address': payout['from_address'],
+            'to_address': payout['to_address'],
+            'comment': payout['comment'],
+        }
+        if payout.get('ton_payment_id') is not None:
+            row['id'] = payout['ton_payment_id']
+        return row
+
+    def _load_wallets(self, partner_ids: Iterable[str]) -> dict:
+        partner_ids = sorted(str(pid) for pid in partner_ids)
+        wallets = {}
+        for start in range(0, len(partner_ids), self.IN_CHUNK):
+            response = self.client.table('partners').select(
+                'chat_id, ton_wallet_address, ton_payments_enabled'
+            ).in_('chat_id', partner_ids[start:start + self.IN_CHUNK]).execute()
+            wallets.update({row['chat_id']: row for row in response.data or []})
+        return wallets
+
+    def _load_existing(self, keys: list) -> dict:
+        existing = {}
+        for start in range(0, len(keys), self.IN_CHUNK):
+            response = self.client.table('ton_payments').select(
+                'id, idempotency_key, status, ton_tx_hash, referral_reward_id'
+            ).in_('idempotency_key', keys[start:start + self.IN_CHUNK]).execute()
+            existing.update({row['idempotency_key']: row for row in response.data or []})
+        return existing
+
+    def _mark_revenue_share_paid(self, items: list):
+        """Переводит начисления в paid_ton одним вызовом RPC (по записи на начисление — если RPC нет)."""
+        try:
+            self.client.rpc('mark_revenue_share_paid_ton', {'p_items': items}).execute()
+            return
+        except Exception as e:
+            logging.warning(f"mark_revenue_share_paid_ton RPC unavailable, updating rows one by one: {e}")
+        for item in items:
+            self.client.table('partner_revenue_share').update({
+                'status': 'paid_ton', 'ton_tx_hash': item['ton_tx_hash'], 'ton_payment_id': item['ton_payment_id']
+            }).eq('id', item['id']).eq('status', 'approved').execute()
+
+    def _mark_referral_rewards_paid(self, items: list):
+        """Переводит комиссии получателей в paid_ton одним вызовом RPC (по запросу на получателя — если RPC нет)."""
+        try:
+            self.client.rpc('mark_referral_rewards_paid_ton', {'p_items': items}).execute()
+            return
+        except Exception as e:
+            logging.warning(f"mark_referral_rewards_paid_ton RPC unavailable, updating per recipient: {e}")
+        for item in items:
+            self.client.table('referral_rewards').update({
+                'status': 'paid_ton', 'ton_tx_hash': item['ton_tx_hash'], 'ton_payment_id': item['ton_payment_id']
+            }).eq('referrer_chat_id', item['referrer_chat_id']).lte('id', item['max_reward_id']).eq(
+                'status', 'pending'
+            ).like('reward_type', 'commission_%').execute()
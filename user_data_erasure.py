@@ -0,0 +1,145 @@
+import datetime
+import logging
+import os
+from typing import Iterable, Optional
+
+
+DELETED_USER_ID = 'DELETED_USER'
+
+ERASURE_QUEUE_TABLE = 'gdpr_erasure_requests'
+
+# Шаги удаления в порядке зависимостей (дочерние таблицы раньше clients/partners):
+# (ключ в отчёте, таблица, колонка с chat_id, None для удаления или dict для анонимизации)
+ERASURE_STEPS = (
+    ('services', 'services', 'partner_chat_id', None),
+    ('promotions', 'promotions', 'partner_chat_id', None),
+    ('transactions', 'transactions', 'client_chat_id', {
+        'client_chat_id': DELETED_USER_ID,
+        'description': 'User data deleted per GDPR request'
+    }),
+    ('transactions', 'transactions', 'partner_chat_id', {'partner_chat_id': DELETED_USER_ID}),
+    ('partner_applications', 'partner_applications', 'chat_id', None),
+    ('partners', 'partners', 'chat_id', None),
+    ('clients', 'clients', 'chat_id', None),
+)
+
+# Ошибка на этих таблицах означает, что данные пользователя остались
+CRITICAL_TABLES = {'transactions', 'clients'}
+
+
+class UserDataEraser:
+    """Очередь GDPR-удаления: пачки пользователей, по одному set-based запросу на таблицу."""
+
+    # Сколько chat_id передаём в одном in_() — ограничение длины URL PostgREST
+    IN_CHUNK = 200
+
+    def __init__(self, manager, batch_size: Optional[int] = None):
+        self.manager = manager
+        self.batch_size = int(batch_size if batch_size is not None else os.getenv("GDPR_ERASURE_BATCH_SIZE", "500"))
+
+    def enqueue(self, chat_ids: Iterable[str], requested_by: Optional[str] = None) -> int:
+        """
+        Ставит пользователей в очередь. Уже ожидающие не дублируются (попытки сохраняются),
+        а выполненные запросы снова становятся pending: пользователь мог зарегистрироваться заново.
+        """
+        chat_ids = list(dict.fromkeys(str(c) for c in chat_ids))
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        for start in range(0, len(chat_ids), self.IN_CHUNK):
+            chunk = chat_ids[start:start + self.IN_CHUNK]
+            self.manager.client.from_(ERASURE_QUEUE_TABLE).upsert(
+                [{'chat_id': chat_id, 'status': 'pending', 'requested_by': requested_by} for chat_id in chunk],
+                on_conflict='chat_id', ignore_duplicates=True
+            ).execute()
+            self.manager.client.from_(ERASURE_QUEUE_TABLE).update({
+                'status': 'pending',
+                'requested_by': requested_by,
+                'requested_at': now,
+                'attempts': 0,
+                'last_error': None,
+                'completed_at': None,
+            }).in_('chat_id', chunk).eq('status', 'completed').execute()
+        return len(chat_ids)
+
+    def erase(self, chat_ids: list) -> dict:
+        """
+        Удаляет/анонимизирует данные пачки пользователей.
+        Сначала пробует RPC erase_user_data_batch (одна транзакция), иначе — шаги по таблицам.
+        Возвращает статус по каждой таблице: 'deleted', 'anonymized' или 'error: ...'.
+        """
+        chat_ids = [str(c) for c in chat_ids]
+        if not chat_ids:
+            return {}
+        try:
+            response = self.manager.client.rpc('erase_user_data_batch', {'p_chat_ids': chat_ids}).execute()
+            if isinstance(response.data, dict):
+                return response.data
+        except Exception as e:
+            logging.warning(f"erase_user_data_batch RPC unavailable, falling back to per-table steps: {e}")
+        return self._erase_by_steps(chat_ids)
+
+    def process_pending(self, max_batches: Optional[int] = None) -> dict:
+        """
+        Обрабатывает очередь пачками по batch_size. Пачка отмечается выполненной только
+        если все критичные шаги прошли; иначе остаётся pending с увеличенным attempts,
+        и следующий проход повторит её (все шаги идемпотентны).
+        """
+        stats = {'batches': 0, 'completed': 0, 'failed': 0}
+        failed_ids: set = set()
+        while max_batches is None or stats['batches'] < max_batches:
+            response = (
+                self.manager.client.from_(ERASURE_QUEUE_TABLE)
+                .select('chat_id, attempts')
+                .eq('status', 'pending')
+                .order('chat_id')
+                .limit(self.batch_size + len(failed_ids))
+                .execute()
+            )
+            batch = [row for row in response.data or [] if row['chat_id'] not in failed_ids][:self.batch_size]
+            if not batch:
+                break
+            chat_ids = [row['chat_id'] for row in batch]
+            results = self.erase(chat_ids)
+            stats['batches'] += 1
+
+            errors = {table: status for table, status in results.items() if str(status).startswith('error')}
+            now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            if not errors.keys() & CRITICAL_TABLES:
+                self._update_requests(chat_ids, {'status': 'completed', 'completed_at': now, 'last_error': None})
+                stats['completed'] += len(chat_ids)
+            else:
+                # Повтор в следующем проходе process_pending, а не в этом
+                failed_ids.update(chat_ids)
+                attempts = {}
+                for row in batch:
+                    attempts.setdefault((row.get('attempts') or 0) + 1, []).append(row['chat_id'])
+                for value, ids in attempts.items():
+                    self._update_requests(ids, {'attempts': value, 'last_error': '; '.join(f'{t}: {s}' for t, s in errors.items())})
+                stats['failed'] += len(chat_ids)
+                logging.error(f"GDPR erasure batch of {len(chat_ids)} users failed: {errors}")
+        return stats
+
+    def _erase_by_steps(self, chat_ids: list) -> dict:
+        results: dict = {}
+        for key, table, column, anonymize in ERASURE_STEPS:
+            if str(results.get(key, '')).startswith('error'):
+                continue
+            try:
+                for start in range(0, len(chat_ids), self.IN_CHUNK):
+                    chunk = chat_ids[start:start + self.IN_CHUNK]
+                    query = self.manager.client.from_(table)
+                    query = query.update(anonymize) if anonymize else query.delete()
+                    query.in_(column, chunk).execute()
+                results[key] = 'anonymized' if anonymize else 'deleted'
+            except Exception as e:
+                results[key] = f'error: {str(e)}'
+                logging.warning(f"GDPR erasure: {table}.{column} failed for {len(chat_ids)} users: {e}")
+                if key in CRITICAL_TABLES:
+                    # Не удаляем clients, если транзакции не анонимизированы
+                    break
+        return results
+
+    def _update_requests(self, chat_ids: list, values: dict):
+        for start in range(0, len(chat_ids), self.IN_CHUNK):
+            self.manager.client.from_(ERASURE_QUEUE_TABLE).update(values).in_(
+                'chat_id', chat_ids[start:start + self.IN_CHUNK]
+            ).execute()
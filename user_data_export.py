@@ -0,0 +1,110 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+
+# Разделы экспорта: (имя, таблица, колонка с chat_id, колонка курсора пагинации)
+EXPORT_SECTIONS = (
+    ('client_data', 'clients', 'chat_id', 'chat_id'),
+    ('partner_data', 'partners', 'chat_id', 'chat_id'),
+    ('transactions', 'transactions', 'client_chat_id', 'id'),
+    ('partner_transactions', 'transactions', 'partner_chat_id', 'id'),
+    ('partner_applications', 'partner_applications', 'chat_id', 'id'),
+    ('partner_services', 'services', 'partner_chat_id', 'id'),
+    ('partner_promotions', 'promotions', 'partner_chat_id', 'id'),
+    ('messages_as_client', 'messages', 'client_chat_id', 'id'),
+    ('messages_as_partner', 'messages', 'partner_chat_id', 'id'),
+    ('referrals', 'referral_tree', 'referrer_chat_id', 'id'),
+    ('referred_by', 'referral_tree', 'referred_chat_id', 'id'),
+    ('referral_rewards', 'referral_rewards', 'referrer_chat_id', 'id'),
+    ('nps_ratings', 'nps_ratings', 'client_chat_id', 'id'),
+)
+
+
+class UserDataExporter:
+    """GDPR-экспорт: разделы читаются параллельно и постранично, результат — zip-архив с манифестом."""
+
+    def __init__(self, manager, page_size: Optional[int] = None, max_workers: Optional[int] = None):
+        self.manager = manager
+        # Сколько строк раздела держим в памяти одновременно
+        self.page_size = int(page_size if page_size is not None else os.getenv("GDPR_EXPORT_PAGE_SIZE", "1000"))
+        self.max_workers = int(max_workers if max_workers is not None else os.getenv("GDPR_EXPORT_WORKERS", "4"))
+
+    def iter_section(self, table: str, column: str, cursor_column: str, chat_id: str) -> Iterator[list]:
+        """Отдаёт строки раздела страницами по курсору cursor_column."""
+        after = None
+        while True:
+            query = self.manager.client.from_(table).select('*').eq(column, chat_id)
+            if after is not None:
+                query = query.gt(cursor_column, after)
+            rows = query.order(cursor_column).limit(self.page_size).execute().data or []
+            if not rows:
+                return
+            yield rows
+            if len(rows) < self.page_size:
+                return
+            after = rows[-1][cursor_column]
+
+    def export_to_archive(self, chat_id: str, output_dir: Optional[str] = None) -> str:
+        """
+        Пишет данные пользователя в zip-архив: по файлу JSON Lines на раздел и manifest.json.
+        Возвращает путь к архиву.
+        """
+        chat_id = str(chat_id)
+        output_dir = output_dir or os.path.join(os.path.dirname(__file__), 'exports')
+        os.makedirs(output_dir, exist_ok=True)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        archive_path = os.path.join(output_dir, f"user_{chat_id}_gdpr_export_{now.strftime('%Y%m%d_%H%M%S')}.zip")
+
+        work_dir = tempfile.mkdtemp(prefix='gdpr_export_', dir=output_dir)
+        try:
+            with ThreadPoolExecutor(max_workers=max(self.max_workers, 1)) as pool:
+                futures = [
+                    pool.submit(self._write_section, work_dir, chat_id, *section)
+                    for section in EXPORT_SECTIONS
+                ]
+                sections = [future.result() for future in futures]
+
+            manifest = {
+                'export_date': now.isoformat(),
+                'chat_id': chat_id,
+                'format': 'jsonl',
+                'complete': all('error' not in s for s in sections),
+                'sections': sections,
+            }
+            tmp_archive = f"{archive_path}.part"
+            with zipfile.ZipFile(tmp_archive, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+                for section in sections:
+                    archive.write(os.path.join(work_dir, section['file']), section['file'])
+                archive.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+            os.replace(tmp_archive, archive_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        logging.info(f"GDPR export for {chat_id} written to {archive_path}")
+        return archive_path
+
+    def _write_section(self, work_dir: str, chat_id: str, name: str, table: str, column: str, cursor_column: str) -> dict:
+        filename = f"{name}.jsonl"
+        info = {'name': name, 'table': table, 'file': filename, 'rows': 0}
+        digest = hashlib.sha256()
+        with open(os.path.join(work_dir, filename), 'w', encoding='utf-8') as f:
+            try:
+                for rows in self.iter_section(table, column, cursor_column, chat_id):
+                    for row in rows:
+                        line = json.dumps(row, ensure_ascii=False, default=str) + '\n'
+                        f.write(line)
+                        digest.update(line.encode('utf-8'))
+                    info['rows'] += len(rows)
+            except Exception as e:
+                logging.warning(f"GDPR export: section {name} failed for {chat_id}: {e}")
+                info['error'] = str(e)
+        info['sha256'] = digest.hexdigest()
+        return info